@@ -231,6 +231,19 @@ class FerreCoarse(BaseModel, FerreOutputMixin):
     flag_n_m_atm_grid_edge_bad = ferre_flags.flag(2**20)    
 
 
+    class Meta:
+        # For selecting the best result per spectrum (see `astra.pipelines.aspcap.utils.select_best_results`).
+        indexes = (
+            (
+                (
+                    "spectrum_pk",
+                    "penalized_rchi2",
+                ),
+                False,
+            ),
+        )
+
+
 
     '''
     class Meta:
@@ -361,6 +374,19 @@ class FerreStellarParameters(BaseModel, FerreOutputMixin):
 
 
 
+    class Meta:
+        # For selecting the best result per spectrum (see `astra.pipelines.aspcap.utils.select_best_results`).
+        indexes = (
+            (
+                (
+                    "spectrum_pk",
+                    "penalized_rchi2",
+                ),
+                False,
+            ),
+        )
+
+
 
     '''
     class Meta:
@@ -45,8 +45,11 @@ class NMFRectify(BaseModel):
     deg = IntegerField(help_text="Sinusoidal degree for continuum")
     rchi2 = FloatField(null=True, help_text=Glossary.rchi2)
     joint_rchi2 = FloatField(null=True, help_text="Joint reduced chi^2 from simultaneous fit")
+    n_iter = IntegerField(null=True, help_text="Number of alternating iterations")
+    nfev = IntegerField(null=True, help_text="Number of function evaluations")
     nmf_flags = BitField(default=0, help_text="NMF Continuum method flags") #TODO: rename as nmf_flags
     flag_initialised_from_small_w = nmf_flags.flag(2**0)
+    flag_initialised_from_previous_result = nmf_flags.flag(2**1)
 
     flag_could_not_read_spectrum = nmf_flags.flag(2**3)
     flag_runtime_exception = nmf_flags.flag(2**4)
\ No newline at end of file
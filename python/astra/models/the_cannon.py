@@ -12,6 +12,7 @@ from peewee import (
 )
 import pickle
 from astra.utils import expand_path
+from astra.utils.intermediate import read_intermediate_outputs
 from astra.models.fields import BitField, PixelArray, BasePixelArrayAccessor, LogLambdaArrayAccessor
 from astra.models.base import BaseModel
 from astra.models.fields import BitField
@@ -35,8 +36,14 @@ class TheCannonPixelArrayAccessor(BasePixelArrayAccessor):
                 # Load them all.
                 instance.__pixel_data__ = {}
 
-                with open(expand_path(instance.intermediate_output_path), "rb") as fp:
-                    continuum, rectified_model_flux = pickle.load(fp)
+                if instance.intermediate_output_store:
+                    continuum, rectified_model_flux = read_intermediate_outputs(
+                        instance.intermediate_output_store, 
+                        instance.spectrum_pk
+                    )
+                else:
+                    with open(expand_path(instance.intermediate_output_path), "rb") as fp:
+                        continuum, rectified_model_flux = pickle.load(fp)
                 
                 continuum = continuum.flatten()
                 rectified_model_flux = rectified_model_flux.flatten()
@@ -194,6 +201,10 @@ class TheCannon(BaseModel):
     x0_index = IntegerField(default=-1, help_text="Index of initial guess used")
     result_flags = BitField(default=0, help_text="Result flags")
     flag_fitting_failure = result_flags.flag(2**0, "Fitting failure")
+    intermediate_output_store = TextField(
+        null=True, 
+        help_text="Path of a file with intermediate outputs for many spectra (see `intermediate_output_path`)"
+    )
     
     #> Spectral data
     wavelength = PixelArray(
@@ -10,6 +10,7 @@ import datetime
 import pickle
 from astra import __version__
 from astra.utils import expand_path
+from astra.utils.intermediate import read_intermediate_outputs
 from astra.models.base import BaseModel
 from astra.models.fields import BitField, PixelArray, BasePixelArrayAccessor, LogLambdaArrayAccessor
 from astra.models.source import Source
@@ -28,8 +29,14 @@ class PaynePixelArrayAccessor(BasePixelArrayAccessor):
                 # Load them all.
                 instance.__pixel_data__ = {}
 
-                with open(expand_path(instance.intermediate_output_path), "rb") as fp:
-                    continuum, rectified_model_flux = pickle.load(fp)
+                if instance.intermediate_output_store:
+                    continuum, rectified_model_flux = read_intermediate_outputs(
+                        instance.intermediate_output_store, 
+                        instance.spectrum_pk
+                    )
+                else:
+                    with open(expand_path(instance.intermediate_output_path), "rb") as fp:
+                        continuum, rectified_model_flux = pickle.load(fp)
                 
                 continuum = continuum.flatten()
                 rectified_model_flux = rectified_model_flux.flatten()
@@ -139,6 +146,11 @@ class ThePayne(BaseModel, PipelineOutputMixin):
     reduced_chi2 = FloatField(null=True)
     result_flags = BitField(default=0)
     flag_fitting_failure = result_flags.flag(2**0, "Fitting failure")
+    flag_not_converged = result_flags.flag(2**1, "Optimizer did not converge")
+    intermediate_output_store = TextField(
+        null=True, 
+        help_text="Path of a file with intermediate outputs for many spectra (see `intermediate_output_path`)"
+    )
     
     #> Formal uncertainties
     raw_e_teff = FloatField(null=True)
@@ -3,7 +3,7 @@ import numpy as np
 from datetime import datetime
 from tempfile import mkdtemp
 from typing import Optional, Iterable, List, Tuple, Callable, Union
-from peewee import JOIN, fn
+from peewee import fn, ModelSelect
 from tqdm import tqdm
 
 from astra import __version__, task
@@ -14,7 +14,8 @@ from astra.pipelines.aspcap.initial import get_initial_guesses
 from astra.pipelines.aspcap.coarse import coarse_stellar_parameters, post_coarse_stellar_parameters
 from astra.pipelines.aspcap.stellar_parameters import stellar_parameters, post_stellar_parameters
 from astra.pipelines.aspcap.abundances import abundances, get_species, post_abundances
-from astra.pipelines.aspcap.utils import ABUNDANCE_RELATIVE_TO_H
+from astra.pipelines.aspcap.streaming import stream_aspcap_stages
+from astra.pipelines.aspcap.utils import ABUNDANCE_RELATIVE_TO_H, select_best_results, stream_query
 
 
 @task
@@ -26,6 +27,7 @@ def aspcap(
     weight_path: Optional[str] = "$MWM_ASTRA/pipelines/aspcap/masks/global.mask",
     element_weight_paths: str = "$MWM_ASTRA/pipelines/aspcap/masks/elements.list",
     operator_kwds: Optional[dict] = None,
+    streaming: Optional[bool] = False,
     **kwargs
 ) -> Iterable[ASPCAP]:
     """
@@ -57,6 +59,12 @@ def aspcap(
 
     :param operator_kwds: [optional]
         A dictionary of keywords to supply to the `astra.pipelines.ferre.operator.FerreOperator` class.
+
+    :param streaming: [optional]
+        Run the stages as a pipeline, where spectra are handed to the next stage as soon as their
+        upstream executions are finished, instead of waiting for every execution in a stage to finish.
+        See `astra.pipelines.aspcap.streaming.stream_aspcap_stages` for additional keywords (e.g.,
+        `min_batch_size`).
     
     Keyword arguments
     -----------------
@@ -80,6 +88,20 @@ def aspcap(
     if isinstance(spectra, SpectrumMixin):
         spectra = [spectra]
 
+    if streaming:
+        stellar_parameter_results, chemical_abundance_results = stream_aspcap_stages(
+            spectra,
+            parent_dir=parent_dir,
+            initial_guess_callable=initial_guess_callable,
+            header_paths=header_paths,
+            weight_path=weight_path,
+            element_weight_paths=element_weight_paths,
+            operator_kwds=operator_kwds,
+            **kwargs
+        )
+        yield from create_aspcap_results(stellar_parameter_results, chemical_abundance_results)
+        return None
+
     # Use the list() to make sure this is executed before other stages.
     coarse_stellar_parameter_results = list(
         coarse_stellar_parameters(
@@ -133,17 +155,8 @@ def post_process_aspcap(parent_dir, **kwargs) -> Iterable[ASPCAP]:
 
 @task
 def create_aspcap_results(
-    stellar_parameter_results: Optional[Iterable[FerreStellarParameters]] = (
-        FerreStellarParameters
-        .select()
-        .distinct(FerreStellarParameters.spectrum_pk)
-        .join(ASPCAP, JOIN.LEFT_OUTER, on=(ASPCAP.stellar_parameters_task_pk == FerreStellarParameters.task_pk))
-        .where(ASPCAP.stellar_parameters_task_pk.is_null())
-    ), 
-    chemical_abundance_results: Optional[Iterable[FerreChemicalAbundances]] = (
-        FerreChemicalAbundances
-        .select()
-    ), 
+    stellar_parameter_results: Optional[Iterable[FerreStellarParameters]] = None, 
+    chemical_abundance_results: Optional[Iterable[FerreChemicalAbundances]] = None, 
     **kwargs
 ) -> Iterable[ASPCAP]:
     """
@@ -153,13 +166,51 @@ def create_aspcap_results(
     `FerreStellarParameters.task_pk` attributes. One ASPCAP result will be created for each stellar parameter result,
     even if there are no abundances available for that stellar parameter result.
 
-    :param stellar_parameter_results:
-        An iterable of `FerreStellarParameters`.
-    
-    :param chemical_abundance_results:
-        An iterable of `FerreChemicalAbundances`
+    :param stellar_parameter_results: [optional]
+        An iterable of `FerreStellarParameters`. If `None` is given then the best stellar parameter result
+        (see `select_best_results`) will be used for each spectrum, among the results that are not already
+        linked to an ASPCAP result.
+
+    :param chemical_abundance_results: [optional]
+        An iterable of `FerreChemicalAbundances`. If `None` is given then all chemical abundance results
+        linked to the stellar parameter results will be used.
+
+    .. note::
+        The default selection used to be an arbitrary unassigned result per spectrum (`DISTINCT ON` without
+        an ordering), and every chemical abundance result. Now it is the unassigned result with the lowest
+        `penalized_rchi2` (the most recent, if tied), and only the abundances linked to those results. Pass
+        the queries explicitly if you need a different selection.
     """
 
+    if stellar_parameter_results is None:
+        stellar_parameter_results = select_best_results(
+            FerreStellarParameters,
+            FerreStellarParameters.task_pk.not_in(
+                ASPCAP
+                .select(ASPCAP.stellar_parameters_task_pk)
+                .where(ASPCAP.stellar_parameters_task_pk.is_null(False))
+            )
+        )
+
+    # Queries are streamed, so that we don't need to hold them in memory as well as the ASPCAP results.
+    if isinstance(stellar_parameter_results, ModelSelect):
+        spectrum_pks = stellar_parameter_results.select(FerreStellarParameters.spectrum_pk)
+        stellar_task_pks = stellar_parameter_results.select(FerreStellarParameters.task_pk)
+        stellar_parameter_results = stream_query(stellar_parameter_results)
+    else:
+        stellar_parameter_results = list(stellar_parameter_results)
+        spectrum_pks = [ea.spectrum_pk for ea in stellar_parameter_results]
+        stellar_task_pks = [ea.task_pk for ea in stellar_parameter_results]
+
+    if chemical_abundance_results is None:
+        chemical_abundance_results = (
+            FerreChemicalAbundances
+            .select()
+            .where(FerreChemicalAbundances.upstream_pk.in_(stellar_task_pks))
+        )
+    if isinstance(chemical_abundance_results, ModelSelect):
+        chemical_abundance_results = stream_query(chemical_abundance_results)
+
     t_coarse = (
         FerreCoarse
         .select(
@@ -167,7 +218,7 @@ def create_aspcap_results(
             fn.sum(FerreCoarse.t_elapsed),        
             fn.sum(FerreCoarse.ferre_time_elapsed)
         )
-        .where(FerreCoarse.spectrum_pk.in_([ea.spectrum_pk for ea in stellar_parameter_results]))
+        .where(FerreCoarse.spectrum_pk.in_(spectrum_pks))
         .group_by(FerreCoarse.spectrum_pk)
         .tuples()
     )
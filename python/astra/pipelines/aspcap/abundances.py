@@ -14,7 +14,7 @@ from astra.pipelines.ferre.operator import FerreOperator
 from astra.pipelines.ferre.pre_process import pre_process_ferre
 from astra.pipelines.ferre.post_process import post_process_ferre
 from astra.pipelines.ferre.utils import (get_apogee_pixel_mask, parse_ferre_spectrum_name, read_ferre_headers, parse_header_path, get_input_spectrum_primary_keys)
-from astra.pipelines.aspcap.utils import (get_input_nml_paths, get_abundance_keywords, sanitise_parent_dir)
+from astra.pipelines.aspcap.utils import (get_input_nml_paths, get_abundance_keywords, sanitise_parent_dir, stream_best_results)
 
 STAGE = "abundances"
 
@@ -93,12 +93,20 @@ def pre_abundances(
         )
 
     # Create the FERRE files for each execution.
-    group = {}
+    group, skipped_by_group = ({}, {})
     for kwd in ferre_kwds:
-        pre_process_ferre(**kwd)
-
         pwd = kwd["pwd"].rstrip("/")
         group_dir = "/".join(pwd.split("/")[:-1])
+
+        # The input files are written by the first species of each grid, and any spectra that were 
+        # skipped then (e.g., because the pixel arrays could not be read) are not in those files.
+        skipped = skipped_by_group.get(group_dir, None)
+        if skipped:
+            kwd = _without_spectra(kwd, skipped)
+
+        *_, skipped = pre_process_ferre(**kwd)
+        skipped_by_group.setdefault(group_dir, skipped)
+
         group.setdefault(group_dir, [])
         group[group_dir].append(pwd[1 + len(group_dir):] + "/input.nml")
         
@@ -115,17 +123,24 @@ def pre_abundances(
 
 
 @task
-def post_abundances(parent_dir, ferre_list_mode=False, skip_pixel_arrays=True, **kwargs) -> Iterable[FerreChemicalAbundances]:
+def post_abundances(parent_dir, ferre_list_mode=False, skip_pixel_arrays=True, pwds: Optional[Iterable[str]] = None, **kwargs) -> Iterable[FerreChemicalAbundances]:
     """
     Collect the results from FERRE and create database entries for the abundance step.
 
     :param parent_dir:
         The parent directory where these FERRE executions were planned.
+
+    :param pwds: [optional]
+        Only collect results from these (per-species) execution directories. If `None` (default),
+        then results will be collected from all executions in the abundance stage.
     """    
 
     # Note the "/*" after STAGE because of the way folders are structured for abundances
     # And we use the `ref_dir` because it was executed from the parent folder.
-    for dir in map(os.path.dirname, get_input_nml_paths(parent_dir, f"{STAGE}/*")):
+    if pwds is None:
+        pwds = map(os.path.dirname, get_input_nml_paths(parent_dir, f"{STAGE}/*"))
+
+    for dir in pwds:
         
         # If the abundances were executed from the parent directory with the -l flag, you should use
         if ferre_list_mode:
@@ -144,6 +159,8 @@ def plan_abundances(
     continuum_order: Optional[int] = -1,
     continuum_flag: Optional[int] = 0,
     continuum_observations_flag: Optional[int] = 0,
+    pwd_suffix: Optional[str] = "",
+    share_input_parameters: Optional[bool] = True,
     **kwargs,
 ):
     """
@@ -160,6 +177,14 @@ def plan_abundances(
     
     :param element_weight_paths:
         A path containing the masks to supply per element.
+
+    :param pwd_suffix: [optional]
+        A suffix to add to the grid directory names (e.g., to separate batches of spectra).
+
+    :param share_input_parameters: [optional]
+        Write the input parameter file once per grid and reference it from every species, like the
+        flux arrays. The input parameters only differ between species by which labels are frozen,
+        which is set in each control file.
     """
 
     with open(expand_path(element_weight_paths), "r") as fp:
@@ -186,69 +211,18 @@ def plan_abundances(
 
     parent_dir = sanitise_parent_dir(parent_dir)
 
-    '''
-    Alias = FerreStellarParameters.alias()
-    sq = (
-        Alias
-        .select(
-            Alias.spectrum_pk.alias("spectrum_pk"),
-            fn.MIN(Alias.penalized_rchi2).alias("min_penalized_rchi2"),
-        )
-        .where(Alias.spectrum_pk << spectrum_pks)
-        .where(Alias.pwd.startswith(expand_path(parent_dir)))
-        .group_by(Alias.spectrum_pk)
-        .alias("sq")
-    )        
-
-    q = (
-        FerreStellarParameters
-        .select()
-        # Only get one result per spectrum.
-        .where(
-            FerreStellarParameters.penalized_rchi2.is_null(False)
-            # Don't calculate abundances for things that failed SPECTACULARLY
-        &   (~FerreStellarParameters.flag_ferre_fail)
-        &   (~FerreStellarParameters.flag_spectrum_io_error)
-        &   (~FerreStellarParameters.flag_no_suitable_initial_guess)
-        &   (~FerreStellarParameters.flag_missing_model_flux)
-        &   (FerreStellarParameters.pwd.startswith(expand_path(parent_dir)))
-        )
-        .join(
-            sq, 
-            on=(
-                (FerreStellarParameters.spectrum_pk == sq.c.spectrum_pk) &
-                (FerreStellarParameters.penalized_rchi2 == sq.c.min_penalized_rchi2)
-            )
-        )
-        # We will only get one result per spectrum, but we'll do it by recency.
-        .order_by(FerreStellarParameters.task_pk.desc())
-    )
-    '''
-
-    q = (
-        FerreStellarParameters
-        .select()
-        .where(
-            FerreStellarParameters.penalized_rchi2.is_null(False)
-            # Don't calculate abundances for things that failed SPECTACULARLY
+    # Only get one result per spectrum: the one with the lowest penalized rchi2.
+    is_usable = (
+        (FerreStellarParameters.penalized_rchi2.is_null(False))
+        # Don't calculate abundances for things that failed SPECTACULARLY
         &   (~FerreStellarParameters.flag_ferre_fail)
         &   (~FerreStellarParameters.flag_spectrum_io_error)
         &   (~FerreStellarParameters.flag_no_suitable_initial_guess)
         &   (~FerreStellarParameters.flag_missing_model_flux)
         &   (FerreStellarParameters.pwd.startswith(expand_path(parent_dir)))
-        )
+        &   (FerreStellarParameters.spectrum_pk << spectrum_pks)
     )
 
-    # You can do this by a SQL join, but it gets heavy and we kind of want to know about duplicate results.
-    all_results = {}
-    for result in q:
-        all_results.setdefault(result.spectrum_pk, [])
-        all_results[result.spectrum_pk].append(result)
-
-    best_results = {}
-    for spectrum_pk, results in all_results.items():
-        best_results[spectrum_pk] = sorted(results, key=lambda r: r.penalized_rchi2)[0]
-
     # Load abundance keywords on demand.
     ferre_headers, abundance_keywords = ({}, {})
     lookup_spectrum_by_primary_key = { s.spectrum_pk: s for s in spectra }
@@ -258,13 +232,9 @@ def plan_abundances(
     continuum_cache, continuum_cache_names = ({}, {})
 
     shown_BA_lsfcombo5_warning = False
-    done, group_task_kwds, pre_computed_continuum = ([], {}, {})
-    for result in tqdm(best_results.values(), total=len(best_results), desc="Planning for abundances"):
-        if result.spectrum_pk in done:
-            # We have a more recent FerreStellarParameters result which we will use instead of this one.
-            log.warning(f"Ignoring stellar parameter result {result} because we have a more recent result for this spectrum_pk={result.spectrum_pk}")
-            continue
-        
+    group_task_kwds, pre_computed_continuum = ({}, {})
+    best_results = stream_best_results(FerreStellarParameters, is_usable)
+    for result in tqdm(best_results, total=len(spectrum_pks), desc="Planning for abundances"):
         # TODO: make a better check for this
         if result.header_path.find("BA_lsfcombo5") > 0:
             if not shown_BA_lsfcombo5_warning:
@@ -272,7 +242,6 @@ def plan_abundances(
                 shown_BA_lsfcombo5_warning = True
             continue
 
-        done.append(result.spectrum_pk)
         group_task_kwds.setdefault(result.header_path, [])
         if result.header_path not in abundance_keywords:
             abundance_keywords[result.header_path] = {}
@@ -355,8 +324,9 @@ def plan_abundances(
     PARENT/abundances/Mg_d/input.nml
     PARENT/abundances/Mg_d/flux.input
     PARENT/abundances/Mg_d/e_flux.input
+    PARENT/abundances/Mg_d/parameters.input  (if `share_input_parameters`)
     PARENT/abundances/Mg_d/Al/input.nml
-    PARENT/abundances/Mg_d/Al/parameters.input
+    PARENT/abundances/Mg_d/Al/parameters.input  (if not `share_input_parameters`)
     PARENT/abundances/Mg_d/Al/parameters.output
 
     # These two should be the same if we are not doing normalisation
@@ -377,10 +347,15 @@ def plan_abundances(
 
         grid_kwds = list_to_dict(group_task_kwds[header_path])
         short_grid_name = parse_header_path(header_path)["short_grid_name"]
+        n_before = len(kwds_list)
 
-        for i, (species, details) in enumerate(abundance_keywords[header_path].items()):
+        for species, details in abundance_keywords[header_path].items():
             weight_path, frozen_parameters, ferre_kwds = details
-            pwd = os.path.join(parent_dir, STAGE, short_grid_name, species)
+            if all(frozen_parameters.get(ln, False) for ln in ferre_headers[header_path][0]["LABEL"]):
+                log.warning(f"Ignoring {species} species on grid {short_grid_name} because all parameters are frozen")
+                continue
+
+            pwd = os.path.join(parent_dir, STAGE, f"{short_grid_name}{pwd_suffix}", species)
             kwds = grid_kwds.copy()
             kwds.update(
                 pwd=pwd,
@@ -390,14 +365,11 @@ def plan_abundances(
                 ferre_kwds=ferre_kwds,
                 # In the chemical abundances stage we avoid repeating the flux/e_flux files everywhere
                 reference_pixel_arrays_for_abundance_run=True,
+                reference_input_parameters_for_abundance_run=share_input_parameters,
                 # Only write the flux arrays to the parent folder on the first run of this header path
-                write_input_pixel_arrays=(i == 0)
+                write_input_pixel_arrays=(len(kwds_list) == n_before)
             )
             kwds.update(extra_kwds)
-            
-            if all(frozen_parameters.get(ln, False) for ln in ferre_headers[kwds["header_path"]][0]["LABEL"]):
-                log.warning(f"Ignoring {species} species on grid {short_grid_name} because all parameters are frozen")
-                continue
             kwds_list.append(kwds)
         
         spectra_with_no_stellar_parameters -= set(grid_kwds["spectra"])
@@ -407,5 +379,15 @@ def plan_abundances(
     return (kwds_list, spectra_with_no_stellar_parameters)
 
 
+def _without_spectra(kwds, spectra):
+    """Return a copy of the pre-processing keywords for a FERRE execution, without some spectra."""
+    N = len(kwds["spectra"])
+    keep = [i for i, spectrum in enumerate(kwds["spectra"]) if spectrum not in spectra]
+    return {
+        k: ([v[i] for i in keep] if isinstance(v, list) and len(v) == N else v)
+        for k, v in kwds.items()
+    }
+
+
 def get_species(weight_path):
     return os.path.basename(weight_path)[:-5]
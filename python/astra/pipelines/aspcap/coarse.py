@@ -5,12 +5,12 @@ from tqdm import tqdm
 from astra import task
 from astra.models.spectrum import Spectrum
 from astra.models.aspcap import FerreCoarse
-from astra.utils import log, expand_path, list_to_dict
+from astra.utils import log, expand_path
 from astra.pipelines.ferre.operator import FerreOperator, FerreMonitoringOperator
 from astra.pipelines.ferre.pre_process import pre_process_ferre
 from astra.pipelines.ferre.post_process import post_process_ferre
-from astra.pipelines.ferre.utils import (execute_ferre, parse_header_path, read_ferre_headers, clip_initial_guess)
-from astra.pipelines.aspcap.utils import (approximate_log10_microturbulence, get_input_nml_paths, yield_suitable_grids)
+from astra.pipelines.ferre.utils import (execute_ferre, parse_header_path, read_ferre_headers, clip_initial_guesses)
+from astra.pipelines.aspcap.utils import (approximate_log10_microturbulence, get_input_nml_paths, get_grid_table, get_suitable_grid_masks, group_ferre_kwds_by_header_path)
 from astra.pipelines.aspcap.initial import get_initial_guesses
 
 #from astra.tools.continuum import Continuum, Scalar
@@ -19,6 +19,9 @@ from typing import Iterable, Union, List, Tuple, Optional, Callable
 
 STAGE = "coarse"
 
+# The initial guess labels given to FERRE, in the order they are written to the columnar tables.
+INITIAL_GUESS_LABEL_NAMES = ("teff", "logg", "log10_v_sini", "log10_v_micro", "m_h", "alpha_m", "c_m", "n_m")
+
 @task
 def coarse_stellar_parameters(
     spectra: Iterable[Spectrum],
@@ -138,15 +141,22 @@ def pre_coarse_stellar_parameters(
 
 
 @task
-def post_coarse_stellar_parameters(parent_dir, **kwargs) -> Iterable[FerreCoarse]:
+def post_coarse_stellar_parameters(parent_dir, pwds: Optional[Iterable[str]] = None, **kwargs) -> Iterable[FerreCoarse]:
     """
     Collect the results from FERRE and create database entries for the coarse stellar parameter determination step.
 
     :param parent_dir:
         The parent directory where these FERRE executions were planned.
+
+    :param pwds: [optional]
+        Only collect results from these execution directories. If `None` (default), then results will
+        be collected from all executions in the coarse stage.
     """
 
-    for pwd in map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE)):
+    if pwds is None:
+        pwds = map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE))
+
+    for pwd in pwds:
         log.info("Post-processing FERRE results in {0}".format(pwd))
         for kwds in post_process_ferre(pwd):
             result = FerreCoarse(**kwds)
@@ -200,6 +210,9 @@ def plan_coarse_stellar_parameters(
 ):
     """
     Plan a set of FERRE executions for a coarse stellar parameter run.
+
+    Suitable grids are found for all initial guesses at once, and the FERRE inputs for each grid
+    are given as a columnar table (see `group_ferre_kwds_by_header_path`).
     """
 
     if initial_guess_callable is None:
@@ -215,84 +228,93 @@ def plan_coarse_stellar_parameters(
         axis=0
     )
 
+    spectra_with_initial_guesses, initial_guesses = ([], [])
+    for spectrum, initial_guess in tqdm(initial_guess_callable(spectra), total=0, desc="Initial guesses"):
+        spectra_with_initial_guesses.append(spectrum)
+        initial_guesses.append(initial_guess)
+
+    # Put all initial guesses into arrays, so that we can find suitable grids for all of them at once.
+    grids = get_grid_table(all_headers)
+    as_float = lambda key: np.array([np.nan if g[key] is None else g[key] for g in initial_guesses], dtype=float).flatten()
+    columns = { key: as_float(key) for key in INITIAL_GUESS_LABEL_NAMES }
+    mean_fiber = as_float("mean_fiber")
+    telescope = np.array([g["telescope"] for g in initial_guesses], dtype=str).flatten()
+    initial_flags = np.array([g.get("initial_flags", 0) or 0 for g in initial_guesses], dtype=int).flatten()
+
+    n_no_fiber = np.sum(~np.isfinite(mean_fiber))
+    if n_no_fiber > 0:
+        log.warning(f"Missing finite mean_fiber value for {n_no_fiber} initial guesses, not yielding any start position")
+
+    # Only require teff to be within the grid limits if (logg, teff) is not within any grid.
+    strict, loose = get_suitable_grid_masks(grids, mean_fiber, columns["teff"], columns["logg"], telescope)
+    is_suitable = np.where(np.any(strict, axis=1)[:, None], strict, loose)
+    guess_index, grid_index = np.nonzero(is_suitable)
+    center_index = -np.ones_like(guess_index)
+
+    # No suitable initial guess has been found for some. Send them to all grids, at the grid centers.
+    no_suitable_initial_guess = np.flatnonzero(~np.any(is_suitable, axis=1))
+    if no_suitable_initial_guess.size > 0:
+        log.warning(f"No suitable initial guess found for {no_suitable_initial_guess.size} initial guesses. Starting at all grid centers.")
+        guess_index, grid_index, center_index = ([guess_index], [grid_index], [center_index])
+        for c, (logg, teff) in enumerate(unique_grid_centers):
+            N = no_suitable_initial_guess.size
+            centered_strict, _ = get_suitable_grid_masks(
+                grids,
+                mean_fiber[no_suitable_initial_guess],
+                np.repeat(teff, N),
+                np.repeat(logg, N),
+                telescope[no_suitable_initial_guess]
+            )
+            gi, gg = np.nonzero(centered_strict)
+            guess_index.append(no_suitable_initial_guess[gi])
+            grid_index.append(gg)
+            center_index.append(np.repeat(c, gi.size))
+        guess_index, grid_index, center_index = map(np.hstack, (guess_index, grid_index, center_index))
+
+    # Keep spectra in the same order as their initial guesses, then centers, then grids.
+    order = np.lexsort((grid_index, center_index, guess_index))
+    guess_index, grid_index, center_index = (guess_index[order], grid_index[order], center_index[order])
+
+    planned = { key: values[guess_index] for key, values in columns.items() }
+    is_centered = (center_index >= 0)
+    planned["logg"][is_centered] = unique_grid_centers[center_index[is_centered], 0]
+    planned["teff"][is_centered] = unique_grid_centers[center_index[is_centered], 1]
+    planned_initial_flags = initial_flags[guess_index]
+    if np.any(is_centered):
+        planned_initial_flags[is_centered] = FerreCoarse(flag_initial_guess_at_grid_center=True).initial_flags 
+        assert np.all(planned_initial_flags[is_centered] > 0), "Have the initial flag definitions changed for `astra.models.aspcap.FerreCoarse`?"
+
+    # Create a columnar table of FERRE inputs for each grid.
     all_kwds = []
-    spectrum_primary_keys_with_at_least_one_initial_guess = set()
-    for spectrum, input_initial_guess in tqdm(initial_guess_callable(spectra), total=0, desc="Initial guesses"):
-
-        n_initial_guesses = 0
-        for strict in (True, False):
-            for header_path, meta, headers in yield_suitable_grids(all_headers, strict=strict, **input_initial_guess):
-                spectrum_primary_keys_with_at_least_one_initial_guess.add(spectrum.spectrum_pk)
-
-                initial_guess = clip_initial_guess(input_initial_guess, headers)
-
-                frozen_parameters = dict()
-                if meta["spectral_type"] != "BA":
-                    frozen_parameters.update(c_m=True, n_m=True)
-                    if meta["gd"] == "d" and meta["spectral_type"] == "F":
-                        frozen_parameters.update(alpha_m=True)
-
-                kwds = dict(
-                    spectra=spectrum,
-                    header_path=header_path,
-                    frozen_parameters=frozen_parameters,
-                    initial_teff=initial_guess["teff"],
-                    initial_logg=initial_guess["logg"], 
-                    initial_log10_v_sini=initial_guess["log10_v_sini"],
-                    initial_log10_v_micro=initial_guess["log10_v_micro"],
-                    initial_m_h=initial_guess["m_h"],
-                    initial_alpha_m=initial_guess["alpha_m"],
-                    initial_c_m=initial_guess["c_m"],
-                    initial_n_m=initial_guess["n_m"],
-                    initial_flags=initial_guess.get("initial_flags", 0),
-                    weight_path=weight_path,
-                )
-
-                all_kwds.append(kwds)
-                n_initial_guesses += 1
-            
-            if n_initial_guesses > 0:
-                break
-        
-        else:
-            # No suitable initial guess has been found.
-            # Send it to all grids, at the grid centers.
-            initial_flags = FerreCoarse(flag_initial_guess_at_grid_center=True).initial_flags 
-            assert initial_flags > 0, "Have the initial flag definitions changed for `astra.models.aspcap.FerreCoarse`?"
-
-            log.warning(f"No suitable initial guess found for {spectrum} (from inputs {input_initial_guess}). Starting at all grid centers.")
-            for logg, teff in unique_grid_centers:
-                centered_initial_guess = input_initial_guess.copy()
-                centered_initial_guess.update(teff=teff, logg=logg)
-
-                for header_path, meta, headers in yield_suitable_grids(all_headers, strict=True, **centered_initial_guess):
-                    spectrum_primary_keys_with_at_least_one_initial_guess.add(spectrum.spectrum_pk)                    
-                    initial_guess = clip_initial_guess(centered_initial_guess, headers)
-
-                    frozen_parameters = dict()
-                    if meta["spectral_type"] != "BA":
-                        frozen_parameters.update(c_m=True, n_m=True)
-                        if meta["gd"] == "d" and meta["spectral_type"] == "F":
-                            frozen_parameters.update(alpha_m=True)
-
-                    kwds = dict(
-                        spectra=spectrum,
-                        header_path=header_path,
-                        frozen_parameters=frozen_parameters,
-                        initial_teff=initial_guess["teff"],
-                        initial_logg=initial_guess["logg"], 
-                        initial_log10_v_sini=initial_guess["log10_v_sini"],
-                        initial_log10_v_micro=initial_guess["log10_v_micro"],
-                        initial_m_h=initial_guess["m_h"],
-                        initial_alpha_m=initial_guess["alpha_m"],
-                        initial_c_m=initial_guess["c_m"],
-                        initial_n_m=initial_guess["n_m"],
-                        initial_flags=initial_flags,
-                        weight_path=weight_path,
-                    )
-
-                    all_kwds.append(kwds)
-    
+    _, first_index = np.unique(grid_index, return_index=True)
+    for g in grid_index[np.sort(first_index)]:
+        header_path, meta = (grids["header_path"][g], grids["meta"][g])
+        indices = np.flatnonzero(grid_index == g)
+        initial_guess = clip_initial_guesses(
+            { key: values[indices] for key, values in planned.items() }, 
+            all_headers[header_path]
+        )
+
+        frozen_parameters = dict()
+        if meta["spectral_type"] != "BA":
+            frozen_parameters.update(c_m=True, n_m=True)
+            if meta["gd"] == "d" and meta["spectral_type"] == "F":
+                frozen_parameters.update(alpha_m=True)
+
+        kwds = dict(
+            spectra=[spectra_with_initial_guesses[i] for i in guess_index[indices]],
+            header_path=header_path,
+            frozen_parameters=frozen_parameters,
+            weight_path=weight_path,
+            initial_flags=planned_initial_flags[indices].tolist(),
+        )
+        kwds.update({ f"initial_{key}": initial_guess[key].tolist() for key in INITIAL_GUESS_LABEL_NAMES })
+        all_kwds.append(kwds)
+
+    spectrum_primary_keys_with_at_least_one_initial_guess = set(
+        spectra_with_initial_guesses[i].spectrum_pk for i in np.unique(guess_index)
+    )
+
     # Anything that has no suitable initial guess?
     spectra_with_no_initial_guess = [
         s for s in spectra \
@@ -310,32 +332,9 @@ def plan_coarse_stellar_parameters(
 
     log.info(f"Processing {len(spectrum_primary_keys_with_at_least_one_initial_guess)} unique spectra")
 
-    # Bundle them together into executables based on common header paths.
-    header_paths = list(set([ea["header_path"] for ea in all_kwds]))
-    log.info(f"Found {len(header_paths)} unique header paths")
-
-    grouped_task_kwds = { header_path: [] for header_path in header_paths }
-    for kwds in all_kwds:
-        grouped_task_kwds[kwds.pop("header_path")].append(kwds)
-
-    return_list_of_kwds = []
-    for header_path, kwds in grouped_task_kwds.items():
-
-        grouped_task_kwds[header_path] = list_to_dict(kwds)
-
-        short_grid_name = parse_header_path(header_path)["short_grid_name"]
-
-        pwd = os.path.join(parent_dir, STAGE, short_grid_name)
-
-        grouped_task_kwds[header_path].update(
-            header_path=header_path,
-            pwd=pwd,
-            weight_path=weight_path,
-            # Frozen parameters are common to the header path, so just set as the first value.
-            frozen_parameters=grouped_task_kwds[header_path]["frozen_parameters"][0],
-        )
-        grouped_task_kwds[header_path].update(kwargs)
-        return_list_of_kwds.append(grouped_task_kwds[header_path])
+    # Bundle them together into executables based on common header paths (and frozen parameters),
+    # so that each grid is loaded as few times as possible.
+    return_list_of_kwds = group_ferre_kwds_by_header_path(all_kwds, parent_dir, STAGE, **kwargs)
 
     return (return_list_of_kwds, spectra_with_no_initial_guess)
 
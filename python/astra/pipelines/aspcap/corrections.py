@@ -1,6 +1,7 @@
 import numpy as np
+import warnings
 print("A")
-from peewee import JOIN, fn, chunked
+from peewee import JOIN, fn, chunked, ValuesList
 print("A")
 from tqdm import tqdm
 print("A")
@@ -24,34 +25,68 @@ print("A")
 import astropy.units as u
 import astropy.constants as c
 
-def clear_corrections(batch_size: int = 500):
+def update_from_values(model, pks, values, batch_size: int = 10_000):
     """
-    Clear any existing corrections.
+    Update many rows with different values, using one `UPDATE ... FROM (VALUES ...)` statement per
+    batch instead of fetching and saving model instances.
+
+    :param model:
+        The model (table) to update.
+
+    :param pks:
+        An array of primary keys of the rows to update.
+
+    :param values:
+        A dictionary with fields as keys, and arrays of values (the same length as `pks`) as values.
+
+    :param batch_size: [optional]
+        The number of rows to update per statement.
+
+    :returns:
+        The number of rows updated.
     """
-    # TODO: Have some reference columns of what fields we should use / update with raw_ prefixes?
-    N_updated = 0
-    for chunk in chunked(ASPCAP.select(), batch_size):
-        for result in chunk:
-            result.teff = result.raw_teff
-            result.e_teff = result.raw_e_teff
-            result.logg = result.raw_logg
-            result.e_logg = result.raw_e_logg
+    fields = list(values.keys())
+    columns = [np.asarray(pks).tolist()] + [np.asarray(values[field]).tolist() for field in fields]
 
+    pk = model._meta.primary_key
+    N_updated = 0
+    for chunk in chunked(zip(*columns), batch_size):
+        # Columns from a VALUES list are named column1, column2, ... in both PostgreSQL and SQLite.
+        vl = ValuesList(chunk, alias="vl")
         N_updated += (
-            ASPCAP
-            .bulk_update(
-                chunk,
-                fields=[
-                    ASPCAP.teff,
-                    ASPCAP.e_teff,
-                    ASPCAP.logg,
-                    ASPCAP.e_logg,
-                ]
-            )
+            model
+            .update({ field: getattr(vl.c, f"column{i}") for i, field in enumerate(fields, start=2) })
+            .from_(vl)
+            .where(pk == vl.c.column1)
+            .execute()
         )
-
     return N_updated
 
+
+def clear_corrections(batch_size: int = None):
+    """
+    Clear any existing corrections.
+
+    :param batch_size: [optional]
+        Deprecated, and ignored. The corrections are cleared in a single statement.
+    """
+    if batch_size is not None:
+        warnings.warn(
+            "`batch_size` is deprecated and ignored: corrections are cleared in a single statement",
+            DeprecationWarning
+        )
+    # TODO: Have some reference columns of what fields we should use / update with raw_ prefixes?
+    return (
+        ASPCAP
+        .update(
+            teff=ASPCAP.raw_teff,
+            e_teff=ASPCAP.raw_e_teff,
+            logg=ASPCAP.raw_logg,
+            e_logg=ASPCAP.raw_e_logg,
+        )
+        .execute()
+    )
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -110,46 +145,20 @@ def apply_flags():
         .where(ASPCAP.rchi2 > 1000)
         .execute()
     )
-    q = (
-        ASPCAP
-        .select(
-            ASPCAP,
-            ApogeeCoaddedSpectrumInApStar.std_v_rad)
-        .join(ApogeeCoaddedSpectrumInApStar, on=(ASPCAP.spectrum_pk == ApogeeCoaddedSpectrumInApStar.spectrum_pk))
-        .objects()
-        
-    )
-    with tqdm() as pb:            
-        for chunk in chunked(q, 1000):
-            updated = []
-            for item in chunk:
-                if item.std_v_rad > 1:
-                    item.flag_high_std_v_rad = True
-                    updated.append(item)
-                
-            if len(updated) > 0:
-                (
-                    ASPCAP
-                    .bulk_update(
-                        updated,
-                        fields=[
-                            ASPCAP.result_flags
-                        ]
-                    )
-                )
-                pb.update(1000)
-    
-    '''
     (
         ASPCAP
         .update(
             result_flags=ASPCAP.flag_high_std_v_rad.set()
         )
         .where(
-            (ASPCAP.std_v_rad > 1)
+            ASPCAP.spectrum_pk.in_(
+                ApogeeCoaddedSpectrumInApStar
+                .select(ApogeeCoaddedSpectrumInApStar.spectrum_pk)
+                .where(ApogeeCoaddedSpectrumInApStar.std_v_rad > 1)
+            )
         )
+        .execute()
     )
-    '''
 
     
 def apply_ipl3_irfm_corrections():
@@ -421,18 +430,6 @@ def apply_ipl3_logg_corrections(batch_size: int = 500, limit: int = None):
     # First let's construct a classifier for the RC/RGB stars.
     apokasc = Table.read(expand_path("$MWM_ASTRA/aux/external-catalogs/APOKASC_cat_v7.0.5.fits"))
     
-    q = (
-        ASPCAP
-        .select(
-            ASPCAP,
-            Source.sdss4_apogee_id
-        )
-        .distinct(Source)
-        .join(Source)
-        .where(Source.sdss4_apogee_id.in_(list(apokasc["2MASS_ID"])))
-        .objects()
-    )
-    
     fields = (
         ASPCAP.raw_teff,
         ASPCAP.raw_logg,
@@ -441,15 +438,30 @@ def apply_ipl3_logg_corrections(batch_size: int = 500, limit: int = None):
         ASPCAP.raw_n_m_atm,
         ASPCAP.raw_v_micro,
     )
-    
+    q = (
+        ASPCAP
+        .select(
+            Source.sdss4_apogee_id,
+            *fields
+        )
+        .distinct(Source)
+        .join(Source)
+        .where(Source.sdss4_apogee_id.in_(list(apokasc["2MASS_ID"])))
+        .tuples()
+    )
+
     for field in fields:
         apokasc[field.name] = np.nan * np.ones(len(apokasc))
-    
-    for row in q:
-        mask = (apokasc["2MASS_ID"] == row.sdss4_apogee_id)
-        for field in fields:
-            apokasc[field.name][mask] = getattr(row, field.name)
-        
+
+    apokasc_indices = {}
+    for index, apogee_id in enumerate(apokasc["2MASS_ID"]):
+        apokasc_indices.setdefault(apogee_id, [])
+        apokasc_indices[apogee_id].append(index)
+
+    for sdss4_apogee_id, *values in q:
+        for field, value in zip(fields, values):
+            apokasc[field.name][apokasc_indices[sdss4_apogee_id]] = value
+
     
     clf = RandomForestClassifier(n_estimators=100, max_depth=10, random_state=0)
 
@@ -527,18 +539,42 @@ def apply_ipl3_logg_corrections(batch_size: int = 500, limit: int = None):
     lm_rgb = LinearRegression()
     lm_rgb.fit(X[mask_lm_rgb], y[mask_lm_rgb])
     
-    def logg_correction_dwarf(r):
-        return r.raw_logg - (-0.947 + 1.886e-4 * r.raw_teff + 0.410 * r.raw_m_h_atm) # Eq 2.
-
     print("getting mdwarf callable")
     teff_logg_m_dwarfs = get_m_dwarf_callable()
     print("ok got it")
 
+    return update_ipl3_logg_corrections(clf, lm_rgb, rc_offset, batch_size=batch_size, limit=limit)
+
+
+def update_ipl3_logg_corrections(clf, lm_rgb, rc_offset, batch_size: int = 500, limit: int = None):
+    """
+    Update the logg and calibration flags of ASPCAP results with the IPL-3 logg corrections.
+
+    :param clf:
+        A classifier that predicts red giant branch (1) or red clump (2) stars, given the raw teff,
+        logg, [M/H], and [C/M].
+
+    :param lm_rgb:
+        A linear model that predicts logg for red giant branch stars, given the raw [M/H] and logg.
+
+    :param rc_offset:
+        The logg offset to subtract from red clump stars.
+
+    :param batch_size: [optional]
+        The number of rows to update per statement.
+
+    :param limit: [optional]
+        Limit the number of results to correct.
+    """
     # We're ready to apply corrections for RGB, RC, and MS stars.
     q = (
         ASPCAP
         .select(
-            ASPCAP,
+            ASPCAP.task_pk,
+            ASPCAP.raw_teff,
+            ASPCAP.raw_logg,
+            ASPCAP.raw_m_h_atm,
+            ASPCAP.raw_c_m_atm,
             Source.bp_mag,
             Source.rp_mag,
             Source.k_mag,
@@ -550,7 +586,7 @@ def apply_ipl3_logg_corrections(batch_size: int = 500, limit: int = None):
         &   ASPCAP.raw_logg.is_null(False)
         &   ASPCAP.raw_m_h_atm.is_null(False)
         )
-        .objects()
+        .tuples()
         .limit(limit)
     )
     
@@ -559,88 +595,93 @@ def apply_ipl3_logg_corrections(batch_size: int = 500, limit: int = None):
     #    a, b, c = (-1.495465498565102e-07, 0.0016514861990204446, -4.613929004721487)
     #    return a * raw_teff**2 + b*raw_teff + c
     #results["bp_mag"] - results["rp_mag"])
-    
-    with tqdm(total=0, desc="Applying corrections") as pb:
-        for chunk in chunked(q, batch_size):
-            any_mass_radius = False
-            updated = []
-            for r in chunk:   
-                r.calibrated_flags = 0 # remove any previous classifications     
-                r.logg = r.raw_logg
-                
-                #if r.raw_logg >= 3.8 and r.raw_teff < 4800 and r.bp_mag is not None and r.rp_mag is not None and 5.5 > (r.bp_mag - r.rp_mag) and (r.bp_mag - r.rp_mag) > 1.5:
-                #    # dwarf
-                #    r.logg = r.raw_logg - isochrone_main_sequence_logg_delta(r.raw_teff)
-                #    r.flag_as_dwarf_for_calibration = True
-                if r.raw_logg >= 3.8:
-                
-                    if r.raw_teff > 4100:
-                        r.logg = logg_correction_dwarf(r)
-                        r.flag_as_dwarf_for_calibration = True
-
-                    else:                                            
-                        # M-dwarf
-                        try:                        
-                            bp_rp = r.bp_mag - r.rp_mag
-                        except:
-                            r.logg = logg_correction_dwarf(r)
-                            r.flag_as_dwarf_for_calibration = True                            
-                        else:
-                            if (3.5 > bp_rp > 1.5) and np.all(np.isfinite(np.array([r.k_mag, r.plx]).astype(float))) and r.plx > 0:
-                                r.flag_as_m_dwarf_for_calibration = True                        
-                            else:
-                                r.logg = logg_correction_dwarf(r)
-                                r.flag_as_dwarf_for_calibration = True                            
-                                                
-                elif r.raw_logg < 3.8:
-                    # evolved                            
-                    X = np.atleast_2d([
-                        r.raw_teff,
-                        r.raw_logg,
-                        r.raw_m_h_atm,
-                        r.raw_c_m_atm,
-                    ]).astype(float)
-                    if np.isfinite(X).all():
-                        predicted_class, = clf.predict(X)
-                        if predicted_class == 1: # rgb
-                            r.flag_as_giant_for_calibration = True
-                            r.logg, = lm_rgb.predict(np.atleast_2d([
-                                r.raw_m_h_atm,
-                                r.raw_logg,                            
-                            ]))
-                        elif predicted_class == 2: # rc
-                            r.flag_as_red_clump_for_calibration = True
-                            r.logg = r.raw_logg - rc_offset
-                        else:
-                            raise ValueError("arrrgh")
-                    else:
-                        r.logg = r.raw_logg
-                else:
-                    r.logg = r.raw_logg
-                    
-                    
-                if np.isfinite(r.logg):
-                    updated.append(r)
-
-            if updated:      
-                fields = [ASPCAP.logg, ASPCAP.calibrated_flags]              
-                if any_mass_radius:
-                    fields.extend([
-                        ASPCAP.teff,
-                    ])
-                #        ASPCAP.mass,
-                #        ASPCAP.radius
-                
-                (
-                    ASPCAP
-                    .bulk_update(
-                        updated,
-                        fields=fields
-                    )
-                )
-            pb.update(batch_size)
-            
-    return None    
+
+    rows = list(q)
+    if not rows:
+        return None
+
+    task_pk, *columns = np.array(rows, dtype=float).T
+    logg, calibrated_flags = get_ipl3_logg_corrections(*columns, clf, lm_rgb, rc_offset)
+
+    # Only update results with a finite corrected logg.
+    updated = np.isfinite(logg)
+    log.info(f"Applying corrections to {np.sum(updated)} of {len(rows)} results")
+    update_from_values(
+        ASPCAP,
+        task_pk[updated].astype(int),
+        {
+            ASPCAP.logg: logg[updated],
+            ASPCAP.calibrated_flags: calibrated_flags[updated],
+        },
+        batch_size=batch_size
+    )
+    return None
+
+
+def get_ipl3_logg_corrections(raw_teff, raw_logg, raw_m_h_atm, raw_c_m_atm, bp_mag, rp_mag, k_mag, plx, clf, lm_rgb, rc_offset):
+    """
+    Classify stars for the IPL-3 logg calibration and compute the corrected logg for each.
+
+    All inputs are arrays of the same length, where missing values are NaN.
+
+    :param clf:
+        A classifier that predicts red giant branch (1) or red clump (2) stars, given the raw teff,
+        logg, [M/H], and [C/M].
+
+    :param lm_rgb:
+        A linear model that predicts logg for red giant branch stars, given the raw [M/H] and logg.
+
+    :param rc_offset:
+        The logg offset to subtract from red clump stars.
+
+    :returns:
+        A two-length tuple of the corrected logg values, and the calibration flags.
+    """
+    raw_teff, raw_logg, raw_m_h_atm, raw_c_m_atm, bp_mag, rp_mag, k_mag, plx = (
+        np.asarray(a, dtype=float) for a in (raw_teff, raw_logg, raw_m_h_atm, raw_c_m_atm, bp_mag, rp_mag, k_mag, plx)
+    )
+
+    logg = np.copy(raw_logg)
+    calibrated_flags = np.zeros(logg.size, dtype=int)
+
+    # Eq 2.
+    logg_dwarf = raw_logg - (-0.947 + 1.886e-4 * raw_teff + 0.410 * raw_m_h_atm)
+
+    with np.errstate(invalid="ignore"):
+        is_dwarf = (raw_logg >= 3.8)
+        is_evolved = (raw_logg < 3.8)
+
+        bp_rp = bp_mag - rp_mag
+        is_m_dwarf = (
+            is_dwarf
+        &   (raw_teff <= 4100)
+        &   (3.5 > bp_rp) & (bp_rp > 1.5)
+        &   np.isfinite(k_mag) & np.isfinite(plx) & (plx > 0)
+        )
+    is_dwarf &= ~is_m_dwarf
+
+    logg[is_dwarf] = logg_dwarf[is_dwarf]
+    calibrated_flags[is_dwarf] |= ASPCAP.flag_as_dwarf_for_calibration._value
+    calibrated_flags[is_m_dwarf] |= ASPCAP.flag_as_m_dwarf_for_calibration._value
+
+    X = np.array([raw_teff, raw_logg, raw_m_h_atm, raw_c_m_atm]).T
+    is_evolved &= np.isfinite(X).all(axis=1)
+    if np.any(is_evolved):
+        predicted_class = clf.predict(X[is_evolved])
+        if not np.all(np.isin(predicted_class, (1, 2))):
+            raise ValueError("arrrgh")
+
+        is_rgb, is_rc = (np.zeros_like(is_evolved), np.zeros_like(is_evolved))
+        is_rgb[is_evolved] = (predicted_class == 1)
+        is_rc[is_evolved] = (predicted_class == 2)
+
+        if np.any(is_rgb):
+            logg[is_rgb] = lm_rgb.predict(np.array([raw_m_h_atm[is_rgb], raw_logg[is_rgb]]).T)
+        logg[is_rc] = raw_logg[is_rc] - rc_offset
+        calibrated_flags[is_rgb] |= ASPCAP.flag_as_giant_for_calibration._value
+        calibrated_flags[is_rc] |= ASPCAP.flag_as_red_clump_for_calibration._value
+
+    return (logg, calibrated_flags)
 
 
 def apply_dr16_parameter_corrections(batch_size: int = 500):
@@ -1,11 +1,14 @@
 from astropy.io import fits
 from astra.utils import log
+from astra.models.source import Source
 from astra.models.apogee import ApogeeVisitSpectrum
 from astra.models import ApogeeNetV2 as ApogeeNet
 from astra.models.aspcap import FerreCoarse
 from astra.pipelines.aspcap.utils import approximate_log10_microturbulence 
 
-from peewee import ModelSelect
+from peewee import chunked
+
+DOPPLER_TEFF_RANGE = (2000, 100_000)
 
 def get_effective_fiber(spectrum):
     for field_name in ("fiber", "mean_fiber"):
@@ -17,10 +20,57 @@ def get_effective_fiber(spectrum):
     log.warning(f"Getting effective fiber from headers for {spectrum}; these should be ingested to the database")
     return fits.getval(spectrum.absolute_path, "MEANFIB")    
 
-def get_initial_defaults(spectrum, logg=None):
+
+def ingest_mean_fibers(spectra, save=True, batch_size=1000):
+    """
+    Read the mean fiber (`MEANFIB`) from the headers of any spectra that do not have a fiber or
+    mean fiber, and (optionally) store them in the database so that they need not be read again.
+
+    :param spectra:
+        An iterable of spectra.
+
+    :param save: [optional]
+        Save the mean fibers to the database, for spectra with a `mean_fiber` field.
+
+    :param batch_size: [optional]
+        The number of rows to update per query.
+
+    :returns:
+        A dictionary of effective fibers, with spectrum primary keys as keys.
+    """
+    fibers, missing = ({}, {})
+    for spectrum in spectra:
+        fiber = next(
+            (v for v in (getattr(spectrum, f, None) for f in ("fiber", "mean_fiber")) if v is not None),
+            None
+        )
+        if fiber is None:
+            missing[spectrum.spectrum_pk] = spectrum
+        else:
+            fibers[spectrum.spectrum_pk] = fiber
+
+    if not missing:
+        return fibers
+
+    log.warning(f"Getting effective fiber from headers for {len(missing)} spectra; these should be ingested to the database")
+    to_save = {}
+    for spectrum_pk, spectrum in missing.items():
+        fibers[spectrum_pk] = fits.getval(spectrum.absolute_path, "MEANFIB")
+        model = spectrum.__class__
+        if save and "mean_fiber" in model._meta.fields:
+            spectrum.mean_fiber = fibers[spectrum_pk]
+            to_save.setdefault(model, []).append(spectrum)
+
+    for model, instances in to_save.items():
+        model.bulk_update(instances, fields=[model.mean_fiber], batch_size=batch_size)
+        log.info(f"Ingested mean fibers for {len(instances)} {model.__name__} rows")
+    return fibers
+
+
+def get_initial_defaults(spectrum, logg=None, mean_fiber=None):
     kwds = {
         "telescope": spectrum.telescope,
-        "mean_fiber": get_effective_fiber(spectrum),
+        "mean_fiber": get_effective_fiber(spectrum) if mean_fiber is None else mean_fiber,
         "alpha_m": 0.0,
         "log10_v_sini": 1.0,
         "c_m": 0.0,
@@ -30,123 +80,141 @@ def get_initial_defaults(spectrum, logg=None):
         kwds["log10_v_micro"] = approximate_log10_microturbulence(logg)
     return kwds
 
-def get_initial_guess_from_gaia_xp_zhang_2023(spectrum):
-    if spectrum.source.zgr_teff is not None and spectrum.source.zgr_quality_flags == 0:
+def get_initial_guess_from_gaia_xp_zhang_2023(spectrum, source=None, mean_fiber=None):
+    if source is None:
+        source = spectrum.source
+    if source.zgr_teff is not None and source.zgr_quality_flags == 0:
         initial_guess = {
-            "teff": spectrum.source.zgr_teff,
-            "logg": spectrum.source.zgr_logg,
-            "m_h": spectrum.source.zgr_fe_h,
+            "teff": source.zgr_teff,
+            "logg": source.zgr_logg,
+            "m_h": source.zgr_fe_h,
             "initial_flags": FerreCoarse(flag_initial_guess_from_gaia_xp_zhang_2023=True).initial_flags
         }
-        initial_guess.update(get_initial_defaults(spectrum, spectrum.source.zgr_logg))
+        initial_guess.update(get_initial_defaults(spectrum, source.zgr_logg, mean_fiber))
         return initial_guess
     else:
         return None
 
 
-def get_initial_guesses(spectra):
-    """
-    Get an initial guess of the stellar parameters for ASPCAP, given some spectra.
+def _get_doppler_results(where):
+    lower, upper = DOPPLER_TEFF_RANGE
+    return (
+        ApogeeVisitSpectrum
+        .select(
+            ApogeeVisitSpectrum.spectrum_pk,
+            ApogeeVisitSpectrum.source_pk,
+            ApogeeVisitSpectrum.doppler_teff,
+            ApogeeVisitSpectrum.doppler_logg,
+            ApogeeVisitSpectrum.doppler_fe_h,
+        )
+        .where(
+            where
+        &   (ApogeeVisitSpectrum.doppler_teff >= lower)
+        &   (ApogeeVisitSpectrum.doppler_teff <= upper)
+        )
+        .order_by(ApogeeVisitSpectrum.spectrum_pk)
+        .tuples()
+    )
 
-    :param spectra:
-        An iterable of spectra.
+
+def _get_initial_guesses_for_chunk(spectra):
+    """
+    Get initial guesses for a chunk of spectra, with one query for each source of initial guesses.
     """
 
-    if False and isinstance(spectra, ModelSelect):
-        q = (
-            spectra
-            .select_from(
-                ApogeeNet.teff.alias("initial_teff"),
-                ApogeeNet.logg.alias("initial_logg"),
-                ApogeeNet.fe_h.alias("initial_fe_h"),
-            )
-            .join(ApogeeNet, on=(ApogeeNet.spectrum_pk == spectra.model.spectrum_pk))
-            .where(ApogeeNet.result_flags == 0)
+    spectrum_pks = [s.spectrum_pk for s in spectra]
+    sources = {
+        source.pk: source for source in
+        Source
+        .select(
+            Source.pk,
+            Source.zgr_teff,
+            Source.zgr_logg,
+            Source.zgr_fe_h,
+            Source.zgr_quality_flags,
         )
+        .where(Source.pk << list(set(s.source_pk for s in spectra)))
+    }
 
-        for spectrum in q:
-            initial_guess = {
-                "teff": spectrum.initial_teff,
-                "logg": spectrum.initial_logg,
-                "m_h": spectrum.initial_fe_h,
-                "initial_flags": FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags,
-                "mean_fiber": fits.getval(spectrum.absolute_path, "MEANFIB"),
-                "telescope": spectrum.telescope,
-                "alpha_m": 0.0,
-                "log10_v_sini": 1.0,
-                "c_m": 0.0,
-                "n_m": 0.0, 
-            }
-            initial_guess["log10_v_micro"] = approximate_log10_microturbulence(initial_guess["logg"])
-            yield (spectrum, initial_guess)
+    # `ApogeeNet.get` would return the first matching result, so we keep the first by primary key.
+    apogeenet = {}
+    q = (
+        ApogeeNet
+        .select(ApogeeNet.spectrum_pk, ApogeeNet.teff, ApogeeNet.logg, ApogeeNet.fe_h)
+        .where((ApogeeNet.result_flags == 0) & (ApogeeNet.spectrum_pk << spectrum_pks))
+        .order_by(ApogeeNet.task_pk)
+        .tuples()
+    )
+    for spectrum_pk, teff, logg, fe_h in q:
+        apogeenet.setdefault(spectrum_pk, (teff, logg, fe_h))
 
-    else:         
-        for spectrum in spectra:
-
-            # Zhang et al. (2023)
-            initial_guess = get_initial_guess_from_gaia_xp_zhang_2023(spectrum)
-            if initial_guess is not None:
-                yield (spectrum, initial_guess)
-
-            # APOGEENet
-            try:
-                r = ApogeeNet.get(result_flags=0, spectrum_pk=spectrum.spectrum_pk)
-            except ApogeeNet.DoesNotExist:
-                # Revert to Doppler by matching to DRP spectrum identifier.
-                try:
-                    r = (
-                        ApogeeVisitSpectrum
-                        .select()
-                        .where(
-                            (ApogeeVisitSpectrum.spectrum_pk == spectrum.drp_spectrum_pk)
-                        &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
-                        &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
-                        )
-                        .first()
-                    )
-                except ApogeeVisitSpectrum.DoesNotExist:
-                    raise
-                except:  
-                    # Get Doppler result for anything matching by source.              
-                    r = (
-                        ApogeeVisitSpectrum
-                        .select()
-                        .where(
-                            (ApogeeVisitSpectrum.source_pk == spectrum.source_pk)
-                        &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
-                        &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
-                        )
-                        .first()
-                    )
-                finally:
-                    if r is None:
-                        # Try load it from the headers maybe
-                        continue
-                    params = {
-                        "teff": r.doppler_teff,
-                        "logg": r.doppler_logg,
-                        "m_h": r.doppler_fe_h,
-                        "initial_flags": FerreCoarse(flag_initial_guess_from_doppler=True).initial_flags
-                    }
+    # Doppler results are matched by the DRP spectrum identifier, or by source if there is none.
+    drp_spectrum_pks, source_pks = (set(), set())
+    for spectrum in spectra:
+        if spectrum.spectrum_pk in apogeenet:
+            continue
+        if hasattr(spectrum, "drp_spectrum_pk"):
+            drp_spectrum_pks.add(spectrum.drp_spectrum_pk)
+        else:
+            source_pks.add(spectrum.source_pk)
+
+    doppler_by_spectrum_pk, doppler_by_source_pk = ({}, {})
+    if drp_spectrum_pks:
+        for spectrum_pk, source_pk, *params in _get_doppler_results(ApogeeVisitSpectrum.spectrum_pk << list(drp_spectrum_pks)):
+            doppler_by_spectrum_pk.setdefault(spectrum_pk, params)
+    if source_pks:
+        for spectrum_pk, source_pk, *params in _get_doppler_results(ApogeeVisitSpectrum.source_pk << list(source_pks)):
+            doppler_by_source_pk.setdefault(source_pk, params)
+
+    # Keep the same priority order: Zhang et al. (2023), then APOGEENet, then Doppler.
+    guesses = []
+    for spectrum in spectra:
+        source = sources.get(spectrum.source_pk, None)
+        if source is not None and source.zgr_teff is not None and source.zgr_quality_flags == 0:
+            guesses.append((spectrum, source, None))
+
+        if spectrum.spectrum_pk in apogeenet:
+            teff, logg, m_h = apogeenet[spectrum.spectrum_pk]
+            flags = FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags
+        else:
+            if hasattr(spectrum, "drp_spectrum_pk"):
+                r = doppler_by_spectrum_pk.get(spectrum.drp_spectrum_pk, None)
             else:
-                params = {
-                    "teff": r.teff,
-                    "logg": r.logg,
-                    "m_h": r.fe_h,
-                    "initial_flags": FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags
-                }
-            
-            mean_fiber = get_effective_fiber(spectrum)
-
-            initial_guess = {
-                "telescope": spectrum.telescope,
-                "mean_fiber": mean_fiber,
-                "alpha_m": 0.0,
-                "log10_v_sini": 1.0,
-                "c_m": 0.0,
-                "n_m": 0.0, 
-            }
+                r = doppler_by_source_pk.get(spectrum.source_pk, None)
+            if r is None:
+                continue
+            teff, logg, m_h = r
+            flags = FerreCoarse(flag_initial_guess_from_doppler=True).initial_flags
+        guesses.append((spectrum, None, dict(teff=teff, logg=logg, m_h=m_h, initial_flags=flags)))
+
+    # Only read headers for spectra that we will return an initial guess for.
+    fibers = ingest_mean_fibers({ s.spectrum_pk: s for s, *_ in guesses }.values())
+
+    for spectrum, source, params in guesses:
+        mean_fiber = fibers[spectrum.spectrum_pk]
+        if source is not None:
+            yield (spectrum, get_initial_guess_from_gaia_xp_zhang_2023(spectrum, source, mean_fiber))
+        else:
+            initial_guess = get_initial_defaults(spectrum, mean_fiber=mean_fiber)
             initial_guess.update(params)
             initial_guess["log10_v_micro"] = approximate_log10_microturbulence(initial_guess["logg"])
+            yield (spectrum, initial_guess)
+
+
+def get_initial_guesses(spectra, batch_size=1000):
+    """
+    Get an initial guess of the stellar parameters for ASPCAP, given some spectra.
 
-            yield (spectrum, initial_guess)
\ No newline at end of file
+    Initial guesses are taken from Zhang et al. (2023) (if the Gaia XP labels are reliable), and
+    from APOGEENet, or Doppler if there is no reliable APOGEENet result. A spectrum may therefore
+    have up to two initial guesses. Spectra are resolved in chunks, so that the number of database
+    queries does not scale with the number of spectra.
+
+    :param spectra:
+        An iterable of spectra.
+
+    :param batch_size: [optional]
+        The number of spectra to resolve initial guesses for at once.
+    """
+    for chunk in chunked(spectra, batch_size):
+        yield from _get_initial_guesses_for_chunk(chunk)
@@ -4,7 +4,7 @@ from typing import Iterable, Optional
 from peewee import fn
 from tqdm import tqdm
 from astra import task
-from astra.utils import log, list_to_dict, expand_path
+from astra.utils import log, expand_path
 from astra.models.spectrum import Spectrum
 from astra.models.aspcap import FerreCoarse, FerreStellarParameters
 from astra.pipelines.ferre.operator import FerreOperator, FerreMonitoringOperator
@@ -14,7 +14,9 @@ from astra.pipelines.ferre.utils import (
     parse_header_path, get_input_spectrum_primary_keys, read_control_file, read_file_with_name_and_data, read_ferre_headers,
     format_ferre_input_parameters, format_ferre_control_keywords,
 )
-from astra.pipelines.aspcap.utils import get_input_nml_paths, sanitise_parent_dir
+from astra.pipelines.aspcap.utils import (
+    get_input_nml_paths, sanitise_parent_dir, group_ferre_kwds_by_header_path, stream_best_results
+)
 from astra.pipelines.aspcap.continuum import MedianFilter
 import concurrent.futures
 
@@ -100,15 +102,22 @@ def pre_stellar_parameters(
 
 
 @task
-def post_stellar_parameters(parent_dir, **kwargs) -> Iterable[FerreStellarParameters]:
+def post_stellar_parameters(parent_dir, pwds: Optional[Iterable[str]] = None, **kwargs) -> Iterable[FerreStellarParameters]:
     """
     Collect the results from FERRE and create database entries for the stellar parameter step.
 
     :param parent_dir:
         The parent directory where these FERRE executions were planned.
+
+    :param pwds: [optional]
+        Only collect results from these execution directories. If `None` (default), then results will
+        be collected from all executions in the stellar parameter stage.
     """
-    
-    for pwd in map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE)):
+
+    if pwds is None:
+        pwds = map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE))
+
+    for pwd in pwds:
         log.info("Post-processing FERRE results in {0}".format(pwd))
         for i, kwds in enumerate(post_process_ferre(pwd)):
             yield FerreStellarParameters(**kwds)
@@ -131,6 +140,7 @@ def plan_stellar_parameters(
     weight_path: Optional[str] = "$MWM_ASTRA/pipelines/aspcap/masks/global.mask",
     stellar_parameters_pre_continuum=MedianFilter,
     max_workers=64,
+    pwd_suffix: Optional[str] = "",
     **kwargs,
 ):
     """
@@ -144,7 +154,9 @@ def plan_stellar_parameters(
     
     :param parent_dir:
         The parent directory where these FERRE executions were planned.
-    
+
+    :param pwd_suffix: [optional]
+        A suffix to add to the execution directory names (e.g., to separate batches of spectra).
     """
 
     parent_dir = sanitise_parent_dir(parent_dir)
@@ -168,17 +180,15 @@ def plan_stellar_parameters(
 
     # TODO: Change FerreCoarse to store the given pwd, or the expand_path(pwd)?
 
-    q = (
-        FerreCoarse
-        .select()
-        .where(
-            (FerreCoarse.teff.is_null(False))
-        &   (FerreCoarse.logg.is_null(False))
-        &   (FerreCoarse.m_h.is_null(False))
-        &   (FerreCoarse.pwd.startswith(expand_path(parent_dir)))
-        &   (FerreCoarse.spectrum_pk << spectrum_pks)
-        )
+    is_complete = (
+        (FerreCoarse.teff.is_null(False))
+    &   (FerreCoarse.logg.is_null(False))
+    &   (FerreCoarse.m_h.is_null(False))
+    &   (FerreCoarse.pwd.startswith(expand_path(parent_dir)))
+    &   (FerreCoarse.spectrum_pk << spectrum_pks)
     )
+    # TODO: Should we do it based on other things?
+    is_failed = (FerreCoarse.flag_no_suitable_initial_guess | FerreCoarse.flag_spectrum_io_error)
     
     lookup_spectrum_by_id = { s.spectrum_pk: s for s in spectra }
 
@@ -190,36 +200,16 @@ def plan_stellar_parameters(
     else:
         pre_continuum = None
 
-    # Ensure only one result per spectrum ID first.
-    upstream_failed, coarse_results_dict = ([], {})
-    for r in q:
-        # TODO: Should we do it based on other things?
-        if r.flag_no_suitable_initial_guess or r.flag_spectrum_io_error:
-            upstream_failed.append(r)
-            continue
-
-        coarse_results_dict.setdefault(r.spectrum_pk, [])
-        coarse_results_dict[r.spectrum_pk].append(r)
-    
-    n_spectra_with_equally_good_results = 0
-    for spectrum_pk, coarse_results in coarse_results_dict.items():
-        # TODO: Should we do anything other than getting the minimum penalized rchi2?
-        penalized_rchi2 = np.array([r.penalized_rchi2 for r in coarse_results])
-        indices = np.argsort(penalized_rchi2)
+    upstream_failed = list(FerreCoarse.select().where(is_complete & is_failed))
 
-        if len(indices) > 1 and (penalized_rchi2[indices[0]] == penalized_rchi2[indices[1]]):
-            #log.warning(f"Multiple results for spectrum {spectrum_pk}: {penalized_rchi2[indices]}")
-            n_spectra_with_equally_good_results += 1
-
-        coarse_results_dict[spectrum_pk] = coarse_results[indices[0]]
-
-    if n_spectra_with_equally_good_results:
-        log.warning(f"There were {n_spectra_with_equally_good_results} spectra with multiple equally good results.")
+    # Ensure only one result per spectrum ID first.
+    # TODO: Should we do anything other than getting the minimum penalized rchi2?
+    coarse_results = list(stream_best_results(FerreCoarse, is_complete & ~is_failed))
 
     executor = concurrent.futures.ProcessPoolExecutor(max_workers)
 
     futures = []
-    for coarse_result in coarse_results_dict.values():
+    for coarse_result in coarse_results:
         spectrum = lookup_spectrum_by_id[coarse_result.spectrum_pk]
         futures.append(executor.submit(_pre_compute_continuum, coarse_result, spectrum, pre_continuum))
 
@@ -230,14 +220,14 @@ def plan_stellar_parameters(
             pre_computed_continuum[spectrum_pk] = continuum
             pb.update()
     
-    group_task_kwds = {}
-    for coarse_result in tqdm(coarse_results_dict.values(), desc="Grouping results"):
+    all_kwds = []
+    for coarse_result in tqdm(coarse_results, desc="Grouping results"):
 
-        group_task_kwds.setdefault(coarse_result.header_path, [])
         spectrum = lookup_spectrum_by_id[coarse_result.spectrum_pk]
 
-        group_task_kwds[coarse_result.header_path].append(
+        all_kwds.append(
             dict(
+                header_path=coarse_result.header_path,
                 spectra=spectrum,
                 pre_computed_continuum=pre_computed_continuum[spectrum.spectrum_pk],
                 initial_teff=coarse_result.teff,
@@ -253,22 +243,5 @@ def plan_stellar_parameters(
             )
         )
 
-    log.info(f"Grouping spectra..")
-
-    kwds_list = []
-    for header_path in group_task_kwds.keys():
-
-        short_grid_name = parse_header_path(header_path)["short_grid_name"]
-
-        pwd = os.path.join(parent_dir, STAGE, short_grid_name)
-
-        group_task_kwds[header_path] = list_to_dict(group_task_kwds[header_path])
-        group_task_kwds[header_path].update(
-            header_path=header_path,
-            weight_path=weight_path,
-            pwd=pwd,
-            **kwargs
-        )
-        kwds_list.append(group_task_kwds[header_path])
-
+    kwds_list = group_ferre_kwds_by_header_path(all_kwds, parent_dir, STAGE, pwd_suffix=pwd_suffix, weight_path=weight_path, **kwargs)
     return (kwds_list, upstream_failed)
@@ -0,0 +1,329 @@
+"""Run the ASPCAP stages as a pipeline, handing spectra downstream as soon as their upstream results are ready."""
+
+import os
+import numpy as np
+from glob import glob
+from time import sleep, time
+from typing import Optional, Iterable, List, Tuple, Callable, Union
+
+from astra.utils import log, expand_path
+from astra.utils.slurm import get_queue
+from astra.models.spectrum import Spectrum
+from astra.pipelines.ferre.operator import _load_balancer, FERRE_DONE_BASENAME
+from astra.pipelines.ferre.progress import FerreProgressTracker
+from astra.pipelines.ferre.utils import parse_ferre_spectrum_name
+from astra.pipelines.aspcap.utils import get_input_nml_paths
+from astra.pipelines.aspcap.coarse import (
+    STAGE as COARSE_STAGE, pre_coarse_stellar_parameters, post_coarse_stellar_parameters
+)
+from astra.pipelines.aspcap.stellar_parameters import (
+    STAGE as PARAMS_STAGE, pre_stellar_parameters, post_stellar_parameters
+)
+from astra.pipelines.aspcap.abundances import (
+    STAGE as ABUNDANCES_STAGE, pre_abundances, post_abundances
+)
+
+STAGES = (COARSE_STAGE, PARAMS_STAGE, ABUNDANCES_STAGE)
+
+
+def is_unit_complete(pwd):
+    """
+    Return whether FERRE (and all post-execution steps) have finished in an execution directory,
+    or in one partition of an execution directory.
+
+    :param pwd:
+        The execution (or partition) directory.
+    """
+    return os.path.exists(os.path.join(pwd, FERRE_DONE_BASENAME))
+
+
+def get_unit_directory(output_path):
+    """
+    Return the directory that FERRE is executed from, given the path of an output file.
+
+    Executions in list mode (e.g., abundances) write their outputs in one sub-directory per species,
+    but they are executed (and marked as done) from the parent directory.
+
+    :param output_path:
+        The path of a FERRE output file, as given in the executions from the load balancer.
+    """
+    pwd = os.path.dirname(output_path)
+    if os.path.exists(os.path.join(os.path.dirname(pwd), "input_list.nml")):
+        return os.path.dirname(pwd)
+    return pwd
+
+
+def read_spectrum_primary_keys(pwd):
+    """
+    Return the set of spectrum primary keys in an execution directory.
+
+    :param pwd:
+        The execution directory.
+    """
+    path = os.path.join(pwd, "parameter.input")
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return set()
+    names = np.atleast_1d(np.loadtxt(path, usecols=(0, ), dtype=str))
+    return set(parse_ferre_spectrum_name(name)["spectrum_pk"] for name in names)
+
+
+class _StageExecutions:
+
+    """
+    Track the FERRE executions of one stage.
+
+    Executions that were partitioned by the load balancer are tracked as one unit per partition,
+    so that the spectra in a partition can be handed to the next stage as soon as that partition
+    is finished, without waiting for the other partitions of the same execution.
+
+    :param stage:
+        The name of the stage.
+
+    :param timeout: [optional]
+        The time (in seconds) to wait for units without Slurm jobs (e.g., executed locally) when
+        none of them have written any output. After this, they are considered complete and whatever
+        results exist are collected. If `None`, wait forever.
+    """
+
+    def __init__(self, stage, timeout=None):
+        self.stage = stage
+        self.timeout = timeout
+        self.queue, self.running, self.finished, self.members, self.trackers, self.n_batches = ([], {}, [], {}, [], 0)
+        self._n_lines, self._last_progress = (0, time())
+
+
+    def launch(self, parent_dir, input_paths, operator_kwds=None):
+        """
+        Launch FERRE executions for the given input paths.
+
+        :returns:
+            A dictionary with the directory of each new unit (execution or partition) as keys, and
+            the set of spectrum primary keys in that unit as values.
+        """
+        self.n_batches += 1
+        kwds = dict(operator_kwds or {})
+        kwds.pop("input_nml_wildmask", None)
+        # Each batch needs its own directory for Slurm scripts, because they may still be running.
+        stage_dir = expand_path(f"{parent_dir}/{self.stage}/batch_{self.n_batches:0>2.0f}")
+        os.makedirs(stage_dir, exist_ok=True)
+
+        output = _load_balancer(stage_dir, input_paths, full_output=True, **kwds) if input_paths else None
+        job_ids, executions = output or ((), [])
+        units = self.track([os.path.dirname(p) for p in input_paths], job_ids, executions)
+        log.info(f"Launched {len(units)} {self.stage} executions (batch {self.n_batches}) with {len(job_ids)} Slurm jobs")
+        return units
+
+
+    def track(self, pwds, job_ids, executions):
+        """
+        Track the units of some executions that were launched by the load balancer.
+
+        :param pwds:
+            The execution directories that were given to the load balancer.
+
+        :param job_ids:
+            The Slurm job identifiers for these executions (empty if they were executed locally).
+
+        :param executions:
+            A list of `[output_path, n_input, n_done]` entries, as returned by the load balancer.
+
+        :returns:
+            A dictionary with the directory of each new unit as keys, and the set of spectrum primary
+            keys in that unit as values.
+        """
+        units = {}
+        for output_path, *_ in executions:
+            units.setdefault(get_unit_directory(output_path), None)
+        if executions:
+            self.trackers.append(FerreProgressTracker(executions))
+
+        # Executions that the load balancer did not launch (e.g., nothing to execute) are finished.
+        launched = set(units).union(map(os.path.dirname, units))
+        finished = [pwd for pwd in pwds if pwd not in launched]
+
+        for unit in units:
+            self.running[unit] = tuple(job_ids)
+        self.finished.extend(finished)
+        units.update(dict.fromkeys(finished))
+        for unit in units:
+            units[unit] = self.members[unit] = read_spectrum_primary_keys(unit)
+        self._last_progress = time()
+        return units
+
+
+    def _poll(self):
+        n_lines = 0
+        for tracker in self.trackers:
+            n_lines += sum(tracker.poll().values())
+        if n_lines != self._n_lines:
+            self._n_lines, self._last_progress = (n_lines, time())
+
+
+    def completed(self, queue=None):
+        """
+        Return the directories of units that have finished since the last check.
+
+        :param queue: [optional]
+            The Slurm queue. If given, units whose Slurm jobs are no longer in the queue are
+            considered complete, even if they did not finish cleanly.
+        """
+        self._poll()
+        completed, self.finished = (self.finished, [])
+        for pwd, job_ids in list(self.running.items()):
+            if is_unit_complete(pwd):
+                completed.append(pwd)
+            elif queue is not None and job_ids and not set(job_ids).intersection(queue):
+                log.warning(f"Slurm jobs {job_ids} for {pwd} are no longer in the queue. Collecting whatever results exist.")
+                completed.append(pwd)
+
+        local = [pwd for pwd, job_ids in self.running.items() if not job_ids and pwd not in completed]
+        if local and self.timeout is not None and (time() - self._last_progress) > self.timeout:
+            log.warning(
+                f"No {self.stage} output written for {self.timeout:.0f} s. Collecting whatever results exist "
+                f"for {len(local)} unfinished executions: {', '.join(local)}"
+            )
+            completed.extend(local)
+
+        if completed:
+            self._last_progress = time()
+        for pwd in completed:
+            self.running.pop(pwd, None)
+        return completed
+
+
+    def progress(self):
+        n_done, n_input = (0, 0)
+        for tracker in self.trackers:
+            for row in tracker.summary():
+                n_done += row["n_done"]
+                n_input += row["n_input"]
+        return (n_done, n_input)
+
+
+    @property
+    def idle(self):
+        return not self.running and not self.queue and not self.finished
+
+
+def stream_aspcap_stages(
+    spectra: Iterable[Spectrum],
+    parent_dir: str,
+    initial_guess_callable: Optional[Callable] = None,
+    header_paths: Optional[Union[List[str], Tuple[str], str]] = "$MWM_ASTRA/pipelines/aspcap/synspec_dr17_marcs_header_paths.list",
+    weight_path: Optional[str] = "$MWM_ASTRA/pipelines/aspcap/masks/global.mask",
+    element_weight_paths: str = "$MWM_ASTRA/pipelines/aspcap/masks/elements.list",
+    operator_kwds: Optional[dict] = None,
+    ferre_list_mode: Optional[bool] = False,
+    min_batch_size: Optional[int] = 1000,
+    refresh_interval: Optional[float] = 60,
+    timeout: Optional[float] = 3 * 3600,
+    **kwargs
+):
+    """
+    Run the coarse, stellar parameter, and abundance stages of ASPCAP as a pipeline.
+
+    Instead of waiting for every execution in one stage to finish before planning the next stage,
+    each partition of an execution is post-processed as soon as it finishes. A spectrum is queued
+    for the stellar parameter stage once all of its coarse partitions (one per suitable grid) have
+    finished, and for the abundance stage once its stellar parameter partition has finished. Queued
+    spectra are launched in batches of at least `min_batch_size`, or sooner if no more upstream work
+    remains.
+
+    :param spectra:
+        The spectra to analyze with ASPCAP.
+
+    :param parent_dir:
+        The parent directory where these FERRE executions will be planned.
+
+    :param ferre_list_mode: [optional]
+        Post-process abundances as if they were executed in FERRE list mode (see `post_abundances`).
+
+    :param min_batch_size: [optional]
+        The minimum number of queued spectra needed to launch a batch of executions while upstream
+        executions are still running. Every batch loads its grids again, so this should be large.
+
+    :param refresh_interval: [optional]
+        The time (in seconds) to wait between checking for finished executions.
+
+    :param timeout: [optional]
+        The time (in seconds) to wait for executions without Slurm jobs (e.g., when `max_nodes` is 0
+        in the `operator_kwds`) while none of them write any output. After this, whatever results
+        exist are collected. If `None`, wait forever. Executions with Slurm jobs are collected when
+        their jobs leave the queue.
+
+    See `astra.pipelines.aspcap.aspcap` for a description of the other parameters.
+
+    :returns:
+        A two-length tuple of the stellar parameter results and chemical abundance results.
+    """
+
+    spectra = list(spectra)
+    lookup_spectrum_by_pk = { s.spectrum_pk: s for s in spectra }
+
+    stages = { stage: _StageExecutions(stage, timeout=timeout) for stage in STAGES }
+    coarse, params, abundances = (stages[stage] for stage in STAGES)
+    stellar_parameter_results, chemical_abundance_results = ([], [])
+
+    # All the coarse executions are launched at once.
+    list(pre_coarse_stellar_parameters(spectra, parent_dir, initial_guess_callable, header_paths, weight_path, **kwargs))
+    input_paths = get_input_nml_paths(parent_dir, COARSE_STAGE)
+
+    # A spectrum can be analysed with many grids in the coarse stage, so we can only choose the best
+    # result when all of its coarse partitions are finished.
+    n_coarse_pending = {}
+    for spectrum_pks in coarse.launch(parent_dir, input_paths, operator_kwds).values():
+        for spectrum_pk in spectrum_pks:
+            n_coarse_pending[spectrum_pk] = n_coarse_pending.get(spectrum_pk, 0) + 1
+
+    while True:
+        queue = get_queue() if any(job_ids for s in stages.values() for job_ids in s.running.values()) else None
+
+        for pwd in coarse.completed(queue):
+            list(post_coarse_stellar_parameters(parent_dir, pwds=[pwd]))
+            for spectrum_pk in coarse.members.pop(pwd):
+                n_coarse_pending[spectrum_pk] -= 1
+                if n_coarse_pending[spectrum_pk] == 0:
+                    params.queue.append(lookup_spectrum_by_pk[spectrum_pk])
+
+        for pwd in params.completed(queue):
+            stellar_parameter_results.extend(post_stellar_parameters(parent_dir, pwds=[pwd]))
+            abundances.queue.extend(lookup_spectrum_by_pk[pk] for pk in params.members.pop(pwd))
+
+        for pwd in abundances.completed(queue):
+            abundances.members.pop(pwd, None)
+            species_pwds = [os.path.dirname(p) for p in glob(os.path.join(pwd, "*", "input.nml"))]
+            chemical_abundance_results.extend(
+                post_abundances(parent_dir, ferre_list_mode=ferre_list_mode, pwds=species_pwds)
+            )
+
+        # Launch any downstream batches that are ready.
+        upstream_idle = coarse.idle
+        if params.queue and (upstream_idle or len(params.queue) >= min_batch_size):
+            batch_spectra, params.queue = (params.queue, [])
+            pwd_suffix = f"_b{params.n_batches + 1:0>2.0f}"
+            stellar_parameter_results.extend(
+                pre_stellar_parameters(batch_spectra, parent_dir, weight_path, pwd_suffix=pwd_suffix, **kwargs)
+            )
+            input_paths = glob(expand_path(f"{parent_dir}/{PARAMS_STAGE}/*{pwd_suffix}/input.nml"))
+            params.launch(parent_dir, input_paths, operator_kwds)
+
+        upstream_idle = upstream_idle and params.idle
+        if abundances.queue and (upstream_idle or len(abundances.queue) >= min_batch_size):
+            batch_spectra, abundances.queue = (abundances.queue, [])
+            pwd_suffix = f"_b{abundances.n_batches + 1:0>2.0f}"
+            list(pre_abundances(batch_spectra, parent_dir, element_weight_paths, pwd_suffix=pwd_suffix, **kwargs))
+            input_paths = glob(expand_path(f"{parent_dir}/{ABUNDANCES_STAGE}/*{pwd_suffix}/input_list.nml"))
+            abundances.launch(parent_dir, input_paths, operator_kwds)
+
+        if all(s.idle for s in stages.values()):
+            break
+
+        summary = []
+        for stage, s in stages.items():
+            n_done, n_input = s.progress()
+            summary.append(f"{stage}: {len(s.running)} running, {len(s.queue)} queued, {n_done}/{n_input} spectra")
+        log.info("; ".join(summary))
+
+        sleep(refresh_interval)
+
+    return (stellar_parameter_results, chemical_abundance_results)
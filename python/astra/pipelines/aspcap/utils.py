@@ -2,6 +2,8 @@
 import numpy as np
 import os
 from glob import glob
+from uuid import uuid4
+from peewee import fn, PostgresqlDatabase, Tuple
 from astra.utils import log, expand_path
 from astra.pipelines.ferre.utils import parse_header_path
 
@@ -154,6 +156,229 @@ def get_input_nml_paths(parent_dir, stage):
     return glob(os.path.join(expand_path(parent_dir), stage, "*", "input.nml"))
 
 
+def group_ferre_kwds_by_header_path(all_kwds, parent_dir, stage, merge_keys=("frozen_parameters", "weight_path"), pwd_suffix="", **kwargs):
+    """
+    Merge planned FERRE keywords for individual spectra into as few FERRE executions as possible.
+
+    Every FERRE execution loads its entire grid into memory before analysing any spectra, so all
+    spectra that share a grid (header path) and compatible control settings are merged into one
+    execution. Spectra that share a header path but have incompatible settings (e.g., different
+    frozen parameters) are put in separate executions.
+
+    :param all_kwds:
+        A list of dictionaries, each with keywords for `pre_process_ferre` for one spectrum. Each
+        dictionary must have a `header_path` key. A dictionary can also describe many spectra as a
+        columnar table, where `spectra` is a list and every other keyword (except the `header_path`
+        and `merge_keys`) is a list or array of the same length.
+
+    :param parent_dir:
+        The parent directory of the FERRE executions.
+
+    :param stage:
+        The stage name (e.g., `coarse`), used to construct the execution directories.
+
+    :param merge_keys: [optional]
+        Keywords that must be equal for spectra to be merged into the same execution. These are
+        given as a single value (not a list) for each execution.
+
+    :param pwd_suffix: [optional]
+        A suffix to add to every execution directory name (e.g., to separate batches of spectra).
+
+    :param kwargs: [optional]
+        Additional keywords to include for every execution.
+
+    :returns:
+        A list of dictionaries that can be given to `pre_process_ferre`.
+    """
+    hashable = lambda v: tuple(sorted(v.items())) if isinstance(v, dict) else v
+
+    grouped_kwds, common = ({}, {})
+    for kwds in all_kwds:
+        kwds = kwds.copy()
+        header_path = kwds.pop("header_path")
+        settings = { k: kwds.pop(k) for k in merge_keys if k in kwds }
+        key = (header_path, tuple((k, hashable(v)) for k, v in settings.items()))
+        if not isinstance(kwds.get("spectra"), (list, tuple)):
+            kwds = { k: [v] for k, v in kwds.items() }
+        grouped_kwds.setdefault(key, [])
+        grouped_kwds[key].append(kwds)
+        common[key] = settings
+
+    n_per_header_path = {}
+    for header_path, _ in grouped_kwds.keys():
+        n_per_header_path[header_path] = n_per_header_path.get(header_path, 0) + 1
+
+    list_of_kwds, suffixes = ([], {})
+    for (header_path, settings), kwds in grouped_kwds.items():
+        short_grid_name = parse_header_path(header_path)["short_grid_name"]
+        if n_per_header_path[header_path] > 1:
+            suffixes[header_path] = suffixes.get(header_path, 0) + 1
+            if suffixes[header_path] == 1:
+                log.warning(
+                    f"Spectra planned for {header_path} have {n_per_header_path[header_path]} incompatible sets of "
+                    f"{', '.join(merge_keys)}, so the grid will be loaded {n_per_header_path[header_path]} times"
+                )
+            pwd = os.path.join(parent_dir, stage, f"{short_grid_name}_{suffixes[header_path]:0>2.0f}{pwd_suffix}")
+        else:
+            pwd = os.path.join(parent_dir, stage, f"{short_grid_name}{pwd_suffix}")
+
+        if len(kwds) == 1:
+            execution_kwds = kwds[0]
+        else:
+            execution_kwds = { k: [v for table in kwds for v in table[k]] for k in kwds[0] }
+        execution_kwds.update(common[(header_path, settings)])
+        execution_kwds.update(header_path=header_path, pwd=pwd)
+        execution_kwds.update(kwargs)
+        list_of_kwds.append(execution_kwds)
+
+    n_spectra = sum(len(execution_kwds["spectra"]) for execution_kwds in list_of_kwds)
+    log.info(f"Merged {n_spectra} planned spectra into {len(list_of_kwds)} FERRE executions using {len(n_per_header_path)} grids")
+    return list_of_kwds
+
+
+def select_best_results(model, where=None, order_by=None):
+    """
+    Return a query that selects the best result per spectrum, ordered by spectrum primary key.
+
+    With PostgreSQL this uses `DISTINCT ON (spectrum_pk)`, and otherwise it uses a window function.
+    The best result is the one with the lowest `penalized_rchi2`, and the most recent result is
+    taken if there are equally good results.
+
+    This query benefits from an index on `(spectrum_pk, penalized_rchi2)`.
+
+    :param model:
+        The FERRE result model (e.g., `FerreStellarParameters`).
+
+    :param where: [optional]
+        An expression to restrict the results that are considered.
+
+    :param order_by: [optional]
+        The ordering that decides the best result. Defaults to the lowest `penalized_rchi2`, then
+        the most recent result.
+    """
+    if order_by is None:
+        order_by = (model.penalized_rchi2.asc(nulls="LAST"), model.task_pk.desc())
+
+    if isinstance(model._meta.database, PostgresqlDatabase):
+        q = model.select().distinct(model.spectrum_pk)
+        if where is not None:
+            q = q.where(where)
+        return q.order_by(model.spectrum_pk, *order_by)
+
+    rank = fn.ROW_NUMBER().over(partition_by=[model.spectrum_pk], order_by=list(order_by))
+    ranked = model.select(model.task_pk, rank.alias("rank"))
+    if where is not None:
+        ranked = ranked.where(where)
+    ranked = ranked.alias("ranked")
+    return (
+        model
+        .select()
+        .join(ranked, on=(model.task_pk == ranked.c.task_pk))
+        .where(ranked.c.rank == 1)
+        .order_by(model.spectrum_pk)
+    )
+
+
+def count_duplicate_results(model, where=None):
+    """
+    Count the spectra with more than one result, and the spectra with more than one result that
+    has the lowest `penalized_rchi2`.
+
+    These are separate aggregate queries, so that `select_best_results` does not need to count
+    every partition of results.
+
+    :param model:
+        The FERRE result model (e.g., `FerreStellarParameters`).
+
+    :param where: [optional]
+        An expression to restrict the results that are considered.
+
+    :returns:
+        A two-length tuple of the number of spectra with duplicate results, and the number of
+        spectra with equally good best results.
+    """
+    def select(*columns):
+        q = model.select(*columns)
+        return q if where is None else q.where(where)
+
+    n_spectra_with_duplicates = (
+        select(model.spectrum_pk)
+        .group_by(model.spectrum_pk)
+        .having(fn.COUNT(model.task_pk) > 1)
+        .count()
+    )
+    if not n_spectra_with_duplicates:
+        return (0, 0)
+
+    best = (
+        select(model.spectrum_pk, fn.MIN(model.penalized_rchi2))
+        .group_by(model.spectrum_pk)
+    )
+    n_spectra_with_equally_good_results = (
+        select(model.spectrum_pk)
+        .where(Tuple(model.spectrum_pk, model.penalized_rchi2).in_(best))
+        .group_by(model.spectrum_pk)
+        .having(fn.COUNT(model.task_pk) > 1)
+        .count()
+    )
+    return (n_spectra_with_duplicates, n_spectra_with_equally_good_results)
+
+
+def stream_query(query, array_size=10_000):
+    """
+    Iterate over the results of a query without loading them all into memory at once.
+
+    With PostgreSQL this uses a server-side (named) cursor, so that rows are fetched in batches.
+
+    :param query:
+        A peewee query.
+
+    :param array_size: [optional]
+        The number of rows to fetch from a server-side cursor at a time.
+    """
+    database = query._database
+    if not isinstance(database, PostgresqlDatabase):
+        yield from query.iterator()
+        return
+
+    sql, params = query.sql()
+    # Named cursors only exist within a transaction.
+    with database.atomic():
+        cursor = database.connection().cursor(name=f"astra_{uuid4().hex}")
+        cursor.itersize = array_size
+        try:
+            cursor.execute(sql, params)
+            yield from query._get_cursor_wrapper(cursor).iterator()
+        finally:
+            cursor.close()
+
+
+def stream_best_results(model, where=None, order_by=None, **kwargs):
+    """
+    Stream the best result per spectrum (see `select_best_results`), and report any spectra with
+    duplicate results.
+
+    :param model:
+        The FERRE result model (e.g., `FerreStellarParameters`).
+
+    :param where: [optional]
+        An expression to restrict the results that are considered.
+
+    :param order_by: [optional]
+        The ordering that decides the best result.
+
+    :param kwargs: [optional]
+        Keyword arguments to pass to `stream_query`.
+    """
+    n_spectra_with_duplicates, n_spectra_with_equally_good_results = count_duplicate_results(model, where)
+    if n_spectra_with_duplicates:
+        log.warning(f"There were {n_spectra_with_duplicates} spectra with multiple results; using the best result for each.")
+    if n_spectra_with_equally_good_results:
+        log.warning(f"There were {n_spectra_with_equally_good_results} spectra with multiple equally good results; using the most recent.")
+
+    yield from stream_query(select_best_results(model, where, order_by), **kwargs)
+
+
 def get_species_label_references():
     species_label_reference = {}
     for species, controls in ABUNDANCE_CONTROLS.items():
@@ -333,6 +558,103 @@ def get_lsf_grid_name(fibre_number):
         return "a"
 
 
+def get_lsf_grid_names(fibre_numbers):
+    """
+    Return the appropriate LSF names (a, b, c, or d) to use, given an array of mean fiber numbers.
+
+    :param fibre_numbers:
+        An array of mean fiber numbers of observations.
+
+    :returns:
+        An array of one-length strings describing which LSF grid to use. The string is empty if
+        no LSF grid is appropriate (e.g., the fiber number is not finite).
+    """
+    fibre_numbers = np.round(np.asarray(fibre_numbers, dtype=float))
+    return np.select(
+        [
+            (50 >= fibre_numbers) & (fibre_numbers >= 1),
+            (145 >= fibre_numbers) & (fibre_numbers > 50),
+            (245 >= fibre_numbers) & (fibre_numbers > 145),
+            (300 >= fibre_numbers) & (fibre_numbers > 245),
+        ],
+        ["d", "c", "b", "a"],
+        default=""
+    )
+
+
+def get_grid_table(all_headers):
+    """
+    Return a columnar table of grid information that can be used by `get_suitable_grid_masks`.
+
+    :param all_headers:
+        A dictionary with header paths as keys, and grid headers as values.
+
+    :returns:
+        A dictionary with header paths, metadata, and lower and upper limits of (logg, teff).
+    """
+    header_paths = list(all_headers.keys())
+    meta = [parse_header_path(header_path) for header_path in header_paths]
+    return dict(
+        header_path=header_paths,
+        meta=meta,
+        lsf=np.array([m["lsf"] for m in meta]),
+        lsf_telescope_model=np.array([m["lsf_telescope_model"] for m in meta]),
+        lower_limits=np.array([all_headers[hp]["LLIMITS"][-2:] for hp in header_paths]),
+        upper_limits=np.array([all_headers[hp]["ULIMITS"][-2:] for hp in header_paths]),
+    )
+
+
+def get_suitable_grid_masks(grids, mean_fiber, teff, logg, telescope):
+    """
+    Return masks of suitable FERRE grids for many initial guesses.
+
+    This follows the same logic as `yield_suitable_grids`, for all initial guesses and grids at once.
+
+    :param grids:
+        A table of grid information, as returned by `get_grid_table`.
+
+    :param mean_fiber:
+        An array of mean fiber numbers of observations.
+
+    :param teff:
+        An array of initial guesses of the effective temperature.
+
+    :param logg:
+        An array of initial guesses of the surface gravity.
+
+    :param telescope:
+        An array of telescope names.
+
+    :returns:
+        A two-length tuple of boolean arrays of shape (N, G) for N initial guesses and G grids. The
+        first requires (logg, teff) to be within the grid limits (`strict=True`), and the second
+        only requires teff to be within the grid limits (`strict=False`).
+    """
+    teff, logg = (np.asarray(teff, dtype=float), np.asarray(logg, dtype=float))
+    telescope = np.asarray(telescope)[:, None]
+    lsf_grid = get_lsf_grid_names(mean_fiber)
+
+    lsf, lsf_telescope_model = (grids["lsf"][None], grids["lsf_telescope_model"][None])
+    is_match = (
+        # If it's the BA combo grid, don't worry about matching fiber and telescope LSF
+        np.char.startswith(lsf, "combo")
+    |   (
+            (lsf == lsf_grid[:, None])
+        &   (
+                (telescope == lsf_telescope_model)
+            |   ((telescope == "apo1m") & (lsf_telescope_model == "apo25m"))
+            )
+        )
+    )
+    is_match &= np.isfinite(np.asarray(mean_fiber, dtype=float))[:, None]
+
+    lower_limits, upper_limits = (grids["lower_limits"][None], grids["upper_limits"][None])
+    point = np.stack([logg, teff], axis=-1)[:, None]
+    strict = is_match & np.all((point >= lower_limits) & (point <= upper_limits), axis=-1)
+    loose = is_match & (upper_limits[..., -1] >= teff[:, None]) & (teff[:, None] >= lower_limits[..., -1])
+    return (strict, loose)
+
+
 
 
 def approximate_log10_microturbulence(log_g):
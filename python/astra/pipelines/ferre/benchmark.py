@@ -0,0 +1,336 @@
+"""Benchmark the FERRE orchestration (scheduling, monitoring, post-processing) with `ferre_sim`."""
+
+import os
+import json
+import shutil
+import numpy as np
+from glob import glob
+from time import time
+
+from astra.utils import log, expand_path
+from astra.pipelines.ferre.utils import (
+    validate_ferre_control_keywords,
+    format_ferre_control_keywords,
+    format_ferre_input_parameters,
+    get_ferre_spectrum_name,
+)
+
+# A seven-dimensional grid that looks like the GK giant grids, with three segments like APOGEE.
+SYNTHETIC_GRID_LABELS = ("LOG10VDOP", "O Mg Si S Ca Ti", "C", "N", "METALS", "LOGG", "TEFF")
+SYNTHETIC_GRID_LLIMITS = (-0.301, -0.75, -1.5, -0.5, -2.5, 0.0, 3500.0)
+SYNTHETIC_GRID_STEPS = (0.301, 0.25, 0.5, 0.5, 0.25, 0.5, 250.0)
+SYNTHETIC_GRID_N_P = (4, 7, 7, 5, 13, 9, 11)
+SYNTHETIC_GRID_SEGMENT_PIXELS = (3028, 2495, 1991)
+
+
+def write_synthetic_grid_header(dir, short_grid_name="sgGK"):
+    """
+    Write a FERRE grid header (without any grid) that can be read by `read_ferre_headers` and
+    parsed by `parse_header_path`.
+
+    :param dir:
+        The directory to create the header path within.
+
+    :param short_grid_name: [optional]
+        The short grid name, which is used by the load balancer to predict execution times.
+
+    :returns:
+        The path of the header file.
+    """
+    folder = f"{short_grid_name}_200921nlte_lsfc"
+    header_path = expand_path(
+        f"{dir}/synspec/marcs/solarisotopes/{folder}/p_ap{short_grid_name}_200921nlte_lsfc_012_075.hdr"
+    )
+    os.makedirs(os.path.dirname(header_path), exist_ok=True)
+
+    fmt = lambda values: " ".join(map(str, values))
+    grid = [
+        f" N_OF_DIM = {len(SYNTHETIC_GRID_LABELS)}",
+        f" N_P = {fmt(SYNTHETIC_GRID_N_P)}",
+    ]
+    grid.extend([f" LABEL({i}) = '{label}'" for i, label in enumerate(SYNTHETIC_GRID_LABELS, start=1)])
+    grid.extend([
+        f" LLIMITS = {fmt(map(float, SYNTHETIC_GRID_LLIMITS))}",
+        f" STEPS = {fmt(map(float, SYNTHETIC_GRID_STEPS))}",
+    ])
+    contents = [" &SYNTH"] + grid + [
+        f" NPIX = {sum(SYNTHETIC_GRID_SEGMENT_PIXELS)}",
+        f" MULTI = {len(SYNTHETIC_GRID_SEGMENT_PIXELS)}",
+        " /",
+    ]
+    log10_wl_start = (4.180476, 4.200510, 4.217064)
+    for start, n_pixels in zip(log10_wl_start, SYNTHETIC_GRID_SEGMENT_PIXELS):
+        contents.extend([" &SYNTH"] + grid + [
+            f" NPIX = {n_pixels}",
+            f" WAVE = {start} 6.0e-06",
+            f" LOGW = 1",
+            " /",
+        ])
+    with open(header_path, "w") as fp:
+        fp.write("\n".join(contents) + "\n")
+    return header_path
+
+
+def create_synthetic_stage(
+    stage_dir,
+    header_path,
+    n_executions=4,
+    n_spectra=100,
+    n_threads=4,
+    frozen_parameters=None,
+    seed=0,
+):
+    """
+    Create FERRE-executable directories with synthetic spectra, as `pre_process_ferre` would.
+
+    :param stage_dir:
+        The stage directory (e.g., `~/benchmark/coarse`).
+
+    :param header_path:
+        The path of a FERRE grid header (see `write_synthetic_grid_header`).
+
+    :param n_executions: [optional]
+        The number of executions to create.
+
+    :param n_spectra: [optional]
+        The number of spectra per execution. This can be an integer or a list of integers.
+
+    :param n_threads: [optional]
+        The number of FERRE threads to request.
+
+    :param frozen_parameters: [optional]
+        A dictionary of frozen parameters, as per `validate_ferre_control_keywords`.
+
+    :param seed: [optional]
+        A seed for the random number generator.
+
+    :returns:
+        A list of execution directories.
+    """
+    rng = np.random.default_rng(seed)
+    stage_dir = expand_path(stage_dir)
+    n_spectra = np.atleast_1d(n_spectra)
+    if n_spectra.size == 1:
+        n_spectra = np.repeat(n_spectra, n_executions)
+
+    weight_path = os.path.join(stage_dir, "global.mask")
+    os.makedirs(stage_dir, exist_ok=True)
+    P = sum(SYNTHETIC_GRID_SEGMENT_PIXELS)
+    np.savetxt(weight_path, np.ones(P), fmt="%.1f")
+
+    control_kwds, headers, *_ = validate_ferre_control_keywords(
+        header_path,
+        frozen_parameters=frozen_parameters,
+        weight_path=weight_path,
+        n_threads=n_threads,
+    )
+    lower_limits, upper_limits = (headers["LLIMITS"], headers["ULIMITS"])
+
+    pwds, spectrum_pk = ([], 0)
+    for k, N in enumerate(n_spectra):
+        pwd = os.path.join(stage_dir, f"execution_{k:0>3.0f}")
+        os.makedirs(pwd, exist_ok=True)
+        with open(os.path.join(pwd, "input.nml"), "w") as fp:
+            fp.write(format_ferre_control_keywords(control_kwds))
+
+        initial_parameters = rng.uniform(
+            lower_limits + 0.1 * (upper_limits - lower_limits),
+            upper_limits - 0.1 * (upper_limits - lower_limits),
+            size=(N, lower_limits.size)
+        )
+        with open(os.path.join(pwd, "parameter.input"), "w") as fp:
+            for index, point in enumerate(initial_parameters):
+                spectrum_pk += 1
+                name = get_ferre_spectrum_name(index, spectrum_pk, spectrum_pk, 0, 0)
+                fp.write(format_ferre_input_parameters(*point, name=name))
+
+        flux = 1 + 0.01 * rng.normal(size=(N, P))
+        e_flux = 0.01 * np.ones((N, P))
+        np.savetxt(os.path.join(pwd, "flux.input"), flux, fmt="%.4e")
+        np.savetxt(os.path.join(pwd, "e_flux.input"), e_flux, fmt="%.4e")
+        pwds.append(pwd)
+
+    return pwds
+
+
+def install_ferre_simulator(bin_dir, **kwargs):
+    """
+    Put `ferre_sim` on the PATH as `ferre.x`, so that the load balancer and chaos monkey use it.
+
+    :param bin_dir:
+        A directory to create the `ferre.x` link within. This will be prepended to `$PATH`.
+
+    :param kwargs: [optional]
+        Keyword arguments to pass to the simulator (e.g., `time_scale=0.01`). These are set as
+        environment variables so that they are inherited by any process that calls `ferre.x`.
+    """
+    ferre_sim_path = shutil.which("ferre_sim")
+    if ferre_sim_path is None:
+        raise RuntimeError("Cannot find `ferre_sim` on the PATH")
+
+    bin_dir = expand_path(bin_dir)
+    os.makedirs(bin_dir, exist_ok=True)
+    ferre_x_path = os.path.join(bin_dir, "ferre.x")
+    if os.path.lexists(ferre_x_path):
+        os.unlink(ferre_x_path)
+    # A link (rather than a wrapper script) keeps `ferre.x` in the command line, so `pidof -x` finds it.
+    os.symlink(ferre_sim_path, ferre_x_path)
+
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    for key, value in kwargs.items():
+        if value is not None:
+            os.environ[f"FERRE_SIM_{key.upper()}"] = str(value)
+    return ferre_x_path
+
+
+def _wait_for_child_processes():
+    while True:
+        try:
+            os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+
+
+def benchmark_execution(stage_dir, show_progress=False, **kwargs):
+    """
+    Time the planning (load balancing), execution and monitoring of all FERRE executions in a stage.
+
+    This must be run after `install_ferre_simulator`, unless you want to run FERRE.
+
+    :param stage_dir:
+        The stage directory.
+
+    :param show_progress: [optional]
+        Show a progress bar while monitoring.
+
+    :param kwargs: [optional]
+        Keyword arguments to pass to `_load_balancer`.
+
+    :returns:
+        A dictionary of timings (in seconds).
+    """
+    from astra.pipelines.ferre.operator import _load_balancer, monitor
+
+    stage_dir = expand_path(stage_dir)
+    input_nml_paths = glob(os.path.join(stage_dir, "*/input.nml"))
+
+    kwds = dict(max_nodes=0, chaos_monkey=False, full_output=True)
+    kwds.update(kwargs)
+
+    t_start = time()
+    job_ids, executions = _load_balancer(stage_dir, input_nml_paths, **kwds)
+    t_planned = time()
+    monitor(job_ids, executions, show_progress=show_progress, refresh_interval=1)
+    t_monitored = time()
+    # Wait for the post-execution steps (timing, interpolation, merging partitions).
+    _wait_for_child_processes()
+    t_complete = time()
+
+    return dict(
+        n_executions=len(executions),
+        n_spectra=int(sum(n for _, n, *_ in executions)),
+        t_plan=t_planned - t_start,
+        t_monitor=t_monitored - t_planned,
+        t_execute=t_complete - t_planned,
+    )
+
+
+def benchmark_post_process(stage_dir, skip_pixel_arrays=False):
+    """
+    Time the post-processing of all FERRE executions in a stage.
+
+    :param stage_dir:
+        The stage directory.
+
+    :param skip_pixel_arrays: [optional]
+        Skip loading pixel arrays.
+
+    :returns:
+        A dictionary of timings (in seconds).
+    """
+    from astra.pipelines.ferre.post_process import post_process_ferre
+
+    stage_dir = expand_path(stage_dir)
+    t_start, n_results, n_failed = (time(), 0, 0)
+    for input_nml_path in glob(os.path.join(stage_dir, "*/input.nml")):
+        for result in post_process_ferre(os.path.dirname(input_nml_path), skip_pixel_arrays=skip_pixel_arrays):
+            n_results += 1
+            n_failed += int(result["flag_ferre_fail"] or result["flag_potential_ferre_timeout"])
+
+    t_post_process = time() - t_start
+    return dict(
+        n_results=n_results,
+        n_failed=n_failed,
+        t_post_process=t_post_process,
+        t_post_process_per_result=t_post_process / max(n_results, 1),
+    )
+
+
+def run_benchmark(
+    dir,
+    n_executions=4,
+    n_spectra=100,
+    n_threads=4,
+    seed=0,
+    load_balancer_kwds=None,
+    **simulator_kwds
+):
+    """
+    Create a synthetic stage, execute it with `ferre_sim`, and post-process the results.
+
+    :param dir:
+        A directory to run the benchmark in. This will be created if it does not exist.
+
+    :param simulator_kwds: [optional]
+        Keyword arguments for `ferre_sim` (e.g., `time_scale`, `t_load`, `failure_rate`).
+
+    :returns:
+        A dictionary of benchmark results.
+    """
+    dir = expand_path(dir)
+    header_path = write_synthetic_grid_header(f"{dir}/grids")
+    stage_dir = f"{dir}/coarse"
+    if os.path.exists(stage_dir):
+        shutil.rmtree(stage_dir)
+
+    t_start = time()
+    create_synthetic_stage(stage_dir, header_path, n_executions, n_spectra, n_threads, seed=seed)
+    t_create = time() - t_start
+
+    simulator_kwds.setdefault("seed", seed)
+    install_ferre_simulator(f"{dir}/bin", **simulator_kwds)
+
+    results = dict(t_create=t_create)
+    results.update(benchmark_execution(stage_dir, **(load_balancer_kwds or {})))
+    results.update(benchmark_post_process(stage_dir))
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Compare benchmark results to a baseline and return any timings that have regressed.
+
+    :param results:
+        A dictionary of benchmark results.
+
+    :param baseline:
+        A dictionary of baseline benchmark results, or a path to a JSON file containing them.
+
+    :param tolerance: [optional]
+        The fractional increase in time that is considered a regression.
+
+    :returns:
+        A dictionary of regressed timings, with keys as the timing name and values as a two-length
+        tuple of the (baseline, result) times.
+    """
+    if isinstance(baseline, str):
+        with open(expand_path(baseline), "r") as fp:
+            baseline = json.load(fp)
+
+    regressions = {}
+    for key, value in results.items():
+        if not key.startswith("t_") or key not in baseline:
+            continue
+        if value > (1 + tolerance) * baseline[key]:
+            regressions[key] = (baseline[key], value)
+    return regressions
@@ -11,6 +11,7 @@ from tqdm import tqdm
 from astra.utils import log, expand_path, flatten
 from astra.utils.slurm import SlurmJob, SlurmTask, get_queue
 from astra.pipelines.ferre.utils import parse_control_kwds, wc, read_ferre_headers, format_ferre_input_parameters, execute_ferre
+from astra.pipelines.ferre.progress import FerreProgressTracker
 from shutil import copyfile
 from peewee import chunked
 
@@ -21,6 +22,9 @@ DEFAULT_SLURM_KWDS = dict(
     mem=256_000, # needed to be able to do `srun`
 )
 
+# Written to an execution directory once FERRE and all post-execution steps have finished.
+FERRE_DONE_BASENAME = "done"
+
 def update_control_kwds(input_nml_path, key, value):
     path = expand_path(input_nml_path)
     with open(path, "r") as fp:
@@ -108,7 +112,8 @@ def has_partial_results(pwd, control_kwds=None):
         "stderr",
         control_kwds["OPFILE"],
         control_kwds["OFFILE"],
-        control_kwds["SFFILE"]
+        control_kwds["SFFILE"],
+        FERRE_DONE_BASENAME,
     ]
     
     paths = [f"{pwd}/{basename}" for basename in check_basenames]
@@ -144,6 +149,181 @@ def partition_items(items, K, return_indices=False):
 
 
 
+def co_schedule_items(items, groups, n_nodes, max_tasks_per_node, tolerance=0.1):
+    """
+    Partition items into nodes (and tasks within each node) such that items from the same group
+    are placed on the same node wherever that does not unbalance the nodes.
+
+    FERRE executions (or partitions of executions) that use the same grid will share the operating
+    system page cache when they run on the same node, so the grid is only read from disk once
+    per node.
+
+    :param items:
+        An array of the estimated cost (e.g., core-seconds) of each item.
+
+    :param groups:
+        A list of the same length as `items`, giving the group (e.g., grid) of each item.
+
+    :param n_nodes:
+        The number of nodes to partition items into.
+
+    :param max_tasks_per_node:
+        The maximum number of tasks per node.
+
+    :param tolerance: [optional]
+        The fractional amount that a node can exceed the mean cost per node, if doing so keeps an
+        item on a node that already has items from the same group.
+
+    :returns:
+        A list (one per node) of lists (one per task) of item indices.
+    """
+    items = np.array(items)
+    target = (1 + tolerance) * np.sum(items) / n_nodes
+
+    group_indices = {}
+    for index, group in enumerate(groups):
+        group_indices.setdefault(group, [])
+        group_indices[group].append(index)
+
+    # Most expensive groups first, and the most expensive items within each group first.
+    ordered_groups = sorted(group_indices, key=lambda g: -np.sum(items[group_indices[g]]))
+
+    node_costs = np.zeros(n_nodes)
+    node_items = [[] for _ in range(n_nodes)]
+    node_groups = [set() for _ in range(n_nodes)]
+    for group in ordered_groups:
+        for index in sorted(group_indices[group], key=lambda i: -items[i]):
+            candidates = [n for n in range(n_nodes) if group in node_groups[n] and (node_costs[n] + items[index]) <= target]
+            if candidates:
+                node_index = candidates[np.argmin(node_costs[candidates])]
+            else:
+                node_index = np.argmin(node_costs)
+            node_costs[node_index] += items[index]
+            node_items[node_index].append(index)
+            node_groups[node_index].add(group)
+
+    chunks = []
+    for indices in node_items:
+        if not indices:
+            continue
+        task_indices = partition_items(items[indices], max_tasks_per_node, return_indices=True)
+        chunks.append([np.array(indices)[ti] for ti in task_indices])
+    return chunks
+
+
+def count_grid_loads(chunks, groups):
+    """
+    Count the number of times grids will be read from disk, assuming that executions of the same
+    grid on the same node share the page cache.
+
+    :param chunks:
+        A list (one per node) of lists (one per task) of item indices.
+
+    :param groups:
+        A list giving the group (e.g., grid) of each item.
+
+    :returns:
+        A two-length tuple of the number of grid loads from disk, and the total number of grid loads.
+    """
+    n_disk, n_total = (0, 0)
+    for node_indices in chunks:
+        node_groups = [groups[index] for index in flatten(node_indices)]
+        n_disk += len(set(node_groups))
+        n_total += len(node_groups)
+    return (n_disk, n_total)
+
+
+def schedule_executions(
+    core_seconds,
+    grids,
+    nodes,
+    max_nodes,
+    max_tasks_per_node,
+    balance_threads=False,
+    co_schedule_grids=False,
+    t_load_estimate=300,
+):
+    """
+    Assign FERRE executions to nodes, and to tasks within each node.
+
+    :param core_seconds:
+        An array of the estimated core-seconds of each execution.
+
+    :param grids:
+        A list of the same length as `core_seconds`, giving the grid used by each execution.
+
+    :param nodes:
+        The number of nodes to use, unless `balance_threads` is set.
+
+    :param max_nodes:
+        The maximum number of nodes to use when `balance_threads` is set (0 for no limit).
+
+    :param max_tasks_per_node:
+        The maximum number of tasks per node.
+
+    :param balance_threads: [optional]
+        Choose the number of nodes from the longest execution, so that the number of threads per
+        task can be balanced by the estimated cost of each task.
+
+    :param co_schedule_grids: [optional]
+        Place executions that use the same grid on the same node (see `co_schedule_items`). This
+        uses the same number of nodes that would otherwise be used.
+
+    :param t_load_estimate: [optional]
+        The estimated time to load a grid, only used to report the savings from co-scheduling.
+
+    :returns:
+        A list (one per node) of lists (one per task) of execution indices.
+    """
+    core_seconds = np.array(core_seconds)
+    if balance_threads:
+        longest_job_index = np.argmax(core_seconds)
+        fractional_core_seconds = core_seconds / np.sum(core_seconds)
+        n_nodes = int(np.ceil(1/fractional_core_seconds[longest_job_index]))
+        if max_nodes > 0:
+            n_nodes = min(max_nodes, n_nodes)
+
+        node_indices = partition_items(
+            core_seconds,
+            n_nodes,
+            return_indices=True
+        )
+        # Now sort each node chunk into tasks.
+        chunks = []
+        for node_index in node_indices:
+            task_indices = partition_items(
+                core_seconds[node_index],
+                max_tasks_per_node,
+                return_indices=True
+            )
+            chunks.append([])
+            for task_index in task_indices:
+                chunks[-1].append(np.array(node_index)[task_index])
+
+    else:
+        n_nodes = nodes
+        chunks = list(chunked(
+            partition_items(
+                core_seconds, 
+                nodes * max_tasks_per_node, 
+                return_indices=True,
+            ),
+            max_tasks_per_node
+        ))
+
+    if co_schedule_grids:
+        default_chunks, chunks = (chunks, co_schedule_items(core_seconds, grids, n_nodes, max_tasks_per_node))
+
+        n_default, n_total = count_grid_loads(default_chunks, grids)
+        n_co_scheduled, n_total = count_grid_loads(chunks, grids)
+        log.info(
+            f"Co-scheduling grids: {n_co_scheduled} grid loads from disk instead of {n_default} "
+            f"({n_total} executions), saving an estimated {(n_default - n_co_scheduled) * t_load_estimate / 60:.0f} min of grid loading"
+        )
+
+    return chunks
+
+
 def post_execution_interpolation(pwd, n_threads=128, f_access=1, epsilon=0.001):
     """
     Run a single FERRE process to perform post-execution interpolation of model grids.
@@ -289,7 +469,8 @@ def load_balance(
     t_load_estimate=300, # 5 minutes est to load grid
     chaos_monkey=True,
     full_output=False,
-    experimental_abundances=False
+    experimental_abundances=False,
+    co_schedule_grids=False,
 ):
     
     slurm_kwds = slurm_kwds or DEFAULT_SLURM_KWDS
@@ -310,7 +491,8 @@ def load_balancer(
     t_load_estimate=300, # 5 minutes est to load grid
     chaos_monkey=True,
     full_output=False,
-    experimental_abundances=False
+    experimental_abundances=False,
+    co_schedule_grids=False,
 ):
     stage_dir = expand_path(stage_dir)
 
@@ -337,7 +519,8 @@ def load_balancer(
         t_load_estimate=t_load_estimate,
         chaos_monkey=chaos_monkey,
         full_output=full_output,
-        experimental_abundances=experimental_abundances
+        experimental_abundances=experimental_abundances,
+        co_schedule_grids=co_schedule_grids,
     )
     
 
@@ -357,7 +540,8 @@ def _load_balancer(
     t_load_estimate=300, # 5 minutes est to load grid
     chaos_monkey=True,
     full_output=False,
-    experimental_abundances=False
+    experimental_abundances=False,
+    co_schedule_grids=False,
 ):
 
     slurm_kwds = slurm_kwds or DEFAULT_SLURM_KWDS
@@ -369,7 +553,7 @@ def _load_balancer(
 
     is_input_list = lambda p: os.path.basename(p).lower().startswith("input_list")
 
-    input_paths, spectra, core_seconds = ([], [], [])
+    input_paths, spectra, core_seconds, grids = ([], [], [], [])
     for input_path in input_nml_paths:
 
         if is_input_list(input_path):
@@ -418,6 +602,7 @@ def _load_balancer(
             t = predict_ferre_core_time(grid, N, nov)
         
         input_paths.append(input_path)
+        grids.append(synthfile)
         spectra.append(N)
         # Set the grid load time as a minimum estimate so that we don't get all small jobs partitioned to one node
         core_seconds.append(max(t, t_load_estimate))
@@ -443,13 +628,14 @@ def _load_balancer(
     log.info(f"Found {total_spectra} spectra total for {nodes} nodes ({core_seconds_per_task/60:.0f} min/task)")
 
     
-    parent_partitions, partitioned_input_paths, partitioned_core_seconds = ({}, [], [])
-    for n_tasks, input_path, n_spectra, n_core_seconds in zip(tasks_needed, input_paths, spectra, core_seconds):
+    parent_partitions, partitioned_input_paths, partitioned_core_seconds, partitioned_grids = ({}, [], [], [])
+    for n_tasks, input_path, n_spectra, n_core_seconds, grid in zip(tasks_needed, input_paths, spectra, core_seconds, grids):
 
         if not partition or n_tasks == 1 or is_input_list(input_path): # don't partition the abundances.. too complex
             log.info(f"Keeping FERRE job in {input_path} (with {n_spectra} spectra) as is")
             partitioned_input_paths.append(input_path)
             partitioned_core_seconds.append(n_core_seconds)
+            partitioned_grids.append(grid)
 
         else:
             # This is where we check if we can split by spectra, or just split by input nml files for abundances
@@ -486,43 +672,21 @@ def _load_balancer(
                 parent_partitions[pwd].append(partitioned_pwd)
                 partitioned_input_paths.append(partitioned_input_path)
                 partitioned_core_seconds.append(f * n_core_seconds)
+                partitioned_grids.append(grid)
     
     # Partition by tasks, but chunk by node.
     partitioned_core_seconds = np.array(partitioned_core_seconds)        
     
-    if balance_threads:
-        longest_job_index = np.argmax(partitioned_core_seconds)
-        fractional_core_seconds = partitioned_core_seconds / np.sum(partitioned_core_seconds)
-        use_n_nodes = int(np.ceil(1/fractional_core_seconds[longest_job_index]))
-        if max_nodes > 0:
-            use_n_nodes = min(max_nodes, use_n_nodes)
-
-        node_indices = partition_items(
-            partitioned_core_seconds,
-            use_n_nodes,
-            return_indices=True
-        )
-        # Now sort each node chunk into tasks.
-        chunks = []
-        for node_index in node_indices:
-            task_indices = partition_items(
-                partitioned_core_seconds[node_index],
-                max_tasks_per_node,
-                return_indices=True
-            )
-            chunks.append([])
-            for task_index in task_indices:
-                chunks[-1].append(np.array(node_index)[task_index])
-
-    else:
-        chunks = chunked(
-            partition_items(
-                partitioned_core_seconds, 
-                nodes * max_tasks_per_node, 
-                return_indices=True,
-            ),
-            max_tasks_per_node
-        )
+    chunks = schedule_executions(
+        partitioned_core_seconds,
+        partitioned_grids,
+        nodes,
+        max_nodes,
+        max_tasks_per_node,
+        balance_threads=balance_threads,
+        co_schedule_grids=co_schedule_grids,
+        t_load_estimate=t_load_estimate
+    )
 
     # For merging partitions afterwards
     partitioned_pwds = flatten(parent_partitions.values())
@@ -618,6 +782,8 @@ def _load_balancer(
                     for basename in output_basenames:
                         execution_commands.append(f"cat {cwd}/{basename} >> {parent_dir}/{basename}")
 
+                execution_commands.append(f"touch {cwd}/{FERRE_DONE_BASENAME}")
+
                 for command in execution_commands:
                     log.info(f"    {i}.{j}.{k}: {command}")
                 task_commands.extend(execution_commands)
@@ -669,7 +835,7 @@ def _load_balancer(
     for i, slurm_job in enumerate(slurm_jobs, start=1):
         slurm_path = slurm_job.write()
         if max_nodes == 0:
-            pid = Popen(["sh", slurm_path])
+            pid = Popen(["bash", slurm_path])
             log.info(f"Started job {i} (process={pid}) at {slurm_path}")
         else:
             output = check_output(["sbatch", slurm_path]).decode("ascii")
@@ -704,9 +870,16 @@ def monitor(
         n_spectra += e[1]
         log.info(f"\t{os.path.dirname(e[0])}")
 
+    # Only read what has been appended to each output file since the last check.
+    tracker = FerreProgressTracker(executions)
+
     n_executions_done, last_updated = (0, time())
-    desc = lambda n_executions_done, n_executions, last_updated: f"FERRE ({n_executions_done}/{n_executions}; {(time() - last_updated)/60:.0f} min ago)"
+    def desc(n_executions_done, n_executions, last_updated):
+        eta = tracker.max_eta(exclude=dead_processes)
+        eta_str = f"; ETA {eta/60:.0f} min" if np.isfinite(eta) else ""
+        return f"FERRE ({n_executions_done}/{n_executions}; {(time() - last_updated)/60:.0f} min ago{eta_str})"
 
+    dead_processes, warn_on_dead_processes, chaos_monkey_processes = ([], [], {})
     tqdm_kwds = dict(
         desc=desc(n_executions_done, n_executions, last_updated),
         total=n_spectra, 
@@ -718,7 +891,6 @@ def monitor(
 
     # Get a parent folder from the executions so that we can put the FERRE chaos monkey logs somewhere.
 
-    dead_processes, warn_on_dead_processes, chaos_monkey_processes = ([], [], {})
     with tqdm(**tqdm_kwds) as pb:
         while True:
             
@@ -744,15 +916,13 @@ def monitor(
                             )                        
             
             n_done_this_iteration = 0
+            n_done_by_output_path = tracker.poll(exclude=dead_processes)
             for i, (output_path, n_input, n_done) in enumerate(executions):
                 if n_done >= n_input or output_path in dead_processes:
                     continue
                 
                 absolute_path = expand_path(output_path)
-                if os.path.exists(absolute_path):
-                    n_now_done = wc(absolute_path)
-                else:
-                    n_now_done = 0
+                n_now_done = n_done_by_output_path[output_path]
                 n_new = n_now_done - n_done
                 n_done_this_iteration += n_new
                 
@@ -846,6 +1016,7 @@ class FerreOperator:
         max_nodes=0,
         max_tasks_per_node=4,
         cpus_per_node=128,
+        co_schedule_grids=False,
     ):
         """
         :param stage_dir:
@@ -873,6 +1044,12 @@ class FerreOperator:
             are very small executions and the rest are very large, then this operator might send 4 of those
             small processes to one node, each with `n_threads` threads, and the other 9 processes to the
             other 9 nodes, where the number of threads requested will be adjusted to 32 * 4.
+
+        :param co_schedule_grids: [optional]
+            Place executions (and partitions of executions) that use the same grid on the same node,
+            so that the grid is only read from disk once per node and is then shared through the
+            page cache. This can be combined with `balance_threads`, in which case the executions
+            are co-scheduled over the number of nodes chosen by thread balancing.
         """
 
         self.n_threads = int(n_threads)
@@ -886,6 +1063,7 @@ class FerreOperator:
         self.slurm_kwds = slurm_kwds or DEFAULT_SLURM_KWDS
 
         self.input_nml_wildmask = input_nml_wildmask
+        self.co_schedule_grids = co_schedule_grids
         return None
 
 
@@ -901,6 +1079,7 @@ class FerreOperator:
             max_nodes=self.max_nodes,
             max_tasks_per_node=self.max_tasks_per_node,
             cpus_per_node=self.cpus_per_node,
+            co_schedule_grids=self.co_schedule_grids,
             full_output=True         
         )
 
@@ -54,6 +54,7 @@ def pre_process_ferre(
     min_sigma_value: float = 0.05,
     spike_threshold_to_inflate_uncertainty: float = 3,
     reference_pixel_arrays_for_abundance_run=False,
+    reference_input_parameters_for_abundance_run=False,
     write_input_pixel_arrays=True,
     **kwargs
 ):
@@ -95,7 +96,11 @@ def pre_process_ferre(
 
     if reference_pixel_arrays_for_abundance_run:
         prefix = os.path.basename(pwd.rstrip("/")) + "/"
-        for key in ("pfile", "opfile", "offile", "sffile"):
+        keys = ("opfile", "offile", "sffile")
+        if not reference_input_parameters_for_abundance_run:
+            # Otherwise, the input parameter file is shared by all abundance runs with this grid.
+            keys += ("pfile", )
+        for key in keys:
             control_kwds[key] = prefix + control_kwds[key]
 
     absolute_pwd = expand_path(pwd)
@@ -202,10 +207,17 @@ def pre_process_ferre(
         fp.write(control_kwds_formatted)       
 
     # hack: we do basename here in case we wrote the prefix to PFILE for the abundances run
-    log.info(f"Writing input parameters")
-    with open(os.path.join(absolute_pwd, os.path.basename(control_kwds["pfile"])), "w") as fp:
-        for name, point in zip(batch_names, batch_initial_parameters_array):
-            fp.write(utils.format_ferre_input_parameters(*point, name=name))
+    if reference_input_parameters_for_abundance_run:
+        # Like the pixel arrays, the shared input parameters are only written on the first run of this grid.
+        pfile_path = os.path.join(absolute_pwd, "../", control_kwds["pfile"]) if write_input_pixel_arrays else None
+    else:
+        pfile_path = os.path.join(absolute_pwd, os.path.basename(control_kwds["pfile"]))
+
+    if pfile_path is not None:
+        log.info(f"Writing input parameters")
+        with open(pfile_path, "w") as fp:
+            for name, point in zip(batch_names, batch_initial_parameters_array):
+                fp.write(utils.format_ferre_input_parameters(*point, name=name))
 
     if write_input_pixel_arrays:
         log.info(f"Writing input pixel arrays")
@@ -0,0 +1,224 @@
+"""Incremental progress tracking for FERRE executions."""
+
+import os
+import numpy as np
+from time import time
+from astra.utils import log, expand_path
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+class IncrementalLineCounter:
+
+    def __init__(self, path, chunk_size=1_048_576):
+        """
+        Count the number of lines in a file that is being appended to, by only reading the bytes
+        that were appended since the last update.
+
+        :param path:
+            The path of the file to count lines in. The file does not need to exist yet.
+
+        :param chunk_size: [optional]
+            The number of bytes to read at a time.
+        """
+        self.path = expand_path(path)
+        self.chunk_size = int(chunk_size)
+        self.offset, self.n_lines, self.inode = (0, 0, None)
+        return None
+
+
+    def update(self):
+        """
+        Read any bytes appended since the last update.
+
+        If the file has been replaced (e.g., a new inode) or truncated, then the count is reset.
+
+        :returns:
+            The change in the number of lines since the last update.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+
+        n_lines_before = self.n_lines
+        if (self.inode is not None and stat.st_ino != self.inode) or stat.st_size < self.offset:
+            self.offset, self.n_lines = (0, 0)
+        self.inode = stat.st_ino
+
+        if stat.st_size > self.offset:
+            with open(self.path, "rb") as fp:
+                fp.seek(self.offset)
+                while True:
+                    chunk = fp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    self.n_lines += chunk.count(b"\n")
+                    self.offset += len(chunk)
+
+        return self.n_lines - n_lines_before
+
+
+class FerreProgressTracker:
+
+    def __init__(self, executions, use_inotify=None, full_scan_interval=60):
+        """
+        Track the progress of many FERRE executions by remembering the byte offset of every output
+        file, and only reading what has been appended since the last poll.
+
+        :param executions:
+            A list of `[output_path, n_input, n_done]` entries, as returned by the load balancer.
+
+        :param use_inotify: [optional]
+            Use `inotify` (through the `inotify_simple` package) to only check output files in
+            directories that have changed. If `None` (default), `inotify` will be used if it is
+            available. Otherwise every incomplete output file is checked with `stat` on every poll.
+
+        :param full_scan_interval: [optional]
+            When using `inotify`, the minimum time (in seconds) between checks of every incomplete
+            output file. This is needed on network file systems (e.g., Lustre) where `inotify`
+            events are not raised for files written from other nodes.
+        """
+        if use_inotify is None:
+            use_inotify = INotify is not None
+        elif use_inotify and INotify is None:
+            log.warning(f"Cannot import `inotify_simple`: falling back to polling FERRE output files")
+            use_inotify = False
+
+        self.full_scan_interval = full_scan_interval
+        self.counters, self.n_input, self.history = ({}, {}, {})
+        for output_path, n_input, *_ in executions:
+            self.counters[output_path] = IncrementalLineCounter(output_path)
+            self.n_input[output_path] = n_input
+            self.history[output_path] = []
+
+        self._inotify, self._watches, self._last_full_scan = (None, {}, None)
+        if use_inotify:
+            self._inotify = INotify()
+            mask = inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.MOVED_TO | inotify_flags.CLOSE_WRITE
+            for output_path, counter in self.counters.items():
+                pwd = os.path.dirname(counter.path)
+                if pwd in self._watches.values():
+                    continue
+                try:
+                    wd = self._inotify.add_watch(pwd, mask)
+                except OSError:
+                    # Directory does not exist yet, so we will rely on full scans.
+                    continue
+                else:
+                    self._watches[wd] = pwd
+        return None
+
+
+    def n_done(self, output_path):
+        """Return the number of spectra completed for the given execution, as of the last poll."""
+        return self.counters[output_path].n_lines
+
+
+    def _changed_directories(self):
+        changed, overflow = (set(), False)
+        for event in self._inotify.read(timeout=0):
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                overflow = True
+            else:
+                changed.add(self._watches.get(event.wd, None))
+        return (changed, overflow)
+
+
+    def poll(self, exclude=None):
+        """
+        Update the progress of all incomplete executions.
+
+        :param exclude: [optional]
+            An iterable of output paths to skip (e.g., dead executions).
+
+        :returns:
+            A dictionary with output paths as keys, and the number of completed spectra as values.
+        """
+        exclude = set(exclude or [])
+        now = time()
+
+        full_scan = (
+            self._inotify is None
+        or  self._last_full_scan is None
+        or  (now - self._last_full_scan) >= self.full_scan_interval
+        )
+        changed = set()
+        if self._inotify is not None:
+            changed, overflow = self._changed_directories()
+            full_scan = full_scan or overflow
+        if full_scan:
+            self._last_full_scan = now
+
+        for output_path, counter in self.counters.items():
+            if output_path in exclude or counter.n_lines >= self.n_input[output_path]:
+                continue
+            if not full_scan and os.path.dirname(counter.path) not in changed:
+                continue
+            n_new = counter.update()
+            if n_new < 0:
+                # The output file was replaced or truncated.
+                self.history[output_path] = []
+            if n_new != 0:
+                # Only the first and most recent observations are needed to estimate the rate.
+                self.history[output_path][1:] = [(now, counter.n_lines)]
+
+        return { output_path: counter.n_lines for output_path, counter in self.counters.items() }
+
+
+    def rate(self, output_path):
+        """
+        Return the rate (spectra per second) for an execution, measured between the first and most
+        recent poll where progress was observed. This excludes the time taken to load the grid.
+        """
+        history = self.history[output_path]
+        if len(history) < 2:
+            return np.nan
+        (t_first, n_first), (t_last, n_last) = (history[0], history[-1])
+        if t_last <= t_first:
+            return np.nan
+        return (n_last - n_first) / (t_last - t_first)
+
+
+    def eta(self, output_path):
+        """Return the estimated time (in seconds) until the given execution is complete."""
+        n_remaining = self.n_input[output_path] - self.n_done(output_path)
+        if n_remaining <= 0:
+            return 0
+        rate = self.rate(output_path)
+        if not (rate > 0):
+            return np.nan
+        return n_remaining / rate
+
+
+    def summary(self):
+        """
+        Return a list of dictionaries summarising the progress, rate, and estimated time remaining
+        for every execution.
+        """
+        rows = []
+        for output_path in self.counters:
+            rows.append(dict(
+                pwd=os.path.dirname(output_path),
+                n_done=self.n_done(output_path),
+                n_input=self.n_input[output_path],
+                rate=self.rate(output_path),
+                eta=self.eta(output_path),
+            ))
+        return rows
+
+
+    def max_eta(self, exclude=None):
+        """
+        Return the estimated time (in seconds) until all executions are complete, assuming they are
+        running in parallel. If no estimate is available, this returns `np.nan`.
+        """
+        exclude = set(exclude or [])
+        etas = [self.eta(output_path) for output_path in self.counters if output_path not in exclude]
+        etas = np.array(etas, dtype=float)
+        if not np.any(np.isfinite(etas)):
+            return np.nan
+        return np.nanmax(etas)
@@ -0,0 +1,313 @@
+"""A stand-in for the FERRE executable, for exercising the orchestration without model grids."""
+
+import os
+import sys
+import heapq
+import numpy as np
+from time import time, sleep
+
+from astra.utils import expand_path
+from astra.pipelines.ferre.utils import (
+    parse_control_kwds,
+    read_ferre_headers,
+    format_ferre_input_parameters,
+)
+
+FERRE_SIM_VERSION = "4.8.8-sim"
+
+# Number of pixels in the APOGEE grids, used when there is no header or flux file to tell us.
+DEFAULT_N_PIXELS = 7514
+
+
+def predict_per_spectrum_core_time(synthfile, N, nov, t_per_spectrum):
+    """
+    Predict the core-seconds needed per spectrum, using the same coefficients as the load balancer.
+    If the grid is not known, then `t_per_spectrum` is returned.
+    """
+    from astra.pipelines.ferre.operator import CORE_TIME_COEFFICIENTS, predict_ferre_core_time
+
+    grid = synthfile.split("/")[-2].split("_")[0] if "/" in synthfile else None
+    if grid not in CORE_TIME_COEFFICIENTS or N == 0:
+        return t_per_spectrum
+    return predict_ferre_core_time(grid, N, max(nov, 1)) / N
+
+
+def synthetic_model_flux(parameters, n_pixels):
+    """
+    Return deterministic, well-behaved synthetic model spectra for the given parameters.
+
+    :param parameters:
+        A 2D array of shape (N, D) of grid parameters.
+
+    :param n_pixels:
+        The number of pixels per spectrum.
+    """
+    parameters = np.atleast_2d(parameters)
+    x = np.arange(n_pixels)
+    phase = np.nansum(parameters, axis=1).reshape((-1, 1)) / 1000.0
+    depth = 0.05 + 0.2 * (1 + np.tanh(np.nan_to_num(parameters[:, [-1]])))
+    return 1 - depth * np.abs(np.sin(0.05 * x + phase))**8
+
+
+def _smooth(a, width=5):
+    c = np.cumsum(np.pad(a, ((0, 0), (width // 2 + 1, width // 2)), mode="edge"), axis=1)
+    return (c[:, width:] - c[:, :-width]) / width
+
+
+def _read_names_and_parameters(path, n_dim):
+    with open(path, "r") as fp:
+        rows = [line.split() for line in fp if line.strip()]
+    names = [row[0] for row in rows]
+    parameters = np.array([row[1:1 + n_dim] for row in rows], dtype=float).reshape((-1, n_dim))
+    return (names, parameters)
+
+
+class _Writer:
+
+    def __init__(self, path):
+        self.fp = open(path, "a") if path is not None else None
+
+    def write(self, name, values, fmt="{:.4e}"):
+        self.write_line(f"{name} " + " ".join(map(fmt.format, values)) + "\n")
+
+    def write_line(self, line):
+        if self.fp is None:
+            return
+        self.fp.write(line)
+        self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+
+def simulate_ferre(
+    input_path,
+    cwd=None,
+    list_mode=False,
+    t_load=5.0,
+    t_per_spectrum=0.5,
+    nov_exponent=1.0,
+    cost_model="constant",
+    jitter=0.1,
+    time_scale=1.0,
+    failure_rate=0.0,
+    drop_rate=0.0,
+    crash_after=None,
+    hang_after=None,
+    n_pixels=None,
+    seed=None,
+    stdout=None,
+    stderr=None,
+):
+    """
+    Simulate a FERRE execution.
+
+    This reads the same control file as FERRE, consumes the input parameter, flux and flux error
+    files, sleeps according to a cost model, and writes correctly formatted outputs in the order
+    that spectra are completed (as FERRE does when `F_SORT = 0`). The standard output mimics that
+    of FERRE so that `ferre_timing` and `get_processing_times` can parse it.
+
+    :param input_path:
+        The path of the FERRE control file (e.g., `input.nml`), or a list of control files if
+        `list_mode` is True (as per `ferre.x -l`). Paths in control files are relative to `cwd`.
+
+    :param cwd: [optional]
+        The directory to execute from. Defaults to the current working directory.
+
+    :param list_mode: [optional]
+        Treat `input_path` as a list of control files to execute sequentially. The grid load
+        time is only charged when the `SYNTHFILE(1)` changes between executions.
+
+    :param t_load: [optional]
+        The time (in seconds) to load the grid.
+
+    :param t_per_spectrum: [optional]
+        The core-seconds needed per spectrum per free parameter, when `cost_model` is `constant`.
+
+    :param nov_exponent: [optional]
+        The cost per spectrum scales as `NOV**nov_exponent` when `cost_model` is `constant`.
+
+    :param cost_model: [optional]
+        Either `constant` (use `t_per_spectrum` and `nov_exponent`) or `predict` (use the same
+        core-time coefficients as the load balancer, where the grid is known).
+
+    :param jitter: [optional]
+        The log-normal scatter in the time taken per spectrum.
+
+    :param time_scale: [optional]
+        A multiplicative factor applied to all sleep times (e.g., 0.01 to run 100 times faster).
+
+    :param failure_rate: [optional]
+        The fraction of spectra that will have failed results (-9999 values).
+
+    :param drop_rate: [optional]
+        The fraction of spectra that will have no outputs written (e.g., a FERRE timeout).
+
+    :param crash_after: [optional]
+        Exit as if with a segmentation fault after this many spectra have been completed.
+
+    :param hang_after: [optional]
+        Stop making progress (without exiting) after this many spectra have been completed.
+
+    :param n_pixels: [optional]
+        The number of pixels to use if it cannot be inferred from the grid header or flux file.
+
+    :param seed: [optional]
+        A seed for the random number generator.
+
+    :returns:
+        An exit code: 0 for success, 139 for a simulated segmentation fault.
+    """
+
+    cwd = expand_path(cwd or os.getcwd())
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    rng = np.random.default_rng(seed)
+
+    if list_mode:
+        with open(os.path.join(cwd, input_path), "r") as fp:
+            input_nml_paths = [line.strip() for line in fp if line.strip()]
+    else:
+        input_nml_paths = [input_path]
+
+    t_start, n_completed, last_synthfile, flux_cache = (time(), 0, None, {})
+    elapsed = lambda: time() - t_start
+
+    for input_nml_path in input_nml_paths:
+        control_kwds = parse_control_kwds(os.path.join(cwd, input_nml_path))
+        path = lambda key: os.path.join(cwd, control_kwds[key]) if key in control_kwds else None
+
+        n_dim = int(control_kwds["NDIM"])
+        nov = int(control_kwds.get("NOV", n_dim))
+        n_threads = max(1, int(control_kwds.get("NTHREADS", 1)))
+        full_covariance = bool(int(control_kwds.get("COVPRINT", 0)))
+        synthfile = expand_path(str(control_kwds.get("SYNTHFILE(1)", "")))
+
+        names, initial_parameters = _read_names_and_parameters(path("PFILE"), n_dim)
+        N = len(names)
+
+        try:
+            headers, *_ = read_ferre_headers(synthfile)
+        except Exception:
+            lower_limits, upper_limits, grid_n_pixels = (None, None, None)
+        else:
+            lower_limits, upper_limits, grid_n_pixels = (headers["LLIMITS"], headers["ULIMITS"], headers.get("NPIX", None))
+            if grid_n_pixels is not None:
+                grid_n_pixels = int(np.sum(grid_n_pixels))
+
+        if nov > 0:
+            for key in ("FFILE", "ERFILE"):
+                if path(key) not in flux_cache:
+                    flux_cache[path(key)] = np.atleast_2d(np.loadtxt(path(key)))
+            flux, e_flux = (flux_cache[path("FFILE")], flux_cache[path("ERFILE")])
+            P = flux.shape[1]
+        else:
+            flux = e_flux = None
+            P = grid_n_pixels or n_pixels or DEFAULT_N_PIXELS
+
+        stdout.write(
+            f"{'-' * 65}\n"
+            f" f e r r e                                   {FERRE_SIM_VERSION}\n"
+            f"{'-' * 65}\n"
+            f" {input_nml_path} \n"
+            f" nthreads =  {n_threads:>6d}\n"
+            f" nobj =  {N:>6d}\n"
+        )
+        for i, name in enumerate(names, start=1):
+            stdout.write(f" {i:>6d} {name}\n")
+
+        t_this_load = t_load if synthfile != last_synthfile else 0
+        last_synthfile = synthfile
+
+        # Each thread is assigned a contiguous block of spectra, as in FERRE.
+        if cost_model == "predict":
+            t_spectrum = predict_per_spectrum_core_time(synthfile, N, nov, t_per_spectrum * max(nov, 1)**nov_exponent)
+        else:
+            t_spectrum = t_per_spectrum * max(nov, 1)**nov_exponent
+        costs = t_spectrum * rng.lognormal(0, jitter, size=N) if jitter > 0 else t_spectrum * np.ones(N)
+
+        n_per_thread, n_mod = divmod(N, n_threads)
+        events, si = ([], 0)
+        for thread in range(min(n_threads, N)):
+            ei = si + n_per_thread + (1 if n_mod > thread else 0)
+            t = t_this_load
+            for index in range(si, ei):
+                t += costs[index]
+                heapq.heappush(events, (t, index, index == (ei - 1)))
+            si = ei
+
+        t_offset = elapsed()
+        sleep(t_this_load * time_scale)
+        stdout.write(f" ellapsed time:  {elapsed():>10.3f} s\n")
+        stdout.flush()
+
+        failed = rng.uniform(size=N) < failure_rate
+        dropped = rng.uniform(size=N) < drop_rate
+        fitted_parameters = np.copy(initial_parameters)
+        free = [int(i) - 1 for i in str(control_kwds.get("INDV", "")).split()] if nov > 0 else []
+        if free:
+            fitted_parameters[:, free] += rng.normal(0, 0.01, size=(N, len(free))) * np.abs(initial_parameters[:, free] + 1)
+        if lower_limits is not None:
+            fitted_parameters = np.clip(fitted_parameters, lower_limits, upper_limits)
+        model_flux = synthetic_model_flux(fitted_parameters, P)
+
+        writers = {
+            key: _Writer(path(key)) for key in ("OPFILE", "OFFILE", "SFFILE")
+        }
+        try:
+            while events:
+                t, index, is_last_in_block = heapq.heappop(events)
+
+                if hang_after is not None and n_completed >= hang_after:
+                    while True:
+                        sleep(3600)
+
+                if crash_after is not None and n_completed >= crash_after:
+                    stderr.write("Program received signal SIGSEGV: Segmentation fault - invalid memory reference.\n")
+                    stderr.write("Segmentation fault (core dumped)\n")
+                    stderr.flush()
+                    return 139
+
+                sleep(max(0, t_offset + t * time_scale - elapsed()))
+                n_completed += 1
+
+                if is_last_in_block:
+                    stdout.write(f" ellapsed time:  {elapsed():>10.3f} s\n")
+                else:
+                    stdout.write(f" ellapsed time:  {elapsed():>10.3f} s   next object #{index + 2:>6d}\n")
+                stdout.flush()
+
+                if dropped[index]:
+                    continue
+
+                name = names[index]
+                if nov > 0:
+                    if failed[index]:
+                        stderr.write(f" error: failed to converge for object {name}\n")
+                        stderr.flush()
+                        parameters = -9999 * np.ones(n_dim)
+                        e_parameters = -1 * np.ones(n_dim)
+                    else:
+                        parameters = fitted_parameters[index]
+                        e_parameters = 0.01 * np.ones(n_dim)
+
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        snr = np.nanmedian(flux[index] / e_flux[index])
+                        continuum = np.nanmedian(flux[index])
+                        rectified_flux = flux[index] / (continuum if continuum > 0 else 1)
+                    log_snr_sq = np.log10(max(snr, 1e-5)**2)
+                    log_chisq_fit = rng.normal(0, 0.2)
+                    values = list(parameters) + list(e_parameters) + [1.0, log_snr_sq, log_chisq_fit]
+                    if full_covariance:
+                        values.extend(np.diag(e_parameters**2).flatten())
+                    writers["OPFILE"].write_line(format_ferre_input_parameters(*values, name=name))
+                    writers["SFFILE"].write(name, rectified_flux)
+                    writers["OFFILE"].write(name, _smooth(model_flux[[index]])[0])
+                else:
+                    writers["OFFILE"].write(name, model_flux[index])
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    return 0
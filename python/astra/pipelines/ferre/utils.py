@@ -10,6 +10,7 @@ from tqdm import tqdm
 from glob import glob
 from itertools import cycle
 from astra.utils import log, expand_path
+from astra.pipelines.ferre.progress import IncrementalLineCounter
 
 
 TRANSLATE_LABELS = { 
@@ -971,6 +972,45 @@ def clip_initial_guess(initial_guess, headers, transforms=None, percent_epsilon=
                     clipped_value = np.round(clipped_value, decimals)
                 clipped_initial_guess[parameter] = clipped_value
     return clipped_initial_guess
+
+
+def clip_initial_guesses(initial_guesses, headers, transforms=None, percent_epsilon=1, decimals=2):
+    """
+    Clip many initial guesses to some epsilon within the bounds of the FERRE grid.
+
+    This is the same as `clip_initial_guess`, except the values of `initial_guesses` are arrays.
+
+    :param initial_guesses:
+        A dictionary containing parameter names (arbitrary) as keys, and arrays of initial guesses
+        for that parameter as values.
+
+    :param headers:
+        The FERRE grid headers.
+
+    See `clip_initial_guess` for a description of the other parameters.
+    """
+    clip = percent_epsilon * (headers["ULIMITS"] - headers["LLIMITS"]) / 100.0
+    lower_limits, upper_limits = (headers["LLIMITS"] + clip, headers["ULIMITS"] - clip)
+
+    if decimals is not None:
+        lower_limits = np.round(lower_limits, decimals)
+        upper_limits = np.round(upper_limits, decimals)
+
+    clipped_initial_guesses = {}
+    transforms = transforms or TRANSLATE_LABELS
+    for parameter, values in initial_guesses.items():
+        try:
+            index = headers["LABEL"].index(transforms[parameter])
+        except (KeyError, ValueError):
+            # No clipping to apply!
+            clipped_initial_guesses[parameter] = values
+            continue
+
+        clipped_values = np.clip(values, lower_limits[index], upper_limits[index])
+        if decimals is not None:
+            clipped_values = np.round(clipped_values, decimals)
+        clipped_initial_guesses[parameter] = clipped_values
+    return clipped_initial_guesses
             
 
 
@@ -1112,6 +1152,9 @@ def check_ferre_progress(
 
     total = wc(os.path.join(dir, input_path))
 
+    # Avoid a full `wc -l` of the output file on every iteration.
+    counter = IncrementalLineCounter(os.path.join(dir, output_path))
+
     stdout, stderr = ("", "")
 
     total_done, total_errors = (0, 0)
@@ -1126,7 +1169,8 @@ def check_ferre_progress(
                     stdout += _stdout
                     stderr += _stderr
 
-            n_done = wc(os.path.join(dir, output_path))
+            counter.update()
+            n_done = counter.n_lines
 
             n_errors = stderr.lower().count("error")
 
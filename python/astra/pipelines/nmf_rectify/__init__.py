@@ -1,14 +1,17 @@
 
 import numpy as np
 import os
+from itertools import groupby
 from typing import Iterable, Optional
 import concurrent.futures
+from threadpoolctl import threadpool_limits
 from astra.models import Source, BossVisitSpectrum, ApogeeCoaddedSpectrumInApStar
 from astra.models.nmf_rectify import NMFRectify
 from astra.specutils.continuum.nmf.apogee import ApogeeNMFContinuum
 from astra.specutils.continuum.nmf.boss import BossNMFContinuum
 from astra import task, __version__
 from astra.utils import log, expand_path
+from time import time
 from peewee import chunked, JOIN, fn, ModelSelect
 from tqdm import tqdm
 from astra.products.utils import dispersion_array
@@ -29,8 +32,27 @@ def rectify_boss_spectra_by_source(
         )
     ),
     page: Optional[int] = None,
-    limit: Optional[int] = None        
+    limit: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    batch_size: Optional[int] = 16,
+    warm_start: Optional[bool] = False,
 ) -> Iterable[NMFRectify]:
+    """
+    Rectify BOSS visit spectra by fitting all visits of each source simultaneously.
+
+    :param sources: [optional]
+        The sources whose BOSS visit spectra will be rectified.
+
+    :param max_workers: [optional]
+        The number of worker processes (default: the number of CPUs). If 1, no workers are used.
+
+    :param batch_size: [optional]
+        The number of sources to send to a worker at once.
+
+    :param warm_start: [optional]
+        Start each fit from the most recent stored result for the same spectra (or source), and
+        fall back to the usual initial guess if that fit does not converge.
+    """
 
     # TODO: Should consider this logic to be executed somewhere else, either in the astra CLI call, or in the task wrapper, etc
     if isinstance(sources, ModelSelect):
@@ -39,20 +61,21 @@ def rectify_boss_spectra_by_source(
         elif limit is not None:
             sources = sources.limit(limit)    
     
-    model = BossNMFContinuum()    
-    for source in tqdm(sources, total=0, desc="Rectifying"):
-        yield from _rectify_boss_spectra_by_source([source], model)
-        
-    '''
-    futures = []
-    for chunk in tqdm(chunked(sources, batch_size), total=0, desc="Chunking"):
-        futures.append(executor.submit(_rectify_boss_spectra_by_source, chunk, model))
-    
-    with tqdm(total=len(futures) * batch_size, desc="Rectifying") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            yield from future.result()
-            pb.update(batch_size)
-    '''
+    # Database queries happen here; reading and fitting the spectra happens in the workers.
+    groups = (
+        spectra
+        for spectra in map(_get_boss_visit_spectra_in_coadd, sources)
+        if spectra
+    )
+    results = _rectify_in_parallel(
+        _rectify_boss_spectra_by_source,
+        _with_previous_results(groups, BossNMFContinuum, batch_size, warm_start),
+        BossNMFContinuum,
+        max_workers=max_workers,
+        batch_size=batch_size,
+        desc="Rectifying"
+    )
+    yield from (_report_warm_starts(results) if warm_start else results)
 
 
 @task
@@ -62,10 +85,31 @@ def rectify_apogee_coadded_spectra_in_apstar(
         .select()
         .join(NMFRectify, JOIN.LEFT_OUTER, on=(ApogeeCoaddedSpectrumInApStar.spectrum_pk == NMFRectify.spectrum_pk))
         .where(NMFRectify.spectrum_pk.is_null())
+        .order_by(ApogeeCoaddedSpectrumInApStar.source_pk)
     ),
     page: Optional[int] = None,
-    limit: Optional[int] = None    
+    limit: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    batch_size: Optional[int] = 64,
+    warm_start: Optional[bool] = False,
 ) -> Iterable[NMFRectify]:
+    """
+    Rectify APOGEE coadded spectra.
+
+    :param spectra: [optional]
+        The spectra to rectify.
+
+    :param max_workers: [optional]
+        The number of worker processes (default: the number of CPUs). If 1, no workers are used.
+
+    :param batch_size: [optional]
+        The number of spectra to send to a worker at once. Spectra of the same source are kept in
+        the same batch.
+
+    :param warm_start: [optional]
+        Start each fit from the most recent stored result for the same spectrum (or source), and
+        fall back to the usual initial guess if that fit does not converge.
+    """
     
     # TODO: Should consider this logic to be executed somewhere else, either in the astra CLI call, or in the task wrapper, etc
     if isinstance(spectra, ModelSelect):
@@ -73,15 +117,27 @@ def rectify_apogee_coadded_spectra_in_apstar(
             spectra = spectra.paginate(page, limit)
         elif limit is not None:
             spectra = spectra.limit(limit)
-            
-    model = ApogeeNMFContinuum()
-        
+
+    groups = (list(group) for _, group in groupby(spectra, key=lambda s: s.source_pk))
+    results = _rectify_in_parallel(
+        _rectify_apogee_coadded_spectra,
+        _with_previous_results(groups, ApogeeNMFContinuum, batch_size, warm_start),
+        ApogeeNMFContinuum,
+        max_workers=max_workers,
+        batch_size=batch_size,
+        desc="Rectifying"
+    )
+    yield from (_report_warm_starts(results) if warm_start else results)
+
+
+def _rectify_apogee_coadded_spectra(groups, model):
+    
     initial_flags = [
         ("flag_initialised_from_small_w", model.get_initial_guess_with_small_W),
         #("flag_initialised_from_llsqb", model.get_initial_guess_by_linear_least_squares_with_bounds),
     ]
     results = []
-    for spectrum in tqdm(spectra, total=0):
+    for spectrum, previous in ((spectrum, previous) for group, previous in groups for spectrum in group):
         
         kwds = dict(
             spectrum_pk=spectrum.spectrum_pk,
@@ -95,38 +151,250 @@ def rectify_apogee_coadded_spectra_in_apstar(
         try:
             args = list(map(np.atleast_2d, (spectrum.flux, spectrum.ivar)))
         except:
-            yield NMFRectify(flag_could_not_read_spectrum=True, **kwds)
-        else:
+            results.append(NMFRectify(flag_could_not_read_spectrum=True, **kwds))
+            continue
             
-            for flag_name, f in initial_flags:        
-                try:
-                    x0 = f(*args)        
-                    continuum, result = model.fit(*args, x0=x0, full_output=True)                
-                except:
-                    log.exception(f"Exception fitting {flag_name} x0 with spectrum {spectrum}")
-                    continue
-                else:
-                    break
+        for flag_name, f in initial_flags:        
+            try:
+                t_start = time()
+                x0 = f(*args)        
+                continuum, result = model.fit(
+                    *args, 
+                    x0=x0, 
+                    warm_start=_get_warm_start(model, [spectrum], previous, x0),
+                    full_output=True
+                )
+                t_elapsed = time() - t_start
+            except:
+                log.exception(f"Exception fitting {flag_name} x0 with spectrum {spectrum}")
+                continue
             else:
-                yield NMFRectify(flag_runtime_exception=True, **kwds)
+                break
+        else:
+            results.append(NMFRectify(flag_runtime_exception=True, **kwds))
+            continue
+        
+        dof = result["W"].size + result["theta"].size
+        pixel_chi2 = result["pixel_chi2"].reshape((1, -1))
+        thetas = result["theta"].reshape((1, -1))
+        rchi2s = np.nansum(pixel_chi2, axis=1) / (np.sum(np.isfinite(pixel_chi2), axis=1) - dof - 1)
+        
+        kwds.update(
+            log10_W=np.log10(result["W"]),
+            L=model.L,
+            deg=model.deg,
+            joint_rchi2=result["rchi2"],
+            continuum_theta=thetas[0],
+            rchi2=rchi2s[0],
+            n_iter=result["n_iter"],
+            nfev=result["nfev"],
+            t_elapsed=t_elapsed,
+        )
+        kwds["flag_initialised_from_previous_result" if result["warm_started"] else flag_name] = True
+        results.append(NMFRectify(**kwds))
+    
+    return results
 
-            
-            dof = result["W"].size + result["theta"].size
-            pixel_chi2 = result["pixel_chi2"].reshape((1, -1))
-            thetas = result["theta"].reshape((1, -1))
-            rchi2s = np.nansum(pixel_chi2, axis=1) / (np.sum(np.isfinite(pixel_chi2), axis=1) - dof - 1)
-            
-            kwds.update(
-                log10_W=np.log10(result["W"]),
-                L=model.L,
-                deg=model.deg,
-                joint_rchi2=result["rchi2"],
-                continuum_theta=thetas[0],
-                rchi2=rchi2s[0]
+
+def _with_previous_results(groups, model_class, batch_size, warm_start=True):
+    """
+    Pair each group of spectra with the most recent stored results for those spectra.
+
+    If there is no stored result for a spectrum, then the most recent result for the same source
+    is used. Only results from the same continuum model (same `L` and `deg`) are considered.
+
+    :param groups:
+        An iterable of lists of spectra.
+
+    :param model_class:
+        The continuum model class.
+
+    :param batch_size:
+        The number of groups to query results for at once.
+
+    :param warm_start: [optional]
+        If `False`, every group is paired with no previous results.
+
+    :returns:
+        A generator of two-length tuples of the group, and a dictionary with spectrum primary keys
+        as keys, and `(log10_W, continuum_theta)` tuples as values.
+    """
+    if not warm_start:
+        yield from ((group, {}) for group in groups)
+        return
+
+    model = model_class()
+    for batch in chunked(groups, batch_size):
+        spectrum_pks = [s.spectrum_pk for group in batch for s in group]
+        source_pks = list(set(s.source_pk for group in batch for s in group))
+        q = (
+            NMFRectify
+            .select(
+                NMFRectify.source_pk,
+                NMFRectify.spectrum_pk,
+                NMFRectify.log10_W,
+                NMFRectify.continuum_theta
+            )
+            .where(
+                (NMFRectify.spectrum_pk.in_(spectrum_pks) | NMFRectify.source_pk.in_(source_pks))
+            &   NMFRectify.log10_W.is_null(False)
+            &   (NMFRectify.L == model.L)
+            &   (NMFRectify.deg == model.deg)
             )
-            kwds[flag_name] = True
-            yield NMFRectify(**kwds)
+            .order_by(NMFRectify.task_pk.asc())
+            .tuples()
+        )
+        # Later results replace earlier ones.
+        by_spectrum_pk, by_source_pk = ({}, {})
+        for source_pk, spectrum_pk, log10_W, continuum_theta in q:
+            by_spectrum_pk[spectrum_pk] = by_source_pk[source_pk] = (log10_W, continuum_theta)
+
+        for group in batch:
+            previous = {}
+            for s in group:
+                value = by_spectrum_pk.get(s.spectrum_pk, by_source_pk.get(s.source_pk, None))
+                if value is not None:
+                    previous[s.spectrum_pk] = value
+            yield (group, previous)
+
+
+def _get_warm_start(model, spectra, previous, x0):
+    """
+    Return the NMF and continuum coefficients to start from, given previous results.
+
+    Spectra without a previous result (or with a different number of coefficients) start from `x0`.
+    If there are no usable previous results, `None` is returned.
+    """
+    C = model.components.shape[0]
+    K = (x0.size - C) // len(spectra)
+    W, theta = (None, np.copy(x0[C:]).reshape((len(spectra), K)))
+    for i, spectrum in enumerate(spectra):
+        try:
+            log10_W, continuum_theta = previous[spectrum.spectrum_pk]
+        except KeyError:
+            continue
+        if len(log10_W) != C or len(continuum_theta) != K:
+            continue
+        W = 10**np.array(log10_W) if W is None else W
+        theta[i] = continuum_theta
+    if W is None:
+        return None
+    return np.hstack([W, theta.flatten()])
+
+
+def _report_warm_starts(results):
+    """
+    Log how many fits were warm-started, and estimate the alternating iterations, function
+    evaluations, and time saved.
+    """
+    t_start = time()
+    stats = { True: [], False: [] }
+    for result in results:
+        if result.n_iter is not None:
+            stats[bool(result.flag_initialised_from_previous_result)].append(
+                (result.n_iter, result.nfev, result.t_elapsed)
+            )
+        yield result
+    t_wall = time() - t_start
+
+    (n_warm, n_cold) = (len(stats[True]), len(stats[False]))
+    log.info(f"Warm-started {n_warm} of {n_warm + n_cold} spectra from previous results.")
+    if n_warm > 0:
+        warm_iter, warm_nfev, warm_time = np.mean(stats[True], axis=0)
+        log.info(
+            f"Warm-started fits took {warm_iter:.1f} iterations, {warm_nfev:.1f} function evaluations, "
+            f"and {warm_time:.3f} s per spectrum, on average."
+        )
+    if n_warm > 0 and n_cold > 0:
+        cold_iter, cold_nfev, cold_time = np.mean(stats[False], axis=0)
+        log.info(
+            f"Other fits took {cold_iter:.1f} iterations, {cold_nfev:.1f} function evaluations, "
+            f"and {cold_time:.3f} s per spectrum, on average."
+        )
+        # Fits may run in parallel, so scale the wall time by the fraction of fitting time saved.
+        t_saved = n_warm * (cold_time - warm_time)
+        t_fitting = np.sum([t for *_, t in stats[True] + stats[False]])
+        t_wall_saved = t_wall * t_saved / t_fitting if t_fitting > 0 else 0
+        log.info(
+            f"Estimated savings from warm starts: {n_warm * (cold_iter - warm_iter):.0f} iterations, "
+            f"{n_warm * (cold_nfev - warm_nfev):.0f} function evaluations, {t_saved:.1f} s of fitting time, "
+            f"and {t_wall_saved:.1f} s of wall time (of {t_wall:.1f} s)"
+        )
+
 
+# Each worker process keeps its own continuum model, so the model is never sent with the work.
+_worker_model = None
+
+def _initialize_worker(model_class):
+    global _worker_model
+    # Each worker should use one thread, otherwise the workers compete with each other.
+    threadpool_limits(1)
+    _worker_model = model_class()
+
+
+def _execute_in_worker(f, batch):
+    return f(batch, _worker_model)
+
+
+def _rectify_in_parallel(f, groups, model_class, max_workers=None, batch_size=16, max_in_flight=None, desc=None):
+    """
+    Execute a rectification function on batches of spectra, and yield results as they complete.
+
+    :param f:
+        A function that takes a list of groups and a continuum model, and returns a list of results.
+
+    :param groups:
+        An iterable of groups (e.g., lists of spectra from the same source). Groups are never split
+        across batches.
+
+    :param model_class:
+        The continuum model class. Each worker creates one instance of this class when it starts.
+        The components are loaded here first, so that forked workers share them with this process.
+
+    :param max_workers: [optional]
+        The number of worker processes (default: the number of CPUs). If 1, no workers are used.
+
+    :param batch_size: [optional]
+        The number of groups to send to a worker at once.
+
+    :param max_in_flight: [optional]
+        The maximum number of batches that can be submitted and not yet finished (default: twice
+        the number of workers). This bounds the memory used by pending work.
+
+    :param desc: [optional]
+        A description for the progress bar.
+    """
+    model = model_class()
+    batches = chunked(groups, batch_size)
+    with tqdm(total=0, desc=desc) as pb:
+        if max_workers == 1:
+            for batch in batches:
+                for result in f(batch, model):
+                    yield result
+                    pb.update()
+            return
+
+        max_workers = max_workers or os.cpu_count()
+        max_in_flight = max_in_flight or 2 * max_workers
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers, 
+            initializer=_initialize_worker, 
+            initargs=(model_class, )
+        ) as executor:
+            pending = set()
+            for batch in batches:
+                if len(pending) >= max_in_flight:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        for result in future.result():
+                            yield result
+                            pb.update()
+                pending.add(executor.submit(_execute_in_worker, f, batch))
+
+            for future in concurrent.futures.as_completed(pending):
+                for result in future.result():
+                    yield result
+                    pb.update()
 
 
 boss_resample_wavelength = dispersion_array("boss")   
@@ -231,7 +499,18 @@ def plot_boss_rectified_spectra():
     
 
 
-def _rectify_boss_spectra_by_source(sources, model):
+def _get_boss_visit_spectra_in_coadd(source):
+    boss_callable_in_coadd = lambda s: (
+            (s.snr is not None)
+        &   np.isfinite(s.snr)
+        &   (s.snr > 3)
+        &   ((s.xcsao_rxc > 6) | ("mwm_wd" in source.sdss5_cartons["program"]))
+        &   (s.zwarning_flags <= 0)
+    )
+    return list(filter(boss_callable_in_coadd, source.boss_visit_spectra))
+
+
+def _rectify_boss_spectra_by_source(groups, model):
     
     P = boss_resample_wavelength.size
     initial_flags = [
@@ -239,19 +518,9 @@ def _rectify_boss_spectra_by_source(sources, model):
         #("flag_initialised_from_llsqb", model.get_initial_guess_by_linear_least_squares_with_bounds),
     ]
     results = []
-    for source in sources:
-        boss_callable_in_coadd = lambda s: (
-                (s.snr is not None)
-            &   np.isfinite(s.snr)
-            &   (s.snr > 3)
-            &   ((s.xcsao_rxc > 6) | ("mwm_wd" in source.sdss5_cartons["program"]))
-            &   (s.zwarning_flags <= 0)
-        )
-        spectra = list(filter(boss_callable_in_coadd, source.boss_visit_spectra))
-        
+    for spectra, previous in groups:        
+        source_pk = spectra[0].source_pk
         N = len(spectra)
-        if N == 0:
-            continue
         visit_flux, visit_ivar = (np.zeros((N, P)), np.zeros((N, P)))
         for i, spectrum in enumerate(spectra):
             rest_wavelength = boss_rest_frame_wavelength(spectrum, ...)
@@ -272,17 +541,20 @@ def _rectify_boss_spectra_by_source(sources, model):
         
         for flag_name, f in initial_flags:        
             try:                            
+                t_start = time()
                 x0 = f(visit_flux, visit_ivar)
 
                 continuum, result = model.fit(
                     visit_flux, 
                     visit_ivar, 
                     x0=x0,
+                    warm_start=_get_warm_start(model, spectra, previous, x0),
                     full_output=True
                 )
+                t_elapsed = time() - t_start
                 
             except:
-                log.exception(f"Exception fitting {flag_name} x0 with source {source}")
+                log.exception(f"Exception fitting {flag_name} x0 with source {source_pk}")
                 continue
             
             else:
@@ -295,9 +567,13 @@ def _rectify_boss_spectra_by_source(sources, model):
                     log10_W=np.log10(result["W"]),
                     L=model.L,
                     deg=model.deg,
-                    joint_rchi2=result["rchi2"]
+                    joint_rchi2=result["rchi2"],
+                    n_iter=result["n_iter"],
+                    nfev=result["nfev"],
+                    # All visits are fit together, so we share the time between them.
+                    t_elapsed=t_elapsed / N,
                 )
-                common_kwds[flag_name] = True
+                common_kwds["flag_initialised_from_previous_result" if result["warm_started"] else flag_name] = True
                 
                 for i, (spectrum, theta, rchi2) in enumerate(zip(spectra, thetas, rchi2s)):
                     results.append(
@@ -9,6 +9,7 @@ from peewee import chunked, JOIN, ModelSelect
 
 from astra import task
 from astra.utils import log, expand_path
+from astra.utils.intermediate import IntermediateOutputStore, get_intermediate_output_store_path
 from astra.models.spectrum import SpectrumMixin
 from astra.models import ApogeeCoaddedSpectrumInApStar, ApogeeVisitSpectrumInApStar
 from astra.models.nmf_rectify import NMFRectify
@@ -39,12 +40,16 @@ def the_apogee_coadd_cannon(
     model_path: Optional[str] = "$MWM_ASTRA/pipelines/TheCannon/20231106-beta.model", 
     page=None,
     limit=None,
+    batch_size: Optional[int] = None,
 ) -> Iterable[TheCannon]:
     """
     Run inference (the test step) on some spectra with The Cannon.    
+
+    If `batch_size` is given, spectra are fit in batches of this size and the continuum and model
+    flux for all spectra are written to a single HDF5 file, instead of one file per spectrum.
     """
 
-    yield from _the_cannon(spectra, model_path, page, limit, ApogeeNMFContinuum())
+    yield from _the_cannon(spectra, model_path, page, limit, ApogeeNMFContinuum(), batch_size)
 
 
 # TODO: it is so dumb to have to split up this as two tasks just because we need the convenience of a default query on `spectra`
@@ -70,17 +75,21 @@ def the_apogee_visit_cannon(
     model_path: Optional[str] = "$MWM_ASTRA/pipelines/TheCannon/20231106-beta.model", 
     page=None,
     limit=None,
+    batch_size: Optional[int] = None,
 ) -> Iterable[TheCannon]:
     """
     Run inference (the test step) on some spectra with The Cannon.    
+
+    If `batch_size` is given, spectra are fit in batches of this size and the continuum and model
+    flux for all spectra are written to a single HDF5 file, instead of one file per spectrum.
     """
 
-    yield from _the_cannon(spectra, model_path, page, limit, ApogeeNMFContinuum())
+    yield from _the_cannon(spectra, model_path, page, limit, ApogeeNMFContinuum(), batch_size)
 
 
 
 
-def _the_cannon(spectra, model_path, page, limit, continuum_model):
+def _the_cannon(spectra, model_path, page, limit, continuum_model, batch_size=None):
     
     total = None
     if isinstance(spectra, ModelSelect):
@@ -96,6 +105,10 @@ def _the_cannon(spectra, model_path, page, limit, continuum_model):
         spectra = spectra.iterator()
         
     model = CannonModel.read(expand_path(model_path))
+
+    if batch_size is not None:
+        yield from _the_cannon_batched(spectra, model, continuum_model, batch_size, total)
+        return
     
     for spectrum in tqdm(spectra, total=total, unit="spectra", desc="Inference"):
         continuum = continuum_model.continuum(spectrum.wavelength, spectrum.continuum_theta)[0]
@@ -196,7 +209,99 @@ def _the_cannon(spectra, model_path, page, limit, continuum_model):
 
         yield output
     '''
-        
+
+
+def _the_cannon_batched(spectra, model, continuum_model, batch_size, total=None):
+    """
+    Fit spectra with The Cannon in batches, and write intermediate outputs to one HDF5 file.
+
+    The continuum design matrix is shared by all spectra on the same wavelength grid, so the
+    continuum for each batch is computed with one matrix product.
+
+    :param spectra:
+        An iterable of spectra, each with a `continuum_theta` attribute.
+
+    :param model:
+        A trained `CannonModel`.
+
+    :param continuum_model:
+        The continuum model.
+
+    :param batch_size:
+        The number of spectra to fit at once.
+    """
+
+    P = model.s2.size
+    store_path = get_intermediate_output_store_path("TheCannon")
+    log.info(f"Writing intermediate outputs to {expand_path(store_path)}")
+
+    with IntermediateOutputStore(store_path, P) as store, tqdm(total=total, unit="spectra", desc="Inference") as pb:
+        for batch in chunked(spectra, batch_size):
+            N = len(batch)
+            wavelength = batch[0].wavelength
+            if all(np.array_equal(wavelength, spectrum.wavelength) for spectrum in batch[1:]):
+                continuum_theta = np.array([spectrum.continuum_theta for spectrum in batch])
+                continuum = continuum_model.continuum(wavelength, continuum_theta)
+            else:
+                continuum = np.vstack([
+                    continuum_model.continuum(spectrum.wavelength, spectrum.continuum_theta)
+                    for spectrum in batch
+                ])
+            flux = np.array([spectrum.flux for spectrum in batch]) / continuum
+            ivar = np.array([spectrum.ivar for spectrum in batch]) * continuum**2
+            non_finite = (
+                ~np.isfinite(flux)
+            |   ~np.isfinite(ivar)
+            |   (ivar == 0)
+            )
+            flux[non_finite] = 0
+            ivar[non_finite] = 0
+
+            try:
+                op_params, op_cov, op_meta = model.fit_spectrum(
+                    flux, 
+                    ivar, 
+                    method="batched", 
+                    batch_size=batch_size, 
+                    tqdm_kwds=dict(disable=True)
+                )
+            except:
+                log.exception(f"Exception when fitting batch of {N} spectra")
+                for spectrum in batch:
+                    yield TheCannon(
+                        spectrum_pk=spectrum.spectrum_pk,
+                        source_pk=spectrum.source_pk,
+                        flag_fitting_failure=True
+                    )
+                pb.update(N)
+                continue
+
+            store.append(
+                [spectrum.spectrum_pk for spectrum in batch],
+                continuum=continuum,
+                rectified_model_flux=[meta.get("model_flux", np.nan * np.ones(P)) for meta in op_meta]
+            )
+
+            L = len(model.label_names)
+            e_labels = np.sqrt(np.diagonal(op_cov, axis1=1, axis2=2))
+            for i, spectrum in enumerate(batch):
+                result = dict(zip(map(str.lower, model.label_names), op_params[i, :L]))
+                result.update(zip((f"e_{ln.lower()}" for ln in model.label_names), e_labels[i, :L]))
+                result.update(
+                    spectrum_pk=spectrum.spectrum_pk,
+                    source_pk=spectrum.source_pk,
+                    chi2=op_meta[i].get("chi2", np.nan),
+                    rchi2=op_meta[i].get("rchi2", np.nan),
+                    ier=op_meta[i].get("ier", -1),
+                    nfev=op_meta[i].get("nfev", -1),
+                    x0_index=np.argmin(op_meta[i]["trial_chi2"]),
+                    flag_fitting_failure=op_meta[i].get("flag_fitting_failure", False),
+                    intermediate_output_store=store_path,
+                )
+                yield TheCannon(**result)
+            pb.update(N)
+
+
 def _the_cannon_worker(spectra, model, **kwargs):
     
     continuum_model = ApogeeNMFContinuum()
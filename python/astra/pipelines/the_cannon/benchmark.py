@@ -0,0 +1,134 @@
+"""Benchmark The Cannon inference with `curve_fit` against the batched solver, on a synthetic model."""
+
+import numpy as np
+from time import time
+
+from astra.pipelines.the_cannon.model import CannonModel, _design_matrix, _design_matrix_indices, _normalize
+
+
+def synthetic_model(n_labels=5, n_pixels=2000, n_training_spectra=500, seed=0):
+    """
+    Return a trained Cannon model with random (but spectrum-like) coefficients.
+
+    The coefficients are drawn directly, so no training is needed: the mean flux is near one, and
+    each label contributes small linear and quadratic terms.
+
+    :param n_labels: [optional]
+        The number of labels.
+
+    :param n_pixels: [optional]
+        The number of pixels.
+
+    :param n_training_spectra: [optional]
+        The number of (random) training labels, which set the label offsets and scales.
+
+    :param seed: [optional]
+        The random seed.
+    """
+    rng = np.random.default_rng(seed)
+    label_names = [f"label_{i}" for i in range(n_labels)]
+    training_labels = rng.normal(rng.uniform(-1, 1, n_labels), rng.uniform(0.5, 2, n_labels), (n_training_spectra, n_labels))
+
+    idx = _design_matrix_indices(n_labels)
+    is_linear = (idx[1] == 0)
+    theta = rng.normal(0, 0.01, (idx[0].size, n_pixels))
+    theta[is_linear] *= 5
+    theta[0] = 1 + rng.normal(0, 0.01, n_pixels)
+
+    model = CannonModel(
+        training_labels,
+        np.ones((n_training_spectra, n_pixels)),
+        np.ones((n_training_spectra, n_pixels)),
+        label_names,
+        theta=theta,
+        s2=np.full(n_pixels, 1e-5),
+    )
+    return model
+
+
+def simulate_spectra(model, n_spectra=100, snr=100, seed=1):
+    """
+    Simulate spectra from a Cannon model.
+
+    :param model:
+        A trained Cannon model.
+
+    :param n_spectra: [optional]
+        The number of spectra to simulate.
+
+    :param snr: [optional]
+        The signal-to-noise ratio of each pixel.
+
+    :param seed: [optional]
+        The random seed.
+
+    :returns:
+        A three-length tuple of the true labels, the flux, and the inverse variance.
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.uniform(
+        model.offsets - model.scales,
+        model.offsets + model.scales,
+        (n_spectra, model.offsets.size)
+    )
+    flux = _design_matrix(_normalize(labels, model.offsets, model.scales), model._design_matrix_indices) @ model.theta
+    ivar = np.full_like(flux, snr**2)
+    flux += rng.normal(0, 1 / snr, flux.shape)
+    return (labels, flux, ivar)
+
+
+def run_benchmark(
+    n_spectra=200,
+    n_labels=5,
+    n_pixels=2000,
+    batch_size=100,
+    snr=100,
+    seed=0,
+):
+    """
+    Fit simulated spectra with `curve_fit` (one spectrum at a time) and with the batched solver.
+
+    :param n_spectra: [optional]
+        The number of spectra to fit.
+
+    :param n_labels: [optional]
+        The number of labels in the model.
+
+    :param n_pixels: [optional]
+        The number of pixels in the model.
+
+    :param batch_size: [optional]
+        The number of spectra to fit at once with the batched solver.
+
+    :param snr: [optional]
+        The signal-to-noise ratio of the simulated spectra.
+
+    :param seed: [optional]
+        The random seed.
+
+    :returns:
+        A dictionary of timings (in seconds), and the largest differences between the two methods.
+    """
+    model = synthetic_model(n_labels, n_pixels, seed=seed)
+    _, flux, ivar = simulate_spectra(model, n_spectra, snr=snr, seed=seed + 1)
+
+    kwds = dict(n_threads=1, tqdm_kwds=dict(disable=True))
+
+    t_init = time()
+    expected_labels, _, expected_meta = model.fit_spectrum(flux, ivar, method="curve_fit", **kwds)
+    t_curve_fit = time() - t_init
+
+    t_init = time()
+    actual_labels, _, actual_meta = model.fit_spectrum(flux, ivar, method="batched", batch_size=batch_size, **kwds)
+    t_batched = time() - t_init
+
+    expected_chi2 = np.array([meta["chi2"] for meta in expected_meta])
+    actual_chi2 = np.array([meta["chi2"] for meta in actual_meta])
+    L = model.offsets.size
+    return {
+        "t_curve_fit": t_curve_fit,
+        "t_batched": t_batched,
+        "speedup": t_curve_fit / t_batched,
+        "max_abs_label_difference_in_scales": np.max(np.abs(actual_labels[:, :L] - expected_labels[:, :L]) / model.scales),
+        "max_rel_chi2_difference": np.max(np.abs(actual_chi2 / expected_chi2 - 1)),
+    }
@@ -3,7 +3,7 @@ import pickle
 #from astra import log, __version__
 #from astra.base import Parameter
 #from astra.database.astradb import DataProduct, TaskOutputDataProducts
-from astra.contrib.thecannon.model import CannonModel
+from astra.pipelines.the_cannon.model import CannonModel
 #from astra.utils import expand_path
 
 
@@ -42,10 +42,13 @@ def grid_search(
     models = {}
     validation_chisq = {}
 
+    # Each model is warm-started from the coefficients of the previous (more regularized) model.
+    initial_theta = None
     for i, alpha in enumerate(alphas[::-1]):
 
         model = CannonModel(*args, regularization=alpha)
-        model.train(n_threads=n_threads, prefer=prefer)
+        model.train(n_threads=n_threads, prefer=prefer, initial_theta=initial_theta)
+        initial_theta = model.theta
         validation_chisq[alpha] = np.sum((model.predict(validation_labels) - validation_flux)**2 * validation_ivar)
 
         models[alpha] = model
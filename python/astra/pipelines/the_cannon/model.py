@@ -1,11 +1,12 @@
 import os
 import numpy as np
 import pickle
+import struct
+import zipfile
 import warnings
 from itertools import cycle
 from functools import cached_property
 from scipy import optimize as op
-import concurrent.futures
 from sklearn.linear_model import Lasso, LinearRegression
 from joblib import Parallel, delayed
 from time import time
@@ -106,6 +107,8 @@ class CannonModel:
         tqdm_kwds=None,
         n_threads=-1,
         prefer="processes",
+        method="vectorized",
+        initial_theta=None,
         **kwargs,
     ):
         """
@@ -117,7 +120,22 @@ class CannonModel:
 
         :param tqdm_kwds: [optional]
             Keyword arguments to pass to `tqdm` (default: None).
+
+        :param method: [optional]
+            The training method. If `vectorized` (default), all pixels are solved together: by
+            weighted least squares if `regularization` is zero, or otherwise by coordinate descent
+            that is vectorized across pixels. If `sklearn`, each pixel is fit separately with
+            `sklearn` in `n_threads` workers.
+
+        :param initial_theta: [optional]
+            Initial coefficients of shape `(n_terms, n_pixels)` to warm-start the coordinate descent
+            (e.g., from a model trained with stronger regularization). This is only used when
+            `method` is `vectorized` and `regularization` is non-zero.
+
+        Any additional keyword arguments are passed to the solver (e.g., `max_iter`, `tol`).
         """
+        if method not in ("vectorized", "sklearn"):
+            raise ValueError(f"method must be 'vectorized' or 'sklearn', not '{method}'")
 
         # Calculate design matrix without bias term, using normalized labels
         X = self.design_matrix[:, 1:]
@@ -128,57 +146,94 @@ class CannonModel:
         _tqdm_kwds = dict(total=P, desc="Training", unit="pixel")
         _tqdm_kwds.update(tqdm_kwds or {})
 
-        n_threads = _evaluate_n_threads(n_threads)
-        args = (X, self.regularization, hide_warnings)
-
         t_init = time()
-        results = Parallel(n_threads, prefer=prefer)(
-            delayed(_fit_pixel)(p, Y, W, *args, **kwargs)
-            for p, (Y, W) in tqdm(enumerate(zip(flux.T, ivar.T)), **_tqdm_kwds)
-        )
-        t_train = time() - t_init
-        self.theta = np.zeros((1 + L, P))
-        self.meta.update(
-            t_train=t_train,
-            train_warning=np.zeros(P, dtype=bool),
-            n_iter=np.zeros(P, dtype=int),
-            dual_gap=np.zeros(P, dtype=float),
-        )
-        for index, pixel_theta, meta in results:
-            self.theta[:, index] = pixel_theta
-            self.meta["train_warning"][index] = meta.get("warning", False)
-            self.meta["n_iter"][index] = meta.get("n_iter", -1)
-            self.meta["dual_gap"][index] = meta.get("dual_gap", np.nan)
+        if method == "vectorized":
+            if self.regularization == 0:
+                self.theta = _fit_pixels_least_squares(X, flux, ivar, tqdm_kwds=_tqdm_kwds, **kwargs)
+                pixel_meta = {}
+            else:
+                self.theta, pixel_meta = _fit_pixels_lasso(
+                    X, flux, ivar, self.regularization, initial_theta, tqdm_kwds=_tqdm_kwds, **kwargs
+                )
+                if not hide_warnings and np.any(pixel_meta["warning"]):
+                    warnings.warn(
+                        f"Coordinate descent did not converge for {np.sum(pixel_meta['warning'])} pixels",
+                        ConvergenceWarning
+                    )
+            t_train = time() - t_init
+            self.meta.update(
+                t_train=t_train,
+                train_warning=pixel_meta.get("warning", np.zeros(P, dtype=bool)),
+                n_iter=pixel_meta.get("n_iter", -np.ones(P, dtype=int)),
+                dual_gap=pixel_meta.get("dual_gap", np.nan * np.ones(P)),
+            )
+        else:
+            n_threads = _evaluate_n_threads(n_threads)
+            args = (X, self.regularization, hide_warnings)
+
+            results = Parallel(n_threads, prefer=prefer)(
+                delayed(_fit_pixel)(p, Y, W, *args, **kwargs)
+                for p, (Y, W) in tqdm(enumerate(zip(flux.T, ivar.T)), **_tqdm_kwds)
+            )
+            t_train = time() - t_init
+            self.theta = np.zeros((1 + L, P))
+            self.meta.update(
+                t_train=t_train,
+                train_warning=np.zeros(P, dtype=bool),
+                n_iter=np.zeros(P, dtype=int),
+                dual_gap=np.zeros(P, dtype=float),
+            )
+            for index, pixel_theta, meta in results:
+                self.theta[:, index] = pixel_theta
+                self.meta["train_warning"][index] = meta.get("warning", False)
+                self.meta["n_iter"][index] = meta.get("n_iter", -1)
+                self.meta["dual_gap"][index] = meta.get("dual_gap", np.nan)
 
         # Calculate the model variance given the trained coefficients.
         self.s2 = self._calculate_s2()
         return self
 
 
-    def _calculate_s2(self, min_log10_s2=-6, max_log10_s2=0, n_steps=120, large=1e3, max_workers=32):
+    def _calculate_s2(
+        self,
+        min_log10_s2=-6,
+        max_log10_s2=0,
+        n_steps=120,
+        large=1e3,
+        max_elements=10_000_000,
+        newton_steps=0,
+    ):
+        """
+        Calculate the model variance (s^2) at each pixel.
+
+        For each pixel we choose the value of s^2 on a log-spaced grid that makes the mean
+        chi-squared per training spectrum closest to one. Pixels with no valid data have s^2 = `large`.
+
+        :param min_log10_s2: [optional]
+            The minimum value of log10(s^2) to consider.
 
-        L2s = (self.training_flux - self.predict(self.training_labels))**2
+        :param max_log10_s2: [optional]
+            The maximum value of log10(s^2) to consider.
+
+        :param n_steps: [optional]
+            The number of log-spaced s^2 values to evaluate.
+
+        :param large: [optional]
+            The value of s^2 for pixels without any valid data.
+
+        :param max_elements: [optional]
+            The maximum number of `(n_spectra, n_pixels)` elements to evaluate at once. This bounds
+            the memory used.
+
+        :param newton_steps: [optional]
+            The number of Newton-Raphson steps to refine the s^2 value of each pixel, starting from
+            the best value on the grid. Refined values stay between the neighbouring grid points. If
+            zero (default), the best grid value is returned.
+        """
+        L2 = (self.training_flux - self.predict(self.training_labels))**2
         s2_steps = np.logspace(min_log10_s2, max_log10_s2, n_steps)
-        N, P = self.training_flux.shape
-        
-        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
-        futures = []
-        for i, (L2, ivar) in enumerate(zip(L2s.T, self.training_ivar.T)):
-            if np.all(ivar == 0):
-                continue            
-            futures.append(executor.submit(_calculate_s2_single_pixel, i, L2, ivar, s2_steps))
-            
-        s2 = large * np.ones(P, dtype=float)                
-        with tqdm(total=len(futures)) as pb:
-            for future in concurrent.futures.as_completed(futures):
-                i, pixel_s2 = future.result()
-                s2[i] = pixel_s2
-                pb.update(1)
-        
-        return s2
+        return _calculate_s2(L2, self.training_ivar, s2_steps, large, max_elements, newton_steps)
 
-        
-        
     def _calculate_s2_bad_way(self, SMALL=1e-12):
         """Calculate the model variance (s^2)."""
 
@@ -199,6 +254,9 @@ class CannonModel:
         """
         Write the model to disk.
 
+        If the path ends with `.npz` then the model is written as an uncompressed NumPy archive that
+        can be memory-mapped by `CannonModel.read`. Otherwise the model is pickled.
+
         :param path:
             The path to write the model to.
 
@@ -230,21 +288,49 @@ class CannonModel:
             keys += ["training_labels", "training_flux", "training_ivar"]
 
         state = {k: getattr(self, k) for k in keys}
-        with open(path, "wb") as fp:
-            pickle.dump(state, fp)
+        if full_path.endswith(".npz"):
+            state["design_matrix_indices"] = np.array(self._design_matrix_indices)
+            _write_npz(full_path, state)
+        else:
+            with open(path, "wb") as fp:
+                pickle.dump(state, fp)
         return True
 
     @classmethod
-    def read(cls, path):
-        """Read a model from disk."""
+    def read(cls, path, mmap_mode="r", load_training_set=True):
+        """
+        Read a model from disk.
+
+        :param path:
+            The path of a pickled model, or a model written in the `.npz` format.
+
+        :param mmap_mode: [optional]
+            The memory-map mode for arrays in `.npz` models (default: `r`). Memory-mapped arrays are
+            only read from disk when they are used, and processes on the same node share the same
+            page-cached copy. If `None`, the arrays are read into memory. This is ignored for
+            pickled models.
+
+        :param load_training_set: [optional]
+            Load the training set, if it was saved with the model (default: True).
+        """
 
         full_path = expand_path(path)
-        with open(full_path, "rb") as fp:
-            state = pickle.load(fp)
+        if zipfile.is_zipfile(full_path):
+            state = _read_npz(full_path, mmap_mode)
+            design_matrix_indices = state.pop("design_matrix_indices", None)
+        else:
+            with open(full_path, "rb") as fp:
+                state = pickle.load(fp)
+            design_matrix_indices = None
         # if there's no training data, just give Nones
         for k in ("training_labels", "training_flux", "training_ivar"):
+            if not load_training_set:
+                state.pop(k, None)
             state.setdefault(k, None)
-        return cls(**state)
+        model = cls(**state)
+        if design_matrix_indices is not None:
+            model.__dict__["_design_matrix_indices"] = tuple(np.array(design_matrix_indices))
+        return model
 
     @property
     def term_descriptions(self):
@@ -330,6 +416,9 @@ class CannonModel:
         n_threads=None,
         prefer="processes",
         tqdm_kwds=None,
+        method="curve_fit",
+        batch_size=100,
+        **kwargs
     ):
         """
         Return the stellar labels given the observed flux and inverse variance.
@@ -353,7 +442,22 @@ class CannonModel:
 
         :param tqdm_kwds: [optional]
             Keyword arguments to pass to `tqdm` (default: None).
+
+        :param method: [optional]
+            The optimization method to use. If `curve_fit` (default), each spectrum is fit separately
+            with `scipy.optimize.curve_fit` using finite-difference derivatives. If `batched`, then
+            `batch_size` spectra are fit at once with a Levenberg-Marquardt solver that uses the
+            analytic derivatives of the model. The `n_threads` and `prefer` keywords are ignored
+            when `method` is `batched`.
+
+        :param batch_size: [optional]
+            The number of spectra to fit at once when `method` is `batched`.
+
+        Any additional keyword arguments are passed to `_fit_spectra` when `method` is `batched`.
         """
+        if method not in ("curve_fit", "batched"):
+            raise ValueError(f"method must be 'curve_fit' or 'batched', not '{method}'")
+
         P = self.s2.size
         try:
             N, P = flux.shape
@@ -387,15 +491,27 @@ class CannonModel:
             continuum_order,
         )
 
-        iterable = tqdm(zip(flux, ivar, x0, frozen_values), **_tqdm_kwds)
-
-        n_threads = _evaluate_n_threads(n_threads)
-        if N == 1 or n_threads in (0, 1, None):
-            results = [_fit_spectrum(*data, *args) for data in iterable]
+        if method == "batched":
+            flux, ivar = (np.atleast_2d(flux), np.atleast_2d(ivar))
+            results = []
+            with tqdm(**_tqdm_kwds) as pb:
+                for si in range(0, N, batch_size):
+                    sl = slice(si, si + batch_size)
+                    batch_x0 = None if x0 is None or isinstance(x0, cycle) else np.atleast_2d(x0)[sl]
+                    results.extend(
+                        _fit_spectra(flux[sl], ivar[sl], batch_x0, frozen_values[sl], *args, **kwargs)
+                    )
+                    pb.update(flux[sl].shape[0])
         else:
-            results = Parallel(n_threads, prefer=prefer)(
-                delayed(_fit_spectrum)(*data, *args) for data in iterable
-            )
+            iterable = tqdm(zip(flux, ivar, x0, frozen_values), **_tqdm_kwds)
+
+            n_threads = _evaluate_n_threads(n_threads)
+            if N == 1 or n_threads in (0, 1, None):
+                results = [_fit_spectrum(*data, *args) for data in iterable]
+            else:
+                results = Parallel(n_threads, prefer=prefer)(
+                    delayed(_fit_spectrum)(*data, *args) for data in iterable
+                )
 
         # Aggregate nicely.
         K = L
@@ -470,6 +586,97 @@ def _initial_estimate(
         return x0 if normalize else _denormalize(x0, offsets, scales)
 
 
+def convert_model(path, output_path=None, overwrite=False):
+    """
+    Convert a pickled Cannon model to the memory-mappable `.npz` format.
+
+    :param path:
+        The path of the pickled model.
+
+    :param output_path: [optional]
+        The path to write the converted model to. If `None`, the extension of `path` is replaced
+        with `.npz`.
+
+    :param overwrite: [optional]
+        Overwrite the output path if it exists.
+
+    :returns:
+        The path of the converted model.
+    """
+    model = CannonModel.read(path)
+    if output_path is None:
+        output_path = f"{os.path.splitext(expand_path(path))[0]}.npz"
+    if not output_path.endswith(".npz"):
+        raise ValueError(f"output path must end with .npz: {output_path}")
+    model.write(output_path, save_training_set=model.training_flux is not None, overwrite=overwrite)
+    return output_path
+
+
+def _write_npz(path, state):
+    arrays = {}
+    for key, value in state.items():
+        if value is None:
+            continue
+        if key == "meta":
+            # The meta dictionary can contain anything, so we store it as pickled bytes.
+            arrays[key] = np.frombuffer(pickle.dumps(value), dtype=np.uint8)
+        elif key == "label_names":
+            arrays[key] = np.array(value, dtype=str)
+        else:
+            arrays[key] = np.asarray(value)
+    # Arrays must be stored without compression so that they can be memory-mapped.
+    with open(path, "wb") as fp:
+        np.savez(fp, **arrays)
+
+
+def _read_npz(path, mmap_mode="r"):
+    """
+    Read the arrays in an uncompressed `.npz` file, memory-mapping them where possible.
+
+    `np.load` does not memory-map arrays inside `.npz` files, so we find where the data for each
+    array starts within the archive and memory-map it directly.
+    """
+    state = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as fp:
+        for info in archive.infolist():
+            key = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    state[key] = np.load(member)
+                continue
+
+            # The local file header is 30 bytes, followed by the file name and an extra field.
+            fp.seek(info.header_offset)
+            n_name, n_extra = struct.unpack("<HH", fp.read(30)[26:30])
+            fp.seek(info.header_offset + 30 + n_name + n_extra)
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+
+            if dtype.hasobject or np.prod(shape) == 0 or len(shape) == 0:
+                with archive.open(info) as member:
+                    state[key] = np.load(member)
+            else:
+                state[key] = np.memmap(
+                    path,
+                    dtype=dtype,
+                    mode=mmap_mode,
+                    offset=fp.tell(),
+                    shape=shape,
+                    order="F" if fortran_order else "C"
+                )
+
+    if "meta" in state:
+        state["meta"] = pickle.loads(np.asarray(state["meta"]).tobytes())
+    if "label_names" in state:
+        state["label_names"] = list(map(str, state["label_names"]))
+    if "regularization" in state:
+        state["regularization"] = state["regularization"].item()
+    return state
+
+
 def _design_matrix_indices(L):
     return np.tril_indices(1 + L)
 
@@ -643,6 +850,242 @@ def _fit_spectrum(
         return (p_opt, cov, meta)
 
 
+def _design_matrix_derivatives(labels, idx):
+    """
+    Return the derivatives of the design matrix with respect to the (normalized) labels.
+
+    :param labels:
+        An array of normalized labels with shape `(n_spectra, n_labels)`.
+
+    :param idx:
+        The design matrix indices (see `_design_matrix_indices`).
+
+    :returns:
+        An array with shape `(n_spectra, n_terms, n_labels)`.
+    """
+    N, L = labels.shape
+    l = np.hstack([np.ones((N, 1)), labels])
+    j, k = idx
+    D = np.zeros((N, j.size, L))
+    for i in range(1, 1 + L):
+        D[:, :, i - 1] = (j == i) * l[:, k] + (k == i) * l[:, j]
+    return D
+
+
+def _fit_spectra(
+    flux,
+    ivar,
+    x0,
+    frozen_values,
+    theta,
+    idx,
+    s2,
+    offsets,
+    scales,
+    continuum_order=-1,
+    max_iter=1000,
+    ftol=1.49012e-08,
+    xtol=1.49012e-08,
+    initial_damping=1e-3,
+):
+    """
+    Fit many spectra at once with a Levenberg-Marquardt solver that uses analytic derivatives.
+
+    This returns the same results as calling `_fit_spectrum` for each spectrum, but the trial
+    starting points, design matrices, and Jacobians are all evaluated for every spectrum at once.
+    Spectra are removed from the active set as soon as they converge.
+
+    :param flux:
+        An array of rectified flux values with shape `(n_spectra, n_pixels)`.
+
+    :param ivar:
+        An array of inverse variances with shape `(n_spectra, n_pixels)`.
+
+    :param x0:
+        An array of initial labels with shape `(n_spectra, n_labels)`, or `None` to choose the best
+        of four trial starting points for each spectrum.
+
+    :param frozen_values:
+        An array of shape `(n_spectra, n_labels)` with the values of frozen labels, and NaN for
+        labels that are free.
+
+    :param max_iter: [optional]
+        The maximum number of iterations.
+
+    :param ftol: [optional]
+        The relative reduction in chi-squared that is considered converged.
+
+    :param xtol: [optional]
+        The relative change in parameters that is considered converged.
+
+    :param initial_damping: [optional]
+        The initial Levenberg-Marquardt damping factor.
+
+    :returns:
+        A list of `(labels, cov, meta)` tuples, one per spectrum. If `continuum_order` is
+        non-negative then the continuum coefficients are appended to the labels.
+    """
+    flux, ivar = (np.atleast_2d(flux), np.atleast_2d(ivar))
+    N, P = flux.shape
+    L = offsets.size
+    C = continuum_order + 1
+    K = L + C
+
+    is_frozen = np.isfinite(frozen_values)
+    normalized_frozen_values = _normalize(frozen_values, offsets, scales)
+    adjusted_ivar = ivar / (1.0 + ivar * s2)
+
+    # Columns are ordered as np.polyval expects, from the highest power to the constant term.
+    V = _get_continuum_x(P)[:, np.newaxis] ** np.arange(C - 1, -1, -1)
+
+    def predict(labels):
+        l = np.hstack([np.ones((labels.shape[0], 1)), labels])
+        return (l[:, idx[0]] * l[:, idx[1]]) @ theta
+
+    def evaluate(p):
+        base = predict(p[:, :L])
+        continuum = p[:, L:] @ V.T if C > 0 else 1
+        return (base, continuum, continuum * base)
+
+    def chi2(model_flux, index):
+        return np.sum((flux[index] - model_flux)**2 * adjusted_ivar[index], axis=1)
+
+    meta = [dict() for _ in range(N)]
+    if x0 is None:
+        x0_normalized_trials = np.array([
+            np.zeros((N, L)),
+            +np.ones((N, L)),
+            -np.ones((N, L)),
+            _initial_guess(flux, theta, idx, offsets, scales, normalize=True),
+        ])
+        T = x0_normalized_trials.shape[0]
+        trial_labels = np.where(is_frozen, normalized_frozen_values, x0_normalized_trials).reshape((T * N, L))
+        trial_flux = predict(trial_labels)
+        trial_chi2 = np.sum(
+            (np.tile(flux, (T, 1)) - trial_flux)**2 * np.tile(adjusted_ivar, (T, 1)),
+            axis=1
+        ).reshape((T, N))
+        x0_normalized = x0_normalized_trials[np.argmin(trial_chi2, axis=0), np.arange(N)]
+        trial_x0 = x0_normalized_trials * scales + offsets
+        for i in range(N):
+            meta[i]["trial_x0"] = trial_x0[:, i]
+            meta[i]["trial_chi2"] = trial_chi2[:, i]
+    else:
+        x0_normalized = _normalize(np.atleast_2d(x0), offsets, scales)
+
+    for i, x0_ in enumerate(np.where(is_frozen, frozen_values, _denormalize(x0_normalized, offsets, scales))):
+        meta[i]["x0"] = x0_
+
+    p = np.zeros((N, K))
+    p[:, :L] = np.where(is_frozen, normalized_frozen_values, x0_normalized)
+    if C > 0:
+        p[:, -1] = 1
+
+    # Frozen labels have no derivatives, so we put them on the diagonal to keep the system solvable.
+    is_fixed = np.hstack([is_frozen, np.zeros((N, C), dtype=bool)])
+
+    def normal_equations(p, index):
+        base, continuum, model_flux = evaluate(p)
+        n = index.size
+        D = _design_matrix_derivatives(p[:, :L], idx)
+        J = np.empty((n, K, P))
+        J[:, :L] = (D.transpose((0, 2, 1)).reshape((n * L, -1)) @ theta).reshape((n, L, P))
+        J[:, :L] *= continuum[:, np.newaxis] if C > 0 else 1
+        if C > 0:
+            J[:, L:] = base[:, np.newaxis] * V.T
+        J[is_fixed[index]] = 0
+        Jw = J * adjusted_ivar[index, np.newaxis]
+        JtJ = Jw @ J.transpose((0, 2, 1))
+        g = (Jw @ (flux[index] - model_flux)[:, :, np.newaxis])[:, :, 0]
+        ii, jj = np.where(is_fixed[index])
+        JtJ[ii, jj, jj] = 1
+        return (JtJ, g, model_flux)
+
+    nfev = np.ones(N, dtype=int)
+    ier = np.zeros(N, dtype=int)
+    damping = initial_damping * np.ones(N)
+    index = np.arange(N)
+    current_chi2 = chi2(evaluate(p)[2], index)
+    JtJ, g, _ = normal_equations(p, index)
+    for n_iter in range(max_iter):
+        if index.size == 0:
+            break
+
+        A = JtJ + damping[index, np.newaxis, np.newaxis] * (JtJ * np.eye(K))
+        try:
+            delta = np.linalg.solve(A, g[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            delta = np.array([np.linalg.lstsq(a, b, rcond=-1)[0] for a, b in zip(A, g)])
+
+        p_trial = p[index] + delta
+        trial_chi2 = chi2(evaluate(p_trial)[2], index)
+        nfev[index] += 1
+
+        accept = trial_chi2 <= current_chi2[index]
+        reduction = current_chi2[index] - trial_chi2
+        small_reduction = accept & (reduction <= ftol * current_chi2[index])
+        small_step = np.all(np.abs(delta) <= xtol * (np.abs(p[index]) + xtol), axis=1)
+
+        p[index[accept]] = p_trial[accept]
+        current_chi2[index[accept]] = trial_chi2[accept]
+        damping[index[accept]] = np.clip(damping[index[accept]] / 10, 1e-15, None)
+        damping[index[~accept]] *= 10
+
+        ier[index[small_reduction]] = 1
+        ier[index[small_step & ~small_reduction]] = 2
+        ier[index[(damping[index] > 1e15) & (ier[index] == 0)]] = 3
+
+        still_active = (ier[index] == 0)
+        if np.any(accept & still_active):
+            # Only update the normal equations for spectra that moved.
+            update = accept & still_active
+            JtJ[update], g[update], _ = normal_equations(p[index[update]], index[update])
+        index, JtJ, g = (index[still_active], JtJ[still_active], g[still_active])
+
+    ier[index] = 5
+
+    JtJ, _, model_flux = normal_equations(p, np.arange(N))
+    cov_norm = np.linalg.pinv(JtJ)
+    final_chi2 = chi2(model_flux, np.arange(N))
+    nu = np.sum(ivar > 0, axis=1) - L
+    ier[~np.isfinite(final_chi2) | ~np.all(np.isfinite(p), axis=1)] = -1
+
+    messages = {
+        -1: "Non-finite parameters encountered.",
+        1: "The relative reduction in chi-squared is at most ftol.",
+        2: "The relative change in parameters is at most xtol.",
+        3: "The damping factor is too large to make further progress.",
+        5: f"The number of iterations has reached max_iter={max_iter}."
+    }
+    results = []
+    for i in range(N):
+        failure = ier[i] < 0
+        meta[i].update(ier=ier[i], message=messages[ier[i]], nfev=nfev[i], flag_fitting_failure=failure)
+        if failure:
+            p_opt = np.nan * np.ones(K)
+            cov = np.nan * np.ones((K, K))
+            meta[i].update(chi2=np.nan, rchi2=np.nan, model_flux=np.nan * np.ones(P))
+        else:
+            # Continuum coefficients (if any) are appended to the labels, as `fit_spectrum` expects.
+            p_opt = np.hstack([frozen_values[i], p[i, L:]])
+            p_opt[:L][~is_frozen[i]] = _denormalize(
+                p[i, :L][~is_frozen[i]], offsets[~is_frozen[i]], scales[~is_frozen[i]]
+            )
+            if np.any(is_frozen[i]):
+                cov = np.nan * np.ones((K, K))  # TODO: deal with freezing
+            else:
+                cov = cov_norm[i] * np.hstack([scales, np.ones(C)])**2
+            meta[i].update(
+                chi2=final_chi2[i],
+                rchi2=final_chi2[i] / nu[i],
+                p_opt_norm=p[i, :L][~is_frozen[i]],
+                p_opt_cont=p[i, L:],
+                model_flux=model_flux[i],
+            )
+        results.append((p_opt, cov, meta[i]))
+    return results
+
+
 def _fit_pixel(index, Y, W, X, alpha, hide_warnings=True, **kwargs):
     N, T = X.shape
     if np.allclose(W, np.zeros_like(W)):
@@ -681,6 +1124,228 @@ def _fit_pixel(index, Y, W, X, alpha, hide_warnings=True, **kwargs):
     return (index, theta, meta)
 
 
+def _fit_pixels_least_squares(X, flux, ivar, chunk_size=256, tqdm_kwds=None):
+    """
+    Solve for the coefficients of every pixel at once by weighted least squares.
+
+    This gives the same result as `_fit_pixel` with `alpha = 0` (an unregularized linear regression
+    with an intercept), but the normal equations for many pixels are built and solved together.
+
+    :param X:
+        The design matrix without the bias term, with shape `(n_spectra, n_terms - 1)`.
+
+    :param flux:
+        The training set flux, with shape `(n_spectra, n_pixels)`.
+
+    :param ivar:
+        The training set inverse variance, with shape `(n_spectra, n_pixels)`.
+
+    :param chunk_size: [optional]
+        The number of pixels to solve at once. Memory scales as `chunk_size * n_spectra * n_terms`.
+
+    :returns:
+        The coefficients, with shape `(n_terms, n_pixels)`.
+    """
+    N, P = flux.shape
+    X = np.hstack([np.ones((N, 1)), X])
+    theta = np.zeros((X.shape[1], P))
+    fit = ~np.all(np.isclose(ivar, 0), axis=0)
+    indices = np.where(fit)[0]
+    products = _outer_products(X)
+    with tqdm(**(tqdm_kwds or dict(total=P, disable=True))) as pb:
+        pb.update(P - indices.size)
+        for si in range(0, indices.size, chunk_size):
+            chunk = indices[si:si + chunk_size]
+            W = ivar[:, chunk].T
+            XtWX = _weighted_gram_matrices(products, W)
+            XtWY = (W * flux[:, chunk].T) @ X
+            try:
+                theta[:, chunk] = np.linalg.solve(XtWX, XtWY[:, :, np.newaxis])[:, :, 0].T
+            except np.linalg.LinAlgError:
+                for i, (A, b) in enumerate(zip(XtWX, XtWY)):
+                    theta[:, chunk[i]] = np.linalg.lstsq(A, b, rcond=None)[0]
+            pb.update(chunk.size)
+    return theta
+
+
+def _fit_pixels_lasso(
+    X,
+    flux,
+    ivar,
+    alpha,
+    initial_theta=None,
+    max_iter=20_000,
+    tol=1e-10,
+    precompute=True,
+    chunk_size=1024,
+    tqdm_kwds=None,
+):
+    """
+    Solve for the L1-regularized coefficients of every pixel by cyclic coordinate descent.
+
+    This minimizes the same objective as `_fit_pixel` with `alpha > 0` (a `sklearn` `Lasso` with
+    sample weights and an unpenalized intercept) with the same convergence criteria, but the
+    coordinate updates are vectorized across pixels and can be warm-started.
+
+    :param X:
+        The design matrix without the bias term, with shape `(n_spectra, n_terms - 1)`.
+
+    :param flux:
+        The training set flux, with shape `(n_spectra, n_pixels)`.
+
+    :param ivar:
+        The training set inverse variance, with shape `(n_spectra, n_pixels)`.
+
+    :param alpha:
+        The L1 regularization strength.
+
+    :param initial_theta: [optional]
+        Initial coefficients with shape `(n_terms, n_pixels)`. The bias term is ignored.
+
+    :param max_iter: [optional]
+        The maximum number of coordinate descent iterations.
+
+    :param tol: [optional]
+        The tolerance for the duality gap, relative to the weighted sum of squares of the flux.
+
+    :param precompute: [optional]
+        Ignored. The Gram matrix is always pre-computed. This is accepted for compatibility with
+        the keywords given to `sklearn`.
+
+    :param chunk_size: [optional]
+        The number of pixels to solve at once. Memory scales as `chunk_size * n_terms**2`.
+
+    :returns:
+        A two-length tuple of the coefficients with shape `(n_terms, n_pixels)`, and a dictionary
+        of per-pixel arrays: `n_iter`, `dual_gap` and `warning`.
+    """
+    N, T = X.shape
+    N, P = flux.shape
+    theta = np.zeros((1 + T, P))
+    meta = dict(
+        n_iter=-np.ones(P, dtype=int),
+        dual_gap=np.nan * np.ones(P),
+        warning=np.zeros(P, dtype=bool),
+    )
+    fit = ~np.all(np.isclose(ivar, 0), axis=0)
+    indices = np.where(fit)[0]
+    l1_reg = alpha * N
+    diagonal = np.arange(T)
+    products = _outer_products(X)
+
+    with tqdm(**(tqdm_kwds or dict(total=P, disable=True))) as pb:
+        pb.update(P - indices.size)
+        for si in range(0, indices.size, chunk_size):
+            chunk = indices[si:si + chunk_size]
+
+            # Weights are re-scaled to sum to the number of spectra, as sklearn does.
+            W = ivar[:, chunk].T
+            W = W * (N / np.sum(W, axis=1))[:, np.newaxis]
+            Y = flux[:, chunk].T
+            X_mean = (W @ X) / N
+            Y_mean = np.sum(W * Y, axis=1) / N
+            Q = _weighted_gram_matrices(products, W) - N * X_mean[:, :, np.newaxis] * X_mean[:, np.newaxis]
+            q = (W * Y) @ X - N * X_mean * Y_mean[:, np.newaxis]
+            y_norm2 = np.sum(W * (Y - Y_mean[:, np.newaxis])**2, axis=1)
+            gap_tol = tol * y_norm2
+
+            w = np.zeros((chunk.size, T)) if initial_theta is None else np.array(initial_theta[1:, chunk].T)
+            Qw = (Q @ w[:, :, np.newaxis])[:, :, 0]
+            Q_diag = Q[:, diagonal, diagonal]
+
+            # Arrays for the pixels that have not converged are kept contiguous, and only shrunk as
+            # pixels converge.
+            active = np.arange(chunk.size)
+            Q_, q_, w_, Qw_, Q_diag_ = (Q, q, w, Qw, Q_diag)
+            gap = np.nan * np.ones(chunk.size)
+            n_iter = np.zeros(chunk.size, dtype=int)
+            for iteration in range(max_iter):
+                if active.size == 0:
+                    break
+                d_w_max, w_max = (np.zeros(active.size), np.zeros(active.size))
+                for j in range(T):
+                    w_j = w_[:, j]
+                    tmp = q_[:, j] - Qw_[:, j] + w_j * Q_diag_[:, j]
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        new_w_j = np.where(
+                            Q_diag_[:, j] == 0,
+                            w_j,
+                            np.sign(tmp) * np.clip(np.abs(tmp) - l1_reg, 0, None) / Q_diag_[:, j]
+                        )
+                    d_w_j = new_w_j - w_j
+                    Qw_ += d_w_j[:, np.newaxis] * Q_[:, j]
+                    w_[:, j] = new_w_j
+                    d_w_max = np.maximum(d_w_max, np.abs(d_w_j))
+                    w_max = np.maximum(w_max, np.abs(new_w_j))
+
+                n_iter[active] = iteration + 1
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    check = (w_max == 0) | (d_w_max / w_max <= tol) | (iteration == max_iter - 1)
+                if not np.any(check):
+                    continue
+
+                gap[active[check]] = _lasso_dual_gap(
+                    w_[check], l1_reg, Qw_[check], q_[check], y_norm2[active[check]]
+                )
+                converged = np.zeros(active.size, dtype=bool)
+                converged[check] = gap[active[check]] <= gap_tol[active[check]]
+                if np.any(converged):
+                    w[active[converged]] = w_[converged]
+                    keep = ~converged
+                    active, Q_, q_, w_, Qw_, Q_diag_ = (
+                        active[keep], Q_[keep], q_[keep], w_[keep], Qw_[keep], Q_diag_[keep]
+                    )
+            w[active] = w_
+
+            theta[1:, chunk] = w.T
+            theta[0, chunk] = Y_mean - np.sum(X_mean * w, axis=1)
+            meta["n_iter"][chunk] = n_iter
+            meta["dual_gap"][chunk] = gap / N
+            meta["warning"][chunk] = n_iter >= max_iter
+            pb.update(chunk.size)
+
+    return (theta, meta)
+
+
+def _outer_products(X):
+    """Return the unique elements of the outer product of each row of `X` with itself."""
+    j, k = np.tril_indices(X.shape[1])
+    return X[:, j] * X[:, k]
+
+
+def _weighted_gram_matrices(products, W):
+    """
+    Return the weighted Gram matrices `X.T @ diag(w) @ X` for each row `w` of `W`.
+
+    :param products:
+        The outer products of the design matrix, from `_outer_products(X)`.
+
+    :param W:
+        An array of weights with shape `(n_pixels, n_spectra)`.
+
+    :returns:
+        An array with shape `(n_pixels, n_terms, n_terms)`.
+    """
+    T = int((np.sqrt(8 * products.shape[1] + 1) - 1) / 2)
+    j, k = np.tril_indices(T)
+    unique = W @ products
+    G = np.empty((W.shape[0], T, T))
+    G[:, j, k] = unique
+    G[:, k, j] = unique
+    return G
+
+
+def _lasso_dual_gap(w, alpha, Qw, q, y_norm2):
+    """Return the duality gap of the Lasso problem in the Gram matrix formulation, for many pixels."""
+    q_dot_w = np.sum(w * q, axis=1)
+    R_norm2 = y_norm2 + np.sum(w * Qw, axis=1) - 2.0 * q_dot_w
+    dual_norm_XtA = np.max(np.abs(q - Qw), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        const = np.where(dual_norm_XtA > alpha, alpha / dual_norm_XtA, 1)
+    gap = np.where(dual_norm_XtA > alpha, 0.5 * R_norm2 * (1 + const**2), R_norm2)
+    return gap + alpha * np.sum(np.abs(w), axis=1) - const * (y_norm2 - q_dot_w)
+
+
 def _check_inputs(label_names, labels, flux, ivar, offsets=None, scales=None, **kwargs):
     label_names = list(label_names)
     if len(label_names) > len(set(label_names)):
@@ -760,9 +1425,60 @@ def _evaluate_n_threads(given_n_threads):
     return n_threads
 
     
-def _calculate_s2_single_pixel(i, L2, ivar, s2_steps):
-    adjusted_ivar = ivar/(1 + ivar * s2_steps.reshape((-1, 1)))
-    chi2 = (np.mean(L2 * adjusted_ivar, axis=1) - 1)**2
-    s2 = s2_steps[np.argmin(chi2)]
-    return (i, s2)
-            
\ No newline at end of file
+def _calculate_s2(L2, ivar, s2_steps, large=1e3, max_elements=10_000_000, newton_steps=0):
+    """
+    Calculate the model variance (s^2) for many pixels at once. See `CannonModel._calculate_s2`.
+
+    The mean chi-squared decreases monotonically with s^2, so instead of evaluating every grid point
+    we bisect the grid for the point where it crosses one, and then take the closer of the two
+    neighbouring grid points. This gives the same result as an exhaustive search of the grid.
+
+    :param L2:
+        The squared residuals between the training flux and the model, with shape `(n_spectra, n_pixels)`.
+
+    :param ivar:
+        The inverse variance of the training flux, with shape `(n_spectra, n_pixels)`.
+
+    :param s2_steps:
+        The s^2 values to evaluate, in increasing order.
+    """
+    N, P = L2.shape
+    S = s2_steps.size
+    s2 = large * np.ones(P, dtype=float)
+    indices = np.where(~np.all(ivar == 0, axis=0))[0]
+    chunk_size = max(1, int(max_elements / N))
+
+    for si in range(0, indices.size, chunk_size):
+        chunk = indices[si:si + chunk_size]
+        L2_, ivar_ = (L2[:, chunk], ivar[:, chunk])
+        mean_chi2 = lambda pixel_s2: np.mean(L2_ * ivar_ / (1 + ivar_ * pixel_s2), axis=0)
+
+        # Find the first grid index where the mean chi-squared is at most one.
+        lower, upper = (np.zeros(chunk.size, dtype=int), S * np.ones(chunk.size, dtype=int))
+        while np.any(lower < upper):
+            middle = (lower + upper) // 2
+            below = mean_chi2(s2_steps[np.clip(middle, 0, S - 1)]) <= 1
+            searching = lower < upper
+            upper = np.where(searching & below, middle, upper)
+            lower = np.where(searching & ~below, middle + 1, lower)
+
+        # Choose the closest of the grid points either side of the crossing, preferring the lower.
+        after = np.clip(lower, 0, S - 1)
+        before = np.clip(lower - 1, 0, S - 1)
+        chi2_after = (mean_chi2(s2_steps[after]) - 1)**2
+        chi2_before = (mean_chi2(s2_steps[before]) - 1)**2
+        best = np.where(chi2_before <= chi2_after, before, after)
+        pixel_s2 = s2_steps[best]
+
+        if newton_steps > 0:
+            lower = s2_steps[np.clip(best - 1, 0, S - 1)]
+            upper = s2_steps[np.clip(best + 1, 0, S - 1)]
+            for _ in range(newton_steps):
+                denominator = 1 + ivar_ * pixel_s2
+                f = np.mean(L2_ * ivar_ / denominator, axis=0) - 1
+                df = -np.mean(L2_ * ivar_**2 / denominator**2, axis=0)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    step = np.where(df < 0, f / df, 0)
+                pixel_s2 = np.clip(pixel_s2 - step, lower, upper)
+        s2[chunk] = pixel_s2
+    return s2
@@ -8,11 +8,12 @@ from typing import Iterable, Optional
 
 from astra import task
 from astra.utils import log, executable, expand_path
-from astra.pipelines.the_payne.model import estimate_labels
+from astra.utils.intermediate import IntermediateOutputStore, get_intermediate_output_store_path
+from astra.pipelines.the_payne.model import estimate_labels, estimate_labels_batched
 from astra.pipelines.the_payne.utils import read_mask, read_model
 
 from astra.models.the_payne import ThePayne
-from peewee import ModelSelect
+from peewee import ModelSelect, chunked
 
 @task
 def the_payne(
@@ -29,8 +30,16 @@ def the_payne(
         mask="$MWM_ASTRA/pipelines/ThePayne/cannon_apogee_pixels.npy",
     ),
     page=None,
-    limit=None
+    limit=None,
+    batch_size: Optional[int] = None,
 ) -> Iterable[ThePayne]:
+    """
+    Estimate stellar labels with The Payne.
+
+    If `batch_size` is given (and the radial velocity is not being fit), spectra are fit in batches
+    of this size and the continuum and model flux for all spectra are written to a single HDF5 file,
+    instead of one file per spectrum.
+    """
 
     if isinstance(spectra, ModelSelect):
         if page is not None and limit is not None:
@@ -53,42 +62,172 @@ def the_payne(
         )
     ]
 
+    # The continuum object can be re-used for every spectrum.
+    f_continuum = None if continuum_method is None else executable(continuum_method)(**continuum_kwargs)
+
+    if batch_size is not None and not (v_rad_tolerance is not None and v_rad_tolerance > 0):
+        yield from _the_payne_batched(
+            spectra, 
+            args, 
+            f_continuum, 
+            batch_size, 
+            mask=mask, 
+            initial_labels=initial_labels, 
+            opt_tolerance=opt_tolerance
+        )
+        return
+
     for spectrum in spectra:
-        try:
-            if continuum_method is not None:
-                f_continuum = executable(continuum_method)(**continuum_kwargs)
-                continuum = np.atleast_2d(f_continuum.fit(spectrum))
-            else:
-                continuum = None            
-
-            # With SpectrumList, we should only ever have 1 spectrum
-            (result, ), (meta, ) = estimate_labels(
-                spectrum,
-                *args,
-                mask=mask,
-                initial_labels=initial_labels,
-                v_rad_tolerance=v_rad_tolerance,
-                opt_tolerance=opt_tolerance,
-                continuum=continuum,
-            )
+        yield _the_payne_spectrum(
+            spectrum,
+            args,
+            f_continuum,
+            mask=mask,
+            initial_labels=initial_labels,
+            v_rad_tolerance=v_rad_tolerance,
+            opt_tolerance=opt_tolerance,
+        )
 
-            output = ThePayne(
-                spectrum_pk=spectrum.spectrum_pk,
-                source_pk=spectrum.source_pk,
-                **result
-            )
 
-            path = expand_path(output.intermediate_output_path)
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            with open(path, "wb") as fp:
-                pickle.dump((meta["continuum"], meta["rectified_model_flux"]), fp)
-
-            yield output
-        
-        except:
-            log.exception(f"Exception when fitting spectrum {spectrum}")
-            yield ThePayne(
-                spectrum_pk=spectrum.spectrum_pk,
-                source_pk=spectrum.source_pk,
-                flag_fitting_failure=True
+def _the_payne_spectrum(spectrum, args, f_continuum, continuum=None, **kwargs):
+    """
+    Fit one spectrum with The Payne, and write its intermediate outputs to a pickle file.
+
+    :param spectrum:
+        The spectrum to fit.
+
+    :param args:
+        The network weights, biases, label scales, model wavelength, and label names.
+
+    :param f_continuum:
+        The continuum object to fit the spectrum with, or `None`.
+
+    :param continuum: [optional]
+        The continuum, if it has already been fit.
+
+    :param kwargs:
+        Keyword arguments to pass to `estimate_labels`.
+    """
+    try:
+        if continuum is None and f_continuum is not None:
+            continuum = f_continuum.fit(spectrum)
+        if continuum is not None:
+            continuum = np.atleast_2d(continuum)
+
+        # With SpectrumList, we should only ever have 1 spectrum
+        (result, ), (meta, ) = estimate_labels(spectrum, *args, continuum=continuum, **kwargs)
+
+        output = ThePayne(
+            spectrum_pk=spectrum.spectrum_pk,
+            source_pk=spectrum.source_pk,
+            **result
+        )
+
+        path = expand_path(output.intermediate_output_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            pickle.dump((meta["continuum"], meta["rectified_model_flux"]), fp)
+
+        return output
+
+    except:
+        log.exception(f"Exception when fitting spectrum {spectrum}")
+        return ThePayne(
+            spectrum_pk=spectrum.spectrum_pk,
+            source_pk=spectrum.source_pk,
+            flag_fitting_failure=True
+        )
+
+
+def _the_payne_batched(spectra, args, f_continuum, batch_size, **kwargs):
+    """
+    Fit spectra with The Payne in batches, and write intermediate outputs to one HDF5 file.
+
+    Spectra that are not on the same wavelength grid as the first spectrum of their batch are
+    fit one at a time, as they would be without batching.
+
+    :param spectra:
+        An iterable of spectra.
+
+    :param args:
+        The network weights, biases, label scales, model wavelength, and label names.
+
+    :param f_continuum:
+        The continuum object to fit each spectrum with, or `None`.
+
+    :param batch_size:
+        The number of spectra to fit at once.
+
+    :param kwargs:
+        Keyword arguments to pass to `estimate_labels_batched`.
+    """
+    store_path = get_intermediate_output_store_path("ThePayne")
+    log.info(f"Writing intermediate outputs to {expand_path(store_path)}")
+
+    store = None
+    try:
+        for batch in chunked(spectra, batch_size):
+            fitted, continua = ([], [])
+            for spectrum in batch:
+                try:
+                    continuum = None if f_continuum is None else f_continuum.fit(spectrum)
+                except:
+                    log.exception(f"Exception when fitting continuum for spectrum {spectrum}")
+                    yield ThePayne(
+                        spectrum_pk=spectrum.spectrum_pk,
+                        source_pk=spectrum.source_pk,
+                        flag_fitting_failure=True
+                    )
+                else:
+                    fitted.append(spectrum)
+                    continua.append(continuum)
+            if not fitted:
+                continue
+
+            wavelength = fitted[0].wavelength
+            same_grid = [np.array_equal(wavelength, spectrum.wavelength) for spectrum in fitted]
+            if not all(same_grid):
+                for spectrum, continuum, is_same_grid in zip(fitted, continua, same_grid):
+                    if not is_same_grid:
+                        yield _the_payne_spectrum(spectrum, args, f_continuum, continuum=continuum, **kwargs)
+                fitted = [spectrum for spectrum, is_same_grid in zip(fitted, same_grid) if is_same_grid]
+                continua = [continuum for continuum, is_same_grid in zip(continua, same_grid) if is_same_grid]
+
+            continuum = None if f_continuum is None else np.array(continua)
+            try:
+                results, metas = estimate_labels_batched(
+                    wavelength,
+                    np.array([spectrum.flux for spectrum in fitted]),
+                    np.array([spectrum.ivar for spectrum in fitted]),
+                    *args,
+                    continuum=continuum,
+                    **kwargs
+                )
+            except:
+                log.exception(f"Exception when fitting batch of {len(fitted)} spectra")
+                for spectrum in fitted:
+                    yield ThePayne(
+                        spectrum_pk=spectrum.spectrum_pk,
+                        source_pk=spectrum.source_pk,
+                        flag_fitting_failure=True
+                    )
+                continue
+
+            if store is None:
+                store = IntermediateOutputStore(store_path, wavelength.size).__enter__()
+            store.append(
+                [spectrum.spectrum_pk for spectrum in fitted],
+                continuum=[meta["continuum"] for meta in metas],
+                rectified_model_flux=[meta["rectified_model_flux"] for meta in metas],
             )
+            for spectrum, result, meta in zip(fitted, results, metas):
+                yield ThePayne(
+                    spectrum_pk=spectrum.spectrum_pk,
+                    source_pk=spectrum.source_pk,
+                    intermediate_output_store=store_path,
+                    flag_not_converged=not meta["converged"],
+                    **result
+                )
+    finally:
+        if store is not None:
+            store.__exit__()
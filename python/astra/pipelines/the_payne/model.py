@@ -191,6 +191,257 @@ def estimate_labels(
     return (results, meta_results)
 
 
+def estimate_labels_batched(
+    wavelength: np.ndarray,
+    flux: np.ndarray,
+    ivar: np.ndarray,
+    weights: Tuple[np.ndarray],
+    biases: Tuple[np.ndarray],
+    x_min: Tuple[np.ndarray],
+    x_max: Tuple[np.ndarray],
+    model_wavelength: Tuple[np.ndarray],
+    label_names: Tuple[str],
+    mask: Optional[np.array] = None,
+    initial_labels: Optional[np.array] = None,
+    continuum: Optional[np.array] = None,
+    opt_tolerance: Optional[float] = 5e-4,
+    max_iter: Optional[int] = 100,
+    **kwargs,
+):
+    """
+    Estimate the stellar labels for many spectra on the same wavelength grid at once.
+
+    Instead of fitting each spectrum with `curve_fit` and numerical derivatives, all spectra are
+    fit together with a bounded Levenberg-Marquardt solver that uses the analytic Jacobian of the
+    network. Radial velocity is not fit. The results are close to, but not the same as, those
+    from `estimate_labels`: the two optimizers stop at different points, so the chi-squared values
+    can differ by a few percent, and some spectra can converge to a different local minimum.
+
+    The metadata for each spectrum includes a `converged` entry, which is `False` if the solver
+    stopped because it reached `max_iter` iterations.
+
+    :param wavelength:
+        The observed wavelength array, shared by all spectra.
+
+    :param flux:
+        An array of observed flux values with shape `(n_spectra, n_pixels)`.
+
+    :param ivar:
+        An array of inverse variances with shape `(n_spectra, n_pixels)`.
+
+    :param max_iter: [optional]
+        The maximum number of iterations.
+
+    See `estimate_labels` for a description of the other parameters.
+
+    :returns:
+        A two-length tuple of lists of results and metadata, one per spectrum.
+    """
+    K = weights[0].shape[1]
+    L = K
+
+    all_flux, all_ivar = (np.atleast_2d(flux), np.atleast_2d(ivar))
+    if continuum is not None:
+        all_flux = all_flux / continuum
+        all_ivar = all_ivar * continuum**2
+    N, _ = all_flux.shape
+
+    if mask is None:
+        mask = np.zeros(model_wavelength.shape, dtype=bool)
+    else:
+        assert (
+            mask.shape == model_wavelength.shape
+        ), "Mask and model wavelengths do not have the same shape"
+
+    # Interpolate data onto model wavelengths -- not The Right Thing to do!
+    interpolate_to_model = LinearInterpolator(model_wavelength, wavelength)
+    flux = interpolate_to_model(all_flux, left=1, right=1)
+    ivar = interpolate_to_model(all_ivar, left=0, right=0)
+    ivar[:, mask] = 0
+
+    # Fix non-finite pixels and error values.
+    non_finite = ~np.isfinite(flux) + ~np.isfinite(ivar) + (ivar <= 0)
+    flux[non_finite] = 1
+    ivar[non_finite] = 0
+
+    # "normalize"
+    scale = np.median(flux, axis=1)[:, np.newaxis]
+    flux /= scale
+    ivar *= scale**2
+
+    lower, upper = (-0.5, +0.5)
+    p = np.zeros((N, L)) if initial_labels is None else np.clip(np.broadcast_to(initial_labels, (N, L)), lower, upper)
+
+    def chi2(p, index):
+        return np.sum((predict_stellar_spectra(p, weights, biases) - flux[index])**2 * ivar[index], axis=1)
+
+    def normal_equations(p, index):
+        model_flux, J = predict_stellar_spectra(p, weights, biases, full_output=True)
+        Jw = J.transpose((0, 2, 1)) * ivar[index, np.newaxis]
+        return (Jw @ J, (Jw @ (flux[index] - model_flux)[:, :, np.newaxis])[:, :, 0])
+
+    index = np.arange(N)
+    converged = np.zeros(N, dtype=bool)
+    damping = 1e-3 * np.ones(N)
+    current_chi2 = chi2(p, index)
+    JtJ, g = normal_equations(p, index)
+    for n_iter in range(max_iter):
+        if index.size == 0:
+            break
+        A = JtJ + damping[index, np.newaxis, np.newaxis] * (JtJ * np.eye(L))
+        try:
+            delta = np.linalg.solve(A, g[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            delta = np.array([np.linalg.lstsq(a, b, rcond=-1)[0] for a, b in zip(A, g)])
+
+        # Project the step onto the bounds.
+        p_trial = np.clip(p[index] + delta, lower, upper)
+        step = p_trial - p[index]
+        trial_chi2 = chi2(p_trial, index)
+
+        accept = trial_chi2 <= current_chi2[index]
+        small_reduction = accept & (current_chi2[index] - trial_chi2 <= opt_tolerance * current_chi2[index])
+        small_step = (
+            np.linalg.norm(step, axis=1)
+        <=  opt_tolerance * (opt_tolerance + np.linalg.norm(p[index], axis=1))
+        )
+        p[index[accept]] = p_trial[accept]
+        current_chi2[index[accept]] = trial_chi2[accept]
+        damping[index[accept]] = np.clip(damping[index[accept]] / 10, 1e-15, None)
+        damping[index[~accept]] *= 10
+
+        done = small_reduction | small_step | (damping[index] > 1e15)
+        converged[index[done]] = True
+        update = accept & ~done
+        if np.any(update):
+            JtJ[update], g[update] = normal_equations(p[index[update]], index[update])
+        index, JtJ, g = (index[~done], JtJ[~done], g[~done])
+
+    JtJ, _ = normal_equations(p, np.arange(N))
+    p_cov = np.linalg.pinv(JtJ)
+    model_flux = predict_stellar_spectra(p, weights, biases)
+    interpolate_to_data = LinearInterpolator(wavelength, model_wavelength)
+    resampled_model_flux = interpolate_to_data(model_flux, left=np.nan, right=np.nan)
+
+    results = []
+    meta_results = []
+    for i in range(N):
+        result = OrderedDict([])
+        if not np.all(np.isfinite(p[i])) or not np.all(np.isfinite(p_cov[i])):
+            log.error(f"Error occurred fitting spectrum {i}: non-finite labels or covariance")
+            result.update(dict(zip(label_names, [np.nan] * len(label_names))))
+            result.update(dict(zip([f"e_{ln}" for ln in label_names], [np.nan] * len(label_names))))
+            for j, k in zip(*np.triu_indices(L, 1)):
+                result[f"rho_{label_names[j]}_{label_names[k]}"] = np.nan
+            result.update(OrderedDict([
+                    ("chi_sq", np.nan),
+                    ("reduced_chi_sq", np.nan),
+                    ("bitmask_flag", 1), # TODO: bitmask flag definitions
+                ])
+            )
+            meta = OrderedDict([("rectified_model_flux", np.nan * np.ones(wavelength.size))])
+        else:
+            labels = (p[i] + 0.5) * (x_max - x_min) + x_min
+            e_labels = np.sqrt(np.diag(p_cov[i])) * (x_max - x_min)
+
+            result.update(dict(zip(label_names, labels)))
+            result.update(dict(zip([f"e_{ln}" for ln in label_names], e_labels)))
+
+            rho = np.corrcoef(p_cov[i])
+            for j, k in zip(*np.triu_indices(L, 1)):
+                result[f"rho_{label_names[j]}_{label_names[k]}"] = rho[j, k]
+
+            chi2_ = np.sum(((model_flux[i] - flux[i])** 2 * ivar[i]))
+            reduced_chi2 = chi2_ / (np.sum(ivar[i] > 0) - L - 1)
+            result.update(
+                OrderedDict([
+                    ("chi2", chi2_),
+                    ("reduced_chi2", reduced_chi2),
+                    ("bitmask_flag", 0), # TODO: bitmask flag definitions
+                ])
+            )
+            meta = OrderedDict([("rectified_model_flux", resampled_model_flux[i])])
+        if continuum is not None:
+            meta["continuum"] = continuum[i]
+        else:
+            meta["continuum"] = np.ones(wavelength.size)
+        meta["converged"] = converged[i]
+
+        results.append(result)
+        meta_results.append(meta)
+
+    return (results, meta_results)
+
+
+class LinearInterpolator:
+
+    """
+    Linearly interpolate many arrays that share the same `xp` onto the same `x`, like `np.interp`.
+
+    The interpolation indices and weights are computed once, so interpolating each array is cheap.
+
+    :param x:
+        The coordinates to interpolate at.
+
+    :param xp:
+        The (increasing) coordinates of the data points.
+    """
+
+    def __init__(self, x, xp):
+        self.x, self.xp = (np.asarray(x), np.asarray(xp))
+        self.index = np.clip(np.searchsorted(self.xp, self.x, side="right") - 1, 0, self.xp.size - 2)
+        self.t = (self.x - self.xp[self.index]) / (self.xp[self.index + 1] - self.xp[self.index])
+        self.is_left, self.is_right = (self.x < self.xp[0], self.x > self.xp[-1])
+        return None
+
+    def __call__(self, fp, left=None, right=None):
+        """
+        Interpolate the data points.
+
+        :param fp:
+            An array of data values, with the last axis corresponding to `xp`.
+
+        :param left: [optional]
+            The value to return for `x < xp[0]` (default: `fp[..., 0]`).
+
+        :param right: [optional]
+            The value to return for `x > xp[-1]` (default: `fp[..., -1]`).
+        """
+        fp = np.asarray(fp)
+        y = fp[..., self.index] * (1 - self.t) + fp[..., self.index + 1] * self.t
+        y[..., self.is_left] = fp[..., :1] if left is None else left
+        y[..., self.is_right] = fp[..., -1:] if right is None else right
+        return y
+
+
+def predict_stellar_spectra(unscaled_labels, weights, biases, full_output=False):
+    """
+    Predict stellar spectra for many sets of labels at once.
+
+    :param unscaled_labels:
+        An array of labels with shape `(n_spectra, n_labels)`.
+
+    :param full_output: [optional]
+        Also return the Jacobian of the spectra with respect to the labels, with shape
+        `(n_spectra, n_pixels, n_labels)`.
+    """
+    unscaled_labels = np.atleast_2d(unscaled_labels)
+    inside = unscaled_labels @ weights[0].T + biases[0]
+    outside = leaky_relu(inside) @ weights[1].T + biases[1]
+    flux = leaky_relu(outside) @ weights[2].T + biases[2]
+    if not full_output:
+        return flux
+
+    # Chain rule through both layers: W_2 @ diag(f'(outside)) @ W_1 @ diag(f'(inside)) @ W_0
+    J = leaky_relu_derivative(inside)[:, :, np.newaxis] * weights[0]
+    J = leaky_relu_derivative(outside)[:, :, np.newaxis] * (weights[1] @ J)
+    return (flux, weights[2] @ J)
+
+
+def leaky_relu_derivative(z):
+    return 1.0 * (z > 0) + 0.01 * (z < 0)
+
+
 def leaky_relu(z):
     return z * (z > 0) + 0.01 * z * (z < 0)
 
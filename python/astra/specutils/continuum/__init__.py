@@ -1,4 +1,4 @@
 """Methods to represent the convolution of the stellar continuum with the instrument response."""
 #from .scalar import Scalar
-#from .sinusoids import Sinusoids
+from astra.specutils.continuum.sinusoids import Sinusoids
 from astra.specutils.continuum.chebyshev import Chebyshev
@@ -2,6 +2,7 @@
 
 import numpy as np
 from typing import Optional, Union, Tuple, List
+from astra.utils import expand_path
 
 class Continuum:
 
@@ -32,14 +33,16 @@ class Continuum:
         return None
 
     def _initialize(self, wavelength):
-        try:
-            self._initialized_args
-        except AttributeError:
-            self._initialized_args = _pixel_slice_and_mask(
-                wavelength, self.regions, self.mask
-            )
-        finally:
-            return self._initialized_args
+        """
+        Return the region slices and continuum pixel indices for a wavelength array.
+
+        These are cached for each wavelength array, so they are only computed once per grid.
+        """
+        return cached_by_wavelength(
+            self.__dict__.setdefault("_initialized_args_by_wavelength", {}),
+            wavelength,
+            lambda w: _pixel_slice_and_mask(w, self.regions, self.mask)
+        )
 
 
     @property
@@ -85,6 +88,72 @@ class Continuum:
     
     
 
+def cached_by_wavelength(cache, wavelength, f, max_size=16):
+    """
+    Return `f(wavelength)` from a cache keyed by the wavelength array, or compute and store it.
+
+    :param cache:
+        A dictionary to use as the cache.
+
+    :param wavelength:
+        The wavelength array.
+
+    :param f:
+        A callable that takes the wavelength array.
+
+    :param max_size: [optional]
+        The maximum number of entries to keep. The oldest entry is removed first.
+    """
+    wavelength = np.ascontiguousarray(wavelength)
+    key = (wavelength.size, hash(wavelength.tobytes()))
+    try:
+        return cache[key]
+    except KeyError:
+        if len(cache) >= max_size:
+            cache.pop(next(iter(cache)))
+        cache[key] = value = f(wavelength)
+        return value
+
+
+def weighted_least_squares(A, flux, weight, ridge=0):
+    """
+    Solve weighted least-squares problems that share the same design matrix, all at once.
+
+    :param A:
+        The design matrix, with shape `(n_pixels, n_parameters)`.
+
+    :param flux:
+        An array of flux values with shape `(n_spectra, n_pixels)`. Non-finite values must have
+        zero weight.
+
+    :param weight:
+        An array of weights (e.g., inverse variances) with shape `(n_spectra, n_pixels)`.
+
+    :param ridge: [optional]
+        Add this fraction of the largest eigenvalue of each problem to the diagonal of its normal
+        equations.
+
+    :returns:
+        An array of parameters with shape `(n_spectra, n_parameters)`. Problems without any weight
+        have all parameters set to zero.
+    """
+    N, P = weight.shape
+    K = A.shape[1]
+    ATA = (weight @ (A[:, :, np.newaxis] * A[:, np.newaxis, :]).reshape((P, -1))).reshape((N, K, K))
+    ATy = (weight * np.where(weight > 0, flux, 0)) @ A
+    if ridge > 0:
+        ATA[:, np.arange(K), np.arange(K)] += ridge * np.linalg.eigvalsh(ATA)[:, -1:]
+
+    empty = ~np.any(weight > 0, axis=1)
+    ATA[empty] = np.eye(K)
+    ATy[empty] = 0
+    try:
+        return np.linalg.solve(ATA, ATy[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        # Some problems are singular (e.g., too few pixels), so use the minimum-norm solution.
+        return (np.linalg.pinv(ATA) @ ATy[:, :, np.newaxis])[:, :, 0]
+
+
 def _pixel_slice_and_mask(
     wavelength: np.array,
     regions: Optional[List[Tuple[float, float]]] = None,
@@ -141,4 +210,3 @@ def _pixel_slice_and_mask(
                 region_masks.append(np.where(~mask[lower:upper])[0] + lower)
 
     return (region_slices, region_masks)
-    
\ No newline at end of file
@@ -5,7 +5,7 @@ import numpy as np
 #from astra.tools.spectrum import SpectralAxis, Spectrum1D
 from typing import Optional, Union, Tuple, List
 from astropy.nddata import StdDevUncertainty
-from astra.specutils.continuum.base import Continuum
+from astra.specutils.continuum.base import Continuum, cached_by_wavelength, weighted_least_squares
 
 
 class Chebyshev(Continuum):
@@ -40,34 +40,19 @@ class Chebyshev(Continuum):
         return None
 
     def fit(self, spectrum):
-        _initialized_args = self._initialize(spectrum.wavelength)
-        
+        region_slices, region_masks, A_region, A_continuum = self._initialize_design_matrices(spectrum.wavelength)
+
         flux, ivar = (np.atleast_2d(spectrum.flux), np.atleast_2d(spectrum.ivar))
         N, P = flux.shape
-        
+
         self.theta = np.empty((N, self.num_regions, self.deg + 1))
-        for i in range(N):
-            for j, ((lower, upper), indices) in enumerate(zip(*_initialized_args)):
-                x = np.linspace(-1, 1, upper - lower)
-                # Restrict to finite values.
-                y = flux[i, indices]
-                w = np.sqrt(ivar[i, indices])
-                finite = np.isfinite(y * w)
-                f = np.polynomial.Chebyshev.fit(
-                    x[indices - lower][finite],
-                    y[finite],
-                    self.deg,
-                    w=w[finite],
-                )
-                self.theta[i, j] = f.convert().coef
-
-        continuum = self.fill_value * np.ones((N, P))
-        for i in range(N):
-            for j, ((lower, upper), _) in enumerate(zip(*_initialized_args)):
-                continuum[i, slice(lower, upper)] = np.polynomial.chebyshev.chebval(
-                    np.linspace(-1, 1, upper - lower), self.theta[i, j]
-                )
-        return continuum.reshape(spectrum.flux.shape)
+        for j, (indices, A) in enumerate(zip(region_masks, A_continuum)):
+            # Restrict to finite values by giving everything else zero weight.
+            y, w = (flux[:, indices], ivar[:, indices])
+            w = np.where(np.isfinite(y * np.sqrt(w)), w, 0)
+            self.theta[:, j] = weighted_least_squares(A, y, w)
+
+        return self._evaluate(self.theta, region_slices, A_region, P).reshape(spectrum.flux.shape)
 
 
     def __call__(
@@ -78,17 +63,37 @@ class Chebyshev(Continuum):
     ) -> np.ndarray:
         if theta is None:
             theta = self.theta
+        if wavelength is None:
+            wavelength = self.wavelength
+
+        region_slices, _, A_region, _ = self._initialize_design_matrices(wavelength)
+        return self._evaluate(np.atleast_3d(theta), region_slices, A_region, wavelength.size)
+
 
-        _initialized_args = self._initialize(wavelength)
+    def _evaluate(self, theta, region_slices, A_region, P):
+        theta = theta.reshape((-1, self.num_regions, self.deg + 1))
+        continuum = self.fill_value * np.ones((theta.shape[0], P))
+        for j, ((lower, upper), A) in enumerate(zip(region_slices, A_region)):
+            continuum[:, lower:upper] = theta[:, j] @ A.T
+        return continuum
 
-        #N, P = self._get_shape(spectrum)
-        
-        
-        continuum = self.fill_value * np.ones((N, P))
 
-        for i in range(N):
-            for j, ((lower, upper), _) in enumerate(zip(*_initialized_args)):
-                continuum[i, slice(lower, upper)] = np.polynomial.chebyshev.chebval(
-                    np.linspace(-1, 1, upper - lower), self.theta[i, j]
-                )
-        return continuum.reshape(spectrum.flux.shape)
+    def _initialize_design_matrices(self, wavelength):
+        """
+        Return the region slices, continuum pixel indices, and the Chebyshev design matrices for
+        all pixels and continuum pixels in each region. These are cached for each wavelength array.
+        """
+        def initialize(wavelength):
+            region_slices, region_masks = self._initialize(wavelength)
+            A_region, A_continuum = ([], [])
+            for (lower, upper), indices in zip(region_slices, region_masks):
+                A = np.polynomial.chebyshev.chebvander(np.linspace(-1, 1, upper - lower), self.deg)
+                A_region.append(A)
+                A_continuum.append(A[indices - lower])
+            return (region_slices, region_masks, A_region, A_continuum)
+
+        return cached_by_wavelength(
+            self.__dict__.setdefault("_design_matrices_by_wavelength", {}),
+            wavelength,
+            initialize
+        )
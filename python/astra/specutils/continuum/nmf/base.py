@@ -3,9 +3,10 @@ import numpy as np
 import warnings
 import pickle
 from astra.utils import expand_path
-from functools import cache
+from functools import cache, cached_property
 from typing import Optional, Tuple
 from scipy import optimize as op
+from scipy import sparse
 from sklearn.decomposition._nmf import _fit_coordinate_descent
 from sklearn.exceptions import ConvergenceWarning
 
@@ -62,29 +63,59 @@ class BaseNMFSinusoidsContinuum(object):
     def n_parameters_per_region(self):
         return 2 * self.deg + 1
 
-    def _theta_step(self, flux, ivar, rectified_flux):        
-        N, P = flux.shape
-        theta = np.zeros((N, self.n_regions, self.n_parameters_per_region))
-        continuum = np.nan * np.ones_like(flux)
-        continuum_flux = flux / rectified_flux
-        continuum_ivar = ivar * rectified_flux**2
-        for i in range(N):            
-            #for j, (A, mask) in enumerate(zip(*self._dmm)):
-            for j, mask in enumerate(self.region_masks):
-                sj, ej = (j * self.n_parameters_per_region, (j + 1) * self.n_parameters_per_region)
-                A = self.continuum_design_matrix[mask, sj:ej]
-                MTM = A.T @ (continuum_ivar[i, mask][:, None] * A)
-                MTy = A.T @ (continuum_ivar[i, mask] * continuum_flux[i, mask])
-                try:
-                    theta[i, j] = np.linalg.solve(MTM, MTy)
-                except np.linalg.LinAlgError:
-                    if np.any(continuum_ivar[i, mask] > 0):
-                        raise
-                continuum[i, mask] = A @ theta[i, j]        
+    def _theta_step(self, flux, ivar, rectified_flux):
+        """
+        Solve for the continuum coefficients of every spectrum and region, given the rectified flux.
+
+        Every region uses the same sinusoid basis, so the normal equations for all (spectrum, region)
+        blocks are formed at once, and solved with one batched solve.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values.
 
+        :param rectified_flux:
+            A (P, ) or (N, P) shape array of rectified flux values.
+
+        :returns:
+            A two-length tuple of the (N, R, D) shape array of continuum coefficients, and the
+            (N, P) shape array of continuum values.
+        """
+        N, P = flux.shape
+        R, D = (self.n_regions, self.n_parameters_per_region)
+        
+        # (flux - rectified_flux * continuum)**2 * ivar, without dividing by the rectified flux
+        weight = ivar * rectified_flux**2
+        MTM = (weight @ self._continuum_design_matrix_outer_products).reshape((N, R, D, D))
+        MTy = ((ivar * rectified_flux * flux) @ self.continuum_design_matrix).reshape((N, R, D))
+
+        # Regions without any data have no constraints, so their coefficients are zero.
+        no_data = ~np.any(MTM.reshape((N, R, -1)), axis=-1)
+        MTM[no_data] = np.eye(D)
+        MTy[no_data] = 0
+        theta = np.linalg.solve(MTM, MTy[..., np.newaxis])[..., 0]
+        continuum = theta.reshape((N, R * D)) @ self.continuum_design_matrix.T
+        continuum[:, self._outside_regions] = np.nan
         return (theta, continuum)
 
 
+    @cached_property
+    def _continuum_design_matrix_outer_products(self):
+        # Each pixel is in at most one region, so we only need the outer products within a region.
+        R, D = (self.n_regions, self.n_parameters_per_region)
+        A = self.continuum_design_matrix.reshape((-1, R, D))
+        return (A[:, :, :, np.newaxis] * A[:, :, np.newaxis, :]).reshape((-1, R * D * D))
+
+
+    @cached_property
+    def _outside_regions(self):
+        outside = np.ones(self.dispersion.size, dtype=bool)
+        outside[np.hstack(self.region_masks)] = False
+        return outside
+
+
     def _W_step(self, mean_rectified_flux, W, **kwargs):
         absorption = 1 - mean_rectified_flux
         use = np.zeros(mean_rectified_flux.size, dtype=bool)
@@ -138,8 +169,36 @@ class BaseNMFSinusoidsContinuum(object):
 
 
     def continuum(self, wavelength, theta):
-        C, P = self.components.shape
-        
+        """
+        Return the continuum given the wavelengths and continuum parameters.
+
+        :param wavelength:
+            The wavelengths to evaluate the continuum at.
+
+        :param theta:
+            The continuum parameters for one spectrum, or an array of shape `(n_spectra, n_parameters)`
+            for many spectra.
+
+        :returns:
+            An array of shape `(n_spectra, n_pixels)`.
+        """
+        A = self._get_continuum_design_matrix(wavelength)
+        return np.atleast_2d(theta) @ A.T
+
+
+    def _get_continuum_design_matrix(self, wavelength):
+        # The design matrix only depends on the wavelengths, which are usually the same for every
+        # spectrum, so we keep the most recent one.
+        if np.array_equal(wavelength, self.dispersion):
+            return self.continuum_design_matrix
+        try:
+            cached_wavelength, A = self._cached_continuum_design_matrix
+        except AttributeError:
+            pass
+        else:
+            if np.array_equal(wavelength, cached_wavelength):
+                return A
+
         A = np.zeros(
             (wavelength.size, self.n_regions * self.n_parameters_per_region), 
             dtype=float
@@ -148,8 +207,8 @@ class BaseNMFSinusoidsContinuum(object):
             si = i * self.n_parameters_per_region
             ei = (i + 1) * self.n_parameters_per_region
             A[mask, si:ei] = design_matrix(wavelength[mask], self.deg, self.L).T
-        
-        return (A @ theta).reshape((-1, P))
+        self._cached_continuum_design_matrix = (np.copy(wavelength), A)
+        return A
 
     def _predict(self, theta, A_slice, C, P):
         return (1 - theta[:C] @ self.components) * (A_slice @ theta[C:]).reshape((-1, P))
@@ -159,15 +218,12 @@ class BaseNMFSinusoidsContinuum(object):
     def __call__(self, theta, A_slice=None, full_output=False):
         C, P = self.components.shape
         
-        if A_slice is None:
-            T = len(theta)
-            R = self.n_regions
-            N = int((T - C) / (R * (self.n_parameters_per_region)))
-            A = self.full_design_matrix(N)
-            A_slice = A[:, C:]
-
         rectified_flux = 1 - theta[:C] @ self.components
-        continuum = (A_slice @ theta[C:]).reshape((-1, P))
+        if A_slice is None:
+            # Every spectrum has the same (block-diagonal) design matrix, so we don't need to build it.
+            continuum = np.reshape(theta[C:], (-1, self.continuum_design_matrix.shape[1])) @ self.continuum_design_matrix.T
+        else:
+            continuum = (A_slice @ theta[C:]).reshape((-1, P))
         flux = rectified_flux * continuum
 
         if not full_output:
@@ -196,44 +252,98 @@ class BaseNMFSinusoidsContinuum(object):
     
 
     def get_initial_guess_with_small_W(self, flux, ivar, A=None, small=1e-12):
+        """
+        Return an initial guess with small NMF coefficients, where the continuum coefficients are
+        the weighted least-squares solution for a rectified flux of one.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+        
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values.
+
+        :param A: [optional]
+            Ignored. This is kept for compatibility with other initial guess functions.
+
+        :param small: [optional]
+            The value of all NMF coefficients.
+        """
         with warnings.catch_warnings():        
             warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-            N, P = flux.shape
-            if A is None:
-                A = self.full_design_matrix(N)
-            Y = flux.flatten()
-            use = ~self.get_mask(ivar).flatten()
-            result = op.lsq_linear(
-                A[use],
-                Y[use],
-                bounds=self.get_bounds(N, [-np.inf, 0]),
-            )
-            
             C, P = self.components.shape
-            return np.hstack([small * np.ones(C), result.x[C:]])
+            ivar = np.where(self.get_mask(ivar), 0, ivar)
+            theta, _ = self._theta_step(flux, ivar, 1 - small * np.sum(self.components, axis=0))
+            return np.hstack([small * np.ones(C), theta.flatten()])
                     
 
     def get_initial_guess_by_linear_least_squares_with_bounds(self, flux, ivar, A=None):
+        """
+        Return an initial guess by solving the linear problem `flux = W @ components + continuum`
+        (with `W <= 0`) for all spectra, and then taking a NMF step given that continuum.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+        
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values. Only pixels with positive
+            inverse variance are used, but they are not weighted.
+
+        :param A: [optional]
+            Ignored. This is kept for compatibility with other initial guess functions.
+        """
         with warnings.catch_warnings():        
             warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-            N, P = flux.shape
-            if A is None:
-                A = self.full_design_matrix(N)
-            Y = flux.flatten()
-            use = ~self.get_mask(ivar).flatten()            
-            result = op.lsq_linear(
-                A[use],
-                Y[use],
-                bounds=self.get_bounds(N, [-np.inf, 0]),
-            )
             C, P = self.components.shape
-            continuum = (A[:, C:] @ result.x[C:]).reshape(flux.shape)
+            W, theta = self._linear_least_squares_with_bounds(flux, (~self.get_mask(ivar)).astype(float))
+            continuum = self.continuum(self.dispersion, theta.reshape((flux.shape[0], -1)))
 
             mean_rectified_flux, _ = self.get_mean_rectified_flux(flux, ivar, continuum)
-            W_next, *_ = self._W_step(mean_rectified_flux, result.x[:C].astype(np.float64).reshape((1, C))) #np.zeros((1, C), dtype=np.float64))        
-            return np.hstack([W_next.flatten(), result.x[C:]])
+            W_next, *_ = self._W_step(mean_rectified_flux, W.reshape((1, C)))
+            return np.hstack([W_next.flatten(), theta.flatten()])
+
+
+    def _linear_least_squares_with_bounds(self, flux, weight):
+        """
+        Solve the linear problem `flux = W @ components + continuum` for all spectra, with `W <= 0`.
+
+        The continuum coefficients of every (spectrum, region) block are eliminated from the normal
+        equations, which leaves a small bounded problem for `W`.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+        
+        :param weight:
+            A (N, P) shape array of weights for each pixel.
+
+        :returns:
+            A two-length tuple of the (C, ) shape array of NMF coefficients, and the (N, R, D) shape
+            array of continuum coefficients.
+        """
+        N, P = flux.shape
+        R, D = (self.n_regions, self.n_parameters_per_region)
+        H, A = (self.components, self.continuum_design_matrix)
+        C = H.shape[0]
+
+        MTM = (weight @ self._continuum_design_matrix_outer_products).reshape((N, R, D, D))
+        MTy = ((weight * flux) @ A).reshape((N, R, D))
+        HTM = ((weight[:, np.newaxis, :] * H) @ A).reshape((N, C, R, D)).transpose((0, 2, 1, 3))
+
+        no_data = ~np.any(MTM.reshape((N, R, -1)), axis=-1)
+        MTM[no_data] = np.eye(D)
+        MTy[no_data] = 0
+        HTM[no_data] = 0
+
+        # theta = z - X @ W for every block, so we can solve for W first.
+        X = np.linalg.solve(MTM, HTM.transpose((0, 1, 3, 2)))
+        z = np.linalg.solve(MTM, MTy[..., np.newaxis])[..., 0]
+        HTH = (H * np.sum(weight, axis=0)) @ H.T - np.einsum("nrcd,nrde->ce", HTM, X)
+        HTy = H @ np.sum(weight * flux, axis=0) - np.einsum("nrcd,nrd->c", HTM, z)
+
+        W = -_nnls_normal_equations(HTH, -HTy, np.zeros(C))
+        theta = z - X @ W
+        return (W, theta)
 
 
     def get_mean_rectified_flux(self, flux, ivar, continuum):
@@ -262,56 +372,87 @@ class BaseNMFSinusoidsContinuum(object):
         return (mean_rectified_flux, mean_rectified_ivar)
 
 
-    def fit(self, flux: np.ndarray, ivar: np.ndarray, x0=None, full_output=False, **kwargs):
+    def fit(
+        self, 
+        flux: np.ndarray, 
+        ivar: np.ndarray, 
+        x0=None, 
+        full_output=False, 
+        method: Optional[str] = "alternating",
+        warm_start=None,
+        **kwargs
+    ):
+        """
+        Fit the NMF coefficients (shared by all spectra) and the continuum coefficients (one set per
+        spectrum and region) to the given spectra.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values.
+
+        :param x0: [optional]
+            The initial NMF and continuum coefficients.
+
+        :param full_output: [optional]
+            Return a two-length tuple of the continuum and a dictionary of results.
+
+        :param method: [optional]
+            The optimization method to use. The default (`alternating`) exploits the block
+            structure of the problem: it alternates between a non-negative least-squares step for
+            the NMF coefficients and linear least-squares steps for the continuum coefficients,
+            before finishing with a bounded solver that uses the (sparse) analytic Jacobian. If
+            `curve_fit`, all coefficients are fit with `scipy.optimize.curve_fit` and a dense
+            design matrix.
+
+        :param warm_start: [optional]
+            NMF and continuum coefficients from a previous fit (e.g., of an earlier reduction of the
+            same spectra). The fit starts from these, and if it does not converge then it is repeated
+            from `x0`. The result dictionary records whether the warm start was used (`warm_started`),
+            and the number of iterations (`n_iter`) and function evaluations (`nfev`) of all attempts.
+
+        :param kwargs: [optional]
+            Keyword arguments to pass to `fit_alternating` (e.g., `max_iter`, `tol`, `polish`).
+
+        :raises RuntimeError:
+            If the fit from `x0` does not converge.
+        """
 
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-            if kwargs.get("check_shapes", True):
+            if kwargs.pop("check_shapes", True):
                 flux, ivar = _check_and_reshape_flux_ivar(self.dispersion, flux, ivar)
 
-            N, P = flux.shape
-            A = self.full_design_matrix(N)
-            if x0 is None:
-                x0_callables = (
-                    self.get_initial_guess_with_small_W, # this one is faster and seems to be less prone to getting into runtimeerrors at optimisation time
-                    self.get_initial_guess_by_linear_least_squares_with_bounds,
-                )
-            else:
-                x0_callables = [lambda *_: x0]
-        
-            # build a mas using ivar and region masks
+            # build a mask using ivar and region masks
             use = ~self.get_mask(ivar).flatten()
-            sigma = ivar**-0.5
-            
-            C, P = self.components.shape
-            A_slice = A[:, C:]
-            
-            def f(_, *params):
-                
-                return self._predict(params, A_slice=A_slice, C=C, P=P).flatten()[use]
-                #chi2 = (r - flux.flatten()[use]) * ivar.flatten()[use]
-                #print(np.nansum(chi2))#, *params)
-                #return r
-                
+
+            if method == "alternating":
+                f = lambda x0: self.fit_alternating(flux, ivar, x0=x0, full_output=True, **kwargs)
+            elif method == "curve_fit":
+                f = lambda x0: self._fit_curve_fit(flux, ivar, use, x0=x0)
+            else:
+                raise ValueError(f"Unknown method '{method}' (available: alternating, curve_fit)")
+
+            n_iter, nfev, warm_started = (0, 0, False)
+            if warm_start is not None and np.all(np.isfinite(warm_start)):
+                try:
+                    p_opt, meta = f(np.asarray(warm_start, dtype=float))
+                except (RuntimeError, np.linalg.LinAlgError):
+                    meta = dict(converged=False)
+                else:
+                    n_iter, nfev = (meta["n_iter"], meta["nfev"])
+                warm_started = meta["converged"]
             
-            for x0_callable in x0_callables:
-                x0 = x0_callable(flux, ivar, A)
-                try:                            
-                    p_opt, cov = op.curve_fit(
-                        f,
-                        None,
-                        flux.flatten()[use],
-                        p0=x0,
-                        sigma=sigma.flatten()[use],
-                        bounds=self.get_bounds(flux.shape[0])
+            if not warm_started:
+                p_opt, meta = f(x0)
+                n_iter, nfev = (n_iter + meta["n_iter"], nfev + meta["nfev"])
+                if not meta["converged"]:
+                    raise RuntimeError(
+                        f"Optimization failed to converge after {meta['n_iter']} iterations "
+                        f"and {meta['nfev']} function evaluations"
                     )
-                except RuntimeError:
-                    continue
-                else:
-                    break
-            else:
-                raise RuntimeError(f"Optimization failed")
             
             model_flux, rectified_model_flux, continuum = self(p_opt, full_output=True)
 
@@ -329,7 +470,10 @@ class BaseNMFSinusoidsContinuum(object):
                 continuum=continuum,
                 mask=~use,
                 pixel_chi2=chi2,
-                rchi2=rchi2
+                rchi2=rchi2,
+                n_iter=n_iter,
+                nfev=nfev,
+                warm_started=warm_started,
             )
 
             if full_output:
@@ -338,6 +482,179 @@ class BaseNMFSinusoidsContinuum(object):
                 return continuum
 
 
+    def _fit_curve_fit(self, flux, ivar, use, x0=None):
+        N, P = flux.shape
+        A = self.full_design_matrix(N)
+        if x0 is None:
+            x0_callables = (
+                self.get_initial_guess_with_small_W, # this one is faster and seems to be less prone to getting into runtimeerrors at optimisation time
+                self.get_initial_guess_by_linear_least_squares_with_bounds,
+            )
+        else:
+            x0_callables = [lambda *_: x0]
+    
+        sigma = ivar**-0.5
+        
+        C, P = self.components.shape
+        A_slice = A[:, C:]
+        
+        def f(_, *params):
+            return self._predict(params, A_slice=A_slice, C=C, P=P).flatten()[use]
+        
+        for x0_callable in x0_callables:
+            x0 = x0_callable(flux, ivar, A)
+            try:                            
+                p_opt, cov, info, *_ = op.curve_fit(
+                    f,
+                    None,
+                    flux.flatten()[use],
+                    p0=x0,
+                    sigma=sigma.flatten()[use],
+                    bounds=self.get_bounds(flux.shape[0]),
+                    full_output=True
+                )
+            except RuntimeError:
+                continue
+            else:
+                return (p_opt, dict(n_iter=0, nfev=info["nfev"], converged=True))
+        else:
+            raise RuntimeError(f"Optimization failed")
+
+
+    def fit_alternating(self, flux, ivar, x0=None, max_iter=1000, tol=1e-8, polish=True, full_output=False, **kwargs):
+        """
+        Fit the NMF and continuum coefficients by exploiting the block structure of the problem.
+
+        The NMF coefficients `W` are shared by all spectra, and the continuum coefficients `theta`
+        are independent for every spectrum and region. Given `W`, the `theta` for every block are
+        found by linear least-squares. Given `theta`, `W` is found by non-negative least-squares
+        using the (small) normal equations. These steps are repeated until the relative change in
+        chi-squared is less than `tol`, and then all coefficients are optimized together with a
+        bounded trust region solver and the analytic (sparse) Jacobian.
+
+        :param flux:
+            A (N, P) shape array of flux values.
+
+        :param ivar:
+            A (N, P) shape array of inverse variances on flux values.
+
+        :param x0: [optional]
+            The initial NMF and continuum coefficients. If `None`, the NMF coefficients start at zero.
+
+        :param max_iter: [optional]
+            The maximum number of alternating iterations.
+
+        :param tol: [optional]
+            The relative change in chi-squared to stop alternating.
+
+        :param polish: [optional]
+            Optimize all coefficients together after alternating.
+
+        :param full_output: [optional]
+            Also return a dictionary with the number of alternating iterations (`n_iter`), the
+            number of function evaluations when polishing (`nfev`), and whether both stages
+            converged (`converged`).
+
+        :param kwargs: [optional]
+            Keyword arguments to pass to `scipy.optimize.least_squares` when polishing.
+
+        :returns:
+            An array of the NMF coefficients followed by the continuum coefficients.
+        """
+        C, P = self.components.shape
+        N = flux.shape[0]
+        use = ~self.get_mask(ivar)
+        ivar = np.where(use, ivar, 0)
+
+        if x0 is None:
+            W = np.zeros(C)
+            theta, continuum = self._theta_step(flux, ivar, np.ones(P))
+        else:
+            W = np.clip(x0[:C], 0, None)
+            theta = x0[C:]
+            continuum = self.continuum(self.dispersion, theta.reshape((N, -1)))
+
+        chi2, converged = (np.inf, False)
+        for n_iter in range(1, max_iter + 1):
+            W = self._nnls_W_step(flux, ivar, continuum, W)
+            rectified_flux = 1 - W @ self.components
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", category=RuntimeWarning)
+                theta, continuum = self._theta_step(flux, ivar, rectified_flux)
+            previous_chi2, chi2 = (chi2, np.sum(((flux - rectified_flux * continuum)**2 * ivar)[use]))
+            if (previous_chi2 - chi2) <= tol * chi2:
+                converged = np.isfinite(chi2)
+                break
+
+        p_opt, nfev = (np.hstack([W, theta.flatten()]), 0)
+        if polish:
+            result = self._least_squares_with_sparse_jacobian(flux, ivar, p_opt, **kwargs)
+            p_opt, nfev = (result.x, result.nfev)
+            converged &= (result.status > 0)
+        
+        if full_output:
+            return (p_opt, dict(n_iter=n_iter, nfev=nfev, converged=converged))
+        return p_opt
+
+
+    def _nnls_W_step(self, flux, ivar, continuum, W):
+        """
+        Solve for the NMF coefficients given the continuum, with non-negative least-squares.
+
+        The model is `flux = continuum * (1 - W @ components)`, so the normal equations only need
+        the (C, C) matrix `components @ diag(w) @ components.T`, where `w` is the sum of
+        `ivar * continuum**2` over all spectra.
+        """
+        use = ivar > 0
+        w = np.sum(np.where(use, ivar * continuum**2, 0), axis=0)
+        H = self.components
+        HTH = (H * w) @ H.T
+        HTy = H @ np.sum(np.where(use, ivar * continuum * (continuum - flux), 0), axis=0)
+        return _nnls_normal_equations(HTH, HTy, W)
+
+
+    def _least_squares_with_sparse_jacobian(self, flux, ivar, x0, **kwargs):
+        C, P = self.components.shape
+        N = flux.shape[0]
+        K = self.continuum_design_matrix.shape[1]
+        n, p = np.where(ivar > 0)
+        sqrt_ivar, y = (np.sqrt(ivar[n, p]), flux[n, p])
+        H = self.components[:, p].T
+
+        # Each pixel of each spectrum only depends on the continuum coefficients of one block.
+        A = sparse.csr_matrix(self.continuum_design_matrix)[p].tocoo()
+        M = n.size
+        rows = np.hstack([np.repeat(np.arange(M), C), A.row])
+        cols = np.hstack([np.tile(np.arange(C), M), C + n[A.row] * K + A.col])
+        
+        def model(x):
+            rectified_flux = 1 - H @ x[:C]
+            continuum = (x[C:].reshape((N, K)) @ self.continuum_design_matrix.T)[n, p]
+            return (rectified_flux, continuum)
+        
+        def residuals(x):
+            rectified_flux, continuum = model(x)
+            return (rectified_flux * continuum - y) * sqrt_ivar
+        
+        def jacobian(x):
+            rectified_flux, continuum = model(x)
+            data = np.hstack([
+                (-(continuum * sqrt_ivar)[:, None] * H).flatten(),
+                (rectified_flux * sqrt_ivar)[A.row] * A.data
+            ])
+            return sparse.csr_matrix((data, (rows, cols)), shape=(M, C + N * K))
+        
+        result = op.least_squares(
+            residuals,
+            x0,
+            jac=jacobian,
+            bounds=self.get_bounds(N),
+            method="trf",
+            **kwargs
+        )
+        return result
+
+
     def get_bounds(self, N, component_bounds=(0, +np.inf)):
         C, P = self.components.shape          
         A = N * self.n_regions * (self.n_parameters_per_region)
@@ -349,6 +666,31 @@ class BaseNMFSinusoidsContinuum(object):
 
 
 
+def _nnls_normal_equations(ATA, ATy, default):
+    """
+    Solve a non-negative least-squares problem given its normal equations.
+
+    The normal equations are factored so that NNLS only sees a small square system.
+
+    :param ATA:
+        The (C, C) shape matrix of the normal equations.
+
+    :param ATy:
+        The (C, ) shape vector of the normal equations.
+
+    :param default:
+        The value to return if the problem is not constrained.
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(ATA)
+    keep = eigenvalues > (eigenvalues.max() * 1e-12)
+    if not np.any(keep):
+        return default
+    R = np.sqrt(eigenvalues[keep])[:, None] * eigenvectors[:, keep].T
+    d = (eigenvectors[:, keep].T @ ATy) / np.sqrt(eigenvalues[keep])
+    x, _ = op.nnls(R, d)
+    return x
+
+
 def region_slices(dispersion, regions):
     slices = []
     for region in regions:
@@ -3,9 +3,7 @@
 from __future__ import annotations
 import numpy as np
 from typing import Optional, Union, Tuple, List
-from astropy.nddata import InverseVariance
-from astra.tools.spectrum import SpectralAxis, Spectrum1D
-from astra.tools.continuum.base import Continuum, _pixel_slice_and_mask
+from astra.specutils.continuum.base import Continuum, cached_by_wavelength, weighted_least_squares
 from astra.utils import log
 
 class Sinusoids(Continuum):
@@ -17,7 +15,7 @@ class Sinusoids(Continuum):
         deg: Optional[int] = 3,
         L: Optional[float] = 1400,
         scalar: Optional[float] = 1e-6,
-        spectral_axis: Optional[SpectralAxis] = None,
+        wavelength=None,
         regions: Optional[List[Tuple[float, float]]] = None,
         mask: Optional[np.array] = None,
         fill_value: Optional[Union[int, float]] = np.nan,
@@ -34,7 +32,7 @@ class Sinusoids(Continuum):
             + Continuum.__init__.__doc__
         )
         super(Sinusoids, self).__init__(
-            spectral_axis=spectral_axis,
+            wavelength=wavelength,
             regions=regions,
             mask=mask,
             fill_value=fill_value,
@@ -45,95 +43,70 @@ class Sinusoids(Continuum):
         self.scalar = float(scalar)
         return None
 
-    def fit(self, spectrum: Spectrum1D) -> Sinusoids:
-        _initialized_args = self._initialize(spectrum)
-        N, P, *_ = _initialized_args
-        all_flux = spectrum.flux.value.reshape((N, P))
-        all_ivar = spectrum.uncertainty.represent_as(InverseVariance).array.reshape(
-            (N, P)
-        )
-        self.theta = self._fit(all_flux, all_ivar, _initialized_args)
-
+    def fit(self, spectrum) -> Sinusoids:
+        _initialized_args = self._initialize_design_matrices(spectrum.wavelength)
+        flux, ivar = (np.atleast_2d(spectrum.flux), np.atleast_2d(spectrum.ivar))
+        self.theta = self._fit(flux, ivar, _initialized_args)
         return self
 
 
     def _fit(self, flux, ivar, _initialized_args):
-        N, P, *region_args = _initialized_args
+        _, region_masks, _, M_continuum = _initialized_args
 
+        N, P = flux.shape
         theta = np.empty((N, self.num_regions, 2 * self.deg + 1))
-        for i, (flux_, ivar_) in enumerate(zip(flux, ivar)):
-            for j, (_, indices, _, M_continuum) in enumerate(zip(*region_args)):
-                MTM = M_continuum @ (ivar_[indices][:, None] * M_continuum.T)
-                MTy = M_continuum @ (ivar_[indices] * flux_[indices]).T
-
-                eigenvalues = np.linalg.eigvalsh(MTM)
-                MTM[np.diag_indices(len(MTM))] += self.scalar * np.max(eigenvalues)
-                # eigenvalues = np.linalg.eigvalsh(MTM)
-                # condition_number = max(eigenvalues) / min(eigenvalues)
-                # TODO: warn on high condition number
-                if np.all(ivar_[indices] == 0):
-                    log.warning(f"Region {j} is empty. Setting theta to zero.")
-                    theta[i, j] = 0.0
-                else:
-                    theta[i, j] = np.linalg.solve(MTM, MTy)
+        for j, (indices, M) in enumerate(zip(region_masks, M_continuum)):
+            y, w = (flux[:, indices], ivar[:, indices])
+            w = np.where(np.isfinite(y * np.sqrt(w)), w, 0)
+            # TODO: warn on high condition number
+            if not np.all(np.any(w > 0, axis=1)):
+                log.warning(f"Region {j} is empty in some spectra. Setting theta to zero for those spectra.")
+            theta[:, j] = weighted_least_squares(M, y, w, ridge=self.scalar)
         return theta
 
 
-    def _evaluate(self, theta, initialized_args):
-        
-        N, P, *region_args = initialized_args
-        continuum = self.fill_value * np.ones((N, P))
-        for i in range(N):
-            for j, ((lower, upper), _, M_region, _) in enumerate(zip(*region_args)):
-                continuum[i, slice(lower, upper)] = M_region.T @ theta[i, j]
+    def _evaluate(self, theta, _initialized_args, P):
+        region_slices, _, M_region, _ = _initialized_args
+        theta = theta.reshape((-1, self.num_regions, 2 * self.deg + 1))
+        continuum = self.fill_value * np.ones((theta.shape[0], P))
+        for j, ((lower, upper), M) in enumerate(zip(region_slices, M_region)):
+            continuum[:, lower:upper] = theta[:, j] @ M.T
         return continuum
 
 
     def __call__(
-        self, spectrum: Spectrum1D, theta: Optional[Union[List, np.array, Tuple]] = None, **kwargs
+        self, 
+        theta: Optional[Union[List, np.array, Tuple]] = None,
+        wavelength: Optional[np.array] = None,
+        **kwargs
     ) -> np.ndarray:
         if theta is None:
             theta = self.theta
+        if wavelength is None:
+            wavelength = self.wavelength
 
-        _initialized_args = self._initialize(spectrum)
-
-        return self._evaluate(theta, _initialized_args)
-
+        _initialized_args = self._initialize_design_matrices(wavelength)
+        return self._evaluate(np.atleast_3d(theta), _initialized_args, wavelength.size)
 
-    def _initialize(self, spectrum: Spectrum1D):
-        try:
-            self._initialized_args
-        except AttributeError:
-            N, P = self._get_shape(spectrum)
 
-            region_slices, region_continuum_indices = _pixel_slice_and_mask(
-                spectrum.wavelength, self.regions, self.mask
-            )
-    
-            # Create the design matrices.
-            M_region = []
-            M_continuum = []
+    def _initialize_design_matrices(self, wavelength):
+        """
+        Return the region slices, continuum pixel indices, and the design matrices for all pixels
+        and continuum pixels in each region. These are cached for each wavelength array.
+        """
+        def initialize(wavelength):
+            region_slices, region_continuum_indices = self._initialize(wavelength)
+            M_region, M_continuum = ([], [])
             for (lower, upper), indices in zip(region_slices, region_continuum_indices):
-                region_pixels = spectrum.wavelength.value[slice(lower, upper)]
-                region_continuum = spectrum.wavelength.value[indices]
-                M_region.append(self._design_matrix(region_pixels))
-                M_continuum.append(self._design_matrix(region_continuum))
-            self._initialized_args = (
-                N,
-                P,
-                region_slices,
-                region_continuum_indices,
-                M_region,
-                M_continuum,
-            )
-        else:
-            # If we already have initialized arguments, we just need to update the shape.
-            N, P = self._get_shape(spectrum)
-            _N, _P, *region_args = self._initialized_args
-            self._initialized_args = (N, P, *region_args)
-
-        finally:
-            return self._initialized_args
+                M_region.append(self._design_matrix(wavelength[lower:upper]).T)
+                M_continuum.append(self._design_matrix(wavelength[indices]).T)
+            return (region_slices, region_continuum_indices, M_region, M_continuum)
+
+        return cached_by_wavelength(
+            self.__dict__.setdefault("_design_matrices_by_wavelength", {}),
+            wavelength,
+            initialize
+        )
 
     def _design_matrix(self, dispersion: np.array) -> np.array:
         scale = 2 * (np.pi / self.L)
@@ -1,9 +1,45 @@
 import numpy as np
 from scipy import sparse, stats
+from collections import OrderedDict
 from typing import Tuple
 
 _fwhm_to_sigma = 1/(2 * np.sqrt(2 * np.log(2)))
 
+# The number of convolution matrices to keep in memory.
+LSF_MATRIX_CACHE_SIZE = 32
+_lsf_matrices = OrderedDict()
+
+
+def _cached(key, f):
+    try:
+        _lsf_matrices.move_to_end(key)
+    except KeyError:
+        _lsf_matrices[key] = f()
+        while len(_lsf_matrices) > LSF_MATRIX_CACHE_SIZE:
+            _lsf_matrices.popitem(last=False)
+    return _lsf_matrices[key]
+
+
+def _hash_array(a: np.array):
+    a = np.ascontiguousarray(a)
+    return (a.size, hash(a.tobytes()))
+
+
+def _band_indices(starts: np.array, stops: np.array):
+    """
+    Return the row and column indices of a banded matrix, where column `j` has rows `starts[j]:stops[j]`.
+    """
+    counts = np.clip(stops - starts, 0, None)
+    offsets = np.cumsum(counts) - counts
+    rows = np.arange(counts.sum()) - np.repeat(offsets - starts, counts)
+    cols = np.repeat(np.arange(counts.size), counts)
+    return (rows, cols)
+
+
+def _normalize_columns(ϕ: np.array, cols: np.array, n_cols: int):
+    ϕ /= np.bincount(cols, weights=ϕ, minlength=n_cols)[cols]
+    return ϕ
+
 
 def lsf_sigma(λ: float, R: Tuple[int, float]):
     """
@@ -82,79 +118,97 @@ def instrument_lsf_dense_matrix(λ_input: np.array, λ_output: np.array, R: Tupl
     :returns:
         A (N, M) dense array representing a convolution kernel.
     """
-    K = np.empty((λ_input.size, λ_output.size), dtype=float)
-    for o, λ in enumerate(λ_output):
-        mask, ϕ = instrument_lsf_kernel(λ_input, λ, R, **kwargs)
-        K[mask, o] += ϕ 
-    return K
+    return instrument_lsf_sparse_matrix(λ_input, λ_output, R, **kwargs).toarray()
     
 
-def instrument_lsf_sparse_matrix(λ_input: np.array, λ_output: np.array, R: Tuple[int, float], **kwargs):
+def instrument_lsf_sparse_matrix(λ_input: np.array, λ_output: np.array, R: Tuple[int, float], σ_window: Tuple[float, int] = 5):
     """
     Construct a sparse matrix to convolve fluxes at input wavelengths (λ_input) at an instrument spectral
     resolution (R) and resample to the given output wavelengths (λ_output).
 
+    Only the entries within the LSF window are computed, and matrices are cached by the wavelength
+    arrays, `R`, and `σ_window`.
+
     :param λ_input:
-        A N-length array of input wavelength values.
+        A N-length array of input wavelength values, in ascending order.
 
     :param λ_output:
         A M-length array of output wavelength values.
 
     :param R:
         Spectral resolution.
+
+    :param σ_window: [optional]
+        The number of sigma where the LSF contributes (default: 5).
     
     :returns:
         A (N, M) sparse array representing a convolution kernel.
     """    
-    K = instrument_lsf_dense_matrix(λ_input, λ_output, R, **kwargs)
-    return sparse.coo_array(K).tocsc()
-
-
-def rotational_broadening_sparse_matrix(λ: np.array, vsini: Tuple[int, float], epsilon: Tuple[int, float]):
+    def construct():
+        σ, (lower, upper) = lsf_sigma_and_bounds(λ_output, R, σ_window)
+        rows, cols = _band_indices(
+            np.searchsorted(λ_input, lower, side="left"),
+            np.searchsorted(λ_input, upper, side="right")
+        )
+        ϕ = np.exp(-0.5 * ((λ_input[rows] - λ_output[cols]) / σ[cols])**2)
+        ϕ = _normalize_columns(ϕ, cols, λ_output.size)
+        return sparse.coo_array((ϕ, (rows, cols)), shape=(λ_input.size, λ_output.size)).tocsc()
+
+    λ_input, λ_output = (np.asarray(λ_input), np.atleast_1d(λ_output))
+    key = ("instrument", _hash_array(λ_input), _hash_array(λ_output), float(R), float(σ_window))
+    return _cached(key, construct)
+
+
+def rotational_broadening_sparse_matrix(λ: np.array, vsini: Tuple[int, float, np.array], epsilon: Tuple[int, float]):
     """
     Construct a sparse matrix to convolve fluxes at input wavelengths (λ) with a rotational broadening kernel
     with a given vsini and epsilon.
+
+    Matrices are cached by the wavelength array, `vsini`, and `epsilon`.
     
     :param λ:
-        A N-length array of input wavelength values.
+        A N-length array of input wavelength values, with uniform sampling.
         
     :param vsini:
-        The projected rotational velocity of the star in km/s.
+        The projected rotational velocity of the star in km/s. If an array of B values is given then the
+        matrices for each value are stacked horizontally, so the product of a flux array and the matrix
+        can be reshaped to give B broadened spectra.
     
     :param epsilon:
         The limb darkening coefficient.
     
     :returns:
-        A (N, N) sparse array representing a convolution kernel.
+        A (N, N) sparse array representing a convolution kernel, or a (N, B * N) sparse array if
+        many `vsini` values are given.
     """
-
-    # Let's pre-calculate some things that are needed in the hot loop.
-    denominator = np.pi * vsini * (1.0 - epsilon / 3.0)
-    c1 = 2.0 * (1.0 - epsilon) / denominator
-    c2 = 0.5 * np.pi * epsilon / denominator    
-
-    vsini_c = vsini / 299792.458
-    scale = vsini_c / (λ[1] - λ[0]) # assume uniform sampling
-    N = λ.size
-
-    data, row_index, col_index = ([], [], [])
-    for i, λ_i in enumerate(λ):
-        n_pix = int(np.ceil(λ_i * scale))
-        si, ei = (max(0, i - n_pix), min(i + n_pix + 1, N))
-        mask = slice(si, ei) # ignoring edge effects
-
-        λ_delta_max = λ_i * vsini_c
-        λ_delta = λ[mask] - λ_i
+    if np.ndim(vsini) > 0:
+        return sparse.hstack(
+            [rotational_broadening_sparse_matrix(λ, v, epsilon) for v in vsini],
+            format="csr"
+        )
+
+    def construct():
+        denominator = np.pi * vsini * (1.0 - epsilon / 3.0)
+        c1 = 2.0 * (1.0 - epsilon) / denominator
+        c2 = 0.5 * np.pi * epsilon / denominator    
+
+        vsini_c = vsini / 299792.458
+        scale = vsini_c / (λ[1] - λ[0]) # assume uniform sampling
+        N = λ.size
+
+        i = np.arange(N)
+        n_pix = np.ceil(λ * scale).astype(int)
+        # ignoring edge effects
+        rows, cols = _band_indices(np.maximum(0, i - n_pix), np.minimum(i + n_pix + 1, N))
+
+        λ_delta_max = λ[cols] * vsini_c
+        λ_delta = λ[rows] - λ[cols]
         λ_ratio_sq = (λ_delta / λ_delta_max)**2.0
-        ϕ = c1 * np.sqrt(1.0 - λ_ratio_sq) + c2 * (1.0 - λ_ratio_sq)
+        ϕ = c1 * np.sqrt(np.clip(1.0 - λ_ratio_sq, 0, None)) + c2 * (1.0 - λ_ratio_sq)
         ϕ[λ_ratio_sq >= 1.0] = 0.0 # flew too close to the sun
-        ϕ /= np.sum(ϕ)
+        ϕ = _normalize_columns(ϕ, cols, N)
+        return sparse.csr_matrix((ϕ, (rows, cols)), shape=(N, N))
 
-        data.extend(ϕ)
-        row_index.extend(list(range(si, ei)))
-        col_index.extend([i] * (ei - si))
-    
-    return sparse.csr_matrix(
-        (data, (row_index, col_index)), 
-        shape=(λ.size, λ.size)
-    )
\ No newline at end of file
+    λ = np.asarray(λ)
+    key = ("rotational", _hash_array(λ), float(vsini), float(epsilon))
+    return _cached(key, construct)
@@ -2,7 +2,7 @@ import numpy as np
 import warnings
 from collections import OrderedDict
 from typing import List, Tuple, Optional
-from itertools import cycle
+from scipy.linalg import cholesky, cho_solve, solve_triangular, toeplitz, hankel, LinAlgError
 
 try:
     import jax.numpy.linalg as linalg
@@ -13,6 +13,9 @@ else:
 #from jax.numpy import linalg as jax_linalg
 #from numpy import linalg
 
+# Whether we have warned that the Cholesky solve fell back to least-squares (we only warn once).
+_warned_about_cholesky_fallback = False
+
 def resample_spectrum(
     resample_wavelength: np.array,
     wavelength: np.array,
@@ -25,6 +28,7 @@ def resample_spectrum(
     min_resampled_flag_value: Optional[float] = 0.1,
     grow: Optional[int] = 1,
     rcond: Optional[float] = None,
+    method: Optional[str] = "cholesky",
 ) -> Tuple[np.array, np.array]:
     """
     Sample a spectrum on a wavelength array given a set of pixels recorded from one or many visits.
@@ -73,7 +77,15 @@ def resample_spectrum(
         sensible choice could be 1/N, where N is the number of visits.    
         
     :param rcond: [optional]
-        Cutoff for small singular values. 
+        Cutoff for small singular values. This is only used by the `lstsq` method.
+
+    :param method: [optional]
+        The method to solve for the resampled spectrum. The default (`cholesky`) computes the normal
+        equations from weighted trigonometric sums and solves them with a Cholesky factorization,
+        without constructing the design matrix for the input pixels. If the normal equations are not
+        positive definite (e.g., if there are fewer data points than `P`, or large gaps in the data),
+        or if `flags` are given, this falls back to `lstsq`, which uses the full design matrices and
+        least-squares solves. The method used is recorded in the metadata.
                 
         
     :returns:
@@ -92,58 +104,81 @@ def resample_spectrum(
     L = L or np.ptp(x_star[~star_data_mask])
     P = P or x_star[~star_data_mask].size
     
-    if flags is not None:
-        # Construct the full X, as we will need it for flags.
-        X_full = construct_design_matrix(wavelength, L, P)
-        X_star_full = construct_design_matrix(x_star, L, P)
-        X_star = X_star_full[~star_data_mask]
-        X = X_full[~visit_data_mask]
-    else:
-        # Only construct the X we need
-        X_star = construct_design_matrix(x_star[~star_data_mask], L, P)        
-        X = construct_design_matrix(wavelength[~visit_data_mask], L, P) # M x P
-        
     Y = flux[~visit_data_mask]
     Cinv = ivar[~visit_data_mask]
+
+    if method not in ("cholesky", "lstsq"):
+        raise ValueError(f"method must be 'cholesky' or 'lstsq', not '{method}'")
+
+    if method == "cholesky" and flags is None and Y.size >= P:
+        try:
+            y_star_masked, ivar_star_masked, condition_number = _solve_with_cholesky(
+                x_star[~star_data_mask], wavelength[~visit_data_mask], Y, Cinv, L, P
+            )
+        except LinAlgError:
+            global _warned_about_cholesky_fallback
+            if not _warned_about_cholesky_fallback:
+                warnings.warn(
+                    "Normal equations are not positive definite (e.g., if there are large gaps in the "
+                    "data). Falling back to least-squares. This warning is only shown once."
+                )
+                _warned_about_cholesky_fallback = True
+            method = "lstsq"
+    else:
+        # Flags need the full design matrices, and with fewer data points than parameters the normal
+        # equations cannot be positive definite.
+        method = "lstsq"
+
+    if method == "lstsq":
+        if flags is not None:
+            # Construct the full X, as we will need it for flags.
+            X_full = construct_design_matrix(wavelength, L, P)
+            X_star_full = construct_design_matrix(x_star, L, P)
+            X_star = X_star_full[~star_data_mask]
+            X = X_full[~visit_data_mask]
+        else:
+            # Only construct the X we need
+            X_star = construct_design_matrix(x_star[~star_data_mask], L, P)        
+            X = construct_design_matrix(wavelength[~visit_data_mask], L, P) # M x P
+        
+        # We need to solve for theta, which is the resampled spectrum at P pixels
+        #   theta = X_star @ (X.T @ C^(-1) @ X)^(-1) @ X.T @ C^(-1) @ Y
+        # and we want to avoid this big (pseudo-)inverse (X.T @ C^(-1) @ X)^(-1)
+
+        # To avoid overloading nomenclature, we will solve for G in the equation
+        #   A @ G = B
+        # where
+        #   A = (X.T @ C^(-1) @ X)
+        #   B = X.T @ C^(-1) @ Y
+        # such that
+        #   (X.T @ C^(-1) @ X) @ G = X.T @ C^(-1) @ Y
+        # and
+        #   G = (X.T @ C^(-1) @ X)^(-1) @ X.T @ C^(-1) @ Y
+        # and
+        #   theta = X_star @ G
     
-    # We need to solve for theta, which is the resampled spectrum at P pixels
-    #   theta = X_star @ (X.T @ C^(-1) @ X)^(-1) @ X.T @ C^(-1) @ Y
-    # and we want to avoid this big (pseudo-)inverse (X.T @ C^(-1) @ X)^(-1)
-
-    # To avoid overloading nomenclature, we will solve for G in the equation
-    #   A @ G = B
-    # where
-    #   A = (X.T @ C^(-1) @ X)
-    #   B = X.T @ C^(-1) @ Y
-    # such that
-    #   (X.T @ C^(-1) @ X) @ G = X.T @ C^(-1) @ Y
-    # and
-    #   G = (X.T @ C^(-1) @ X)^(-1) @ X.T @ C^(-1) @ Y
-    # and
-    #   theta = X_star @ G
-    
-    XtCinv = X.T * Cinv    
-    XtCinvX = XtCinv @ X
-    XtCinvY = XtCinv @ Y
-    G, G_residuals, G_rank, G_s = linalg.lstsq(XtCinvX, XtCinvY, rcond=rcond)
-    condition_number = np.max(G_s)/np.min(G_s)
+        XtCinv = X.T * Cinv    
+        XtCinvX = XtCinv @ X
+        XtCinvY = XtCinv @ Y
+        G, G_residuals, G_rank, G_s = linalg.lstsq(XtCinvX, XtCinvY, rcond=rcond)
+        condition_number = np.max(G_s)/np.min(G_s)
     
-    y_star_masked = X_star @ G
+        y_star_masked = X_star @ G
     
-    # For the inverse variances we need
-    #   C_star = (X_star @ (X.T @ C^(-1) @ X)^(-1) @ X_star.T)^-1
-    # The problematic term is 
-    #   (X.T @ C^(-1) @ X)^(-1)
-    # so we will solve for H in A @ H = B where
-    #   A = (X.T @ C^(-1) @ X)
-    #   B = X_star.T
-    # such that
-    #   H = (X.T @ C^(-1) @ X)^(-1) @ X_star.T
-    # and
-    #   C_star = X_star @ H
-
-    H, H_residuals, H_rank, H_s = linalg.lstsq(XtCinvX, X_star.T, rcond=rcond)
-    ivar_star_masked = 1/np.diag(X_star @ H)
+        # For the inverse variances we need
+        #   C_star = (X_star @ (X.T @ C^(-1) @ X)^(-1) @ X_star.T)^-1
+        # The problematic term is 
+        #   (X.T @ C^(-1) @ X)^(-1)
+        # so we will solve for H in A @ H = B where
+        #   A = (X.T @ C^(-1) @ X)
+        #   B = X_star.T
+        # such that
+        #   H = (X.T @ C^(-1) @ X)^(-1) @ X_star.T
+        # and
+        #   C_star = X_star @ H
+
+        H, H_residuals, H_rank, H_s = linalg.lstsq(XtCinvX, X_star.T, rcond=rcond)
+        ivar_star_masked = 1/np.diag(X_star @ H)
 
     if np.any(ivar_star_masked < 0):
         warnings.warn("Clipping negative inverse variances to zero.")
@@ -174,6 +209,7 @@ def resample_spectrum(
     
     meta = dict(
         condition_number=condition_number,
+        method=method,
         L=L,
         P=P,
         separate_flags=separate_flags
@@ -264,14 +300,105 @@ def construct_design_matrix(wavelength: np.array, L: float, P: int):
     :returns:
         A design matrix of shape (M, P).
     """
-    # TODO: This could be replaced with something that makes use of finufft.
     scale = (np.pi * wavelength) / L
+    j = np.arange(1, P)
+    phase = np.outer(scale, j + (j % 2))
     X = np.ones((wavelength.size, P), dtype=float)
-    for j, f in zip(range(1, P), cycle((np.sin, np.cos))):
-        X[:, j] = f(scale * (j + (j % 2)))
+    X[:, 1::2] = np.sin(phase[:, 0::2])
+    X[:, 2::2] = np.cos(phase[:, 1::2])
     return X
 
 
+def _weighted_trigonometric_sums(ω: np.array, weights: np.array, K: int, block_size: int = 128):
+    """
+    Return the weighted sums of :math:`\exp(i k \omega)` for ``k = 0, ..., K - 1``.
+
+    :param ω:
+        An ``M``-length array of phases.
+
+    :param weights:
+        An array of weights with shape ``(N, M)``.
+
+    :param K:
+        The number of frequencies.
+
+    :param block_size: [optional]
+        The number of frequencies to compute in each matrix product.
+
+    :returns:
+        A complex array of shape ``(N, K)``, where the real (imaginary) part gives the weighted sums of
+        the cosines (sines).
+    """
+    E = np.exp(1j * np.outer(ω, np.arange(min(block_size, K))))
+    sums = np.empty((weights.shape[0], K), dtype=complex)
+    for k in range(0, K, block_size):
+        n = min(block_size, K - k)
+        sums[:, k:k + n] = (weights * np.exp(1j * k * ω)) @ E[:, :n]
+    return sums
+
+
+def _solve_with_cholesky(x_star, wavelength, flux, ivar, L, P, block_size=1024):
+    """
+    Solve for the resampled spectrum with a Cholesky factorization of the normal equations.
+
+    The design matrix columns are a constant, and the sines and cosines of :math:`m \omega` for
+    :math:`\omega = 2\pi x / L`. Products of these columns are sums and differences of sines and
+    cosines, so the normal equations :math:`X^\top C^{-1} X` have Toeplitz-plus-Hankel blocks that
+    only need the weighted sums of :math:`\cos(k\omega)` and :math:`\sin(k\omega)`. This costs
+    O(M P) instead of the O(M P^2) to compute the matrix product, and never constructs ``X``.
+
+    :returns:
+        A three-length tuple of the resampled flux and inverse variance at ``x_star``, and an
+        estimate of the condition number of the normal equations.
+    """
+    # Column j > 0 is sin(m ω) for odd j, and cos(m ω) for even j, where m = (j + j % 2) / 2.
+    is_cos = (np.arange(P) % 2 == 0)
+    n_cos, n_sin = (np.sum(is_cos), np.sum(~is_cos))
+
+    ω = 2 * np.pi * wavelength / L
+    K = 2 * max(n_cos - 1, n_sin) + 1
+    sums = _weighted_trigonometric_sums(ω, np.array([ivar, ivar * flux]), K)
+    C, S = (sums[0].real, sums[0].imag)
+    CY, SY = (sums[1].real, sums[1].imag)
+
+    # S(d) for signed d, with S(-d) = -S(d).
+    S_signed = lambda d: np.sign(d) * S[np.abs(d)]
+
+    # cos(a) cos(b) = [cos(a - b) + cos(a + b)] / 2, and similarly for the others.
+    A = np.empty((P, P), dtype=float)
+    A[np.ix_(is_cos, is_cos)] = 0.5 * (
+        toeplitz(C[:n_cos]) + hankel(C[:n_cos], C[n_cos - 1:2 * n_cos - 1])
+    )
+    if n_sin > 0:
+        A[np.ix_(~is_cos, ~is_cos)] = 0.5 * (
+            toeplitz(C[:n_sin]) - hankel(C[2:n_sin + 2], C[n_sin + 1:2 * n_sin + 1])
+        )
+        A_sin_cos = 0.5 * (
+            toeplitz(S[1:n_sin + 1], S_signed(1 - np.arange(n_cos)))
+        +   hankel(S[1:n_sin + 1], S[n_sin:n_sin + n_cos])
+        )
+        A[np.ix_(~is_cos, is_cos)] = A_sin_cos
+        A[np.ix_(is_cos, ~is_cos)] = A_sin_cos.T
+
+    B = np.empty(P, dtype=float)
+    B[is_cos] = CY[:n_cos]
+    B[~is_cos] = SY[1:n_sin + 1]
+
+    L_A = cholesky(A, lower=True)
+    G = cho_solve((L_A, True), B)
+    # The condition number of A is at least the squared ratio of the diagonal of its Cholesky factor.
+    condition_number = (np.max(np.diag(L_A)) / np.min(np.diag(L_A)))**2
+
+    # We only need the diagonal of C_star^(-1) = X_star @ A^(-1) @ X_star.T, which is the sum of the
+    # squares of L_A^(-1) @ X_star.T for each pixel.
+    y_star, ivar_star = (np.empty(x_star.size), np.empty(x_star.size))
+    for si in range(0, x_star.size, block_size):
+        X_star = construct_design_matrix(x_star[si:si + block_size], L, P)
+        y_star[si:si + block_size] = X_star @ G
+        V = solve_triangular(L_A, X_star.T, lower=True, check_finite=False)
+        ivar_star[si:si + block_size] = 1/np.sum(V**2, axis=0)
+    return (y_star, ivar_star, condition_number)
+
 
 def _check_shape(name, a, P):
     a = np.array(a)
@@ -1,13 +1,19 @@
 import numpy as np
+import warnings
 from scipy import interpolate
 from astropy.constants import c
 from astropy import units as u
 from collections import OrderedDict
+from scipy import sparse
 from scipy.ndimage.filters import median_filter, gaussian_filter
 
 
 C_KM_S = c.to(u.km / u.s).value
 
+# The number of resampling operators to keep in memory (see `resampling_operator`).
+RESAMPLING_OPERATOR_CACHE_SIZE = 32
+_resampling_operators = OrderedDict()
+
 
 
 '''
@@ -56,17 +62,21 @@ smooth_filter = lambda f, median_filter_size=501, gaussian_filter_size=100, medi
     gaussian_filter_size,
 )
 
-def resample(old_wavelength, new_wavelength, flux, ivar, n_res, pixel_flags=None, fill_flux=0, fill_ivar=0, min_bitmask_value=0.1):
+def resample(old_wavelength, new_wavelength, flux, ivar, n_res, pixel_flags=None, fill_flux=0, fill_ivar=0, min_bitmask_value=None):
     # TODO: Check inputs
+    if min_bitmask_value is not None:
+        warnings.warn(
+            "`min_bitmask_value` is deprecated and ignored: pixel flags are propagated from every pixel "
+            "in the resampling kernel support (see `propagate_bitmask`).",
+            DeprecationWarning
+        )
 
     new_flux = fill_flux * np.ones(new_wavelength.size)
     new_ivar = fill_ivar * np.ones(new_wavelength.size)
 
     if pixel_flags is not None:
         pixel_flags = np.atleast_2d(pixel_flags)
-        separate_pixel_flags = separate_bitmasks(pixel_flags)
-        n_flags = len(separate_pixel_flags)
-        resampled_flags = np.zeros((n_flags, new_wavelength.size), dtype=pixel_flags.dtype)
+        new_pixel_flags = np.zeros(new_wavelength.size, dtype=pixel_flags.dtype)
     else:
         new_pixel_flags = np.zeros(new_wavelength.size, dtype=int)        
 
@@ -75,9 +85,6 @@ def resample(old_wavelength, new_wavelength, flux, ivar, n_res, pixel_flags=None
         
     n_res = np.atleast_1d(n_res)
     for i, chip_wavelength in enumerate(old_wavelength):
-        pixel = wave_to_pixel(new_wavelength, chip_wavelength)
-        (finite, ) = np.where(np.isfinite(pixel))
-
         # do a smoothing of bad pixels
         flux_smooth = smooth_filter(flux[i])
         var_smooth = smooth_filter(1/ivar[i])
@@ -90,58 +97,13 @@ def resample(old_wavelength, new_wavelength, flux, ivar, n_res, pixel_flags=None
         sinc_flux[bad] = flux_smooth[bad]
         sinc_var[bad] = var_smooth[bad]
         
-        ((finite_flux, finite_e_flux), ) = sincint(
-            pixel[finite], n_res[i], [
-                [sinc_flux, sinc_var]
-            ]
-        )
-        new_flux[finite] = finite_flux
-        new_ivar[finite] = finite_e_flux**(-2)
+        operator, squared_operator, finite = resampling_operator(chip_wavelength, new_wavelength, n_res[i])
 
-        if pixel_flags is not None:
-        
-            # Do the sinc interpolation on each bitmask value.
-            output = sincint(
-                pixel[finite],
-                n_res[i],
-                [
-                    [flag_this_pixel[i], None]
-                    for flag_this_pixel in separate_pixel_flags.values()
-                ],
-            )
-
-            for k, (flag, (resampled_bitmask_flag, _)) in enumerate(
-                zip(separate_pixel_flags.keys(), output)
-            ):
-                # if num_flagged_pixels[flag][i, j] == 0: continue
-
-                # The resampling will produce a continuous (fraction) of bitmask values everywhere
-                # with an exponential sinc function pattern. In SDSS-IV they decided just to take
-                # any pixel with a fraction > 0.1 (in most cases) and assign pixels like that with
-                # the bitmask.
-
-                # If you have a *single* pixel that is flagged, and zero radial velocity (so no shift)
-                # then this >0.1 metric would end up flagging the neighbouring pixels as well, even
-                # though there was no change to the flux.
-
-                # Instead, here I will take metric to be whatever is needed to keep the same *number*
-                # of pixels originally flagged.
-                # and we take the absolute so that we don't imprint a fringe pattern on the bitmask
-                # metric = np.sort(np.abs(resampled_bitmask_flag))[-num_flagged_pixels[flag][i, j]]
-                # print(f"Took metric={metric:.1f} for bitmask {flag} on visit {i} chip {j}")
-
-                # Turns out that this was not a good idea. Let's be more conservative.
-                resampled_flags[k, finite] = (
-                    np.abs(resampled_bitmask_flag) > min_bitmask_value
-                ).astype(resampled_flags.dtype)            
+        new_flux[finite] = (operator @ sinc_flux)[finite]
+        new_ivar[finite] = (squared_operator @ sinc_var)[finite]**(-1)
 
-    if pixel_flags is not None:
-        new_pixel_flags = np.zeros(new_wavelength.size, dtype=pixel_flags.dtype)
-        # Sum them together.
-        for k, flag in enumerate(separate_pixel_flags.keys()):
-            new_pixel_flags += (resampled_flags[k] * (2**flag)).astype(
-                pixel_flags.dtype
-            )
+        if pixel_flags is not None:
+            new_pixel_flags[finite] = propagate_bitmask(operator, pixel_flags[i])[finite]
 
     return (new_flux, new_ivar, new_pixel_flags)
 
@@ -262,67 +224,163 @@ def wave_to_pixel(wave, wave0):
     return out
 
 
-def sincint(x, nres, speclist):
-    """Use sinc interpolation to get resampled values
-    x : desired positions
-    nres : number of pixels per resolution element (2=Nyquist)
-    speclist : list of [quantity, variance] pairs (variance can be None)
-
-    NOTE: This takes in variance, but returns ERROR.
+def sinc_kernel(x, nres, n_pixels):
     """
+    Return the input pixel indices and damped sinc weights for every output pixel.
+
+    :param x:
+        The desired (fractional) pixel positions.
 
+    :param nres:
+        The number of pixels per resolution element (2=Nyquist).
+
+    :param n_pixels:
+        The number of input pixels.
+
+    :returns:
+        A three-length tuple of `(lobe, sinc, in_range)` arrays, each with shape `(len(x), kernel_width)`.
+        The `lobe` array contains the input pixel indices (clipped to be valid), `sinc` contains the
+        weights, and `in_range` is True where the kernel is within the input pixels. Weights outside
+        the input pixels are zero.
+    """
     dampfac = 3.25 * nres / 2.0
     ksize = int(21 * nres / 2.0)
     if ksize % 2 == 0:
         ksize += 1
     nhalf = ksize // 2
 
-    # number of output and input pixels
-    nx = len(x)
-    nf = len(speclist[0][0])
-
     # integer and fractional pixel location of each output pixel
+    x = np.asarray(x)
     ix = x.astype(int)
     fx = x - ix
 
-    # outputs
-    outlist = []
-    for spec in speclist:
-        if spec[1] is None:
-            outlist.append([np.full_like(x, 0), None])
-        else:
-            outlist.append([np.full_like(x, 0), np.full_like(x, 0)])
-
-    for i in range(len(x)):
-        xkernel = np.arange(ksize) - nhalf - fx[i]
-        # in units of Nyquist
-        xkernel /= nres / 2.0
-        u1 = xkernel / dampfac
-        u2 = np.pi * xkernel
+    offsets = np.arange(ksize) - nhalf
+    xkernel = offsets - fx[:, np.newaxis]
+    # in units of Nyquist
+    xkernel /= nres / 2.0
+    u1 = xkernel / dampfac
+    u2 = np.pi * xkernel
+    with np.errstate(divide="ignore", invalid="ignore"):
         sinc = np.exp(-(u1**2)) * np.sin(u2) / u2
-        sinc /= nres / 2.0
+    sinc /= nres / 2.0
+
+    # the sinc function value at x = 0 is defined by the limit, -> 1
+    sinc[u2 == 0] = 1
+
+    lobe = offsets + ix[:, np.newaxis]
+    in_range = (lobe >= 0) & (lobe < n_pixels)
+    sinc[~in_range] = 0
+    return (np.clip(lobe, 0, max(n_pixels - 1, 0)), sinc, in_range)
+
+
+def sincint(x, nres, speclist):
+    """Use sinc interpolation to get resampled values
+    x : desired positions
+    nres : number of pixels per resolution element (2=Nyquist)
+    speclist : list of [quantity, variance] pairs (variance can be None). The quantity and variance
+        can be 2D arrays of shape (n_spectra, n_pixels) to resample many spectra at once.
+
+    NOTE: This takes in variance, but returns ERROR.
+    """
 
-        # the sinc function value at x = 0 is defined by the limit, -> 1
-        sinc[u2 == 0] = 1
+    # number of input pixels
+    nf = np.shape(speclist[0][0])[-1]
 
-        lobe = np.arange(ksize) - nhalf + ix[i]
-        vals = np.zeros(ksize)
-        gd = np.where((lobe >= 0) & (lobe < nf))[0]
+    lobe, sinc, in_range = sinc_kernel(x, nres, nf)
 
-        for spec, out in zip(speclist, outlist):
-            vals = spec[0][lobe[gd]]
-            out[0][i] = (sinc[gd] * vals).sum()
-            if spec[1] is not None:
-                var = spec[1][lobe[gd]]
-                out[1][i] = (sinc[gd] ** 2 * var).sum()
+    def weighted_sum(weights, values):
+        # Pixels outside the input are given zero value (rather than zero weight) so non-finite
+        # values at the edges do not propagate.
+        return np.sum(weights * np.where(in_range, values[..., lobe], 0), axis=-1)
 
-    for out in outlist:
-        if out[1] is not None:
-            out[1] = np.sqrt(out[1])
+    outlist = []
+    for quantity, variance in speclist:
+        out = [weighted_sum(sinc, np.asarray(quantity)), None]
+        if variance is not None:
+            out[1] = np.sqrt(weighted_sum(sinc**2, np.asarray(variance)))
+        outlist.append(out)
 
     return outlist
 
 
+def resampling_operator(old_wavelength, new_wavelength, n_res):
+    """
+    Return a sparse operator that sinc-interpolates a spectrum from one wavelength array onto another.
+
+    Operators are cached by the wavelength arrays and `n_res`, so spectra that share the same
+    wavelength solution (e.g., visits on the same plate and MJD) only need one operator.
+
+    :param old_wavelength:
+        The wavelength array of the input spectrum.
+
+    :param new_wavelength:
+        The wavelength array to resample onto.
+
+    :param n_res:
+        The number of pixels per resolution element (2=Nyquist).
+
+    :returns:
+        A three-length tuple of `(operator, squared_operator, finite)`. The `operator` is a CSR matrix
+        of shape `(new_wavelength.size, old_wavelength.size)` that resamples a quantity, and the
+        `squared_operator` has the squared weights to resample a variance. The `finite` array gives
+        the indices of new pixels that are within the old wavelength range; all other rows are empty.
+    """
+    old_wavelength, new_wavelength = (np.ascontiguousarray(old_wavelength), np.ascontiguousarray(new_wavelength))
+    key = (
+        old_wavelength.size,
+        hash(old_wavelength.tobytes()),
+        new_wavelength.size,
+        hash(new_wavelength.tobytes()),
+        float(n_res)
+    )
+    try:
+        _resampling_operators.move_to_end(key)
+    except KeyError:
+        pixel = wave_to_pixel(new_wavelength, old_wavelength)
+        (finite, ) = np.where(np.isfinite(pixel))
+
+        lobe, sinc, in_range = sinc_kernel(pixel[finite], n_res, old_wavelength.size)
+        rows = np.broadcast_to(finite[:, np.newaxis], lobe.shape)
+        operator = sparse.csr_matrix(
+            (sinc[in_range], (rows[in_range], lobe[in_range])),
+            shape=(new_wavelength.size, old_wavelength.size)
+        )
+        _resampling_operators[key] = (operator, operator.multiply(operator).tocsr(), finite)
+        while len(_resampling_operators) > RESAMPLING_OPERATOR_CACHE_SIZE:
+            _resampling_operators.popitem(last=False)
+    return _resampling_operators[key]
+
+
+def propagate_bitmask(operator, bitmask):
+    """
+    Propagate a bitmask through a resampling operator.
+
+    Each new pixel gets the bitwise OR of the flags of every old pixel in the support of its
+    resampling kernel (every stored entry in its row of the operator).
+
+    In SDSS-IV each bit was resampled separately, and any pixel with an (absolute) resampled value
+    greater than 0.1 was flagged. Any pixel flagged that way has a flagged old pixel in its kernel
+    support, so this keeps every flag that approach would set, and propagates all bits at once.
+
+    :param operator:
+        A CSR resampling operator (see `resampling_operator`).
+
+    :param bitmask:
+        An integer bitmask array for the old pixels.
+
+    :returns:
+        An integer bitmask array for the new pixels.
+    """
+    bitmask = np.asarray(bitmask)
+    new_bitmask = np.zeros(operator.shape[0], dtype=bitmask.dtype)
+    (non_empty, ) = np.where(np.diff(operator.indptr) > 0)
+    if non_empty.size > 0:
+        # Entries of each row are contiguous in a CSR matrix, so we can reduce over each row.
+        new_bitmask[non_empty] = np.bitwise_or.reduceat(
+            bitmask[operator.indices], operator.indptr[non_empty]
+        )
+    return new_bitmask
+
 
 # Hogg start smashing here
 
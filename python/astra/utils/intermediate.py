@@ -0,0 +1,148 @@
+"""Store intermediate outputs (e.g., continuum and model flux) for many spectra in one HDF5 file."""
+
+import os
+import h5py
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime
+from uuid import uuid4
+
+from astra import __version__
+from astra.utils import expand_path
+
+# The number of stores to keep a `spectrum_pk` index for (see `read_intermediate_outputs`).
+STORE_INDEX_CACHE_SIZE = 8
+_store_indices = OrderedDict()
+
+
+def get_intermediate_output_store_path(pipeline):
+    """
+    Return a new (unique) path for an intermediate output store.
+
+    :param pipeline:
+        The pipeline name (e.g., `TheCannon`).
+
+    :returns:
+        A path that starts with `$MWM_ASTRA`, so that it can be stored in the database.
+    """
+    return f"$MWM_ASTRA/{__version__}/pipelines/{pipeline}/stores/{datetime.now():%Y%m%d%H%M%S}-{uuid4().hex[:8]}.h5"
+
+
+class IntermediateOutputStore:
+
+    """
+    Append pixel arrays for many spectra to one HDF5 file, keyed by `spectrum_pk`.
+
+    :param path:
+        The path of the store.
+
+    :param n_pixels:
+        The number of pixels in each array.
+
+    :param keys: [optional]
+        The names of the arrays to store for each spectrum.
+
+    :param dtype: [optional]
+        The data type of the arrays.
+    """
+
+    def __init__(self, path, n_pixels, keys=("continuum", "rectified_model_flux"), dtype=np.float32):
+        self.path = path
+        self.n_pixels = n_pixels
+        self.keys = tuple(keys)
+        self.dtype = dtype
+        return None
+
+
+    def __enter__(self):
+        full_path = expand_path(self.path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        self._fp = h5py.File(full_path, "w")
+        self._datasets = dict(
+            spectrum_pk=self._fp.create_dataset("spectrum_pk", (0, ), maxshape=(None, ), dtype=np.int64)
+        )
+        for key in self.keys:
+            self._datasets[key] = self._fp.create_dataset(
+                key,
+                (0, self.n_pixels),
+                maxshape=(None, self.n_pixels),
+                chunks=(1, self.n_pixels),
+                dtype=self.dtype
+            )
+        return self
+
+
+    def __exit__(self, *exc):
+        self._fp.close()
+        return False
+
+
+    def append(self, spectrum_pk, **arrays):
+        """
+        Append arrays for many spectra.
+
+        :param spectrum_pk:
+            A list of spectrum primary keys.
+
+        :param arrays:
+            Arrays of shape `(n_spectra, n_pixels)` for every key in the store.
+        """
+        N = len(spectrum_pk)
+        S = self._datasets["spectrum_pk"].shape[0]
+        for key, values in dict(spectrum_pk=spectrum_pk, **arrays).items():
+            self._datasets[key].resize(S + N, axis=0)
+            self._datasets[key][S:] = values
+        self._fp.flush()
+
+
+def _get_store_index(fp, full_path):
+    """
+    Return a dictionary that maps `spectrum_pk` to row index for an intermediate output store.
+
+    The index is read once per store and cached, so that reading outputs for many spectra from one
+    store does not read the whole `spectrum_pk` dataset for every spectrum. The cache is keyed by
+    the path and modification time, so a store that is appended to is indexed again.
+
+    :param fp:
+        An open `h5py.File` of the store.
+
+    :param full_path:
+        The expanded path of the store.
+    """
+    key = (full_path, os.path.getmtime(full_path))
+    try:
+        _store_indices.move_to_end(key)
+    except KeyError:
+        index = {}
+        for row, spectrum_pk in enumerate(fp["spectrum_pk"][:].tolist()):
+            # Keep the first row, like a search through the dataset would.
+            index.setdefault(spectrum_pk, row)
+        _store_indices[key] = index
+        while len(_store_indices) > STORE_INDEX_CACHE_SIZE:
+            _store_indices.popitem(last=False)
+    return _store_indices[key]
+
+
+def read_intermediate_outputs(path, spectrum_pk, keys=("continuum", "rectified_model_flux")):
+    """
+    Read the arrays stored for a spectrum in an intermediate output store.
+
+    :param path:
+        The path of the store.
+
+    :param spectrum_pk:
+        The spectrum primary key.
+
+    :param keys: [optional]
+        The names of the arrays to read.
+
+    :returns:
+        A tuple of arrays, in the same order as `keys`.
+    """
+    full_path = expand_path(path)
+    with h5py.File(full_path, "r") as fp:
+        try:
+            row = _get_store_index(fp, full_path)[spectrum_pk]
+        except KeyError:
+            raise KeyError(f"No intermediate outputs for spectrum_pk={spectrum_pk} in {path}") from None
+        return tuple(fp[key][row] for key in keys)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Allow the tests to run from a source checkout without installing astra.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python"))
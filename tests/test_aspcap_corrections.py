@@ -0,0 +1,246 @@
+import numpy as np
+import pytest
+from peewee import chunked
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+pytest.importorskip("sklearn")
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LinearRegression
+
+from astra.models import ApogeeCoaddedSpectrumInApStar
+from astra.models.aspcap import ASPCAP
+from astra.models.source import Source
+from astra.models.spectrum import Spectrum
+from astra.pipelines.aspcap import corrections
+
+MODELS = (Source, Spectrum, ApogeeCoaddedSpectrumInApStar, ASPCAP)
+
+
+def populate(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+
+    def maybe_null(value, p):
+        return None if rng.uniform() < p else float(value)
+
+    for i in range(n):
+        source = Source.create(
+            bp_mag=maybe_null(rng.uniform(10, 16), 0.1),
+            rp_mag=maybe_null(rng.uniform(9, 13), 0.1),
+            k_mag=float(rng.uniform(6, 12)),
+            plx=float(rng.uniform(-1, 20)),
+        )
+        spectrum = Spectrum.create()
+        if rng.uniform() < 0.7:
+            ApogeeCoaddedSpectrumInApStar.create(
+                source=source,
+                spectrum_pk=spectrum.pk,
+                release="sdss5",
+                apred="1.2",
+                obj=f"2M{i:08d}",
+                telescope="apo25m",
+                std_v_rad=float(rng.uniform(0, 3)),
+            )
+        # Put some stars right at the dwarf/giant and M-dwarf boundaries.
+        raw_logg = rng.choice([rng.uniform(0, 5), 3.8])
+        raw_teff = rng.choice([rng.uniform(3000, 7000), 4100])
+        ASPCAP.create(
+            source_pk=source.pk,
+            spectrum_pk=spectrum.pk,
+            raw_teff=maybe_null(raw_teff, 0.05),
+            raw_e_teff=maybe_null(rng.uniform(10, 100), 0.05),
+            raw_logg=maybe_null(raw_logg, 0.05),
+            raw_e_logg=maybe_null(rng.uniform(0.01, 0.1), 0.05),
+            raw_m_h_atm=maybe_null(rng.uniform(-2, 0.5), 0.05),
+            raw_c_m_atm=float(rng.uniform(-0.5, 0.5)),
+            teff=float(rng.uniform(3000, 7000)),
+            logg=float(rng.uniform(0, 5)),
+            calibrated_flags=int(rng.integers(0, 16)),
+        )
+
+
+@pytest.fixture
+def database():
+    database = SqliteExtDatabase(":memory:")
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+        populate()
+        yield database
+        database.drop_tables(MODELS)
+    database.close()
+
+
+def fetch(*fields):
+    return np.array(list(ASPCAP.select(*fields).order_by(ASPCAP.task_pk).tuples()), dtype=float)
+
+
+def synthetic_models(seed=0):
+    rng = np.random.default_rng(seed)
+    X = np.array([
+        rng.uniform(3500, 5500, 500),
+        rng.uniform(0, 3.8, 500),
+        rng.uniform(-2, 0.5, 500),
+        rng.uniform(-0.5, 0.5, 500),
+    ]).T
+    y = np.where(X[:, 1] + 0.2 * X[:, 2] > 2.3, 2, 1)
+    clf = RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0).fit(X, y)
+    lm_rgb = LinearRegression().fit(X[:, [2, 1]], 0.9 * X[:, 1] + 0.1 * X[:, 2] + 0.05)
+    return (clf, lm_rgb, 0.07)
+
+
+def per_row_clear_corrections(batch_size=500):
+    # The per-row implementation that `clear_corrections` replaced.
+    for chunk in chunked(ASPCAP.select(), batch_size):
+        for result in chunk:
+            result.teff = result.raw_teff
+            result.e_teff = result.raw_e_teff
+            result.logg = result.raw_logg
+            result.e_logg = result.raw_e_logg
+        ASPCAP.bulk_update(chunk, fields=[ASPCAP.teff, ASPCAP.e_teff, ASPCAP.logg, ASPCAP.e_logg])
+
+
+def per_row_flag_high_std_v_rad():
+    # The per-row implementation of the `flag_high_std_v_rad` step in `apply_flags`.
+    q = (
+        ASPCAP
+        .select(ASPCAP, ApogeeCoaddedSpectrumInApStar.std_v_rad)
+        .join(ApogeeCoaddedSpectrumInApStar, on=(ASPCAP.spectrum_pk == ApogeeCoaddedSpectrumInApStar.spectrum_pk))
+        .objects()
+    )
+    for chunk in chunked(q, 1000):
+        updated = []
+        for item in chunk:
+            if item.std_v_rad > 1:
+                item.flag_high_std_v_rad = True
+                updated.append(item)
+        if updated:
+            ASPCAP.bulk_update(updated, fields=[ASPCAP.result_flags])
+
+
+def per_row_ipl3_logg_corrections(clf, lm_rgb, rc_offset, batch_size=500):
+    # The per-row implementation that `update_ipl3_logg_corrections` replaced.
+    def logg_correction_dwarf(r):
+        return r.raw_logg - (-0.947 + 1.886e-4 * r.raw_teff + 0.410 * r.raw_m_h_atm)
+
+    q = (
+        ASPCAP
+        .select(ASPCAP, Source.bp_mag, Source.rp_mag, Source.k_mag, Source.plx)
+        .join(Source)
+        .where(
+            ASPCAP.raw_teff.is_null(False)
+        &   ASPCAP.raw_logg.is_null(False)
+        &   ASPCAP.raw_m_h_atm.is_null(False)
+        )
+        .objects()
+    )
+    for chunk in chunked(q, batch_size):
+        updated = []
+        for r in chunk:
+            r.calibrated_flags = 0
+            r.logg = r.raw_logg
+            if r.raw_logg >= 3.8:
+                if r.raw_teff > 4100:
+                    r.logg = logg_correction_dwarf(r)
+                    r.flag_as_dwarf_for_calibration = True
+                else:
+                    try:
+                        bp_rp = r.bp_mag - r.rp_mag
+                    except:
+                        r.logg = logg_correction_dwarf(r)
+                        r.flag_as_dwarf_for_calibration = True
+                    else:
+                        if (3.5 > bp_rp > 1.5) and np.all(np.isfinite(np.array([r.k_mag, r.plx]).astype(float))) and r.plx > 0:
+                            r.flag_as_m_dwarf_for_calibration = True
+                        else:
+                            r.logg = logg_correction_dwarf(r)
+                            r.flag_as_dwarf_for_calibration = True
+            elif r.raw_logg < 3.8:
+                X = np.atleast_2d([r.raw_teff, r.raw_logg, r.raw_m_h_atm, r.raw_c_m_atm]).astype(float)
+                if np.isfinite(X).all():
+                    predicted_class, = clf.predict(X)
+                    if predicted_class == 1:
+                        r.flag_as_giant_for_calibration = True
+                        r.logg, = lm_rgb.predict(np.atleast_2d([r.raw_m_h_atm, r.raw_logg]))
+                    elif predicted_class == 2:
+                        r.flag_as_red_clump_for_calibration = True
+                        r.logg = r.raw_logg - rc_offset
+                    else:
+                        raise ValueError("arrrgh")
+            if np.isfinite(r.logg):
+                updated.append(r)
+        if updated:
+            ASPCAP.bulk_update(updated, fields=[ASPCAP.logg, ASPCAP.calibrated_flags])
+
+
+def run_on_fresh_database(callable, *args, **kwargs):
+    database = SqliteExtDatabase(":memory:")
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+        populate()
+        callable(*args, **kwargs)
+        values = fetch(ASPCAP.task_pk, ASPCAP.teff, ASPCAP.e_teff, ASPCAP.logg, ASPCAP.e_logg, ASPCAP.calibrated_flags, ASPCAP.result_flags)
+    database.close()
+    return values
+
+
+def test_update_from_values(database):
+    before = fetch(ASPCAP.task_pk, ASPCAP.logg, ASPCAP.calibrated_flags, ASPCAP.teff)
+    pks = before[::3, 0].astype(int)
+    logg = np.linspace(0, 5, pks.size)
+    flags = np.arange(pks.size) % 16
+
+    N_updated = corrections.update_from_values(
+        ASPCAP,
+        pks,
+        { ASPCAP.logg: logg, ASPCAP.calibrated_flags: flags },
+        batch_size=7
+    )
+    assert N_updated == pks.size
+
+    expected = before.copy()
+    expected[::3, 1] = logg
+    expected[::3, 2] = flags
+    after = fetch(ASPCAP.task_pk, ASPCAP.logg, ASPCAP.calibrated_flags, ASPCAP.teff)
+    np.testing.assert_array_equal(after, expected)
+
+
+def test_clear_corrections_matches_per_row():
+    expected = run_on_fresh_database(per_row_clear_corrections)
+    actual = run_on_fresh_database(corrections.clear_corrections)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_clear_corrections_batch_size_is_deprecated(database):
+    with pytest.warns(DeprecationWarning):
+        corrections.clear_corrections(batch_size=500)
+
+
+def test_apply_flags_high_std_v_rad_matches_per_row():
+    expected = run_on_fresh_database(per_row_flag_high_std_v_rad)
+    actual = run_on_fresh_database(corrections.apply_flags)
+
+    flag = ASPCAP.flag_high_std_v_rad._value
+    expected_flag = (expected[:, -1].astype(int) & flag) > 0
+    actual_flag = (actual[:, -1].astype(int) & flag) > 0
+    assert np.any(expected_flag) and not np.all(expected_flag)
+    np.testing.assert_array_equal(actual_flag, expected_flag)
+
+
+@pytest.mark.parametrize("batch_size", [500, 37])
+def test_ipl3_logg_corrections_match_per_row(batch_size):
+    clf, lm_rgb, rc_offset = synthetic_models()
+    expected = run_on_fresh_database(per_row_ipl3_logg_corrections, clf, lm_rgb, rc_offset)
+    actual = run_on_fresh_database(corrections.update_ipl3_logg_corrections, clf, lm_rgb, rc_offset, batch_size=batch_size)
+
+    # Every calibration class should be represented.
+    calibrated_flags = expected[:, 5].astype(int)
+    for field in (
+        ASPCAP.flag_as_dwarf_for_calibration,
+        ASPCAP.flag_as_m_dwarf_for_calibration,
+        ASPCAP.flag_as_giant_for_calibration,
+        ASPCAP.flag_as_red_clump_for_calibration
+    ):
+        assert np.any(calibrated_flags & field._value)
+
+    np.testing.assert_array_equal(actual[:, 5], expected[:, 5])
+    np.testing.assert_allclose(actual[:, 3], expected[:, 3], rtol=1e-12, atol=0)
+    np.testing.assert_array_equal(np.delete(actual, 3, axis=1), np.delete(expected, 3, axis=1))
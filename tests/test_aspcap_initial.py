@@ -0,0 +1,233 @@
+import numpy as np
+import pytest
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from astra.models import ApogeeNetV2 as ApogeeNet
+from astra.models.apogee import ApogeeVisitSpectrum, ApogeeVisitSpectrumInApStar, ApogeeCoaddedSpectrumInApStar
+from astra.models.aspcap import FerreCoarse
+from astra.models.source import Source
+from astra.models.spectrum import Spectrum
+from astra.pipelines.aspcap import initial
+from astra.pipelines.aspcap.utils import approximate_log10_microturbulence
+
+MODELS = (Source, Spectrum, ApogeeVisitSpectrum, ApogeeVisitSpectrumInApStar, ApogeeCoaddedSpectrumInApStar, ApogeeNet)
+
+
+def populate(n=60, seed=0):
+    """
+    Populate the database with sources that cover every branch of the initial guess priority:
+    reliable and unreliable Gaia XP labels, zero, one, or many APOGEENet results (some flagged),
+    and DRP visits with Doppler results inside and outside the valid temperature range.
+
+    :returns:
+        A list of spectra, with visit spectra (matched to Doppler by DRP spectrum) and co-added
+        spectra (matched to Doppler by source) interleaved.
+    """
+    rng = np.random.default_rng(seed)
+
+    def new_spectrum_pk():
+        return Spectrum.create().pk
+
+    spectra = []
+    for i in range(n):
+        has_zgr = rng.uniform() < 0.5
+        source = Source.create(
+            zgr_teff=float(rng.uniform(3500, 7000)) if has_zgr else None,
+            zgr_logg=float(rng.uniform(0, 5)) if has_zgr else None,
+            zgr_fe_h=float(rng.uniform(-2, 0.5)) if has_zgr else None,
+            zgr_quality_flags=int(rng.choice([0, 0, 1])),
+        )
+
+        visits = []
+        for j in range(rng.integers(0, 3)):
+            doppler_teff = rng.choice([None, 1500.0, 200_000.0, float(rng.uniform(3000, 8000))])
+            visits.append(
+                ApogeeVisitSpectrum.create(
+                    source=source,
+                    spectrum_pk=new_spectrum_pk(),
+                    release="sdss5",
+                    apred="1.2",
+                    plate=str(i),
+                    telescope="apo25m",
+                    fiber=int(rng.integers(1, 300)),
+                    mjd=60000 + j,
+                    field="field",
+                    prefix="ap",
+                    doppler_teff=doppler_teff,
+                    doppler_logg=float(rng.uniform(0, 5)),
+                    doppler_fe_h=float(rng.uniform(-2, 0.5)),
+                )
+            )
+
+        for visit in visits:
+            spectra.append(
+                ApogeeVisitSpectrumInApStar.create(
+                    source=source,
+                    spectrum_pk=new_spectrum_pk(),
+                    drp_spectrum_pk=visit.spectrum_pk,
+                    release="sdss5",
+                    apred="1.2",
+                    obj=f"2M{i:08d}",
+                    telescope="apo25m",
+                    plate=str(i),
+                    mjd=visit.mjd,
+                    fiber=visit.fiber,
+                )
+            )
+
+        spectra.append(
+            ApogeeCoaddedSpectrumInApStar.create(
+                source=source,
+                spectrum_pk=new_spectrum_pk(),
+                release="sdss5",
+                apred="1.2",
+                obj=f"2M{i:08d}",
+                telescope="apo25m",
+                mean_fiber=float(rng.uniform(1, 300)),
+            )
+        )
+
+    for spectrum in spectra:
+        for k in range(rng.choice([0, 0, 1, 2])):
+            ApogeeNet.create(
+                source_pk=spectrum.source_pk,
+                spectrum_pk=spectrum.spectrum_pk,
+                teff=float(rng.uniform(3000, 8000)),
+                logg=float(rng.uniform(0, 5)),
+                fe_h=float(rng.uniform(-2, 0.5)),
+                result_flags=int(rng.choice([0, 0, 1])),
+            )
+
+    # Interleave the spectrum types, and do not keep them grouped by source.
+    return [spectra[i] for i in rng.permutation(len(spectra))]
+
+
+@pytest.fixture
+def spectra():
+    database = SqliteExtDatabase(":memory:")
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+        yield populate()
+        database.drop_tables(MODELS)
+    database.close()
+
+
+def per_spectrum_get_initial_guesses(spectra):
+    # The per-spectrum implementation that `get_initial_guesses` replaced.
+    for spectrum in spectra:
+        source = spectrum.source
+        if source.zgr_teff is not None and source.zgr_quality_flags == 0:
+            initial_guess = {
+                "teff": source.zgr_teff,
+                "logg": source.zgr_logg,
+                "m_h": source.zgr_fe_h,
+                "initial_flags": FerreCoarse(flag_initial_guess_from_gaia_xp_zhang_2023=True).initial_flags
+            }
+            initial_guess.update({
+                "telescope": spectrum.telescope,
+                "mean_fiber": initial.get_effective_fiber(spectrum),
+                "alpha_m": 0.0,
+                "log10_v_sini": 1.0,
+                "c_m": 0.0,
+                "n_m": 0.0,
+                "log10_v_micro": approximate_log10_microturbulence(source.zgr_logg),
+            })
+            yield (spectrum, initial_guess)
+
+        try:
+            r = ApogeeNet.get(result_flags=0, spectrum_pk=spectrum.spectrum_pk)
+        except ApogeeNet.DoesNotExist:
+            try:
+                r = (
+                    ApogeeVisitSpectrum
+                    .select()
+                    .where(
+                        (ApogeeVisitSpectrum.spectrum_pk == spectrum.drp_spectrum_pk)
+                    &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
+                    &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
+                    )
+                    .first()
+                )
+            except ApogeeVisitSpectrum.DoesNotExist:
+                raise
+            except:
+                r = (
+                    ApogeeVisitSpectrum
+                    .select()
+                    .where(
+                        (ApogeeVisitSpectrum.source_pk == spectrum.source_pk)
+                    &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
+                    &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
+                    )
+                    .first()
+                )
+            if r is None:
+                continue
+            params = {
+                "teff": r.doppler_teff,
+                "logg": r.doppler_logg,
+                "m_h": r.doppler_fe_h,
+                "initial_flags": FerreCoarse(flag_initial_guess_from_doppler=True).initial_flags
+            }
+        else:
+            params = {
+                "teff": r.teff,
+                "logg": r.logg,
+                "m_h": r.fe_h,
+                "initial_flags": FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags
+            }
+
+        initial_guess = {
+            "telescope": spectrum.telescope,
+            "mean_fiber": initial.get_effective_fiber(spectrum),
+            "alpha_m": 0.0,
+            "log10_v_sini": 1.0,
+            "c_m": 0.0,
+            "n_m": 0.0,
+        }
+        initial_guess.update(params)
+        initial_guess["log10_v_micro"] = approximate_log10_microturbulence(initial_guess["logg"])
+        yield (spectrum, initial_guess)
+
+
+def as_comparable(guesses):
+    return [(spectrum.__class__.__name__, spectrum.spectrum_pk, guess) for spectrum, guess in guesses]
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_get_initial_guesses_matches_per_spectrum(spectra, batch_size):
+    expected = as_comparable(per_spectrum_get_initial_guesses(spectra))
+    actual = as_comparable(initial.get_initial_guesses(spectra, batch_size=batch_size))
+    assert actual == expected
+
+
+def test_initial_guess_priority_and_fallbacks(spectra):
+    expected = as_comparable(per_spectrum_get_initial_guesses(spectra))
+
+    # The test data should exercise every source of initial guesses, and both Doppler matches.
+    flags = {}
+    for name, spectrum_pk, guess in expected:
+        flags.setdefault(guess["initial_flags"], set()).add(name)
+
+    assert flags[FerreCoarse(flag_initial_guess_from_gaia_xp_zhang_2023=True).initial_flags]
+    assert flags[FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags]
+    assert flags[FerreCoarse(flag_initial_guess_from_doppler=True).initial_flags] == {
+        "ApogeeVisitSpectrumInApStar",
+        "ApogeeCoaddedSpectrumInApStar"
+    }
+    # Some spectra should have two initial guesses, and some none.
+    spectrum_pks = [spectrum_pk for name, spectrum_pk, guess in expected]
+    assert len(set(spectrum_pks)) < len(spectrum_pks)
+    assert len(set(spectrum_pks)) < len(spectra)
+
+
+def test_get_initial_guesses_for_chunk_yield_order(spectra):
+    chunk = spectra[:25]
+    actual = as_comparable(initial._get_initial_guesses_for_chunk(chunk))
+    expected = as_comparable(per_spectrum_get_initial_guesses(chunk))
+    assert actual == expected
+
+    # Guesses follow the order of the input spectra.
+    order = { s.spectrum_pk: i for i, s in enumerate(chunk) }
+    positions = [order[spectrum_pk] for name, spectrum_pk, guess in actual]
+    assert positions == sorted(positions)
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from astra.models.aspcap import FerreCoarse, FerreStellarParameters
+from astra.models.source import Source
+from astra.models.spectrum import Spectrum
+from astra.pipelines.aspcap.utils import select_best_results, count_duplicate_results, stream_best_results
+
+MODELS = (Source, Spectrum, FerreCoarse, FerreStellarParameters)
+
+
+def populate(n=50, seed=0):
+    """
+    Populate the database with zero to four stellar parameter results per spectrum. The penalized
+    reduced chi-squared values are drawn from a few values, so that some spectra have equally good
+    results, and some results have no penalized reduced chi-squared at all.
+    """
+    rng = np.random.default_rng(seed)
+    source = Source.create(zgr_quality_flags=0)
+    for i in range(n):
+        spectrum_pk = Spectrum.create().pk
+        upstream = FerreCoarse.create(source_pk=source.pk, spectrum_pk=spectrum_pk)
+        for j in range(rng.choice([0, 1, 1, 2, 3, 4])):
+            penalized_rchi2 = rng.choice([None, 1.0, 2.0, 2.0, 3.0, float(rng.uniform(1, 3))])
+            FerreStellarParameters.create(
+                source_pk=source.pk,
+                spectrum_pk=spectrum_pk,
+                upstream=upstream,
+                penalized_rchi2=penalized_rchi2,
+            )
+
+
+@pytest.fixture
+def database():
+    database = SqliteExtDatabase(":memory:")
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+        populate()
+        yield database
+        database.drop_tables(MODELS)
+    database.close()
+
+
+def dict_and_sort_best_results(where):
+    # The selection that `select_best_results` replaced in `plan_abundances` and `plan_stellar_parameters`.
+    all_results = {}
+    for result in FerreStellarParameters.select().where(where):
+        all_results.setdefault(result.spectrum_pk, [])
+        all_results[result.spectrum_pk].append(result)
+
+    best_results, n_spectra_with_duplicates, n_spectra_with_equally_good_results = ({}, 0, 0)
+    for spectrum_pk, results in all_results.items():
+        penalized_rchi2 = np.array([r.penalized_rchi2 for r in results])
+        indices = np.argsort(penalized_rchi2, kind="stable")
+        if len(indices) > 1:
+            n_spectra_with_duplicates += 1
+            if penalized_rchi2[indices[0]] == penalized_rchi2[indices[1]]:
+                n_spectra_with_equally_good_results += 1
+
+        best_results[spectrum_pk] = [r for r in results if r.penalized_rchi2 == penalized_rchi2[indices[0]]]
+    return (best_results, n_spectra_with_duplicates, n_spectra_with_equally_good_results)
+
+
+@pytest.mark.parametrize("restrict", [False, True])
+def test_select_best_results_matches_dict_and_sort(database, restrict):
+    where = FerreStellarParameters.penalized_rchi2.is_null(False)
+    if restrict:
+        where &= (FerreStellarParameters.spectrum_pk << list(range(1, 30)))
+
+    expected, *expected_counts = dict_and_sort_best_results(where)
+    actual = list(select_best_results(FerreStellarParameters, where))
+
+    assert [r.spectrum_pk for r in actual] == sorted(expected)
+    for result in actual:
+        equally_good = expected[result.spectrum_pk]
+        assert result.penalized_rchi2 == equally_good[0].penalized_rchi2
+        # The dict-and-sort selection took any of the equally good results; now it is the most recent.
+        assert result.task_pk == max(r.task_pk for r in equally_good)
+
+    assert count_duplicate_results(FerreStellarParameters, where) == tuple(expected_counts)
+
+    # The test data should have spectra with duplicates, with and without equally good results.
+    n_spectra_with_duplicates, n_spectra_with_equally_good_results = expected_counts
+    assert 0 < n_spectra_with_equally_good_results < n_spectra_with_duplicates < len(expected)
+
+
+def test_select_best_results_puts_null_penalized_rchi2_last(database):
+    actual = { r.spectrum_pk: r for r in select_best_results(FerreStellarParameters) }
+    for spectrum_pk, result in actual.items():
+        penalized_rchi2 = [
+            r.penalized_rchi2 for r in FerreStellarParameters.select().where(FerreStellarParameters.spectrum_pk == spectrum_pk)
+        ]
+        if any(v is not None for v in penalized_rchi2):
+            assert result.penalized_rchi2 == min(v for v in penalized_rchi2 if v is not None)
+        else:
+            assert result.penalized_rchi2 is None
+
+
+def test_stream_best_results_reports_duplicates(database, caplog):
+    where = FerreStellarParameters.penalized_rchi2.is_null(False)
+    _, n_spectra_with_duplicates, n_spectra_with_equally_good_results = dict_and_sort_best_results(where)
+    with caplog.at_level("WARNING", logger="astra"):
+        results = list(stream_best_results(FerreStellarParameters, where))
+
+    assert [r.task_pk for r in results] == [r.task_pk for r in select_best_results(FerreStellarParameters, where)]
+    assert f"There were {n_spectra_with_duplicates} spectra with multiple results" in caplog.text
+    assert f"There were {n_spectra_with_equally_good_results} spectra with multiple equally good results" in caplog.text
@@ -0,0 +1,187 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+
+from astra.pipelines.aspcap import streaming
+from astra.pipelines.ferre.operator import FERRE_DONE_BASENAME
+
+
+class FakeFerre:
+
+    """
+    A stand-in for the ASPCAP stage tasks, the load balancer, and FERRE itself.
+
+    Every execution is split into two partitions (except abundances, which are executed in list
+    mode), and each call to `sleep` finishes the next partition that is still running, unless it
+    is in `never_finish`.
+    """
+
+    grids = {"A": range(0, 12), "B": range(6, 18)}
+
+    def __init__(self, parent_dir, never_finish=()):
+        self.parent_dir = str(parent_dir)
+        self.never_finish = set(never_finish)
+        self.clock, self.pending, self.finished = (0, [], [])
+        self.handed_off = { streaming.PARAMS_STAGE: [], streaming.ABUNDANCES_STAGE: [] }
+        self.posted = { stage: [] for stage in streaming.STAGES }
+        self.ferre_list_mode = set()
+
+    def patch(self, monkeypatch):
+        for name in (
+            "pre_coarse_stellar_parameters", "post_coarse_stellar_parameters",
+            "pre_stellar_parameters", "post_stellar_parameters",
+            "pre_abundances", "post_abundances",
+            "_load_balancer", "sleep", "time"
+        ):
+            monkeypatch.setattr(streaming, name, getattr(self, name))
+
+    def write_execution(self, pwd, spectrum_pks):
+        os.makedirs(pwd, exist_ok=True)
+        open(os.path.join(pwd, "input.nml"), "w").close()
+        with open(os.path.join(pwd, "parameter.input"), "w") as fp:
+            for index, spectrum_pk in enumerate(spectrum_pks):
+                fp.write(f"{index}_{spectrum_pk}_{spectrum_pk}_0_0 1 2 3\n")
+
+    # Stage tasks
+    def pre_coarse_stellar_parameters(self, spectra, parent_dir, *args, **kwargs):
+        for grid, spectrum_pks in self.grids.items():
+            self.write_execution(f"{parent_dir}/{streaming.COARSE_STAGE}/{grid}", spectrum_pks)
+        return []
+
+    def pre_stellar_parameters(self, spectra, parent_dir, weight_path, pwd_suffix="", **kwargs):
+        spectrum_pks = [s.spectrum_pk for s in spectra]
+        self.handed_off[streaming.PARAMS_STAGE].append((len(self.finished), spectrum_pks))
+        self.write_execution(f"{parent_dir}/{streaming.PARAMS_STAGE}/A{pwd_suffix}", spectrum_pks)
+        return []
+
+    def pre_abundances(self, spectra, parent_dir, element_weight_paths, pwd_suffix="", **kwargs):
+        spectrum_pks = [s.spectrum_pk for s in spectra]
+        self.handed_off[streaming.ABUNDANCES_STAGE].append((len(self.finished), spectrum_pks))
+        pwd = f"{parent_dir}/{streaming.ABUNDANCES_STAGE}/A{pwd_suffix}"
+        for species in ("Fe", "Mg"):
+            self.write_execution(f"{pwd}/{species}", spectrum_pks)
+        with open(f"{pwd}/input_list.nml", "w") as fp:
+            fp.write("Fe/input.nml\nMg/input.nml\n")
+        return []
+
+    def post_coarse_stellar_parameters(self, parent_dir, pwds):
+        self.posted[streaming.COARSE_STAGE].extend(pwds)
+        return []
+
+    def post_stellar_parameters(self, parent_dir, pwds):
+        self.posted[streaming.PARAMS_STAGE].extend(pwds)
+        return [f"params:{pwd}" for pwd in pwds]
+
+    def post_abundances(self, parent_dir, ferre_list_mode=False, pwds=None):
+        self.ferre_list_mode.add(ferre_list_mode)
+        self.posted[streaming.ABUNDANCES_STAGE].extend(pwds)
+        return [f"abundances:{pwd}" for pwd in pwds]
+
+    # Execution
+    def _load_balancer(self, stage_dir, input_paths, full_output=True, **kwargs):
+        executions = []
+        for input_path in sorted(input_paths):
+            pwd = os.path.dirname(input_path)
+            if os.path.basename(input_path) == "input_list.nml":
+                for species in ("Fe", "Mg"):
+                    executions.append([f"{pwd}/{species}/parameter.output", len(streaming.read_spectrum_primary_keys(f"{pwd}/{species}")), 0])
+                self.pending.append((pwd, [f"{pwd}/{species}" for species in ("Fe", "Mg")]))
+                continue
+
+            names = np.atleast_1d(np.loadtxt(f"{pwd}/parameter.input", dtype=str, usecols=(0, )))
+            for k, partition_names in enumerate(np.array_split(names, 2)):
+                partition_pwd = f"{pwd}/partition_{k:0>2.0f}"
+                self.write_execution(partition_pwd, [int(name.split("_")[2]) for name in partition_names])
+                executions.append([f"{partition_pwd}/parameter.output", len(partition_names), 0])
+                self.pending.append((partition_pwd, [partition_pwd]))
+        return ((), executions)
+
+    def sleep(self, seconds):
+        self.clock += seconds
+        for i, (unit, output_dirs) in enumerate(self.pending):
+            if unit in self.never_finish:
+                continue
+            for output_dir in output_dirs:
+                n = len(streaming.read_spectrum_primary_keys(output_dir))
+                with open(f"{output_dir}/parameter.output", "w") as fp:
+                    fp.write("x\n" * n)
+            open(os.path.join(unit, FERRE_DONE_BASENAME), "w").close()
+            self.finished.append(self.pending.pop(i)[0])
+            break
+
+    def time(self):
+        return self.clock
+
+    def run(self, **kwargs):
+        spectra = [SimpleNamespace(spectrum_pk=pk, source_pk=pk) for pk in range(18)]
+        kwargs.setdefault("min_batch_size", 1)
+        kwargs.setdefault("refresh_interval", 1)
+        return streaming.stream_aspcap_stages(spectra, self.parent_dir, **kwargs)
+
+
+def test_each_spectrum_is_handed_on_exactly_once(tmp_path, monkeypatch):
+    ferre = FakeFerre(tmp_path)
+    ferre.patch(monkeypatch)
+    stellar_parameter_results, chemical_abundance_results = ferre.run(ferre_list_mode=True)
+
+    for stage in (streaming.PARAMS_STAGE, streaming.ABUNDANCES_STAGE):
+        spectrum_pks = [pk for _, pks in ferre.handed_off[stage] for pk in pks]
+        assert sorted(spectrum_pks) == list(range(18))
+
+    # Every partition is post-processed once, and never the partitioned execution itself.
+    for stage in streaming.STAGES:
+        assert len(ferre.posted[stage]) == len(set(ferre.posted[stage]))
+    assert len(ferre.posted[streaming.COARSE_STAGE]) == 4
+    assert all("partition_" in pwd for pwd in ferre.posted[streaming.COARSE_STAGE])
+    assert len(stellar_parameter_results) == len(ferre.posted[streaming.PARAMS_STAGE])
+    assert len(chemical_abundance_results) == len(ferre.posted[streaming.ABUNDANCES_STAGE])
+    assert ferre.ferre_list_mode == {True}
+
+
+def test_partitions_are_handed_on_as_soon_as_they_finish(tmp_path, monkeypatch):
+    ferre = FakeFerre(tmp_path)
+    ferre.patch(monkeypatch)
+    ferre.run()
+
+    # The first coarse partition of grid A (spectra 0-5) only has spectra that are not in grid B,
+    # so they are handed on while the other three coarse partitions are still running.
+    (n_finished, first_batch), *_ = ferre.handed_off[streaming.PARAMS_STAGE]
+    assert n_finished == 1
+    assert first_batch == list(range(6))
+
+    # Spectra in both grids are only handed on once their partitions in both grids are finished.
+    finished_when = { pk: n for n, pks in ferre.handed_off[streaming.PARAMS_STAGE] for pk in pks }
+    order = { unit: i for i, unit in enumerate(ferre.finished, start=1) }
+    coarse = f"{tmp_path}/{streaming.COARSE_STAGE}"
+    for pk in range(6, 12):
+        assert finished_when[pk] >= max(order[f"{coarse}/A/partition_01"], order[f"{coarse}/B/partition_00"])
+
+
+def test_loop_ends_when_an_execution_never_finishes(tmp_path, monkeypatch):
+    coarse = f"{tmp_path}/{streaming.COARSE_STAGE}"
+    ferre = FakeFerre(tmp_path, never_finish=[f"{coarse}/B/partition_01"])
+    ferre.patch(monkeypatch)
+    ferre.run(timeout=30)
+
+    assert ferre.clock > 30
+    assert f"{coarse}/B/partition_01" not in ferre.finished
+    # Whatever results exist for the unfinished partition are still collected, once.
+    assert ferre.posted[streaming.COARSE_STAGE].count(f"{coarse}/B/partition_01") == 1
+    spectrum_pks = [pk for _, pks in ferre.handed_off[streaming.PARAMS_STAGE] for pk in pks]
+    assert sorted(spectrum_pks) == list(range(18))
+
+
+def test_loop_without_timeout_waits_for_slow_executions(tmp_path, monkeypatch):
+    coarse = f"{tmp_path}/{streaming.COARSE_STAGE}"
+    ferre = FakeFerre(tmp_path, never_finish=[f"{coarse}/B/partition_01"])
+    ferre.patch(monkeypatch)
+
+    def sleep(seconds, sleep=ferre.sleep):
+        if ferre.clock > 1000:
+            ferre.never_finish.clear()
+        sleep(seconds)
+
+    monkeypatch.setattr(streaming, "sleep", sleep)
+    ferre.run(timeout=None, refresh_interval=100)
+    assert f"{coarse}/B/partition_01" in ferre.finished
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from astra.utils import flatten
+from astra.pipelines.ferre.operator import schedule_executions, count_grid_loads
+
+
+def executions(seed=0):
+    rng = np.random.default_rng(seed)
+    grids = [f"grid_{g}" for g in rng.integers(0, 6, 60)]
+    core_seconds = rng.uniform(300, 3000, len(grids))
+    return (core_seconds, grids)
+
+
+@pytest.mark.parametrize("balance_threads", [False, True])
+@pytest.mark.parametrize("co_schedule_grids", [False, True])
+def test_schedule_executions_assigns_every_execution_once(balance_threads, co_schedule_grids):
+    core_seconds, grids = executions()
+    chunks = schedule_executions(
+        core_seconds,
+        grids,
+        nodes=4,
+        max_nodes=4,
+        max_tasks_per_node=4,
+        balance_threads=balance_threads,
+        co_schedule_grids=co_schedule_grids,
+    )
+    assert sorted(flatten(chunks)) == list(range(len(grids)))
+    assert all(0 < len(node) <= 4 for node in chunks)
+
+
+@pytest.mark.parametrize("balance_threads", [False, True])
+def test_co_schedule_grids_reduces_grid_loads(balance_threads):
+    core_seconds, grids = executions()
+    kwds = dict(nodes=4, max_nodes=4, max_tasks_per_node=4, balance_threads=balance_threads)
+
+    default_chunks = schedule_executions(core_seconds, grids, **kwds)
+    chunks = schedule_executions(core_seconds, grids, co_schedule_grids=True, **kwds)
+
+    # Co-scheduling must not be skipped when threads are balanced, and uses the same nodes.
+    assert len(chunks) == len(default_chunks)
+    assert count_grid_loads(chunks, grids)[0] < count_grid_loads(default_chunks, grids)[0]
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from astra.utils import intermediate
+from astra.utils.intermediate import IntermediateOutputStore, read_intermediate_outputs
+
+
+def search_intermediate_outputs(path, spectrum_pk, keys=("continuum", "rectified_model_flux")):
+    # The implementation that searched the `spectrum_pk` dataset for every spectrum.
+    with h5py.File(path, "r") as fp:
+        index = np.where(fp["spectrum_pk"][:] == spectrum_pk)[0]
+        if index.size == 0:
+            raise KeyError(spectrum_pk)
+        return tuple(fp[key][index[0]] for key in keys)
+
+
+def write_store(path, spectrum_pks, n_pixels=50, seed=0):
+    rng = np.random.default_rng(seed)
+    with IntermediateOutputStore(path, n_pixels) as store:
+        for batch in np.array_split(np.array(spectrum_pks), 3):
+            store.append(
+                batch,
+                continuum=rng.uniform(size=(batch.size, n_pixels)),
+                rectified_model_flux=rng.uniform(size=(batch.size, n_pixels)),
+            )
+
+
+def test_read_intermediate_outputs_matches_search(tmp_path):
+    path = str(tmp_path / "store.h5")
+    spectrum_pks = np.random.default_rng(1).permutation(np.arange(100, 400))
+    write_store(path, spectrum_pks)
+
+    intermediate._store_indices.clear()
+    for spectrum_pk in spectrum_pks:
+        expected = search_intermediate_outputs(path, spectrum_pk)
+        actual = read_intermediate_outputs(path, spectrum_pk)
+        for a, b in zip(actual, expected):
+            np.testing.assert_array_equal(a, b)
+
+    # The index of the store is only read once.
+    assert len(intermediate._store_indices) == 1
+
+    with pytest.raises(KeyError):
+        read_intermediate_outputs(path, 10_000)
+
+
+def test_read_intermediate_outputs_after_store_is_rewritten(tmp_path):
+    path = str(tmp_path / "store.h5")
+    write_store(path, [1, 2, 3])
+    read_intermediate_outputs(path, 1)
+
+    write_store(path, [4, 5, 3], seed=1)
+    # Make sure the modification time changes, even on file systems with coarse timestamps.
+    t = os.path.getmtime(path) + 10
+    os.utime(path, (t, t))
+
+    with pytest.raises(KeyError):
+        read_intermediate_outputs(path, 1)
+    for a, b in zip(read_intermediate_outputs(path, 3), search_intermediate_outputs(path, 3)):
+        np.testing.assert_array_equal(a, b)
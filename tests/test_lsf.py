@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from astra.specutils import lsf
+from astra.specutils.lsf import instrument_lsf_kernel, instrument_lsf_dense_matrix, instrument_lsf_sparse_matrix, rotational_broadening_sparse_matrix
+
+
+def loop_instrument_lsf_dense_matrix(λ_input, λ_output, R, **kwargs):
+    # The dense matrix that was replaced, built one output pixel at a time. It used `np.empty`, which
+    # left entries outside the LSF window uninitialised, so here it starts from zeros.
+    K = np.zeros((λ_input.size, λ_output.size), dtype=float)
+    for o, λ in enumerate(λ_output):
+        mask, ϕ = instrument_lsf_kernel(λ_input, λ, R, **kwargs)
+        K[mask, o] += ϕ
+    return K
+
+
+def loop_rotational_broadening_sparse_matrix(λ, vsini, epsilon):
+    # The rotational broadening matrix that was replaced, built one row at a time.
+    denominator = np.pi * vsini * (1.0 - epsilon / 3.0)
+    c1 = 2.0 * (1.0 - epsilon) / denominator
+    c2 = 0.5 * np.pi * epsilon / denominator
+
+    vsini_c = vsini / 299792.458
+    scale = vsini_c / (λ[1] - λ[0])
+    N = λ.size
+
+    data, row_index, col_index = ([], [], [])
+    for i, λ_i in enumerate(λ):
+        n_pix = int(np.ceil(λ_i * scale))
+        si, ei = (max(0, i - n_pix), min(i + n_pix + 1, N))
+        mask = slice(si, ei)
+
+        λ_delta_max = λ_i * vsini_c
+        λ_delta = λ[mask] - λ_i
+        λ_ratio_sq = (λ_delta / λ_delta_max)**2.0
+        with np.errstate(invalid="ignore"):
+            ϕ = c1 * np.sqrt(1.0 - λ_ratio_sq) + c2 * (1.0 - λ_ratio_sq)
+        ϕ[λ_ratio_sq >= 1.0] = 0.0
+        ϕ /= np.sum(ϕ)
+
+        data.extend(ϕ)
+        row_index.extend(list(range(si, ei)))
+        col_index.extend([i] * (ei - si))
+
+    return sparse.csr_matrix((data, (row_index, col_index)), shape=(λ.size, λ.size))
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    lsf._lsf_matrices.clear()
+    yield
+    lsf._lsf_matrices.clear()
+
+
+@pytest.mark.parametrize("R,σ_window", [(22_500, 5), (5_000, 5), (22_500, 3)])
+def test_instrument_lsf_sparse_matrix_matches_loop(R, σ_window):
+    λ_input = np.linspace(15_100, 15_400, 2000)
+    λ_output = 10**(4.179 + 6e-6 * np.arange(1200))
+
+    expected = loop_instrument_lsf_dense_matrix(λ_input, λ_output, R, σ_window=σ_window)
+    actual = instrument_lsf_sparse_matrix(λ_input, λ_output, R, σ_window=σ_window)
+
+    assert actual.shape == expected.shape
+    assert actual.nnz == np.count_nonzero(expected)
+    np.testing.assert_allclose(actual.toarray(), expected, rtol=0, atol=1e-15)
+    np.testing.assert_array_equal(instrument_lsf_dense_matrix(λ_input, λ_output, R, σ_window=σ_window), actual.toarray())
+
+
+@pytest.mark.parametrize("vsini", [5, 50, 300])
+def test_rotational_broadening_sparse_matrix_matches_loop(vsini):
+    λ = np.linspace(15_100, 17_000, 4000)
+
+    expected = loop_rotational_broadening_sparse_matrix(λ, vsini, 0.6)
+    actual = rotational_broadening_sparse_matrix(λ, vsini, 0.6)
+
+    assert actual.nnz == expected.nnz
+    np.testing.assert_array_equal(actual.indices, expected.indices)
+    np.testing.assert_array_equal(actual.indptr, expected.indptr)
+    np.testing.assert_allclose(actual.data, expected.data, rtol=0, atol=1e-15)
+
+
+def test_rotational_broadening_sparse_matrix_stacks_many_vsini():
+    λ = np.linspace(15_100, 17_000, 4000)
+    vsini = np.array([5, 50, 300])
+    flux = np.random.default_rng(0).normal(size=λ.size)
+
+    K = rotational_broadening_sparse_matrix(λ, vsini, 0.6)
+    assert K.shape == (λ.size, vsini.size * λ.size)
+
+    broadened_flux = (flux @ K).reshape((vsini.size, -1))
+    for v, actual in zip(vsini, broadened_flux):
+        np.testing.assert_allclose(actual, flux @ loop_rotational_broadening_sparse_matrix(λ, v, 0.6), rtol=0, atol=1e-13)
+
+
+def test_lsf_matrices_are_cached(monkeypatch):
+    monkeypatch.setattr(lsf, "LSF_MATRIX_CACHE_SIZE", 2)
+    λ = np.linspace(15_100, 15_400, 500)
+
+    K = instrument_lsf_sparse_matrix(λ, λ, 22_500)
+    assert instrument_lsf_sparse_matrix(λ.copy(), λ.copy(), 22_500) is K
+    assert instrument_lsf_sparse_matrix(λ, λ, 5_000) is not K
+
+    rotational_broadening_sparse_matrix(λ, 10, 0.6)
+    assert len(lsf._lsf_matrices) == 2
+    # The least recently used matrix was dropped.
+    assert instrument_lsf_sparse_matrix(λ, λ, 22_500) is not K
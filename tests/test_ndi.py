@@ -0,0 +1,94 @@
+import warnings
+from itertools import cycle
+
+import numpy as np
+import pytest
+
+from astra.specutils import ndi
+from astra.specutils.ndi import construct_design_matrix, resample_spectrum
+
+
+def per_column_design_matrix(wavelength, L, P):
+    # The column-by-column implementation that `construct_design_matrix` replaced.
+    scale = (np.pi * wavelength) / L
+    X = np.ones((wavelength.size, P), dtype=float)
+    for j, f in zip(range(1, P), cycle((np.sin, np.cos))):
+        X[:, j] = f(scale * (j + (j % 2)))
+    return X
+
+
+def visits(M_star, n_visits=4, seed=0):
+    rng = np.random.default_rng(seed)
+    x_star = np.linspace(15100, 15100 + 0.2 * M_star, M_star)
+    truth = lambda x: 1 - 0.3 * np.exp(-0.5 * ((x - x_star.mean()) / 0.5)**2) + 0.05 * np.sin(x)
+    wavelength = np.hstack([x_star * (1 + rng.normal(0, 3e-5)) + rng.uniform(-0.1, 0.1) for _ in range(n_visits)])
+    ivar = rng.uniform(1e3, 1e4, wavelength.size)
+    flux = truth(wavelength) + rng.normal(size=wavelength.size) / np.sqrt(ivar)
+    ivar[rng.random(wavelength.size) < 0.02] = 0
+    return (x_star, wavelength, flux, ivar)
+
+
+@pytest.mark.parametrize("P", [1, 2, 7, 100, 101])
+def test_construct_design_matrix_matches_per_column(P):
+    wavelength = np.linspace(15100, 17000, 333) + np.random.default_rng(P).uniform(-0.1, 0.1, 333)
+    L = np.ptp(wavelength)
+    np.testing.assert_array_equal(
+        construct_design_matrix(wavelength, L, P),
+        per_column_design_matrix(wavelength, L, P)
+    )
+
+
+@pytest.mark.parametrize("M_star,P", [(300, None), (301, None), (400, 200), (400, 201)])
+def test_resample_spectrum_cholesky_matches_lstsq(M_star, P):
+    x_star, wavelength, flux, ivar = visits(M_star)
+    with warnings.catch_warnings():
+        # Make sure the Cholesky solve does not fall back to least-squares.
+        warnings.simplefilter("error")
+        cholesky = resample_spectrum(x_star, wavelength, flux, ivar, P=P, method="cholesky")
+    assert cholesky[3]["method"] == "cholesky"
+    lstsq = resample_spectrum(x_star, wavelength, flux, ivar, P=P, method="lstsq")
+
+    finite = np.isfinite(lstsq[0])
+    assert np.sum(finite) > 0.9 * M_star
+    np.testing.assert_array_equal(np.isfinite(cholesky[0]), finite)
+    np.testing.assert_allclose(cholesky[0][finite], lstsq[0][finite], rtol=0, atol=1e-10)
+    np.testing.assert_allclose(cholesky[1][finite], lstsq[1][finite], rtol=1e-9)
+
+
+def test_resample_spectrum_unknown_method():
+    x_star, wavelength, flux, ivar = visits(50)
+    with pytest.raises(ValueError):
+        resample_spectrum(x_star, wavelength, flux, ivar, method="qr")
+
+
+def gapped_visit(M_star=300):
+    x_star, wavelength, flux, ivar = visits(M_star, n_visits=1)
+    ivar[:] = 1e3
+    ivar[(wavelength > x_star[100]) & (wavelength < x_star[115])] = 0
+    return (x_star, wavelength, flux, ivar)
+
+
+def test_resample_spectrum_warns_once_when_falling_back_to_lstsq(monkeypatch):
+    monkeypatch.setattr(ndi, "_warned_about_cholesky_fallback", False)
+    x_star, wavelength, flux, ivar = gapped_visit()
+    expected = resample_spectrum(x_star, wavelength, flux, ivar, method="lstsq")
+
+    with pytest.warns(UserWarning, match="not positive definite"):
+        actual = resample_spectrum(x_star, wavelength, flux, ivar, method="cholesky")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        resample_spectrum(x_star, wavelength, flux, ivar, method="cholesky")
+
+    assert actual[3]["method"] == "lstsq"
+    np.testing.assert_array_equal(actual[0], expected[0])
+    np.testing.assert_array_equal(actual[1], expected[1])
+
+
+def test_resample_spectrum_uses_lstsq_with_fewer_data_than_parameters(monkeypatch):
+    monkeypatch.setattr(ndi, "_warned_about_cholesky_fallback", False)
+    x_star, wavelength, flux, ivar = visits(300, n_visits=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        *_, meta = resample_spectrum(x_star, wavelength, flux, ivar, P=x_star.size, method="cholesky")
+    assert meta["method"] == "lstsq"
+    assert not ndi._warned_about_cholesky_fallback
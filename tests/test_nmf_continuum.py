@@ -0,0 +1,156 @@
+import numpy as np
+from scipy import optimize as op
+import pytest
+
+from astra.specutils.continuum.nmf.base import BaseNMFSinusoidsContinuum
+
+REGIONS = [(15_100, 15_800), (15_850, 16_900)]
+
+
+def nmf_model(P=600, C=6, seed=0):
+    """A model with absorption-line-like components, and a gap between two continuum regions."""
+    rng = np.random.default_rng(seed)
+    dispersion = np.linspace(15_100, 16_900, P)
+    centers = rng.uniform(dispersion[0], dispersion[-1], (C, 20, 1))
+    depths = rng.uniform(0, 0.3, (C, 20, 1))
+    components = np.sum(depths * np.exp(-0.5 * ((dispersion - centers) / 3.0)**2), axis=1)
+    return BaseNMFSinusoidsContinuum(dispersion, components, deg=3, L=1400, regions=REGIONS)
+
+
+def simulate(model, N=3, snr=100, seed=1):
+    rng = np.random.default_rng(seed)
+    C, P = model.components.shape
+    W = rng.uniform(0, 1, C)
+    theta = np.zeros((N, model.n_regions, model.n_parameters_per_region))
+    theta[..., 0] = rng.uniform(500, 1500, (N, 1))
+    theta[..., 1:] = rng.normal(0, 20, theta[..., 1:].shape)
+    continuum = theta.reshape((N, -1)) @ model.continuum_design_matrix.T
+    flux = (1 - W @ model.components) * continuum
+    flux += rng.normal(0, 1, flux.shape) * flux / snr
+    ivar = np.zeros_like(flux)
+    has_data = flux > 0
+    ivar[has_data] = (snr / flux[has_data])**2
+    ivar[:, 300:310] = 0 # some bad pixels
+    return (flux, ivar)
+
+
+@pytest.mark.parametrize("N", [1, 3])
+def test_alternating_fit_matches_curve_fit(N):
+    model = nmf_model()
+    flux, ivar = simulate(model, N)
+
+    expected_continuum, expected = model.fit(flux.copy(), ivar.copy(), full_output=True, method="curve_fit")
+    actual_continuum, actual = model.fit(flux.copy(), ivar.copy(), full_output=True, method="alternating")
+
+    use = ~expected["mask"].reshape(flux.shape)
+    np.testing.assert_array_equal(actual["mask"], expected["mask"])
+    # Both methods reach the same optimum, to within the tolerance of `curve_fit`.
+    np.testing.assert_allclose(actual_continuum[use], expected_continuum[use], rtol=1e-6)
+    np.testing.assert_allclose(actual["model_flux"][use], expected["model_flux"][use], rtol=1e-6)
+    np.testing.assert_allclose(actual["W"], expected["W"], atol=1e-5)
+    np.testing.assert_allclose(actual["rchi2"], expected["rchi2"], rtol=1e-8)
+
+
+def test_prediction_without_design_matrix_matches_full_design_matrix():
+    model = nmf_model()
+    N, C = (3, model.components.shape[0])
+    rng = np.random.default_rng(2)
+    theta = np.hstack([rng.uniform(0, 1, C), rng.normal(0, 100, N * model.n_regions * model.n_parameters_per_region)])
+
+    A_slice = model.full_design_matrix(N)[:, C:]
+    for expected, actual in zip(model(theta, A_slice=A_slice, full_output=True), model(theta, full_output=True)):
+        np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=1e-9)
+
+
+def loop_theta_step(model, flux, ivar, rectified_flux):
+    # The `_theta_step` that was replaced by the batched solve: one solve per spectrum and region.
+    N, P = flux.shape
+    theta = np.zeros((N, model.n_regions, model.n_parameters_per_region))
+    continuum = np.nan * np.ones_like(flux)
+    continuum_flux = flux / rectified_flux
+    continuum_ivar = ivar * rectified_flux**2
+    for i in range(N):
+        for j, mask in enumerate(model.region_masks):
+            sj, ej = (j * model.n_parameters_per_region, (j + 1) * model.n_parameters_per_region)
+            A = model.continuum_design_matrix[mask, sj:ej]
+            MTM = A.T @ (continuum_ivar[i, mask][:, None] * A)
+            MTy = A.T @ (continuum_ivar[i, mask] * continuum_flux[i, mask])
+            try:
+                theta[i, j] = np.linalg.solve(MTM, MTy)
+            except np.linalg.LinAlgError:
+                if np.any(continuum_ivar[i, mask] > 0):
+                    raise
+            continuum[i, mask] = A @ theta[i, j]
+    return (theta, continuum)
+
+
+def lsq_linear_initial_guess(model, flux, ivar):
+    # The initial guess that was replaced: a bounded linear fit with the dense design matrix.
+    N, P = flux.shape
+    A = model.full_design_matrix(N)
+    use = ~model.get_mask(ivar).flatten()
+    result = op.lsq_linear(A[use], flux.flatten()[use], bounds=model.get_bounds(N, [-np.inf, 0]), tol=1e-12)
+    C, P = model.components.shape
+    continuum = (A[:, C:] @ result.x[C:]).reshape(flux.shape)
+    mean_rectified_flux, _ = model.get_mean_rectified_flux(flux, ivar, continuum)
+    W_next, *_ = model._W_step(mean_rectified_flux, result.x[:C].astype(np.float64).reshape((1, C)))
+    return (result.x, np.hstack([W_next.flatten(), result.x[C:]]))
+
+
+@pytest.mark.parametrize("per_spectrum_rectified_flux", [False, True])
+def test_theta_step_matches_loop(per_spectrum_rectified_flux):
+    model = nmf_model()
+    flux, ivar = simulate(model, N=4)
+    ivar[2, model.region_masks[1]] = 0 # a region without any data
+
+    rng = np.random.default_rng(3)
+    W = rng.uniform(0, 1, (4 if per_spectrum_rectified_flux else 1, model.components.shape[0]))
+    rectified_flux = np.squeeze(1 - W @ model.components)
+
+    expected_theta, expected_continuum = loop_theta_step(model, flux, ivar, rectified_flux)
+    actual_theta, actual_continuum = model._theta_step(flux, ivar, rectified_flux)
+
+    np.testing.assert_allclose(actual_theta, expected_theta, rtol=1e-8, atol=1e-8)
+    in_regions = ~model._outside_regions
+    np.testing.assert_allclose(actual_continuum[:, in_regions], expected_continuum[:, in_regions], rtol=1e-8)
+    assert np.all(np.isnan(actual_continuum[:, ~in_regions]))
+
+
+@pytest.mark.parametrize("emission", [False, True])
+def test_linear_least_squares_with_bounds_matches_lsq_linear(emission):
+    model = nmf_model()
+    flux, ivar = simulate(model, N=3)
+    N, C = (flux.shape[0], model.components.shape[0])
+    if emission:
+        # Lines in emission make the bounds active for some of the NMF coefficients.
+        flux *= 1 + model.components[:2].sum(axis=0)
+
+    expected_x, _ = lsq_linear_initial_guess(model, flux, ivar)
+    W, theta = model._linear_least_squares_with_bounds(flux, (~model.get_mask(ivar)).astype(float))
+
+    assert np.any(expected_x[:C] > -1e-12) == emission
+    np.testing.assert_allclose(W, expected_x[:C], rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(theta.flatten(), expected_x[C:], rtol=1e-8)
+
+    # The NMF step visits the coefficients in a random order, so use the same order for both.
+    np.random.seed(0)
+    _, expected_x0 = lsq_linear_initial_guess(model, flux, ivar)
+    np.random.seed(0)
+    actual_x0 = model.get_initial_guess_by_linear_least_squares_with_bounds(flux, ivar)
+    np.testing.assert_allclose(actual_x0, expected_x0, rtol=1e-8, atol=1e-10)
+
+
+def test_fits_from_small_W_initial_guess_converge_to_same_solution():
+    # The small-W initial guess changed (the continuum is now ivar-weighted), but not the optimum.
+    model = nmf_model()
+    flux, ivar = simulate(model, N=3)
+    C = model.components.shape[0]
+
+    expected_x, _ = lsq_linear_initial_guess(model, flux, ivar)
+    expected_x0 = np.hstack([1e-12 * np.ones(C), expected_x[C:]])
+    actual_x0 = model.get_initial_guess_with_small_W(flux, ivar)
+
+    expected_continuum = model.fit(flux.copy(), ivar.copy(), x0=expected_x0, method="curve_fit")
+    actual_continuum = model.fit(flux.copy(), ivar.copy(), x0=actual_x0, method="curve_fit")
+    in_regions = ~model._outside_regions
+    np.testing.assert_allclose(actual_continuum[:, in_regions], expected_continuum[:, in_regions], rtol=1e-6)
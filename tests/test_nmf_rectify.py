@@ -0,0 +1,22 @@
+import logging
+from types import SimpleNamespace
+
+from astra.pipelines.nmf_rectify import _report_warm_starts
+
+
+def test_report_warm_starts_separates_iterations_and_function_evaluations(caplog):
+    results = [
+        SimpleNamespace(n_iter=2, nfev=30, t_elapsed=0.1, flag_initialised_from_previous_result=True),
+        SimpleNamespace(n_iter=4, nfev=50, t_elapsed=0.3, flag_initialised_from_previous_result=True),
+        SimpleNamespace(n_iter=10, nfev=200, t_elapsed=1.0, flag_initialised_from_previous_result=False),
+        SimpleNamespace(n_iter=None, nfev=None, t_elapsed=None, flag_initialised_from_previous_result=False),
+    ]
+    with caplog.at_level(logging.INFO, logger="astra"):
+        assert list(_report_warm_starts(results)) == results
+
+    messages = "\n".join(caplog.messages)
+    assert "Warm-started 2 of 3 spectra" in messages
+    assert "Warm-started fits took 3.0 iterations, 40.0 function evaluations, and 0.200 s per spectrum" in messages
+    assert "Other fits took 10.0 iterations, 200.0 function evaluations, and 1.000 s per spectrum" in messages
+    assert "14 iterations, 320 function evaluations, 1.6 s of fitting time" in messages
+    assert "s of wall time" in messages
@@ -0,0 +1,205 @@
+import numpy as np
+import pytest
+from time import time
+
+from astra.specutils.resampling import (
+    resample, resampling_operator, propagate_bitmask, separate_bitmasks, sincint, sinc_kernel, wave_to_pixel
+)
+
+APOGEE_WAVELENGTH = 10**(4.179 + 6e-6 * np.arange(8575))
+APOGEE_N_RES = (5, 4.25, 3.5)
+
+
+def per_pixel_sincint(x, nres, speclist):
+    """The previous implementation of `sincint`, which loops over every output pixel."""
+
+    dampfac = 3.25 * nres / 2.0
+    ksize = int(21 * nres / 2.0)
+    if ksize % 2 == 0:
+        ksize += 1
+    nhalf = ksize // 2
+
+    nf = len(speclist[0][0])
+    ix = x.astype(int)
+    fx = x - ix
+
+    outlist = []
+    for spec in speclist:
+        if spec[1] is None:
+            outlist.append([np.full_like(x, 0), None])
+        else:
+            outlist.append([np.full_like(x, 0), np.full_like(x, 0)])
+
+    for i in range(len(x)):
+        xkernel = np.arange(ksize) - nhalf - fx[i]
+        xkernel /= nres / 2.0
+        u1 = xkernel / dampfac
+        u2 = np.pi * xkernel
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sinc = np.exp(-(u1**2)) * np.sin(u2) / u2
+        sinc /= nres / 2.0
+        sinc[u2 == 0] = 1
+
+        lobe = np.arange(ksize) - nhalf + ix[i]
+        gd = np.where((lobe >= 0) & (lobe < nf))[0]
+
+        for spec, out in zip(speclist, outlist):
+            vals = spec[0][lobe[gd]]
+            out[0][i] = (sinc[gd] * vals).sum()
+            if spec[1] is not None:
+                var = spec[1][lobe[gd]]
+                out[1][i] = (sinc[gd] ** 2 * var).sum()
+
+    for out in outlist:
+        if out[1] is not None:
+            out[1] = np.sqrt(out[1])
+
+    return outlist
+
+
+def sincint_inputs(n_pixels=1024, n_out=700, seed=0):
+    rng = np.random.default_rng(seed)
+    # Include positions at, near, and just beyond the edges of the input pixels.
+    x = np.sort(np.hstack([rng.uniform(-0.5, n_pixels - 0.5, n_out), [0.0, 0.5, 10.0, n_pixels - 1.0]]))
+    flux = rng.normal(size=n_pixels)
+    variance = rng.uniform(0.1, 1, n_pixels)
+    # Non-finite pixels at (and near) the edges.
+    flux[[0, 3, n_pixels - 1]] = np.nan
+    variance[[1, n_pixels - 2]] = np.inf
+    return (x, flux, variance)
+
+
+@pytest.mark.parametrize("nres", [2, 3, 4.25, 4.5, 5])
+def test_sincint_matches_per_pixel_loop(nres):
+    x, flux, variance = sincint_inputs()
+    expected = per_pixel_sincint(x, nres, [[flux, variance], [variance, None]])
+    actual = sincint(x, nres, [[flux, variance], [variance, None]])
+    for (expected_value, expected_error), (actual_value, actual_error) in zip(expected, actual):
+        np.testing.assert_allclose(actual_value, expected_value, rtol=1e-12, atol=1e-14)
+        if expected_error is None:
+            assert actual_error is None
+        else:
+            np.testing.assert_allclose(actual_error, expected_error, rtol=1e-12, atol=1e-14)
+
+
+@pytest.mark.parametrize("nres", [2, 3.5, 5])
+def test_sincint_with_many_spectra(nres):
+    x, flux, variance = sincint_inputs()
+    rng = np.random.default_rng(1)
+    many_flux = np.vstack([flux, rng.normal(size=(4, flux.size))])
+    many_variance = np.vstack([variance, rng.uniform(0.1, 1, size=(4, flux.size))])
+    ((actual_flux, actual_error), ) = sincint(x, nres, [[many_flux, many_variance]])
+    assert actual_flux.shape == actual_error.shape == (5, x.size)
+    for i in range(5):
+        ((expected_flux, expected_error), ) = per_pixel_sincint(x, nres, [[many_flux[i], many_variance[i]]])
+        np.testing.assert_allclose(actual_flux[i], expected_flux, rtol=1e-12, atol=1e-14)
+        np.testing.assert_allclose(actual_error[i], expected_error, rtol=1e-12, atol=1e-14)
+
+
+def apogee_visit_stack(n_visits=20, n_bits=20, seed=0):
+    """Return chip wavelengths and flux, ivar, and pixel flags for a stack of APOGEE-like visits."""
+    rng = np.random.default_rng(seed)
+    chip_wavelength = np.array([APOGEE_WAVELENGTH[i * 2800:i * 2800 + 2048] * (1 + 3e-5) for i in range(3)])
+    shape = (n_visits, *chip_wavelength.shape)
+    flux = 1 + 0.01 * rng.normal(size=shape)
+    ivar = np.full(shape, 1e4)
+    pixel_flags = np.zeros(shape, dtype=np.uint64)
+    for bit in range(n_bits):
+        # Isolated flagged pixels, and runs of flagged pixels (e.g., persistence).
+        pixel_flags[rng.random(shape) < 0.002] |= np.uint64(2**bit)
+        for v in range(n_visits):
+            for c in range(3):
+                for start in rng.integers(0, 2048, 2):
+                    pixel_flags[v, c, start:start + rng.integers(1, 40)] |= np.uint64(2**bit)
+    return (chip_wavelength, flux, ivar, pixel_flags)
+
+
+def per_bit_pixel_flags(chip_wavelength, new_wavelength, pixel_flags, n_res, min_bitmask_value=0.1):
+    """Propagate pixel flags by resampling each bit separately, as SDSS-IV did."""
+    separated = separate_bitmasks(pixel_flags)
+    new_pixel_flags = np.zeros(new_wavelength.size, dtype=pixel_flags.dtype)
+    for i, wavelength in enumerate(chip_wavelength):
+        pixel = wave_to_pixel(new_wavelength, wavelength)
+        (finite, ) = np.where(np.isfinite(pixel))
+        chip_flags = np.zeros(finite.size, dtype=pixel_flags.dtype)
+        for bit, flags in separated.items():
+            ((resampled, _), ) = sincint(pixel[finite], n_res[i], [[flags[i], None]])
+            chip_flags += ((np.abs(resampled) > min_bitmask_value) * 2**bit).astype(pixel_flags.dtype)
+        new_pixel_flags[finite] = chip_flags
+    return new_pixel_flags
+
+
+def kernel_support_pixel_flags(chip_wavelength, new_wavelength, pixel_flags, n_res):
+    """Propagate pixel flags by OR-ing every pixel in the kernel support, one new pixel at a time."""
+    new_pixel_flags = np.zeros(new_wavelength.size, dtype=pixel_flags.dtype)
+    for i, wavelength in enumerate(chip_wavelength):
+        pixel = wave_to_pixel(new_wavelength, wavelength)
+        (finite, ) = np.where(np.isfinite(pixel))
+        lobe, _, in_range = sinc_kernel(pixel[finite], n_res[i], wavelength.size)
+        for k, j in enumerate(finite):
+            new_pixel_flags[j] = np.bitwise_or.reduce(pixel_flags[i, lobe[k, in_range[k]]])
+    return new_pixel_flags
+
+
+def test_propagate_bitmask_isolated_pixel():
+    wavelength = APOGEE_WAVELENGTH[:2048]
+    operator, _, _ = resampling_operator(wavelength, wavelength, 5)
+    bitmask = np.zeros(wavelength.size, dtype=np.uint64)
+    bitmask[1000] = 2**3 + 2**7
+    new_bitmask = propagate_bitmask(operator, bitmask)
+    (flagged, ) = np.where(new_bitmask > 0)
+    assert np.all(new_bitmask[flagged] == bitmask[1000])
+    assert flagged[0] <= 1000 <= flagged[-1]
+
+
+def test_resample_pixel_flags_match_kernel_support():
+    chip_wavelength, flux, ivar, pixel_flags = apogee_visit_stack(n_visits=2)
+    for v in range(2):
+        _, _, new_pixel_flags = resample(
+            chip_wavelength, APOGEE_WAVELENGTH, flux[v], ivar[v], APOGEE_N_RES, pixel_flags=pixel_flags[v]
+        )
+        expected = kernel_support_pixel_flags(chip_wavelength, APOGEE_WAVELENGTH, pixel_flags[v], APOGEE_N_RES)
+        assert np.array_equal(new_pixel_flags, expected)
+
+
+def test_resample_pixel_flags_keep_every_per_bit_flag():
+    chip_wavelength, flux, ivar, pixel_flags = apogee_visit_stack(n_visits=4)
+    for v in range(4):
+        _, _, new_pixel_flags = resample(
+            chip_wavelength, APOGEE_WAVELENGTH, flux[v], ivar[v], APOGEE_N_RES, pixel_flags=pixel_flags[v]
+        )
+        per_bit = per_bit_pixel_flags(chip_wavelength, APOGEE_WAVELENGTH, pixel_flags[v], APOGEE_N_RES)
+        assert np.any(per_bit > 0)
+        # Every flag set by the per-bit approach must still be set.
+        assert np.all((per_bit & ~new_pixel_flags) == 0)
+
+
+def test_resample_min_bitmask_value_is_deprecated():
+    chip_wavelength, flux, ivar, pixel_flags = apogee_visit_stack(n_visits=1)
+    with pytest.warns(DeprecationWarning):
+        resample(chip_wavelength, APOGEE_WAVELENGTH, flux[0], ivar[0], APOGEE_N_RES, pixel_flags=pixel_flags[0], min_bitmask_value=0.1)
+
+
+def test_pixel_flag_propagation_benchmark(capsys):
+    """Time pixel flag propagation for an APOGEE-like stack of visits (see `astra.products.apogee`)."""
+    chip_wavelength, flux, ivar, pixel_flags = apogee_visit_stack()
+    resampling_operator(chip_wavelength[0], APOGEE_WAVELENGTH, APOGEE_N_RES[0]) # warm the cache
+
+    t_start = time()
+    for v in range(len(flux)):
+        per_bit_pixel_flags(chip_wavelength, APOGEE_WAVELENGTH, pixel_flags[v], APOGEE_N_RES)
+    t_per_bit = time() - t_start
+
+    t_start = time()
+    for v in range(len(flux)):
+        for i, wavelength in enumerate(chip_wavelength):
+            operator, _, _ = resampling_operator(wavelength, APOGEE_WAVELENGTH, APOGEE_N_RES[i])
+            propagate_bitmask(operator, pixel_flags[v, i])
+    t_propagate = time() - t_start
+
+    with capsys.disabled():
+        print(
+            f"\nPixel flags for {len(flux)} visits with {int(np.log2(pixel_flags.max())) + 1} bits: "
+            f"{t_per_bit:.3f} s per-bit, {t_propagate:.3f} s with propagate_bitmask"
+        )
+    assert t_propagate < t_per_bit
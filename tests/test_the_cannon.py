@@ -0,0 +1,232 @@
+import numpy as np
+import pytest
+
+from astra.pipelines.the_cannon.benchmark import synthetic_model, simulate_spectra
+from astra.pipelines.the_cannon.model import CannonModel, convert_model, _calculate_s2, _fit_spectrum, _fit_spectra
+
+
+@pytest.fixture
+def model():
+    return synthetic_model(n_labels=4, n_pixels=500)
+
+
+def fit_args(model, continuum_order):
+    return (model.theta, model._design_matrix_indices, model.s2, model.offsets, model.scales, continuum_order)
+
+
+@pytest.mark.parametrize("continuum_order", [-1, 1])
+@pytest.mark.parametrize("use_x0", [False, True])
+def test_fit_spectra_matches_fit_spectrum(model, continuum_order, use_x0):
+    labels, flux, ivar = simulate_spectra(model, n_spectra=20)
+    # Some missing pixels, and some spectra with a continuum.
+    ivar[:, ::50] = 0
+    if continuum_order >= 0:
+        x = np.linspace(-1, 1, flux.shape[1])
+        flux *= 1 + 0.05 * x * np.random.default_rng(2).normal(size=(flux.shape[0], 1))
+
+    N, L = labels.shape
+    x0 = labels + 0.1 * model.scales if use_x0 else None
+    frozen_values = np.nan * np.ones((N, L))
+    args = fit_args(model, continuum_order)
+
+    expected = [
+        _fit_spectrum(flux[i], ivar[i], None if x0 is None else x0[i], frozen_values[i], *args)
+        for i in range(N)
+    ]
+    actual = _fit_spectra(flux, ivar, x0, frozen_values, *args)
+
+    for (expected_labels, expected_cov, expected_meta), (actual_labels, actual_cov, actual_meta) in zip(expected, actual):
+        assert not actual_meta["flag_fitting_failure"]
+        # Both solvers stop at the same minimum, to much better than 1e-4 of the label scales.
+        np.testing.assert_allclose(actual_labels[:L], expected_labels, rtol=0, atol=1e-4 * np.max(model.scales))
+        np.testing.assert_allclose(actual_meta["chi2"], expected_meta["chi2"], rtol=1e-6)
+        np.testing.assert_allclose(actual_meta["model_flux"], expected_meta["model_flux"], rtol=0, atol=1e-6)
+        np.testing.assert_allclose(actual_cov[:L, :L], expected_cov, rtol=1e-3, atol=1e-10)
+        if continuum_order >= 0:
+            np.testing.assert_allclose(actual_labels[L:], expected_meta["p_opt_cont"], rtol=0, atol=1e-5)
+        if x0 is None:
+            np.testing.assert_allclose(actual_meta["trial_chi2"], expected_meta["trial_chi2"], rtol=1e-10)
+
+
+def test_fit_spectra_with_frozen_labels(model):
+    labels, flux, ivar = simulate_spectra(model, n_spectra=10)
+    N, L = labels.shape
+    frozen_values = np.nan * np.ones((N, L))
+    frozen_values[:, 1] = labels[:, 1]
+    args = fit_args(model, -1)
+
+    expected = [_fit_spectrum(flux[i], ivar[i], None, frozen_values[i], *args) for i in range(N)]
+    actual = _fit_spectra(flux, ivar, None, frozen_values, *args)
+    for (expected_labels, _, expected_meta), (actual_labels, _, actual_meta) in zip(expected, actual):
+        assert actual_labels[1] == expected_labels[1]
+        np.testing.assert_allclose(actual_labels, expected_labels, rtol=0, atol=1e-4 * np.max(model.scales))
+        np.testing.assert_allclose(actual_meta["chi2"], expected_meta["chi2"], rtol=1e-6)
+
+
+def test_fit_spectrum_methods_agree(model):
+    _, flux, ivar = simulate_spectra(model, n_spectra=15)
+    kwds = dict(n_threads=1, tqdm_kwds=dict(disable=True))
+    expected_labels, expected_cov, _ = model.fit_spectrum(flux, ivar, method="curve_fit", **kwds)
+    actual_labels, actual_cov, _ = model.fit_spectrum(flux, ivar, method="batched", batch_size=4, **kwds)
+    np.testing.assert_allclose(actual_labels, expected_labels, rtol=0, atol=1e-4 * np.max(model.scales))
+
+
+def training_set(n_spectra=300, n_labels=3, n_pixels=60, seed=0):
+    model = synthetic_model(n_labels=n_labels, n_pixels=n_pixels, seed=seed)
+    labels, flux, ivar = simulate_spectra(model, n_spectra=n_spectra, snr=50, seed=seed + 1)
+    rng = np.random.default_rng(seed + 2)
+    # Variable noise, some missing pixels, and one pixel that is missing in every spectrum.
+    ivar *= rng.uniform(0.5, 1.5, ivar.shape)
+    ivar[rng.uniform(size=ivar.shape) < 0.02] = 0
+    ivar[:, 7] = 0
+    return (model.label_names, labels, flux, ivar)
+
+
+@pytest.mark.parametrize("regularization", [0, 1e-4, 1e-2])
+def test_vectorized_training_matches_sklearn(regularization):
+    label_names, labels, flux, ivar = training_set()
+
+    trained = {}
+    for method in ("sklearn", "vectorized"):
+        trained[method] = CannonModel(labels, flux, ivar, label_names, regularization=regularization)
+        trained[method].train(method=method, n_threads=1, tqdm_kwds=dict(disable=True))
+
+    expected, actual = (trained["sklearn"], trained["vectorized"])
+    np.testing.assert_allclose(actual.theta, expected.theta, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(actual.s2, expected.s2, rtol=1e-6, atol=1e-12)
+    assert np.all(actual.theta[:, 7] == 0)
+    if regularization > 0:
+        # Same sparsity, and the coordinate descent takes the same number of iterations. (Newer
+        # versions of sklearn stop before the first iteration if all-zero coefficients are optimal.)
+        np.testing.assert_array_equal(actual.theta == 0, expected.theta == 0)
+        fit = np.any(actual.theta[1:] != 0, axis=0)
+        np.testing.assert_array_equal(actual.meta["n_iter"][fit], expected.meta["n_iter"][fit])
+        assert np.any(actual.theta[1:] == 0)
+
+
+def test_vectorized_training_warm_start():
+    label_names, labels, flux, ivar = training_set()
+
+    cold = CannonModel(labels, flux, ivar, label_names, regularization=1e-4)
+    cold.train(tqdm_kwds=dict(disable=True))
+
+    stronger = CannonModel(labels, flux, ivar, label_names, regularization=1e-3)
+    stronger.train(tqdm_kwds=dict(disable=True))
+    warm = CannonModel(labels, flux, ivar, label_names, regularization=1e-4)
+    warm.train(initial_theta=stronger.theta, tqdm_kwds=dict(disable=True))
+
+    # Warm starts reach the same solution (to the duality gap tolerance) in fewer iterations.
+    np.testing.assert_allclose(warm.theta, cold.theta, rtol=0, atol=1e-6)
+    assert np.sum(warm.meta["n_iter"]) < np.sum(cold.meta["n_iter"])
+
+
+def per_pixel_calculate_s2(L2s, ivars, s2_steps, large=1e3):
+    # The per-pixel implementation (run in a process pool) that `_calculate_s2` replaced.
+    N, P = L2s.shape
+    s2 = large * np.ones(P, dtype=float)
+    for i, (L2, ivar) in enumerate(zip(L2s.T, ivars.T)):
+        if np.all(ivar == 0):
+            continue
+        adjusted_ivar = ivar/(1 + ivar * s2_steps.reshape((-1, 1)))
+        chi2 = (np.mean(L2 * adjusted_ivar, axis=1) - 1)**2
+        s2[i] = s2_steps[np.argmin(chi2)]
+    return s2
+
+
+def s2_edge_cases(N=50, P=200, seed=0):
+    rng = np.random.default_rng(seed)
+    ivar = rng.uniform(0.5, 2, (N, P)) * 10**rng.uniform(0, 4, P)
+    ivar[rng.uniform(size=(N, P)) < 0.1] = 0
+    L2 = rng.chisquare(1, (N, P)) * 10**rng.uniform(-6, 0, P)
+    ivar[:, :3] = 0     # no data
+    L2[:, 3:6] = 0      # perfect model
+    L2[:, 6:9] *= 1e6   # terrible model
+    return (L2, ivar)
+
+
+@pytest.mark.parametrize("n_steps", [1, 2, 120])
+@pytest.mark.parametrize("max_elements", [1, 1_000, 10_000_000])
+def test_calculate_s2_matches_per_pixel(n_steps, max_elements):
+    L2, ivar = s2_edge_cases()
+    s2_steps = np.logspace(-6, 0, n_steps)
+    expected = per_pixel_calculate_s2(L2, ivar, s2_steps)
+    actual = _calculate_s2(L2, ivar, s2_steps, max_elements=max_elements)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_calculate_s2_newton_steps():
+    L2, ivar = s2_edge_cases()
+    s2_steps = np.logspace(-6, 0, 120)
+    on_grid = _calculate_s2(L2, ivar, s2_steps)
+    refined = _calculate_s2(L2, ivar, s2_steps, newton_steps=3)
+
+    def distance_from_one(s2):
+        return np.abs(np.mean(L2 * ivar / (1 + ivar * s2), axis=0) - 1)
+
+    fit = ~np.all(ivar == 0, axis=0)
+    # Refined values are at least as good, and stay within one grid step of the grid value.
+    assert np.all(distance_from_one(refined)[fit] <= distance_from_one(on_grid)[fit] + 1e-12)
+    ratio = s2_steps[1] / s2_steps[0]
+    assert np.all((refined[fit] >= on_grid[fit] / ratio * (1 - 1e-12)) & (refined[fit] <= on_grid[fit] * ratio * (1 + 1e-12)))
+    np.testing.assert_array_equal(refined[~fit], on_grid[~fit])
+
+
+@pytest.fixture
+def trained_model():
+    label_names, labels, flux, ivar = training_set(n_pixels=40)
+    model = CannonModel(labels, flux, ivar, label_names, dispersion=np.arange(40.0), regularization=1e-4)
+    model.train(tqdm_kwds=dict(disable=True))
+    return model
+
+
+@pytest.mark.parametrize("save_training_set", [False, True])
+def test_npz_model_matches_pickled_model(tmp_path, trained_model, save_training_set):
+    # Pickled models are the format that `.npz` models replace.
+    trained_model.write(f"{tmp_path}/model.pkl", save_training_set=save_training_set)
+    expected = CannonModel.read(f"{tmp_path}/model.pkl")
+    output_path = convert_model(f"{tmp_path}/model.pkl")
+    assert output_path == f"{tmp_path}/model.npz"
+    actual = CannonModel.read(output_path)
+
+    for key in ("theta", "s2", "offsets", "scales", "dispersion", "training_labels", "training_flux", "training_ivar"):
+        if getattr(expected, key) is None:
+            assert getattr(actual, key) is None
+        else:
+            np.testing.assert_array_equal(getattr(actual, key), getattr(expected, key))
+    for key in ("theta", "s2"):
+        assert isinstance(getattr(actual, key), np.memmap)
+        assert not getattr(actual, key).flags.writeable
+
+    assert actual.label_names == expected.label_names
+    assert actual.regularization == expected.regularization
+    assert actual._design_matrix_indices[0].tolist() == expected._design_matrix_indices[0].tolist()
+    assert actual._design_matrix_indices[1].tolist() == expected._design_matrix_indices[1].tolist()
+    np.testing.assert_array_equal(actual.meta["n_iter"], expected.meta["n_iter"])
+
+    _, flux, ivar = simulate_spectra(trained_model, n_spectra=5)
+    np.testing.assert_array_equal(actual.predict(expected.offsets), expected.predict(expected.offsets))
+    kwds = dict(n_threads=1, tqdm_kwds=dict(disable=True))
+    np.testing.assert_array_equal(actual.fit_spectrum(flux, ivar, **kwds)[0], expected.fit_spectrum(flux, ivar, **kwds)[0])
+
+
+def test_npz_model_read_options(tmp_path, trained_model):
+    path = f"{tmp_path}/model.npz"
+    trained_model.write(path, save_training_set=True)
+    with pytest.raises(FileExistsError):
+        trained_model.write(path)
+
+    model = CannonModel.read(path, load_training_set=False)
+    assert model.training_flux is None
+    np.testing.assert_array_equal(model.theta, trained_model.theta)
+
+    model = CannonModel.read(path, mmap_mode=None)
+    assert not isinstance(model.theta, np.memmap)
+    np.testing.assert_array_equal(model.training_flux, trained_model.training_flux)
+
+    # Compressed archives cannot be memory-mapped, but can still be read.
+    state = dict(np.load(path))
+    compressed_path = f"{tmp_path}/compressed.npz"
+    np.savez_compressed(compressed_path, **state)
+    model = CannonModel.read(compressed_path)
+    np.testing.assert_array_equal(model.theta, trained_model.theta)
+    np.testing.assert_array_equal(model.s2, trained_model.s2)
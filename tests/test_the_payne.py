@@ -0,0 +1,108 @@
+import os
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from astra.pipelines.the_payne import _the_payne_batched
+from astra.pipelines.the_payne.model import estimate_labels, estimate_labels_batched, predict_stellar_spectra
+
+LABEL_NAMES = ("teff", "logg", "fe_h")
+
+
+def network(P=300, H=8, seed=0):
+    """
+    A small network whose hidden units are always active, so that each fit has one minimum, and
+    whose spectra have a median near one, like the rectified spectra The Payne is fit to.
+    """
+    rng = np.random.default_rng(seed)
+    K = len(LABEL_NAMES)
+    weights = (rng.normal(0, 1, (H, K)), rng.normal(0, 0.3, (H, H)), rng.normal(0, 0.01, (P, H)))
+    biases = (np.full(H, 3.0), np.full(H, 5.0), np.ones(P))
+    x_min, x_max = (np.array([3000.0, 0.0, -2.0]), np.array([7000.0, 5.0, 0.5]))
+    model_wavelength = np.linspace(15_000, 17_000, P)
+    return (weights, biases, x_min, x_max, model_wavelength, LABEL_NAMES)
+
+
+def simulate(args, N=40, seed=1):
+    rng = np.random.default_rng(seed)
+    weights, biases, *_, model_wavelength, _ = args
+    flux = predict_stellar_spectra(rng.uniform(-0.3, 0.3, (N, len(LABEL_NAMES))), weights, biases)
+    flux += rng.normal(0, 1e-2, flux.shape)
+    return (model_wavelength, flux, np.full_like(flux, 1e4))
+
+
+def per_spectrum(wavelength, flux, ivar, args, **kwargs):
+    results = []
+    for i in range(flux.shape[0]):
+        spectrum = SimpleNamespace(wavelength=wavelength, flux=flux[i].copy(), ivar=ivar[i].copy())
+        (result, ), _ = estimate_labels(spectrum, *args, **kwargs)
+        results.append(result)
+    return results
+
+
+def as_arrays(results):
+    labels = np.array([[r[ln] for ln in LABEL_NAMES] for r in results])
+    return (labels, np.array([r["chi2"] for r in results]))
+
+
+@pytest.mark.parametrize("opt_tolerance,label_tolerance,chi2_rtol", [
+    # At the default tolerance the optimizers stop at different points.
+    (5e-4, 5e-2, 1e-3),
+    (1e-8, 1e-2, 1e-4),
+])
+def test_batched_fits_match_per_spectrum_fits(opt_tolerance, label_tolerance, chi2_rtol):
+    args = network()
+    wavelength, flux, ivar = simulate(args)
+    x_min, x_max = args[2:4]
+
+    expected_labels, expected_chi2 = as_arrays(per_spectrum(wavelength, flux, ivar, args, opt_tolerance=opt_tolerance))
+    results, metas = estimate_labels_batched(wavelength, flux, ivar, *args, opt_tolerance=opt_tolerance)
+    actual_labels, actual_chi2 = as_arrays(results)
+
+    assert all(meta["converged"] for meta in metas)
+    # Labels agree to within a fraction of the label range, and chi-squared to a relative tolerance.
+    assert np.max(np.abs(actual_labels - expected_labels) / (x_max - x_min)) < label_tolerance
+    np.testing.assert_allclose(actual_chi2, expected_chi2, rtol=chi2_rtol)
+
+
+def test_batched_fits_report_convergence():
+    args = network()
+    wavelength, flux, ivar = simulate(args, N=10)
+    _, metas = estimate_labels_batched(wavelength, flux, ivar, *args, opt_tolerance=1e-12, max_iter=2)
+    assert not any(meta["converged"] for meta in metas)
+
+
+def test_mixed_wavelength_grids_are_fit_per_spectrum(tmp_path, monkeypatch):
+    pytest.importorskip("h5py")
+    monkeypatch.setenv("MWM_ASTRA", str(tmp_path))
+
+    args = network()
+    wavelength, flux, ivar = simulate(args, N=6)
+    shifted_wavelength = wavelength + 1.0
+    spectra = [
+        SimpleNamespace(
+            spectrum_pk=i,
+            source_pk=i,
+            wavelength=shifted_wavelength if i in (2, 5) else wavelength,
+            flux=flux[i].copy(),
+            ivar=ivar[i].copy(),
+        )
+        for i in range(len(flux))
+    ]
+
+    outputs = { output.spectrum_pk: output for output in _the_payne_batched(spectra, args, None, 4) }
+
+    assert sorted(outputs) == list(range(len(spectra)))
+    assert not any(output.flag_fitting_failure for output in outputs.values())
+    assert not any(output.flag_not_converged for output in outputs.values())
+    for spectrum_pk, output in outputs.items():
+        if spectrum_pk in (2, 5):
+            # Fit one at a time, with intermediate outputs in a pickle file.
+            assert output.intermediate_output_store is None
+            with open(os.path.expandvars(output.intermediate_output_path), "rb") as fp:
+                continuum, rectified_model_flux = pickle.load(fp)
+            assert rectified_model_flux.size == wavelength.size
+        else:
+            assert output.intermediate_output_store is not None